@@ -18,7 +18,8 @@ from cc.tools.io import DataIO
 from cc.tools.numerical import Gridding
 from cc.managers.ModelingManager import ModelingManager as MM
 from cc.managers.PlottingManager import PlottingManager as PM
-from cc.managers import Vic
+from cc.managers import Batch
+from cc.managers.SearchManager import SearchManager
 from cc.modeling.objects import Star, Transition
 from cc.statistics import UnresoStats, ResoStats, SedStats, ChemStats
 from cc.data.instruments import Pacs, Spire
@@ -52,6 +53,9 @@ class ComboCode(object):
         The inputfile can be given on the command line as:
         python ComboCode.py inputComboCode.dat
 
+        Add --plan-only to only print the execution plan of the grid:
+        python ComboCode.py inputComboCode.dat --plan-only
+
         In the python or ipython shell you can do:
         >>> import ComboCode
         >>> cc = ComboCode.ComboCode('/home/robinl/ComboCode/input/inputComboCode.dat')
@@ -84,7 +88,12 @@ class ComboCode(object):
         '''
         Start a ComboCode session, based on the input read upon initialisation.
 
-        The supercomputer and model managers are set and ran.
+        The supercomputer and model managers are set and ran. If PLAN is on,
+        the execution plan of the grid is printed first. If PLAN_ONLY is on, 
+        the session stops there.
+
+        If SEARCH is on, the grid is the coarse grid of an adaptive search
+        around the best fit model instead (see SearchManager).
 
         The plot manager, statistics module, fitter modules are ran if
         requested.
@@ -96,12 +105,26 @@ class ComboCode(object):
 
         '''
 
-        if not self.finished:
-            self.setVicManager()
+        if not self.finished and self.search:
+            if not self.statistics:
+                raise IOError('SEARCH requires STATISTICS to be on.')
+            self.finished = True
+            sm = SearchManager(session=self,levels=self.search_levels,\
+                               num_best=self.search_best,\
+                               stat=self.search_stat)
+            sm.startSearch()
+            self.runStatistics()
+            self.runPlotManager()
+            self.printStarInfo()
+        elif not self.finished:
+            self.setBatchManager()
             self.setModelManager()
             self.finished = True
+            self.planModelManager()
+            if self.plan_only:
+                return
             self.runModelManager()
-            self.finalizeVic()
+            self.finalizeBatch()
             self.runChemistry()
             self.runPlotManager()
             self.runStatistics()
@@ -122,10 +145,15 @@ class ComboCode(object):
 
         '''
 
-        default_global = [('mcmax',1),('gastronoom',1),('sphinx',1),('vic',0),\
+        default_global = [('mcmax',1),('gastronoom',1),('sphinx',1),\
                           ('iterations',2),('plot_iterative',0),\
-                          ('vic_account','vsc30226'),('statistics',0),\
-                          ('vic_time_per_sphinx',30),('vic_credits',None),\
+                          ('batch',''),('batch_host',''),('batch_path',''),\
+                          ('batch_account',None),('statistics',0),\
+                          ('batch_time_per_sphinx',30),\
+                          ('batch_task_walltime',240),\
+                          ('batch_transfer','tar'),('batch_workers',1),\
+                          ('batch_sphinx','sphinx'),('batch_setup',''),\
+                          ('batch_poll',300),\
                           ('append_results',0),('write_dust_density',0),\
                           ('replace_db_entry',0),('update_spec',0),\
                           ('path_gastronoom',''),('path_mcmax',''),\
@@ -138,13 +166,18 @@ class ComboCode(object):
                           ('star_name','model'),('single_session',0),\
                           ('stat_lll_vmin',0.0),('chemistry',0),\
                           ('stat_lll_vmax',0.0), ('print_check_t',1),\
-                          ('chemstats',0),('chemstats_molecules',[])]
+                          ('chemstats',0),('chemstats_molecules',[]),\
+                          ('db_engine',''),('num_local_workers',0),\
+                          ('plan',0),('plan_only',0),('plan_time_mcmax',60),\
+                          ('plan_time_cooling',30),('plan_time_mline',30),\
+                          ('search',0),('search_levels',3),('search_best',1),\
+                          ('search_stat','chi2')]
         global_pars = dict([(k,self.processed_input.pop(k.upper(),v))
                             for k,v in default_global])
         self.__dict__.update(global_pars)
         self.__setStarName()
-        self.vic = 0
         if not self.gastronoom or not self.mcmax: self.iterations = 1
+        if self.plan_only: self.plan = 1
         if (not self.path_mcmax and self.mcmax):
             raise IOError('Please define PATH_MCMAX in your inputfile.')
         if (not self.path_gastronoom and self.gastronoom):
@@ -514,10 +547,10 @@ class ComboCode(object):
     def getStars(self):
 
         '''
-        Return the list of Star() objects for this ComboCode session.
+        Return the grid of Star() objects for this ComboCode session.
 
         @return: The parameter Star() objects are returned.
-        @rtype: list[Star()]
+        @rtype: StarGrid()
 
         '''
 
@@ -528,11 +561,15 @@ class ComboCode(object):
     def createStarGrid(self):
 
         '''
-        Create a list of Star() objects based on the inputfile that has been
+        Create the grid of Star() objects based on the inputfile that has been
         parsed with cc.readInput().
 
-        The list of Star() objects is saved in self.star_grid, and is accessed
-        through cc.getStarGrid().
+        The grid is saved in self.star_grid, and is accessed through
+        cc.getStars(). It is a StarGrid() that generates the Star() objects
+        on demand from the base parameter set, the additive parameter sets and
+        the multiplicative grid axes. It behaves like a list of stars. A star
+        is kept once generated, so the grid does not build the full product
+        up front, but its stars do accumulate while the grid is modeled.
 
         '''
 
@@ -540,6 +577,7 @@ class ComboCode(object):
                               path_gastronoom=self.path_gastronoom,\
                               path_mcmax=self.path_mcmax,\
                               print_check_t=self.print_check_t)
+        additive_dicts = []
         if self.additive_grid:
             grid_lengths = [len(v) for v in self.additive_grid.values()]
             if len(set(grid_lengths)) != 1:
@@ -550,24 +588,15 @@ class ComboCode(object):
                 additive_dicts = [dict([(key,grid[index])
                                         for key,grid in self.additive_grid.items()])
                                   for index in xrange(grid_lengths[0])]
-                self.star_grid = [Star.Star(example_star=base_star,\
-                                         path_gastronoom=self.path_gastronoom,\
-                                         path_mcmax=self.path_mcmax,\
-                                         extra_input=d,\
-                                         print_check_t=self.print_check_t)
-                                  for d in additive_dicts]
-        else:
-            self.star_grid = [base_star]
-        for key,grid in self.multiplicative_grid.items():
-            self.star_grid = [Star.Star(path_gastronoom=self.path_gastronoom,\
-                                        path_mcmax=self.path_mcmax,\
-                                        example_star=star,\
-                                        extra_input=dict([(key,value)]),\
-                                        print_check_t=self.print_check_t)
-                              for star in self.star_grid
-                              for value in grid]
-        for star in self.star_grid:
-            star.normalizeDustAbundances()
+        #-- The stars are kept: the modeling results are stored in them, and
+        #   the grid is passed through again for plotting and statistics.
+        self.star_grid = Star.StarGrid(base_star=base_star,\
+                                       additive=additive_dicts,\
+                                       axes=self.multiplicative_grid.items(),\
+                                       keep=1,\
+                                       path_gastronoom=self.path_gastronoom,\
+                                       path_mcmax=self.path_mcmax,\
+                                       print_check_t=self.print_check_t)
         if self.processed_input.has_key('LAST_MCMAX_MODEL'):
             del self.processed_input['LAST_MCMAX_MODEL']
         if self.processed_input.has_key('LAST_GASTRONOOM_MODEL'):
@@ -608,23 +637,34 @@ class ComboCode(object):
 
 
 
-    def setVicManager(self):
+    def setBatchManager(self):
 
         '''
-        Set up the VIC manager.
+        Set up the batch manager for running sphinx through a scheduler.
 
         '''
 
-        if self.vic and self.gastronoom and self.sphinx :
-            self.vic_manager = Vic.Vic(path=self.path_gastronoom,\
-                                       account=self.vic_account,\
-                                       time_per_sphinx=self.vic_time_per_sphinx,\
-                                       credits_acc=self.vic_credits,\
-                                       recover_sphinxfiles=self.recover_sphinxfiles)
+        if self.batch and self.gastronoom and self.sphinx:
+            if not self.batch_path:
+                raise IOError('Please define BATCH_PATH in your inputfile.')
+            kwargs = dict([('remote_path',self.batch_path),\
+                           ('host',self.batch_host),\
+                           ('account',self.batch_account),\
+                           ('transfer',self.batch_transfer)])
+            if self.batch.lower() == 'local':
+                kwargs['num_workers'] = self.batch_workers
+            backend = Batch.makeBackend(self.batch,**kwargs)
+            setup = [self.batch_setup] if self.batch_setup else []
+            self.batch_manager = Batch.Batch(backend=backend,\
+                                path=self.path_gastronoom,\
+                                time_per_sphinx=self.batch_time_per_sphinx,\
+                                task_walltime=self.batch_task_walltime,\
+                                sphinx=self.batch_sphinx,setup=setup,\
+                                recover_sphinxfiles=self.recover_sphinxfiles)
             if self.update_spec:
-                self.vic_manager.updateLineSpec()
+                self.batch_manager.updateLineSpec()
         else:
-            self.vic_manager = None
+            self.batch_manager = None
 
 
     def setModelManager(self):
@@ -643,12 +683,14 @@ class ComboCode(object):
                                 sphinx=self.sphinx,\
                                 iterative=self.plot_iterative,\
                                 num_model_sessions=len(self.star_grid),\
-                                vic_manager=self.vic_manager,\
+                                batch_manager=self.batch_manager,\
                                 replace_db_entry=self.replace_db_entry,\
                                 path_mcmax=self.path_mcmax,\
                                 skip_cooling=self.skip_cooling,\
                                 recover_sphinxfiles=self.recover_sphinxfiles,\
                                 single_session=self.single_session,\
+                                db_engine=self.db_engine or None,\
+                                num_local_workers=self.num_local_workers,\
                                 )
 
 
@@ -680,6 +722,29 @@ class ComboCode(object):
 
 
 
+    def planModelManager(self):
+
+        '''
+        Make and print the execution plan of the grid.
+
+        The plan resolves all models in the grid against the databases at
+        once. The model manager then only checks the databases for models that
+        are not done yet.
+
+        '''
+
+        if not self.plan or not (self.gastronoom or self.mcmax):
+            return
+        time_per_model = dict([('mcmax',self.plan_time_mcmax),\
+                               ('cooling',self.plan_time_cooling),\
+                               ('mline',self.plan_time_mline),\
+                               ('sphinx',self.batch_time_per_sphinx)])
+        plan = self.model_manager.planModeling(star_grid=self.star_grid,\
+                                               time_per_model=time_per_model)
+        plan.printPlan()
+
+
+
     def runModelManager(self):
 
         '''
@@ -701,13 +766,16 @@ class ComboCode(object):
                 #-- was done: Only then do a progress check, because a lot of time
                 #-- has passed, but then a wait time is used to make sure the newly
                 #-- queued sphinx models after the mline model are properly queued.
-                if self.vic_manager \
-                        and self.vic_manager.getQueue() \
+                if self.batch_manager \
+                        and self.batch_manager.getQueue() \
                         and self.model_manager.mline_done_list[-1]:
                     print '***********************************'
-                    print '** Current VIC queue:'
-                    print self.vic_manager.getQueue()
-                    self.vic_manager.checkProgress(wait_qstat=1)
+                    print '** Current batch queue:'
+                    print self.batch_manager.getQueue()
+                    self.batch_manager.checkProgress(wait_qstat=1)
+            
+            #-- Wait for the models ran in parallel on the local machine
+            self.model_manager.finalizePool()
 
             if self.single_session:
                 if self.gastronoom: 
@@ -719,28 +787,26 @@ class ComboCode(object):
                 
                 
 
-    def finalizeVic(self):
+    def finalizeBatch(self):
 
         '''
-        At the end of a modeling session, allow Vic to be finalized and clean up.
+        At the end of a modeling session, wait for the batch manager to finish
+        and clean up.
 
         '''
 
-        if not self.vic_manager is None:
-            #vic_running = vic_manager.checkProgress()
-            if self.vic_manager.getQueue():
-                vic_running = True
-            else:
-                vic_running = False
-            while vic_running:
-                print 'VIC is not yet finished. Waiting 5 minutes before checking again.'
-                print self.vic_manager.getQueue()
+        if not self.batch_manager is None:
+            batch_running = self.batch_manager.checkProgress()
+            while batch_running:
+                print 'The batch jobs are not yet finished. Waiting %i '\
+                      %self.batch_poll + 'seconds before checking again.'
+                print self.batch_manager.getQueue()
                 try:
-                    time.sleep(300)
+                    time.sleep(self.batch_poll)
                 except KeyboardInterrupt:
                     print 'Ending wait time, continuing with progress check immediately.'
-                vic_running = self.vic_manager.checkProgress()
-            self.vic_manager.finalizeVic()
+                batch_running = self.batch_manager.checkProgress()
+            self.batch_manager.finalizeBatch()
 
             if self.single_session:
                 self.model_manager.sph_db.sync()
@@ -976,7 +1042,8 @@ class ComboCode(object):
             print '************************************************'
 
             chemistry_db_path = os.path.join(cc.path.cout,'Chemistry_models.db')
-            self.chem_db = Database.Database(db_path=chemistry_db_path)
+            self.chem_db = Database.openDatabase(db_path=chemistry_db_path,\
+                                                 engine=self.db_engine or None)
 
             ch = Chemistry.Chemistry(path_chemistry=self.path_chemistry,\
                                     replace_db_entry = self.replace_db_entry,\
@@ -1142,11 +1209,14 @@ class ComboCode(object):
 
 
 if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg != '--plan-only']
     try:
-        inputfilename=sys.argv[1]
+        inputfilename=args[0]
     except IndexError:
         raise IOError('Please provide an inputfilename. (syntax in the ' + \
                       'command shell: python ComboCode.py ' + \
-                      '/home/robinl/inputComboCode.dat)')
+                      '/home/robinl/inputComboCode.dat [--plan-only])')
     c1m = ComboCode(inputfilename)
+    if '--plan-only' in sys.argv[1:]:
+        c1m.plan = c1m.plan_only = 1
     c1m.startSession()
@@ -7,16 +7,25 @@ Author: R. Lombaert
 
 """
 
+import os
+import hashlib
 import collections
 from scipy import mean, std, sqrt, log, isfinite
 from scipy import array, zeros, arange
 from scipy.stats import tmean, tstd
 from scipy.optimize import leastsq
-from scipy.integrate import trapz
 from scipy.special import erf
+from scipy.sparse import csr_matrix
 import numpy as np
 
 from cc.tools.numerical import Interpol
+from cc.tools.io import DataIO
+
+
+#-- In-memory cache of convolution kernels made by makeKernel: {key: kernel}
+_kernels = dict()
+_kernels_order = []
+MAX_KERNELS = 16
 
 
 def alignY(datalists,xmin,xmax,zeropoint=0,p0=[1,0,1.5,-2.5],func='power'):
@@ -105,16 +114,24 @@ def alignY(datalists,xmin,xmax,zeropoint=0,p0=[1,0,1.5,-2.5],func='power'):
 
 
 
-def doConvolution(x_in,y_in,x_out,widths,factor=5,oversampling=1):
+def doConvolution(x_in,y_in,x_out,widths,factor=5,oversampling=1,\
+                  cache_path=None):
 
     '''
     Perform convolution on lists with a Gaussian filter.
 
     Reduce the input grid to the target grid by integration.
 
+    The convolution is linear in the y-values, and is done with a sparse 
+    kernel matrix for the given input grid, target grid and resolution (see 
+    makeKernel). The kernel is made once, and reused for every next call with 
+    the same setup, such that each model is convolved with a single sparse 
+    matrix product. Multiple models on the same input grid can be convolved in
+    one go by passing a 2d array of y-values.
+
     @param x_in: The input x-values
     @type x_in: array
-    @param y_in: The input y-values
+    @param y_in: The input y-values, or an array of them (x_in x models)
     @type y_in: array
     @param x_out: The target x-grid
     @type x_out: array
@@ -135,49 +152,299 @@ def doConvolution(x_in,y_in,x_out,widths,factor=5,oversampling=1):
 
                            (default: 1)
     @type oversampling: int
+    @keyword cache_path: The folder in which the kernel is cached on disk. Not
+                         cached on disk if None.
+
+                         (default: None)
+    @type cache_path: string
 
-    @return: The resulting y-values
+    @return: The resulting y-values (x_out x models in case of multiple models)
     @rtype: list
 
     '''
 
     x_in,y_in,x_out,widths = array(x_in),array(y_in),array(x_out),array(widths)
-    y_out = []
     print 'Convolving for x_out between %.2f micron and %.2f micron with oversampling %i.' \
           %(x_out[0],x_out[-1],int(oversampling))
     #- Convert FWHM's to sigma for the gaussians
-    sigma = [fwhm/(2.*sqrt(2.*log(2.))) for fwhm in widths]
+    sigma = widths/(2.*sqrt(2.*log(2.)))
     #- Define the binsizes of the bins that will be integrated, i.e. the
     #- apparent resolution of x_out
-    binsize = [w/oversampling for w in widths]
-    for delta_bin,sigi,xi_out in zip(binsize,sigma,x_out):
-        yi_in = y_in[abs(x_in-xi_out)<=factor*sigi]
-        #- if not empty: continue, else add 0
-        if list(yi_in) and set(yi_in) != set([0.0]):
-            #- all relevant xi's for the bin around xi_out, ie in this bin the
-            #- y-values will be integrated
-            xi_in = x_in[abs(x_in-xi_out)<=delta_bin]
-            #- The window for the convolution itself, outside this window the
-            #- data are assumed to be negligible, ie for a gaussian
-            window = x_in[abs(x_in-xi_out)<=factor*sigi]
-            convolution = convolveArray(window,yi_in,sigi)
-            #- if one value in the bin, out of the window selection: add value
-            if len(list(convolution[abs(window-xi_out)<=delta_bin])) == 1:
-                y_out.append(convolution[abs(window-xi_out)<=delta_bin][0])
-                print 'Convolution has a window of only one element at xi_out %f.'%xi_out
-            #- If more than one value: integrate
-            elif list(convolution[abs(window-xi_out)<=delta_bin]):
-                y_out.append(trapz(y=convolution[abs(window-xi_out)<=delta_bin],x=xi_in)/(xi_in[-1]-xi_in[0]))
-            #- If no values in the bin from the window: add average of the window
-            #- This should not occur ideally!
-            else:
+    binsize = widths/float(oversampling)
+    kernel = makeKernel(x_in,x_out,sigma,factor*sigma,binsize,\
+                        cache_path=cache_path)
+    y_out = kernel.dot(y_in)
+    if y_out.ndim == 1: 
+        return list(y_out)
+    return y_out
+
+
+
+def makeKernel(x_in,x_out,sigma,window,binsize,norm=None,cache_path=None):
+
+    '''
+    Make the sparse kernel matrix of the convolution with a Gaussian filter, 
+    followed by the integration over a bin around each target x-value.
+
+    For every target x-value, the input values in the window are convolved as
+    in convolveArray, ie every input value is spread out over the gaussian
+    between the midpoints with its neighbours, and the convolution is 
+    integrated with the trapezium rule over the input points in the bin. 
+
+    The integral is divided by the width of the bin if norm is None. If only 
+    one input point is in the bin, its convolved value is taken, and if none 
+    are, the average of the convolution over the window (as in doConvolution).
+    If norm is given, the integral is divided by norm, and is 0 if less than 
+    two points are in the bin.
+
+    The kernels are kept in memory for the last MAX_KERNELS setups, and on disk
+    in cache_path if requested, keyed on a hash of the setup.
+
+    @param x_in: The input x-values
+    @type x_in: array
+    @param x_out: The target x-grid
+    @type x_out: array
+    @param sigma: The sigma of the gaussian for every target x-value
+    @type sigma: array/float
+    @param window: The half width of the window that is convolved for every 
+                   target x-value
+    @type window: array/float
+    @param binsize: The half width of the bin that is integrated for every 
+                    target x-value
+    @type binsize: array/float
+
+    @keyword norm: The normalisation of the integral for every target x-value.
+                   Divided by the width of the bin if None.
+
+                   (default: None)
+    @type norm: array/float
+    @keyword cache_path: The folder in which the kernel is cached on disk. Not
+                         cached on disk if None.
+
+                         (default: None)
+    @type cache_path: string
+
+    @return: The kernel (x_out x x_in)
+    @rtype: csr_matrix
+
+    '''
+
+    x_in,x_out = np.asarray(x_in,dtype=float),np.asarray(x_out,dtype=float)
+    nout = len(x_out)
+    sigma,window,binsize = [np.zeros(nout)+np.asarray(v,dtype=float)
+                            for v in [sigma,window,binsize]]
+    if not norm is None: 
+        norm = np.zeros(nout)+np.asarray(norm,dtype=float)
+
+    #-- Key the kernel on the full setup
+    sha = hashlib.sha1()
+    for v in [x_in,x_out,sigma,window,binsize,norm]:
+        sha.update('None' if v is None else np.ascontiguousarray(v).tostring())
+    key = sha.hexdigest()
+    if _kernels.has_key(key):
+        _kernels_order.remove(key)
+        _kernels_order.append(key)
+        return _kernels[key]
+
+    kernel = None
+    cachefn = cache_path and os.path.join(cache_path,'kernel_%s.npz'%key)
+    if cachefn and os.path.isfile(cachefn):
+        try:
+            npz = np.load(cachefn)
+            kernel = csr_matrix((npz['data'],npz['indices'],npz['indptr']),\
+                                shape=tuple(npz['shape']))
+            npz.close()
+        except (IOError,ValueError,KeyError):
+            kernel = None
+
+    if kernel is None:
+        #-- The windows are found on the sorted input grid.
+        order = np.argsort(x_in,kind='mergesort')
+        xs = x_in[order]
+        lo = np.clip(np.searchsorted(xs,x_out-window)-1,0,len(xs))
+        hi = np.clip(np.searchsorted(xs,x_out+window,side='right')+1,0,\
+                     len(xs))
+        data, indices, lengths = [], [], []
+        for i in range(nout):
+            xi,sigi = x_out[i],sigma[i]
+            iw = lo[i] + np.flatnonzero(abs(xs[lo[i]:hi[i]]-xi)<=window[i])
+            xw = xs[iw]
+            ib = np.flatnonzero(abs(xw-xi)<=binsize[i])
+            if not len(iw) or (not norm is None and len(ib) < 2):
+                lengths.append(0)
+                continue
+            #-- Convolution of the window, evaluated in the bin (or the whole
+            #   window if the bin is empty). The outer points of the window 
+            #   take the tails of the gaussian.
+            if len(ib) == 0 and norm is None:
                 print 'Convolution has a window of no elements at x_out ' + \
-                      '%f. Careful! Average is taken of '%(xi_out) + \
+                      '%f. Careful! Average is taken of '%(xi) + \
                       'sigma*factor window! This should not be happening...'
-                y_out.append(sum(convolution)/float(len(convolution)))
+                xb = xw
+            else:
+                xb = xw[ib]
+            if len(xw) == 1:
+                conv = np.ones((1,1))
+            else:
+                edges = erf((0.5*(xw[1:]+xw[:-1])-xb[:,None])/(sqrt(2)*sigi))
+                edges = np.hstack([-np.ones((len(xb),1)),edges,\
+                                   np.ones((len(xb),1))])
+                conv = 0.5*np.diff(edges,axis=1)
+            #-- Integration weights over the bin
+            if len(ib) == 0:
+                weights = np.ones(len(xw))/float(len(xw))
+            elif len(ib) == 1:
+                print 'Convolution has a window of only one element at xi_out %f.'%xi
+                weights = np.ones(1)
+            else:
+                dx = np.diff(xb)
+                weights = np.zeros(len(xb))
+                weights[:-1] += 0.5*dx
+                weights[1:] += 0.5*dx
+                weights /= (xb[-1]-xb[0]) if norm is None else norm[i]
+            data.append(np.dot(weights,conv))
+            indices.append(order[iw])
+            lengths.append(len(iw))
+        indptr = np.concatenate([[0],np.cumsum(lengths)])
+        data = np.concatenate(data) if data else np.zeros(0)
+        indices = np.concatenate(indices) if indices else np.zeros(0,int)
+        kernel = csr_matrix((data,indices,indptr),shape=(nout,len(x_in)))
+        if cachefn:
+            try:
+                #-- Write to a temporary file first, so a concurrent reader
+                #   never sees a half-written kernel.
+                DataIO.testFolderExistence(cache_path)
+                tmpfn = cachefn[:-4] + '_%i.npz'%os.getpid()
+                np.savez(tmpfn,data=kernel.data,indices=kernel.indices,\
+                         indptr=kernel.indptr,shape=np.array(kernel.shape))
+                os.rename(tmpfn,cachefn)
+            except (IOError,OSError):
+                pass
+
+    _kernels[key] = kernel
+    _kernels_order.append(key)
+    while len(_kernels_order) > MAX_KERNELS:
+        del _kernels[_kernels_order.pop(0)]
+    return kernel
+
+
+
+def makeSpectrumGrid(segments):
+
+    '''
+    Make the wavelength grid of a spectrum merged from line profiles on a zero
+    continuum.
+
+    Overlapping profiles are grouped, and the grid of a group is the union of
+    the grids of its profiles. Before the first group, zeroes are added in 
+    steps of 0.001 over 1 micron, after the last group in steps of 0.01 over 10
+    micron. Between groups, the gap is filled in steps of 0.001, starting
+    one step of the previous group beyond it, followed by one step of the next
+    group before it. 
+    
+    The padding is identical to the one of the former Instrument.mergeSphinx, 
+    so spectra without blends have the same grid as before. As before, the 
+    grid is not increasing at a gap edge if the step of the next group is 
+    larger than 0.001. 
+
+    @param segments: The line profiles as (wave, flux), wave increasing
+    @type segments: list[(array,array)]
+
+    @return: The wavelength grid
+    @rtype: array
+
+    '''
+
+    segments = sorted(segments,key=lambda seg: seg[0][0])
+
+    #-- Group the overlapping profiles
+    groups = [[segments[0][0]]]
+    end = segments[0][0][-1]
+    for wave,flux in segments[1:]:
+        if wave[0] < end:
+            groups[-1].append(wave)
         else:
-            y_out.append(0.0)
-    return y_out
+            groups.append([wave])
+        end = max(end,wave[-1])
+    groups = [np.asarray(g[0],dtype=float) if len(g) == 1 
+                                           else np.unique(np.concatenate(g))
+              for g in groups]
+
+    #-- Zeroes in front, in between groups and at the end. The steps are added
+    #   one by one, as the profiles were always stitched up.
+    grid = [(groups[0][0]-1)+np.arange(1,1000)/1000.]
+    for this,after in zip(groups[:-1],groups[1:]):
+        grid.append(this)
+        first = 2*this[-1]-this[-2]
+        last = 2*after[0]-after[1]
+        nstep = int((after[0]-first)/0.001)+2
+        pad = np.cumsum(np.concatenate([[first],np.ones(max(nstep,0))*0.001]))
+        grid.append([first])
+        grid.append(pad[1:][pad[1:] < after[0]])
+        grid.append([last])
+    grid.append(groups[-1])
+    grid.append(groups[-1][-1]+np.arange(1,1000)/100.)
+    return np.concatenate(grid)
+
+
+
+def synthesizeSpectrum(segments,wave=None):
+
+    '''
+    Merge line profiles on a zero continuum.
+
+    The profiles are added to a common wavelength grid: Their own grid points
+    are accumulated at once, and other grid points within the range of a 
+    profile (eg from blended lines) get the linearly interpolated profile.
+
+    The grid does not have to be increasing (see makeSpectrumGrid). The
+    fluxes are then calculated on the sorted grid.
+
+    @param segments: The line profiles as (wave, flux), wave increasing
+    @type segments: list[(array,array)]
+
+    @keyword wave: The wavelength grid. Made by makeSpectrumGrid if None. 
+
+                   (default: None)
+    @type wave: array
+
+    @return: The wavelength grid and the merged fluxes
+    @rtype: (array,array)
+
+    '''
+
+    if wave is None:
+        wave = makeSpectrumGrid(segments)
+    if not segments: 
+        return wave, np.zeros(len(wave))
+    if len(wave) > 1 and (np.diff(wave) < 0).any():
+        order = np.argsort(wave,kind='mergesort')
+        flux = np.empty(len(wave))
+        flux[order] = synthesizeSpectrum(segments,wave[order])[1]
+        return wave, flux
+    flux = np.zeros(len(wave))
+    wave_all = np.concatenate([w for w,f in segments])
+    flux_all = np.concatenate([f for w,f in segments])
+    sizes = [len(w) for w,f in segments]
+    bounds = np.cumsum([0]+sizes)
+
+    #-- The profile points that are on the grid
+    idx = np.searchsorted(wave,wave_all)
+    own = wave[np.minimum(idx,len(wave)-1)] == wave_all
+    np.add.at(flux,idx[own],flux_all[own])
+
+    #-- The other grid points in the range of every profile
+    starts = np.searchsorted(wave,wave_all[bounds[:-1]])
+    ends = np.searchsorted(wave,wave_all[bounds[1:]-1],side='right')
+    nown = np.add.reduceat(own,bounds[:-1]) if len(own) else []
+    for i in np.flatnonzero(ends-starts > nown):
+        other = np.ones(ends[i]-starts[i],dtype=bool)
+        iown = idx[bounds[i]:bounds[i+1]][own[bounds[i]:bounds[i+1]]]
+        other[iown-starts[i]] = False
+        sel = starts[i]+np.flatnonzero(other)
+        flux[sel] += np.interp(wave[sel],wave_all[bounds[i]:bounds[i+1]],\
+                               flux_all[bounds[i]:bounds[i+1]])
+    return wave, flux
 
 
 
@@ -24,6 +24,10 @@ from cc.tools.units import Equivalency as eq
 from cc.ivs.sigproc import fit, funclib
 
 
+#-- The telescope properties read by readTelescopeProperties: {telescope: props}
+_telescope_properties = dict()
+
+
 
 def readTelescopeProperties(telescope):
 
@@ -33,6 +37,9 @@ def readTelescopeProperties(telescope):
     This currently includes the telescope size in m, and the default 
     absolute flux calibration uncertainty. 
     
+    Telescope.dat is read once per telescope, and the properties are kept for
+    the rest of the session.
+    
     @param telescope: The telescope requested
     @type telescope: str
     
@@ -41,12 +48,14 @@ def readTelescopeProperties(telescope):
     
     """
     
-    all_telescopes = DataIO.getInputData(keyword='TELESCOPE',start_index=5,\
-                                         filename='Telescope.dat')
     if 'PACS' in telescope: 
         telescope = 'PACS'
     else:
         telescope = telescope
+    if _telescope_properties.has_key(telescope):
+        return _telescope_properties[telescope]
+    all_telescopes = DataIO.getInputData(keyword='TELESCOPE',start_index=5,\
+                                         filename='Telescope.dat')
     try:
         tel_index = all_telescopes.index(telescope)
     except ValueError:
@@ -58,6 +67,7 @@ def readTelescopeProperties(telescope):
     abs_err = DataIO.getInputData(keyword='ABS_ERR',start_index=5,\
                                   filename='Telescope.dat',\
                                   rindex=tel_index)
+    _telescope_properties[telescope] = (size,abs_err)
     return (size,abs_err)
 
 
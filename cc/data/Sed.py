@@ -22,7 +22,7 @@ from astropy import units as u
 from cc.ivs.sed import builder, filters
 import cc.ivs.sed.reddening as ivs_red
 from cc.ivs.sed.model import synthetic_flux
-#from ivs.units import conversions
+from cc.ivs.units import conversions
 
 import cc.path
 from cc.tools.io import DataIO
@@ -240,6 +240,204 @@ def calcPhotometry(w,f,photbands):
 
 
 
+def calcPhotometryGrid(w,f,photbands,chunk=100):
+
+    ''' 
+    Calculate the (model) photometry for a grid of models that share the same
+    wavelength grid. 
+    
+    Gives the same result as calcPhotometry for every model, but the response
+    of every band is first turned into integration weights on the wavelength
+    grid (see getPhotometryWeights), including the conversion to Fnu. The
+    photometry of all models is then a matrix product. Bands in the infrared
+    for which synthetic_flux resamples the spectrum in log-log space on a fine
+    grid are done for all models at once on that fine grid.
+    
+    Reddening is assumed to have been done before this.
+    
+    @param w: the wavelengths in micron, shared by all models
+    @type w: array()
+    @param f: Flux grid in Jy, one row per model
+    @type f: array(array())
+    @param photbands: the photometric bands
+    @type photbands: array(str)
+    
+    @keyword chunk: The number of models resampled at the same time for 
+                    infrared bands, to limit memory use
+                    
+                    (default: 100)
+    @type chunk: int
+    
+    @return: The photometry in Jy, one row per model, one column per band
+    @rtype: array(array())
+    
+    '''
+    
+    f = np.atleast_2d(f)
+    
+    #-- Convert wavelength to angstrom, and Jy to erg/s/cm2/aa, as in 
+    #   calcPhotometry. The latter is a factor per wavelength point.
+    mlam = (w*u.micron).to(u.AA).value
+    fac = (np.ones(len(w))*u.Jy).to(u.erg/u.s/u.cm**2/u.AA,\
+                        equivalencies=u.spectral_density(w*u.micron)).value
+    mflam = f*fac
+    
+    #-- The weight matrix for most bands, and the resampling for the others
+    weights,resampled = getPhotometryWeights(mlam,photbands)
+    mphot = np.dot(mflam,weights)
+    for i,(region,j0,j1,t,coef) in resampled.items():
+        for k in xrange(0,len(f),chunk):
+            logf = np.log10(mflam[k:k+chunk][:,region])
+            fine = 10**(logf[:,j0]*(1-t)+logf[:,j1]*t)
+            mphot[k:k+chunk,i] = np.dot(fine,coef)
+    
+    mphot = (mphot*u.erg/u.s/u.Hz/u.cm**2).to(u.Jy).value
+    return mphot
+
+
+
+def getPhotometryWeights(wave,photbands):
+
+    '''
+    Make the integration weights of synthetic_flux in the Fnu case for a 
+    given wavelength grid.
+    
+    The flux in erg/s/cm2/Hz of a band is the dot product of the model flux in 
+    erg/s/cm2/AA on the wavelength grid with the column of the weight matrix of
+    that band. Bands without any model points in range have nan weights. 
+    
+    Infrared bands (eff_wave >= 4e4 AA) are resampled in log-log space on a 
+    fine grid by synthetic_flux, which is not linear in the flux. For those, 
+    the region of the wavelength grid, the interpolation indices and fractions
+    of the fine grid, and the weights on the fine grid are returned instead.
+    
+    @param wave: The model wavelength grid in angstrom
+    @type wave: array
+    @param photbands: the photometric bands
+    @type photbands: array(str)
+    
+    @return: The weight matrix (wavelength x band, zero for resampled bands),
+             and the resampling info for the resampled bands, by band index:
+             (region,j0,j1,t,weights)
+    @rtype: (array(array()),dict)
+    
+    '''
+    
+    #-- only keep relevant information on filters (as in synthetic_flux):
+    filter_info = filters.get_info()
+    keep = np.searchsorted(filter_info['photband'],photbands)
+    filter_info = filter_info[keep]
+    
+    weights = np.zeros((len(wave),len(photbands)))
+    resampled = dict()
+    for i,photband in enumerate(photbands):
+        waver,transr = filters.get_response(photband)
+        ftype = filter_info['type'][i]
+        region = ((waver[0]-0.4*waver[0])<=wave) & (wave<=(2*waver[-1]))
+        nreg = region.sum()
+        if not nreg:
+            weights[:,i] = np.nan
+        elif filter_info['eff_wave'][i]>=4e4 and nreg<1e5 and nreg>1:
+            wreg = wave[region]
+            wave_ = np.logspace(np.log10(wreg[0]),np.log10(wreg[-1]),int(1e5))
+            j0,j1,t = _interpWeights(np.log10(wreg),np.log10(wave_))
+            coef = _bandWeights(wave_,waver,transr,ftype)
+            resampled[i] = (region,j0,j1,t,coef)
+        else:
+            weights[region,i] = _bandWeights(wave[region],waver,transr,ftype)
+    return weights,resampled
+    
+    
+
+def _interpWeights(xp,x):
+
+    '''
+    Indices and fractions for linear interpolation from xp onto x, clamped at 
+    the edges like numpy.interp: y = yp[j0]*(1-t)+yp[j1]*t.
+    
+    @param xp: The increasing x-coordinates of the data points
+    @type xp: array
+    @param x: The x-coordinates to interpolate to
+    @type x: array
+    
+    @return: The indices j0 and j1, and the fractions t
+    @rtype: (array,array,array)
+    
+    '''
+    
+    if len(xp) == 1:
+        j0 = np.zeros(len(x),dtype=int)
+        return j0,j0,np.zeros(len(x))
+    j0 = np.clip(np.searchsorted(xp,x,side='right')-1,0,len(xp)-2)
+    t = np.clip((x-xp[j0])/(xp[j0+1]-xp[j0]),0.,1.)
+    return j0,j0+1,t
+    
+    
+
+def _bandWeights(wave_,waver,transr,ftype):
+
+    '''
+    The weights of synthetic_flux in the Fnu case for one band on a given 
+    wavelength grid, covering the band.
+    
+    Includes the interpolation onto the response curve wavelengths when few
+    model points cover the band, and follows the integration of synthetic_flux
+    exactly, including its sorting by frequency.
+    
+    @param wave_: The model wavelengths in the region of the band (angstrom)
+    @type wave_: array
+    @param waver: The wavelengths of the response curve (angstrom)
+    @type waver: array
+    @param transr: The response curve
+    @type transr: array
+    @param ftype: The filter type: 'BOL' or 'CCD'
+    @type ftype: str
+    
+    @return: The weights for the flux in erg/s/cm2/AA on wave_
+    @rtype: array
+    
+    '''
+    
+    #-- Few model points covering the response curve: the flux is linearly
+    #   interpolated onto the combined grid
+    few = (np.searchsorted(wave_,waver[-1])-np.searchsorted(wave_,waver[0]))<5
+    if few:
+        wave__ = np.sort(np.hstack([wave_,waver]))
+        j0,j1,t = _interpWeights(wave_,wave__)
+    else:
+        wave__ = wave_
+    transr = np.interp(wave__,waver,transr,left=0,right=0)
+    
+    #-- The conversion to frequency and Fnu, then sort by frequency
+    freq = conversions.convert('AA','Hz',wave__)
+    fnu = conversions.convert('erg/s/cm2/AA','erg/s/cm2/Hz',\
+                              np.ones(len(wave__)),wave=(wave__,'AA'))
+    sa = np.argsort(freq)
+    
+    #-- Trapezoid weights. For CCDs, synthetic_flux integrates the sorted 
+    #   integrand over the unsorted wavelengths.
+    if ftype == 'BOL':
+        x,integrand = freq[sa],transr[sa]
+    elif ftype == 'CCD':
+        x,integrand = wave__,(transr/freq)[sa]
+    else:
+        return np.zeros(len(wave_))
+    dx = np.diff(x)/2.
+    tw = np.zeros(len(x))
+    tw[:-1] += dx
+    tw[1:] += dx
+    coef = np.empty(len(x))
+    coef[sa] = tw*integrand*fnu[sa]/np.trapz(integrand,x=x)
+    
+    if few:
+        coef_ = np.zeros(len(wave_))
+        np.add.at(coef_,j0,coef*(1-t))
+        np.add.at(coef_,j1,coef*t)
+        coef = coef_
+    return coef
+
+
+
 def buildPhotometry(star_name,fn='Photometric_IvS',remove=[]):
     '''
     Retrieve the photometry of a star through the IvS repo's SED builder. 
@@ -9,12 +9,13 @@ Author: R. Lombaert
 
 import os
 from glob import glob
-from scipy import argmin,argmax,array,sqrt
-import scipy
+from scipy import argmin,array,sqrt,zeros
+import numpy as np
 
 import cc.path
 from cc.tools.io import DataIO
-from cc.modeling.objects import Star
+from cc.data import Data
+from cc.modeling.objects import Star, Transition
 
 
 
@@ -377,6 +378,58 @@ class Instrument(object):
                 
                 
                 
+    def getSphinxSegments(self,star,read=1):
+        
+        '''
+        Get the Sphinx line profiles of a model for this instrument, in 
+        wavelength units of micron and flux units of Jy.
+        
+        The intrinsic or convolved line profiles are taken, depending on the 
+        intrinsic setting of the instrument.
+        
+        @param star: The Star object for which all lines are collected
+        @type star: Star()
+        
+        @keyword read: Read the sphinx output of the lines first. Not needed if
+                       it has already been read, eg for a grid of models.
+                       
+                       (default: 1)
+        @type read: bool
+        
+        @return: The line profiles as (wave, flux), wave increasing
+        @rtype: list[(array,array)]
+        
+        '''
+        
+        sphinx_transitions = [trans 
+                              for trans in star['GAS_LINES'] 
+                              if trans.getModelId() \
+                                and self.instrument.upper() in trans.telescope]
+        if read: 
+            Transition.readSphinxMany(sphinx_transitions)
+        segments = []
+        for trans in sphinx_transitions:
+            if trans.sphinx is None: 
+                continue
+            if self.intrinsic:
+                vel = trans.sphinx.getVelocityIntrinsic()
+                flux = trans.sphinx.getLPIntrinsic()
+            else:
+                vel = trans.sphinx.getVelocity()
+                flux = trans.sphinx.getLPConvolved()
+            #- convert km/s to cm/s to micron and flux to Jy 
+            #- doppler shift (1-(v_source - v_observer=delta_v)/c)*f_zero 
+            #- converted to wavelength in micron
+            wav = 1/(1.-(array(vel)*10**5/star.c))*trans.wavelength*10**(4)
+            flux = array(flux,dtype=float)*1e23
+            #-- In case the wavelength/freq scale is counting down, reverse 
+            if wav[0] > wav[-1]:
+                wav, flux = wav[::-1], flux[::-1]
+            segments.append((wav,flux))
+        return segments
+        
+        
+        
     def mergeSphinx(self,star):
         
         '''
@@ -384,6 +437,10 @@ class Instrument(object):
         
         For now only done in wavelength units of micron for PACS/SPIRE spectra.
         
+        The wavelength grid consists of the line profile grids, and zeroes in 
+        between (see Data.makeSpectrumGrid). Blended lines are added on the 
+        union of their grids.
+        
         @param star: The Star object for which all lines are collected + merged
         @type star: Star()
         @return: wave list in micron and flux list in Jy
@@ -391,144 +448,59 @@ class Instrument(object):
         
         '''
                 
-        #read all sphinx output data for the relevant instrument
-        sphinx_transitions = [trans 
-                              for trans in star['GAS_LINES'] 
-                              if trans.getModelId() \
-                                and self.instrument.upper() in trans.telescope]
         #- If no sphinx output found, this list will be empty and no convolution
         #- should be done. 
-        if not sphinx_transitions: 
+        segments = self.getSphinxSegments(star)
+        if not segments: 
             return [[],[]]
         
-        [trans.readSphinx() for trans in sphinx_transitions]
-        sphinx_input = [self.intrinsic \
-                            and (trans.sphinx.getVelocityIntrinsic(),\
-                                 trans.sphinx.getLPIntrinsic())
-                            or (trans.sphinx.getVelocity,\
-                                trans.sphinx.getLPConvolved())
-                        for trans in sphinx_transitions]
-        
-        #- convert km/s to cm/s to micron and flux to Jy 
-        #- doppler shift (1-(v_source - v_observer=delta_v)/c)*f_zero converted 
-        #- to wavelength in micron
-        sphinx_input = [(1/(1.-(vel*10**5/star.c))*trans.wavelength*10**(4),\
-                         flux*10**(23)) 
-                        for (vel,flux),trans in zip(sphinx_input,\
-                                                    sphinx_transitions)]
-        
-        #-- In case the wavelength/freq scale is counting down, reverse arrays
-        sphinx_input = [wav[0] > wav[-1] \
-                            and (wav[::-1],flux[::-1]) or (wav,flux) 
-                        for wav,flux in sphinx_input]
-        sphinx_input = [(list(wav),list(flux)) for wav,flux in sphinx_input]    
-
-        #- Make sure all sphinx segments are increasing in wavelength/frequency
-        sphinx_input.sort()
-        
-        #- Check if overlap between lines is present: 
-        #- False if THIS line is overlapping with the one before it. 
-        #- Hence the first line will always be true.
-        overlap_bools = [1] + \
-                        [sphinx_input[i-1][0][-1] <= sphinx_input[i][0][0] 
-                         for i in xrange(1,len(sphinx_input))]
-        
-        if False in overlap_bools:
+        segments.sort(key=lambda seg: seg[0][0])
+        if [1 
+            for (w0,f0),(w1,f1) in zip(segments[:-1],segments[1:])
+            if w0[-1] > w1[0]]:
             print 'WARNING! There is overlap between emission lines in ' + \
                   'Sphinx output. Overlap is included by simple addition only!'
+        wave, flux = Data.synthesizeSpectrum(segments)
+        return list(wave), list(flux)
         
-        #- Add zeroes on a grid before the first line to make sure the 
-        #- convolution goes right
-        sphinx_final = [(sphinx_input[0][0][0] - 1 + d/1000.,0.0) 
-                        for d in xrange(1,1000)]  
-
-        #- For now stitch up the segments with zeroes. Later on: 
-        #- Make grid with zeroes, then add segments if no overlap, 
-        #- if overlap, make sure the addition works well
-        for i in xrange(len(sphinx_input)-1):
-            #- if True, no overlap with the sphinx file before i and it has to 
-            #- be added
-            #- if False, overlap with the sphinx file before i and it has been 
-            #- added already
-            if overlap_bools[i]:  
-                j = 1
-                this_wave = sphinx_input[i][0]
-                this_flux = sphinx_input[i][1]
-                blend_wave = []
-                blend_flux = []
-                #- If False, overlap: interpolation is needed, select all the 
-                #- sphinx results for which there is a subsequent blend
-                while not i+j == len(sphinx_input)-1 \
-                        and not overlap_bools[i+j]:
-                    blend_wave.append(sphinx_input[i+j][0])
-                    blend_flux.append(sphinx_input[i+j][1])
-                    j += 1
-                
-                #- note that at i+j there is no more blend, and it is a 
-                #- discrete sphinx result: This should not be added yet
-                #- if there are blends here, blend_wave is not []
-                if blend_wave:
-                    #- remember where the largest wavelength is to be found
-                    max_index = argmax(array([wav[-1] 
-                                              for wav in blend_wave]))+i+1
-                    if sphinx_input[max_index][0][-1] < sphinx_input[i][0][-1]: 
-                        max_index = i
-                    #- Making a new wavelength grid beyond the current line at 
-                    #- i; there should be no need to expand the grid
-                    #- to lower wavelengths, since sphinx_final was sorted. 
-                    delta_lambda = (this_wave[-1]-this_wave[0])/len(this_wave)
-                    #- expand until all wavelenghts in all blends are covered 
-                    while this_wave[-1] < max([wav[-1] for wav in blend_wave]):
-                        this_wave.append(this_wave[-1]+delta_lambda)
-                        this_flux.append(0.0)
-                    interpolations = []
-                    #- interpolate to get values for the new grid, where the 
-                    #- original wavelength grid for every blend is expanded
-                    #- such that all wavelengths in the new grid are covered, 
-                    #- adding zeroes in this way does not change the result
-                    for x,y in zip(blend_wave,blend_flux):
-                        this_x = array([this_wave[0],x[0]-(x[1]-x[0])] + x + \
-                                       [x[-1]+(x[-1]-x[-2]),this_wave[-1]])
-                        this_y = array([0,0] + y + [0,0])
-                        interpolations.append(array(scipy.interpolate.interp1d\
-                                                   (this_x,this_y)(this_wave)))
-                    #- add together 
-                    this_flux=array(this_flux)
-                    for blend in interpolations: this_flux += blend
-                else:
-                    max_index = i
-                
-                #- extend result with the new wavelengths and fluxes, 
-                #- including blends if needed
-                sphinx_final.extend([(x,y) 
-                                     for x,y in zip(this_wave,this_flux)])
-                #- extend result further with zeroes up until the next sphinx 
-                #- line, after the last line in the blend 
-                #- Take delta equal to average delta in last Sphinx segment, 
-                #- this may be different from delta in next segment, 
-                #- but since they're zeroes you don't really care 
-                sphinx_final.append((2*sphinx_final[-1][0]\
-                                        -sphinx_final[-2][0],\
-                                     0.0))
-                while sphinx_final[-1][0] + 0.001 < sphinx_input[i+j][0][0]:
-                    sphinx_final.append((sphinx_final[-1][0]+0.001,0.0))
-                sphinx_final.append((2*sphinx_input[i+j][0][0]-\
-                                        sphinx_input[i+j][0][1],\
-                                     0.0))
-        #-- Remember overlap_bools contains FALSE if there IS an overlap. 
-        #   Counterintuitive, I know. 
-        if overlap_bools[-1]:
-            sphinx_final.extend([(w,f) 
-                                 for w,f in zip(sphinx_input[-1][0],\
-                                                sphinx_input[-1][1])])
-        sphinx_final.extend([(sphinx_input[-1][0][-1] + d/100.,0.0) 
-                             for d in xrange(1,1000)])
-
-        #- No final sort for now, it should be aranged already, even if line 
-        #- blends are present
-        return [s[0] 
-                for s in sphinx_final],\
-               [s[1] 
-                for s in sphinx_final]
+        
+        
+    def mergeSphinxGrid(self,star_grid):
+        
+        '''
+        Merge Sphinx output line profiles on a zero-continuum for a grid of 
+        models, on a common wavelength grid.
+        
+        The wavelength grid is the union of the grids of all models (see 
+        mergeSphinx). 
+        
+        @param star_grid: The Star objects for which all lines are merged
+        @type star_grid: list[Star()]
+        
+        @return: The wavelength grid in micron and the flux in Jy (star x wave).
+                 Models without sphinx output have zero flux. 
+        @rtype: (array,array)
+        
+        '''
+        
+        Transition.readSphinxMany([trans 
+                                   for star in star_grid
+                                   for trans in star['GAS_LINES'] 
+                                   if trans.getModelId() \
+                                     and self.instrument.upper() \
+                                            in trans.telescope])
+        all_segments = [star['LAST_GASTRONOOM_MODEL'] \
+                            and self.getSphinxSegments(star,read=0) or []
+                        for star in star_grid]
+        grids = [Data.makeSpectrumGrid(segments)
+                 for segments in all_segments if segments]
+        if not grids: 
+            return array([]),zeros((len(star_grid),0))
+        wave = np.unique(np.concatenate(grids))
+        flux = zeros((len(star_grid),len(wave)))
+        for i,segments in enumerate(all_segments):
+            if segments: 
+                flux[i] = Data.synthesizeSpectrum(segments,wave)[1]
+        return wave, flux
                 
         
\ No newline at end of file
@@ -409,7 +409,11 @@ class Pacs(Instrument):
                                         y_in=sphinx_flux,\
                                         x_out=self.data_wave_list[i_file],\
                                         widths=self.data_delta_list[i_file],\
-                                        oversampling=self.oversampling)
+                                        oversampling=self.oversampling,\
+                                        cache_path=os.path.join(\
+                                                cc.path.gout,'stars',\
+                                                self.star_name,\
+                                                'PACS_results','kernels'))
                 sph_fn = os.path.join(cc.path.gout,'stars',self.star_name,\
                                       'PACS_results',star['LAST_PACS_MODEL'],\
                                       '_'.join(['sphinx',filename])) 
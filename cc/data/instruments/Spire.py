@@ -9,7 +9,7 @@ Author: R. Lombaert
 
 import os
 import numpy as np
-from scipy import array,sqrt,trapz,log, argmin
+from scipy import array,sqrt,log, argmin
 
 import cc.path
 from cc.data import Data
@@ -184,21 +184,21 @@ class Spire(Instrument):
         new_wav, new_flux = array(new_wav), array(new_flux)
         
         #-- convolve the model fluxes with a gaussian and constant sigma(spire)
+        #   and integrate over the bins of the data points, as a sparse kernel
+        #   per data grid. Beyond 10 sigma, the gaussian is negligible.
         print '* Convolving Sphinx model for SPIRE.'
-        convolution = Data.convolveArray(new_wav,new_flux,s)
-        
+        binsize = self.resolution/self.oversampling
+        cache_path = os.path.join(cc.path.gout,'stars',self.star_name,\
+                                  'SPIRE_results','kernels')
         for data_wav,fn in zip(self.data_wave_list,self.data_filenames):
-            rebinned = []
             #-- Convert wavelengths to wave number for integration, and reverse
             data_cm = data_wav[::-1]
             data_cm = 1./data_cm*10**4
-            rebinned = [trapz(y=convolution[abs(new_wav-wavi)<=self.resolution/self.oversampling],\
-                              x=new_wav[abs(new_wav-wavi)<=self.resolution/self.oversampling])\
-                            /(self.resolution/self.oversampling)
-                        for wavi in data_cm]
+            kernel = Data.makeKernel(new_wav,data_cm,s,10*s,binsize,\
+                                     norm=binsize,cache_path=cache_path)
             #-- Reverse the rebinned fluxes so they match up with the 
             #   wavelength grid.
-            rebinned = array(rebinned)[::-1]
+            rebinned = kernel.dot(new_flux)[::-1]
             self.sphinx_convolution[star['LAST_SPIRE_MODEL']][fn] = rebinned
 
 
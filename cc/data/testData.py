@@ -0,0 +1,197 @@
+"""
+Unit test covering the merging of line profiles and the convolution in 
+data.Data.py
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from scipy.integrate import trapz
+
+from cc.data import Data
+
+
+
+def mergeLoop(segments):
+
+    """
+    The merged spectrum of profiles without blends as it was made before the
+    vectorization, by stitching up the profiles with zeroes one by one.
+
+    """
+
+    segments = sorted([(list(w),list(f)) for w,f in segments])
+    final = [(segments[0][0][0] - 1 + d/1000.,0.0) for d in xrange(1,1000)]
+    for i in xrange(len(segments)-1):
+        final.extend(zip(*segments[i]))
+        final.append((2*final[-1][0]-final[-2][0],0.0))
+        while final[-1][0] + 0.001 < segments[i+1][0][0]:
+            final.append((final[-1][0]+0.001,0.0))
+        final.append((2*segments[i+1][0][0]-segments[i+1][0][1],0.0))
+    final.extend(zip(*segments[-1]))
+    final.extend([(segments[-1][0][-1] + d/100.,0.0) for d in xrange(1,1000)])
+    return np.array([w for w,f in final]), np.array([f for w,f in final])
+
+
+
+def convolveLoop(x_in,y_in,x_out,widths,factor=5,oversampling=1):
+
+    """
+    The convolution as it was done before the sparse kernels: per target bin,
+    with convolveArray on the window around it.
+
+    """
+
+    y_out = []
+    sigma = [fwhm/(2.*np.sqrt(2.*np.log(2.))) for fwhm in widths]
+    binsize = [w/oversampling for w in widths]
+    for delta_bin,sigi,xi_out in zip(binsize,sigma,x_out):
+        yi_in = y_in[abs(x_in-xi_out)<=factor*sigi]
+        if not list(yi_in) or set(yi_in) == set([0.0]):
+            y_out.append(0.0)
+            continue
+        xi_in = x_in[abs(x_in-xi_out)<=delta_bin]
+        window = x_in[abs(x_in-xi_out)<=factor*sigi]
+        convolution = Data.convolveArray(window,yi_in,sigi)
+        inbin = convolution[abs(window-xi_out)<=delta_bin]
+        if len(inbin) == 1:
+            y_out.append(inbin[0])
+        elif len(inbin):
+            y_out.append(trapz(y=inbin,x=xi_in)/(xi_in[-1]-xi_in[0]))
+        else:
+            y_out.append(sum(convolution)/float(len(convolution)))
+    return np.array(y_out)
+
+
+
+class MergeTestCase(unittest.TestCase):
+
+    def makeSegments(self,steps,seed=1):
+        rng = np.random.RandomState(seed)
+        segments = []
+        w0 = 100.
+        for step in steps:
+            w0 += rng.uniform(0.05,0.5)
+            n = rng.randint(20,80)
+            wave = w0 + np.arange(n)*step
+            segments.append((wave,rng.rand(n)))
+            w0 = wave[-1]
+        rng.shuffle(segments)
+        return segments
+
+    def testGridWithoutBlends(self):
+        """ Same grid and fluxes as the stitched profiles """
+        for seed,steps in enumerate([[0.0005]*5,[0.0002,0.0008,0.0004],\
+                                     [0.0005,0.003,0.0001,0.002]]):
+            segments = self.makeSegments(steps,seed)
+            old_wave, old_flux = mergeLoop(segments)
+            wave, flux = Data.synthesizeSpectrum(segments)
+            self.assertTrue(np.array_equal(Data.makeSpectrumGrid(segments),\
+                                           old_wave))
+            self.assertTrue(np.array_equal(wave,old_wave))
+            self.assertTrue(np.array_equal(flux,old_flux))
+
+    def testNonMonotonicGrid(self):
+        """ A step of the next profile larger than 0.001 at a gap edge """
+        segments = self.makeSegments([0.0005,0.003],seed=3)
+        wave = Data.makeSpectrumGrid(segments)
+        self.assertTrue((np.diff(wave) < 0).any())
+        self.assertEqual(len(wave),len(mergeLoop(segments)[0]))
+
+    def testBlends(self):
+        """ Blended profiles add up on the union of their grids """
+        x1 = 100. + np.arange(11)*0.001
+        x2 = 100.0055 + np.arange(11)*0.001
+        segments = [(x1,np.ones(11)),(x2,2*np.ones(11))]
+        wave, flux = Data.synthesizeSpectrum(segments)
+        both = (wave >= x2[0]) * (wave <= x1[-1])
+        self.assertTrue(np.allclose(flux[both],3.))
+        self.assertTrue(np.allclose(flux[(wave >= x1[0])*(wave < x2[0])],1.))
+        self.assertTrue(np.allclose(flux[(wave > x1[-1])*(wave <= x2[-1])],2.))
+
+
+
+class ConvolutionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        #-- An irregular grid with a gap, giving empty and one-point bins, 
+        #   and lines on a continuum that is zero at the start
+        rng = np.random.RandomState(1)
+        self.x = 100. + np.cumsum(rng.uniform(0.002,0.01,3000))
+        self.x[1500:] += 0.3
+        lines = [a*np.exp(-0.5*((self.x-c)/0.02)**2)
+                 for a,c in zip(rng.uniform(1,10,20),\
+                                rng.uniform(self.x[0],self.x[-1],20))]
+        self.y = 1. + np.sum(lines,axis=0)
+        self.y[:200] = 0.
+        self.x_out = np.linspace(self.x[0]+0.2,self.x[-1]-0.2,300)
+        self.widths = np.linspace(0.08,0.12,300)
+        Data._kernels.clear()
+        del Data._kernels_order[:]
+
+    def assertConvolution(self,oversampling):
+        new = Data.doConvolution(self.x,self.y,self.x_out,self.widths,\
+                                 oversampling=oversampling)
+        old = convolveLoop(self.x,self.y,self.x_out,self.widths,\
+                           oversampling=oversampling)
+        self.assertTrue(np.allclose(new,old,rtol=1e-10,atol=0),\
+                        msg='Max difference %g'%np.abs(new-old).max())
+        return np.array(new)
+
+    def testConvolution(self):
+        """ Same output as the convolution per bin, with any oversampling """
+        for oversampling in [1,3]:
+            binsize = self.widths/oversampling
+            counts = [np.sum(abs(self.x-xi)<=b)
+                      for xi,b in zip(self.x_out,binsize)]
+            self.assertTrue(0 in counts and 1 in counts)
+            self.assertConvolution(oversampling)
+
+    def testModels(self):
+        """ Multiple models are convolved at once, with the same kernel """
+        y = np.column_stack([self.y,2*self.y,self.y**2])
+        new = Data.doConvolution(self.x,y,self.x_out,self.widths)
+        self.assertEqual(len(Data._kernels),1)
+        for i in range(3):
+            old = convolveLoop(self.x,y[:,i],self.x_out,self.widths)
+            self.assertTrue(np.allclose(new[:,i],old,rtol=1e-10,atol=0))
+        self.assertEqual(len(Data._kernels),1)
+
+    def testCache(self):
+        """ A kernel read from disk gives the same output """
+        path = tempfile.mkdtemp()
+        try:
+            old = self.assertConvolution(1)
+            Data._kernels.clear()
+            new = Data.doConvolution(self.x,self.y,self.x_out,self.widths,\
+                                     cache_path=path)
+            self.assertEqual(len(os.listdir(path)),1)
+            Data._kernels.clear()
+            cached = Data.doConvolution(self.x,self.y,self.x_out,\
+                                        self.widths,cache_path=path)
+            self.assertTrue(np.array_equal(cached,new))
+            self.assertTrue(np.array_equal(new,old))
+        finally:
+            shutil.rmtree(path)
+
+    def testFixedWidth(self):
+        """ SPIRE convolution of the full grid, up to the 10 sigma window """
+        sigma, binsize = 0.03, 0.02
+        convolution = Data.convolveArray(self.x,self.y,sigma)
+        old = np.array([trapz(y=convolution[abs(self.x-xi)<=binsize],\
+                              x=self.x[abs(self.x-xi)<=binsize])/binsize
+                        for xi in self.x_out])
+        kernel = Data.makeKernel(self.x,self.x_out,sigma,10*sigma,binsize,\
+                                 norm=binsize)
+        new = kernel.dot(self.y)
+        #-- The window only matters across the gap, at the 1e-9 level
+        self.assertTrue(np.allclose(new,old,rtol=1e-7,atol=0))
+        self.assertTrue(np.allclose(new[:140],old[:140],rtol=1e-12,atol=0))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+Unit test covering the photometry of model grids in data.Sed.py
+"""
+
+import unittest
+import numpy as np
+
+from cc.data import Sed
+
+#-- Bands from the UV to the far-IR, including infrared bands that are
+#   resampled by synthetic_flux, in the order of the filter info.
+PHOTBANDS = np.array(['2MASS.J','2MASS.KS','GALEX.NUV','IRAS.F12',\
+                      'IRAS.F60','JOHNSON.B','JOHNSON.V','WISE.W3'])
+
+
+
+def blackbody(w,T):
+
+    """
+    A blackbody of temperature T in Jy (arbitrary scale), on wavelengths w in
+    micron.
+
+    """
+
+    nu = 2.99792458e14/w
+    return nu**3/np.expm1(6.62607e-27*nu/(1.380649e-16*T))*1e-20
+
+
+
+class PhotometryGridTestCase(unittest.TestCase):
+
+    def setUp(self):
+        #-- Stars with dust excess, on a fine and a coarse grid
+        rng = np.random.RandomState(1)
+        self.grids = [np.logspace(-1,3,1000),np.logspace(-0.8,2.5,60)]
+        self.Ts = [(rng.uniform(2500,10000),rng.uniform(200,1000))
+                   for i in range(6)]
+
+    def getFluxes(self,w):
+        return np.array([blackbody(w,Ts)+1e-2*blackbody(w,Td)
+                         for Ts,Td in self.Ts])
+
+    def assertPhotometry(self,w,photbands):
+        f = self.getFluxes(w)
+        new = Sed.calcPhotometryGrid(w,f,photbands,chunk=4)
+        old = np.array([Sed.calcPhotometry(w,fi,photbands) for fi in f])
+        self.assertEqual(new.shape,old.shape)
+        self.assertTrue(np.array_equal(np.isnan(new),np.isnan(old)))
+        ok = ~np.isnan(old)
+        self.assertTrue(np.allclose(new[ok],old[ok],rtol=1e-10,atol=0),\
+                        msg='Max relative difference %g'\
+                            %np.abs(new[ok]/old[ok]-1.).max())
+        return new
+
+    def testFineGrid(self):
+        """ Same photometry as calcPhotometry per model on a fine grid """
+        self.assertPhotometry(self.grids[0],PHOTBANDS)
+
+    def testCoarseGrid(self):
+        """ Same photometry with few model points in a band """
+        self.assertPhotometry(self.grids[1],PHOTBANDS)
+
+    def testOutOfRange(self):
+        """ A band without model points in range gives nan, as before """
+        w = np.logspace(0,3,200)
+        new = self.assertPhotometry(w,np.array(['GALEX.FUV','IRAS.F60']))
+        self.assertTrue(np.isnan(new[:,0]).all())
+        self.assertFalse(np.isnan(new[:,1]).any())
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """
 Various decorator functions
-    - Memoization with args and kwargs (@memoized)
+    - Memoization with args and kwargs, with size limits (@memoized)
     - Make a parallel version of a function (@make_parallel)
     - Retry with exponential backoff (@retry(3,2))
     - Retry accessing website with exponential backoff (@retry(3,2))
@@ -11,40 +11,173 @@ Various decorator functions
     - Disable-decorator decorator
     - Extend/Reopen an existing class (like in Ruby)
 """
+import os
 import functools
 import cPickle
+import hashlib
+import collections
 import time
 import logging
 import sys
+import numpy as np
 import math
 import socket
-import logging
 import inspect
 
 logger = logging.getLogger("DEC")
 memory = {}
 
 #{ Common tools
-def memoized(fctn):
+
+#-- LRU bookkeeping and statistics of the memoized functions, per
+#   (module,function): the keys in order of use with their size in bytes, and
+#   the hit/miss counts
+lru = {}
+stats = {}
+#-- directory of the on-disk tier, used by functions memoized with disk=True
+#   (disabled when None)
+disk_cache_dir = None
+
+def fingerprint(obj):
+    """
+    Replace numpy arrays in (nested tuples, lists or dicts of) arguments by a
+    fingerprint.
+    
+    The fingerprint consists of the shape, the dtype and a SHA1 hash of the
+    data buffer, so large arrays do not have to be pickled to make a key.
+    """
+    if isinstance(obj,np.ndarray):
+        if obj.dtype.hasobject:
+            return ('ndarray',obj.shape,obj.dtype.str,cPickle.dumps(obj,2))
+        data = np.ascontiguousarray(obj)
+        return ('ndarray',obj.shape,obj.dtype.str,\
+                hashlib.sha1(data.view(np.uint8)).hexdigest())
+    elif isinstance(obj,(tuple,list)):
+        return type(obj)([fingerprint(iobj) for iobj in obj])
+    elif isinstance(obj,dict):
+        return sorted([(key,fingerprint(val)) for key,val in obj.iteritems()])
+    return obj
+
+def nbytes(obj,depth=3):
+    """
+    Estimate the memory taken by a cached value, including the numpy arrays
+    it contains.
+    """
+    if isinstance(obj,np.ndarray):
+        return obj.nbytes
+    size = sys.getsizeof(obj)
+    if depth==0:
+        return size
+    if isinstance(obj,(tuple,list)):
+        size += sum([nbytes(iobj,depth-1) for iobj in obj])
+    elif isinstance(obj,dict):
+        size += sum([nbytes(iobj,depth-1) for iobj in obj.itervalues()])
+    elif hasattr(obj,'__dict__'):
+        size += sum([nbytes(iobj,depth-1) for iobj in vars(obj).itervalues()])
+    return size
+
+def memoized(fctn=None,maxsize=128,maxbytes=None,disk=False):
     """
     Cache a function's return value each time it is called.
     If called later with the same arguments, the cached value is returned, and
     not re-evaluated.
+    
+    Can be used as C{@memoized} or with limits, e.g.
+    C{@memoized(maxsize=4,maxbytes=2**30,disk=True)}. The least recently used
+    values are dropped when more than C{maxsize} values or more than
+    C{maxbytes} bytes are cached for the function (C{None} for no limit).
+    Numpy arrays in the arguments are fingerprinted (see L{fingerprint}).
+    
+    With C{disk=True}, values are also pickled to L{disk_cache_dir} (if set),
+    and read from there in a next session. Only use this for values that
+    depend on the arguments alone, e.g. grid loads. If the value also depends
+    on module settings, C{disk} can be a function returning those settings,
+    which are then added to the key of the on-disk tier.
+    
+    Hits and misses are counted in L{stats} (see L{cache_info}).
     """
+    if fctn is None:
+        return lambda fctn: memoized(fctn,maxsize=maxsize,maxbytes=maxbytes,\
+                                     disk=disk)
+    modname = fctn.__module__
+    name = (modname,fctn.__name__)
+    lru[name] = collections.OrderedDict()
+    stats[name] = dict(hits=0,misses=0,disk_hits=0,evictions=0,size=0,\
+                       nbytes=0)
+    
     @functools.wraps(fctn)
     def memo(*args,**kwargs):
-        haxh = cPickle.dumps((fctn.__name__, args, sorted(kwargs.iteritems())))
-        modname = fctn.__module__
-        if not (modname in memory):
-            memory[modname] = {}
-        if not (haxh in memory[modname]):
-            memory[modname][haxh] = fctn(*args,**kwargs)
+        haxh = cPickle.dumps((fctn.__name__,fingerprint(args),\
+                              fingerprint(kwargs)),2)
+        order,stat = lru[name],stats[name]
+        cache = memory.setdefault(modname,{})
+        if haxh in cache:
+            stat['hits'] += 1
+            order[haxh] = order.pop(haxh,0)
+            return cache[haxh]
+        stat['misses'] += 1
+        
+        #-- try the disk tier before calculating
+        value,found = None,False
+        if disk and disk_cache_dir is not None:
+            dhaxh = callable(disk) and haxh+cPickle.dumps(disk(),2) or haxh
+            fn = os.path.join(disk_cache_dir,'%s.%s.%s.pkl'\
+                              %(modname,fctn.__name__,\
+                                hashlib.sha1(dhaxh).hexdigest()))
+            if os.path.isfile(fn):
+                try:
+                    with open(fn,'rb') as ff:
+                        value,found = cPickle.load(ff),True
+                    stat['disk_hits'] += 1
+                except Exception:
+                    logger.warning("Could not read %s, recalculating"%(fn))
+        if not found:
+            value = fctn(*args,**kwargs)
             logger.debug("Function %s memoized"%(str(fctn)))
-        return memory[modname][haxh]
+            if disk and disk_cache_dir is not None:
+                try:
+                    tmp = '%s.%d.tmp'%(fn,os.getpid())
+                    with open(tmp,'wb') as ff:
+                        cPickle.dump(value,ff,2)
+                    os.rename(tmp,fn)
+                except (IOError,OSError,cPickle.PicklingError):
+                    logger.warning("Could not write %s to disk cache"%(fn))
+        
+        #-- the function itself may have cleared the memory
+        cache = memory.setdefault(modname,{})
+        cache[haxh] = value
+        order[haxh] = nbytes(value)
+        stat['nbytes'] += order[haxh]
+        
+        #-- drop the least recently used values, but never the new one
+        while len(order)>1 and ((maxsize is not None and len(order)>maxsize)\
+                or (maxbytes is not None and stat['nbytes']>maxbytes)):
+            okey,osize = order.popitem(last=False)
+            cache.pop(okey,None)
+            stat['nbytes'] -= osize
+            stat['evictions'] += 1
+        stat['size'] = len(order)
+        return value
+    
+    memo.cache_info = lambda: cache_info(memo)
     if memo.__doc__:
         memo.__doc__ = "\n".join([memo.__doc__,"This function is memoized."])
     return memo
 
+def cache_info(fctn=None):
+    """
+    Return the cache statistics of a memoized function, or of all of them.
+    
+    @param fctn: memoized function (default: all)
+    @type fctn: function
+    @return: hits, misses, disk_hits, evictions, size and nbytes, for all
+    functions in a dict with 'module.function' keys
+    @rtype: dict
+    """
+    if fctn is not None:
+        return dict(stats[(fctn.__module__,fctn.__name__)])
+    return dict([('.'.join(name),dict(stat)) for name,stat in stats.items()])
+
 def clear_memoization(keys=None):
     """
     Clear contents of memory
@@ -53,7 +186,12 @@ def clear_memoization(keys=None):
         keys = memory.keys()
     for key in keys:
         if key in memory:
-            riddens = [memory[key].pop(ikey) for ikey in memory[key].keys()[:]]
+            memory[key].clear()
+    for name in lru:
+        if name[0] in keys:
+            lru[name].clear()
+            stats[name]['nbytes'] = 0
+            stats[name]['size'] = 0
     logger.debug("Memoization cleared")
 
 def make_parallel(fctn):
@@ -2,67 +2,224 @@
 """
 Decorators specifically for SED package
 """
+import os
+import atexit
+import cPickle
+import hashlib
+import shutil
+import tempfile
 import functools
 import logging
 import numpy as np
 import pylab as pl
-from multiprocessing import Manager,Process,cpu_count
+from multiprocessing import Pool,cpu_count
 from cc.ivs.sed import model
+from cc.ivs.sed import filters
+from cc.ivs.aux.decorators import fingerprint,clear_memoization
 from cc.ivs.units import conversions
 from cc.ivs.units import constants
 
 logger = logging.getLogger('SED.DEC')
 
+#-- The persistent pool of grid search workers, (re)started by get_pool
+_pool = None
+_pool_size = 0
+#-- The stamps of the module settings a worker currently uses (see get_state)
+_worker_stamps = None
+
+def get_threads(threads):
+    """
+    Translate a requested number of workers to an integer.
+    
+    @param threads: number of workers, or 'max', 'half' or 'safe'
+    @type threads: int or str
+    @return: number of workers (at least 1)
+    @rtype: int
+    """
+    if threads=='max':
+        threads = cpu_count()
+    elif threads=='half':
+        threads = cpu_count()/2
+    elif threads=='safe':
+        threads = cpu_count()-1
+    return max(1,int(threads))
+
+def get_state():
+    """
+    Return the module settings a grid search depends on, with their stamps.
+    
+    These are the defaults of the model module, and the custom filters of the
+    filters module. Workers of the pool keep the settings they had when they
+    were forked, so they are handed the current ones with every search (see
+    L{set_state}).
+    
+    @return: the settings and their stamps, per module
+    @rtype: (dict, tuple)
+    """
+    state = dict(model=(model.defaults,model.defaults_multiple),\
+                 filters=filters.custom_filters)
+    stamps = tuple([hashlib.sha1(cPickle.dumps(fingerprint(state[key]),2))\
+                        .hexdigest() for key in ['model','filters']])
+    return state,stamps
+
+def set_state(workdir,stamps):
+    """
+    Apply the module settings of the parent process in a worker, if they
+    changed since the last grid search.
+    
+    The memoized values of a module are cleared when its settings change, as
+    L{model.set_defaults} and L{filters.add_custom_filter} do.
+    
+    @param workdir: work directory of the grid search, with the settings
+    @type workdir: str
+    @param stamps: the stamps of the settings, per module
+    @type stamps: tuple
+    """
+    global _worker_stamps
+    if stamps==_worker_stamps:
+        return
+    with open(os.path.join(workdir,'state.pkl'),'rb') as ff:
+        state = cPickle.load(ff)
+    if _worker_stamps is None or stamps[0]!=_worker_stamps[0]:
+        defaults,defaults_multiple = state['model']
+        model.defaults.clear()
+        model.defaults.update(defaults)
+        model.defaults_multiple[:] = defaults_multiple
+        clear_memoization(keys=[model.__name__])
+    if _worker_stamps is None or stamps[1]!=_worker_stamps[1]:
+        filters.custom_filters.clear()
+        filters.custom_filters.update(state['filters'])
+        clear_memoization(keys=[filters.__name__])
+    _worker_stamps = stamps
+    logger.debug("parallel: worker %d updated its settings"%(os.getpid()))
+
+def _init_worker(stamps):
+    """
+    Remember the stamps of the settings a worker was forked with.
+    
+    @param stamps: the stamps of the settings, per module
+    @type stamps: tuple
+    """
+    global _worker_stamps
+    _worker_stamps = stamps
+
+def get_pool(threads):
+    """
+    Return the persistent pool of grid search workers.
+    
+    The pool is kept alive between grid searches, so that every worker only 
+    loads (and memoizes) the model grids once. It is restarted only when a
+    different number of workers is requested. Changes to the module settings
+    are passed on to the workers with every search (see L{get_state}).
+    
+    @param threads: number of worker processes
+    @type threads: int
+    @return: the worker pool
+    @rtype: multiprocessing.Pool
+    """
+    global _pool,_pool_size
+    if _pool is None or _pool_size!=threads:
+        close_pool()
+        _pool = Pool(processes=threads,initializer=_init_worker,\
+                     initargs=(get_state()[1],))
+        _pool_size = threads
+        logger.debug("parallel: started pool of %d workers"%(threads))
+    return _pool
+
+def close_pool():
+    """
+    Stop the persistent pool of grid search workers, if any.
+    """
+    global _pool,_pool_size
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool,_pool_size = None,0
+
+atexit.register(close_pool)
+
+def _gridsearch_chunk(task):
+    """
+    Evaluate one contiguous chunk of a grid search in a worker.
+    
+    The grid and the photometry are read from, and the results are written to
+    the memory-mapped files in the work directory.
+    
+    @param task: function, work directory, stamps of the module settings, 
+    chunk start and end, photbands and keyword arguments
+    @type task: tuple
+    """
+    fctn,workdir,stamps,start,end,photbands,kwargs = task
+    set_state(workdir,stamps)
+    grid = np.load(os.path.join(workdir,'grid.npy'),mmap_mode='r')
+    meas,e_meas = np.load(os.path.join(workdir,'meas.npy'),mmap_mode='r')
+    out = np.load(os.path.join(workdir,'out.npy'),mmap_mode='r+')
+    #-- the index keyword switches off the progressMeter
+    myargs = [np.array(meas),np.array(e_meas),photbands] + \
+             [np.array(row[start:end]) for row in grid]
+    output = fctn(index=np.arange(start,end),*myargs,**kwargs)
+    for i in range(4):
+        out[i,start:end] = output[i]
+    out.flush()
+    del grid,out
+
 def parallel_gridsearch(fctn):
     """
     Decorator to run SED grid fitting in parallel.
     
-    This splits up the effective temperature range between teffrange[0] and
-    teffrange[1] in 'threads' parts.
+    The grid points and the photometry are written to memory-mapped files, and
+    the grid is split in contiguous chunks that are handed out to a persistent
+    pool of 'threads' workers (see L{get_pool}). Each worker writes its chi
+    squares, scale factors, errors on the scale factors and luminosities
+    directly into a preallocated memory-mapped output array, so the grid
+    ordering is kept.
+    
+    'threads' can be an integer or one of 'max', 'half' or 'safe'. If it is 1
+    (default), the function is evaluated in this process.
+    
+    'chunks' gives the number of chunks per worker (default 4).
     
-    This must decorate a 'make_parallel' decorator.
+    The model defaults and custom filters of this process are applied in the 
+    workers before they evaluate their chunks (see L{get_state}).
     """
     @functools.wraps(fctn)
     def globpar(*args,**kwargs):
-        #-- construct a manager to collect all calculations 
-        manager = Manager() 
-        arr = manager.list([]) 
-        all_processes = []
         #-- get information on threading
-        threads = kwargs.pop('threads',1)
-        if threads=='max':
-            threads = cpu_count()
-        elif threads=='half':
-            threads = cpu_count()/2
-        elif threads=='safe':
-            threads = cpu_count()-1
-        threads = int(threads)
-        index = np.arange(len(args[-1]))
+        threads = get_threads(kwargs.pop('threads',1))
+        chunks = kwargs.pop('chunks',4)
+        N = len(args[-1])
+        if threads==1 or N<2:
+            return fctn(*args,**kwargs)
         
-        #-- distribute the periodogram calcs over different threads, and wait
-        for i in range(threads):
-            #-- extend the arguments to include the parallel array, and split
-            #   up the first four input arrays
-            #myargs = tuple([args[0][i::threads],args[1][i::threads],args[2][i::threads],args[3][i::threads]] + list(args[4:]) + [arr] )
-            myargs = tuple(list(args[:3]) + [args[j][i::threads] for j in range(3,len(args))] +  [arr] )
-            kwargs['index'] = index[i::threads]
-            logger.debug("parallel: starting process %s"%(i))
-            p = Process(target=fctn, args=myargs, kwargs=kwargs) 
-            p.start()
-            all_processes.append(p)
-        
-        for p in all_processes: p.join() 
-        
-        logger.debug("parallel: all processes ended") 
-        
-        #-- join all periodogram pieces
-        chisqs = np.hstack([output[0] for output in arr]) 
-        scales = np.hstack([output[1] for output in arr]) 
-        e_scales = np.hstack([output[2] for output in arr])
-        lumis = np.hstack([output[3] for output in arr])
-        index = np.hstack([output[4] for output in arr])
-        sa = np.argsort(index)
-        return chisqs[sa],scales[sa],e_scales[sa],lumis[sa]#,index[sa]
+        #-- put the grid and the photometry in memory-mapped files, and 
+        #   preallocate the output
+        workdir = tempfile.mkdtemp(prefix='gridsearch_')
+        try:
+            np.save(os.path.join(workdir,'grid.npy'),\
+                    np.array([np.asarray(arg,float) for arg in args[3:]]))
+            np.save(os.path.join(workdir,'meas.npy'),\
+                    np.array([args[0],args[1]],float))
+            out = np.lib.format.open_memmap(os.path.join(workdir,'out.npy'),\
+                                            mode='w+',dtype=float,shape=(4,N))
+            del out
+            state,stamps = get_state()
+            with open(os.path.join(workdir,'state.pkl'),'wb') as ff:
+                cPickle.dump(state,ff,2)
+            
+            #-- distribute contiguous chunks over the workers, and wait
+            edges = np.linspace(0,N,min(N,threads*chunks)+1).astype(int)
+            tasks = [(globpar,workdir,stamps,edges[i],edges[i+1],args[2],kwargs)
+                     for i in range(len(edges)-1)]
+            logger.debug("parallel: %d chunks over %d workers"\
+                         %(len(tasks),threads))
+            get_pool(threads).map(_gridsearch_chunk,tasks)
+            logger.debug("parallel: all chunks ended") 
+            
+            out = np.array(np.load(os.path.join(workdir,'out.npy')))
+        finally:
+            shutil.rmtree(workdir,ignore_errors=True)
+        chisqs,scales,e_scales,lumis = out
+        return chisqs,scales,e_scales,lumis
         
     return globpar
 
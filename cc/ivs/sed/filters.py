@@ -315,6 +315,18 @@ be updated. Make sure to add any additional information on the new filters
 manually in that file (e.g. is t a CCD or bolometer, what are the zeropoint
 magnitudes etc).
 
+Section 4.: The filter store
+----------------------------
+
+All response curves in the ivs/sed/filters directory and the contents of
+C{zeropoints.dat} are packed in one binary file C{filters.pack}, which is
+memory-mapped read-only by L{get_response} and L{get_info}, such that all
+processes share the same pages and no ASCII file has to be parsed. The store is
+built on first use, and rebuilt automatically when a file is added to or
+removed from the filters directory, or when C{zeropoints.dat} changes (see
+L{load_store}). After editing an existing response curve file in place, call
+L{build_store} or L{update_info}.
+
 """
 import os
 import glob
@@ -334,8 +346,115 @@ logger.addHandler(loggers.NullHandler())
 
 custom_filters = {'_prefer_file':True}
 
+#-- The packed filter store and its contents in this process, see load_store
+store_file = os.path.join(basedir,'filters.pack')
+store = {}
+STORE_VERSION = 1
+
+#{ filter store
+def _store_stamp():
+    """
+    Return the stamp of the files packed in the filter store.
+    
+    @return: version of the store, modification time of the filters directory,
+    modification time and size of the zeropoints file
+    @rtype: array
+    """
+    st_dir = os.stat(os.path.join(basedir,'filters'))
+    st_zp = os.stat(os.path.join(basedir,'zeropoints.dat'))
+    return np.array([STORE_VERSION,st_dir.st_mtime,st_zp.st_mtime,
+                     st_zp.st_size],float)
+
+def build_store():
+    """
+    Pack all response curves and the zeropoint information in the filter store.
+    
+    The store file contains, in order, the stamp of the packed files (see
+    L{_store_stamp}), the index of the response curves (photband, start and
+    size in the concatenated arrays), the record array of C{zeropoints.dat} and
+    the concatenated wavelength and response arrays (2xN). The response curves
+    are sorted on wavelength. Files that cannot be read as response curves are
+    skipped.
+    
+    The file is written to a temporary file first, and then moved in place, such
+    that processes reading the store never see a partial file.
+    """
+    stamp = _store_stamp()
+    filter_dir = os.path.join(basedir,'filters')
+    names,waves,responses = [],[],[]
+    for photband in sorted(os.listdir(filter_dir)):
+        photfile = os.path.join(filter_dir,photband)
+        if not os.path.isfile(photfile): continue
+        try:
+            wave, response = ascii.read2array(photfile).T[:2]
+        except ValueError:
+            logger.debug('Cannot pack response curve {0}'.format(photband))
+            continue
+        sa = np.argsort(wave)
+        names.append(photband)
+        waves.append(np.asarray(wave[sa],float))
+        responses.append(np.asarray(response[sa],float))
+    sizes = np.array([len(wave) for wave in waves],int)
+    index = np.zeros(len(names),dtype=[('photband','S50'),('start',int),
+                                       ('size',int)])
+    index['photband'] = names
+    index['start'] = np.cumsum(sizes)-sizes
+    index['size'] = sizes
+    data = np.vstack([np.hstack(waves),np.hstack(responses)])
+    zp = ascii.read2recarray(os.path.join(basedir,'zeropoints.dat'))
+    tmp_file = '{0}.{1:d}'.format(store_file,os.getpid())
+    with open(tmp_file,'wb') as ff:
+        for array in [stamp,index,zp.view(np.ndarray),data]:
+            np.lib.format.write_array(ff,array,version=(1,0))
+    os.rename(tmp_file,store_file)
+    logger.info('Packed {0} response curves in {1}'.format(len(names),store_file))
+
+def load_store():
+    """
+    Return the contents of the filter store, memory-mapping the response curves.
+    
+    The store is read once per process, and (re)built if it does not exist or
+    is out of date. If the store cannot be written, C{None} is returned, and the
+    response curves are read from their files instead.
+    
+    @return: dictionary with the stamp, the index of the response curves
+    (photband: (start, size)), the zeropoint information and the memory-mapped
+    data array
+    @rtype: dict
+    """
+    stamp = _store_stamp()
+    if 'stamp' in store and np.all(store['stamp']==stamp):
+        return store
+    store.clear()
+    for attempt in range(2):
+        try:
+            with open(store_file,'rb') as ff:
+                stamp_ = np.lib.format.read_array(ff)
+                if not (stamp_.shape==stamp.shape and np.all(stamp_==stamp)):
+                    raise ValueError('Filter store is out of date')
+                index = np.lib.format.read_array(ff)
+                zp = np.lib.format.read_array(ff)
+                np.lib.format.read_magic(ff)
+                shape,fortran,dtype = np.lib.format.read_array_header_1_0(ff)
+                offset = ff.tell()
+            data = np.memmap(store_file,dtype=dtype,mode='r',offset=offset,
+                             shape=shape,order=fortran and 'F' or 'C')
+            store.update(stamp=stamp,zp=zp,data=data,
+                         index=dict(zip(index['photband'],
+                                        zip(index['start'],index['size']))))
+            return store
+        except (IOError,ValueError):
+            if attempt: break
+        try:
+            build_store()
+        except (IOError,OSError):
+            break
+    logger.warning('Filter store {0} not available, reading files'.format(store_file))
+    return None
+
+#}
 #{ response curves
-@memoized
+@memoized(maxsize=1024)
 def get_response(photband):
     """
     Retrieve the response curve of a photometric system 'SYSTEM.FILTER'
@@ -361,18 +480,22 @@ def get_response(photband):
     prefer_file = custom_filters['_prefer_file']
     if photband=='OPEN.BOL':
         return np.array([1,1e10]),np.array([1/(1e10-1),1/(1e10-1)])    
-    #-- either get from file or get from dictionary
+    #-- either get from the filter store, from file or from dictionary
+    packed = load_store()
+    is_packed = packed is not None and photband in packed['index']
     photfile = os.path.join(basedir,'filters',photband)
-    photfile_is_file = os.path.isfile(photfile)
-    #-- if the file exists and files have preference
-    if photfile_is_file and prefer_file:
+    photfile_is_file = is_packed or os.path.isfile(photfile)
+    #-- if the file exists and files have preference, or there is no custom
+    #   filter. Packed response curves are already sorted.
+    if photfile_is_file and (prefer_file or not photband in custom_filters):
+        if is_packed:
+            start,size = packed['index'][photband]
+            wave,response = np.asarray(packed['data'][:,start:start+size])
+            return wave,response
         wave, response = ascii.read2array(photfile).T[:2]
     #-- if the custom_filter exist
     elif photband in custom_filters:
         wave, response = custom_filters[photband]['response']
-    #-- if the file exists but custom filters have preference
-    elif photfile_is_file:
-        wave, response = ascii.read2array(photfile).T[:2]
     else:
         raise IOError,('{0} does not exist {1}'.format(photband,custom_filters.keys()))
     sa = np.argsort(wave)
@@ -446,7 +569,7 @@ def add_custom_filter(wave,response,**kwargs):
         if 'lit' in name:
             myrow[name] = 0
         myrow[name] = kwargs.pop(name,myrow[name])
-    del decorators.memory[__name__]
+    decorators.clear_memoization(keys=[__name__])
     #-- add info:
     custom_filters[photband]['zp'] = myrow
     logger.debug('Added photband {0} to the predefined set'.format(photband))
@@ -653,7 +776,7 @@ def eff_wave(photband,model=None,det_type=None):
     
     return my_eff_wave
 
-@memoized
+@memoized(maxsize=64)
 def get_info(photbands=None):
     """
     Return a record array containing all filter information.
@@ -675,8 +798,12 @@ def get_info(photbands=None):
     @return: record array containing all information on the requested photbands.
     @rtype: record array
     """
-    zp_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),'zeropoints.dat')
-    zp = ascii.read2recarray(zp_file)
+    packed = load_store()
+    if packed is not None:
+        zp = packed['zp'].view(np.recarray)
+    else:
+        zp_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),'zeropoints.dat')
+        zp = ascii.read2recarray(zp_file)
     for iph in custom_filters:
         if iph=='_prefer_file': continue
         if 'zp' in custom_filters[iph]:
@@ -686,13 +813,22 @@ def get_info(photbands=None):
     #-- list photbands in order given, and remove those that do not have
     #   zeropoints etc.
     if photbands is not None:
-        order = np.searchsorted(zp['photband'],photbands)
-        zp = zp[order]
-        keep = (zp['photband']==photbands)
-        zp = zp[keep]
+        rows = get_info_rows()
+        zp = zp[[rows[iph] for iph in photbands if iph in rows]]
     
     return zp
 
+@memoized
+def get_info_rows():
+    """
+    Return the row of each photband in the record array of L{get_info}.
+    
+    @return: photband: row index
+    @rtype: dict
+    """
+    return dict([(iph,i) for i,iph in enumerate(get_info()['photband'])])
+
+
 
 
 
@@ -737,6 +873,10 @@ def update_info(zp=None):
     zp = np.hstack([zp,new_zp])
     sa = np.argsort(zp['photband'])
     ascii.write_array(zp[sa],'zeropoints.dat',header=True,auto_width=True,comments=['#'+line for line in comms[:-2]],use_float='%g')
+    #-- repack the filter store and forget what was read before
+    build_store()
+    store.clear()
+    decorators.clear_memoization(keys=[__name__])
     
 
 
@@ -18,10 +18,10 @@ from cc.ivs.tools import pca
 from cc.ivs.sed import model
 from cc.ivs.sed import filters
 from cc.ivs.sed.decorators import iterate_gridsearch,parallel_gridsearch
+from cc.ivs.sed import decorators
 from cc.ivs.sigproc import fit as sfit
 from cc.ivs.aux import numpy_ext
 from cc.ivs.aux import progressMeter
-from cc.ivs.aux.decorators import make_parallel
 from cc.ivs.units import constants
 
 logger = logging.getLogger("SED.FIT")
@@ -534,11 +534,15 @@ def generate_grid_single(photbands,teffrange=(-inf,inf),loggrange=(-inf,inf),
     @keyword clear_memory: flag to clear memory from previously loaded SED tables.
     If you set it to False, you can easily get an overloaded memory!
     @type clear_memory: boolean
+    @keyword threads: number of workers for a following L{igrid_search}. The
+    workers are started after the SED tables are loaded, so they share them
+    with this process instead of each loading their own copy.
+    @type threads: int or str
     @return: record array containing the searched grid, chi-squares and scale
     factors
     @rtype: record array
     """
-    #test
+    threads = kwargs.pop('threads',None)
     logger.info('Grid search with parameters teffrange=%s, loggrange=%s, ebvrange=%s, zrange=%s, points=%s'%(teffrange,loggrange,ebvrange,zrange,points))
     
     #-- we first get/set the grid. Calling this function means it will be
@@ -553,6 +557,9 @@ def generate_grid_single(photbands,teffrange=(-inf,inf),loggrange=(-inf,inf),
         logger.info('Received grid (%s)'%model.defaults2str())
     else:
         logger.info('Received custom grid (%s)'%kwargs)
+    if threads is not None:
+        decorators.close_pool()
+        decorators.get_pool(decorators.get_threads(threads))
     teffs,loggs,ebvs,zs = gridpnts.T
     
     #-- We need to avoid having only one grid point! If nessessary the grid needs to be 
@@ -876,7 +883,6 @@ def igrid_search_pix(meas,e_meas,photbands, constraints={},**kwargs):
         return chisqs,scales,e_scales,lumis
 
 @parallel_gridsearch
-@make_parallel
 def igrid_search(meas,e_meas,photbands,*args,**kwargs):
     """
     Run over gridpoints and evaluate model C{model_func} via C{stat_func}.
@@ -898,9 +904,11 @@ def igrid_search(meas,e_meas,photbands,*args,**kwargs):
     L{stat_chi2}.
     
     Extra arguments are passed to L{parallel_gridsearch} for parallelization
-    and to {model_func} for further specification of grids etc.
+    (C{threads}, C{chunks}) and to {model_func} for further specification of
+    grids etc.
     
-    The index array is returned to trace the results after parallelization.
+    The index array of a chunk is returned when it is given, to trace the
+    results after parallelization.
     
     @param meas: the measurements that have to be compared with the models
     @type meas: 1D numpy array of floats
@@ -912,6 +920,8 @@ def igrid_search(meas,e_meas,photbands,*args,**kwargs):
     @type model_func: function
     @keyword stat_func: function to evaluate the fit
     @type stat_func: function
+    @keyword threads: number of worker processes, or 'max', 'half', 'safe'
+    @type threads: int or str
     @return: (chi squares, scale factors, error on scale factors, absolute
     luminosities (R=1Rsol), index
     @rtype: 4/5X1d array
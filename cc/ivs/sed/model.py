@@ -1728,7 +1728,7 @@ def get_igrid_dimensions(**kwargs):
 
 
 
-@memoized
+@memoized(maxsize=4,maxbytes=2**31)
 def get_grid_mesh(wave=None,teffrange=None,loggrange=None,**kwargs):
     """
     Return InterpolatingFunction spanning the available grid of atmosphere models.
@@ -2156,6 +2156,10 @@ def synthetic_flux(wave,flux,photbands,units=None):
     keep = np.searchsorted(filter_info['photband'],photbands)
     filter_info = filter_info[keep]
     
+    #-- compiled conversions for the FNU case
+    to_freq = conversions.get_converter('AA','Hz')
+    to_fnu = conversions.get_converter('erg/s/cm2/AA','erg/s/cm2/Hz')
+    
     for i,photband in enumerate(photbands):
         #if filters.is_color
         waver,transr = filters.get_response(photband)
@@ -2198,8 +2202,8 @@ def synthetic_flux(wave,flux,photbands,units=None):
         #-- we work in FNU
         elif units[i].upper()=='FNU':
             #-- convert wavelengths to frequency, Flambda to Fnu
-            freq_ = conversions.convert('AA','Hz',wave_)
-            flux_f = conversions.convert('erg/s/cm2/AA','erg/s/cm2/Hz',flux_,wave=(wave_,'AA'))
+            freq_ = to_freq(wave_)
+            flux_f = to_fnu(flux_,wave=(wave_,'AA'))
             #-- sort again!
             sa = np.argsort(freq_)
             transr = transr[sa]
@@ -2276,7 +2280,7 @@ def luminosity(wave,flux,radius=1.):
 
 #}
 
-@memoized
+@memoized(maxsize=4,maxbytes=2**31,disk=defaults2str)
 def _get_itable_markers(photbands,
                     teffrange=(-np.inf,np.inf),loggrange=(-np.inf,np.inf),
                     ebvrange=(-np.inf,np.inf),zrange=(-np.inf,np.inf),
@@ -2342,7 +2346,7 @@ def _get_itable_markers(photbands,
     return np.array(markers),(grid_teffs,grid_loggs,grid_ebvs,grid_z),gridpnts,flux
 
 
-@memoized
+@memoized(maxsize=2,maxbytes=2**31,disk=defaults2str)
 def _get_pix_grid(photbands,
                     teffrange=(-np.inf,np.inf),loggrange=(-np.inf,np.inf),
                     ebvrange=(-np.inf,np.inf),zrange=(-np.inf,np.inf),
@@ -0,0 +1,75 @@
+"""
+Unit test covering the parallel grid search in sed.decorators.py
+"""
+
+import os
+import unittest
+import numpy as np
+
+from cc.ivs.sed import decorators
+from cc.ivs.sed import model
+from cc.ivs.sed import filters
+
+
+
+@decorators.parallel_gridsearch
+def settings_gridsearch(meas,e_meas,photbands,teffs,index=None):
+    """
+    Stand-in for a grid search, reporting the settings of the process that
+    evaluates it: the metallicity of the model defaults as scale factor, the
+    number of custom filters as luminosity and the process id as chi square.
+    The grid itself is returned as error on the scale factor.
+    """
+    N = len(teffs)
+    return np.ones(N)*os.getpid(),np.ones(N)*model.defaults['z'],\
+           np.array(teffs),np.ones(N)*len(filters.custom_filters)
+
+
+
+class ParallelGridsearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.meas = np.ones(3)
+        self.teffs = np.linspace(3000.,40000.,40)
+        #-- start the pool with the current settings
+        decorators.close_pool()
+        self.search()
+
+    def tearDown(self):
+        decorators.close_pool()
+        model.set_defaults()
+        filters.custom_filters.pop('TEST.FILTER',None)
+
+    def search(self):
+        return settings_gridsearch(self.meas,self.meas,['JOHNSON.V']*3,\
+                                   self.teffs,threads=2)
+
+    def testOrder(self):
+        """ Results are kept in grid order, and evaluated in the pool """
+        chisqs,scales,e_scales,lumis = self.search()
+        self.assertTrue(np.array_equal(e_scales,self.teffs))
+        self.assertTrue(np.all(chisqs!=os.getpid()))
+
+    def testDefaults(self):
+        """ Changed model defaults reach the workers of a running pool """
+        pool = decorators.get_pool(2)
+        model.set_defaults(z=-0.5)
+        chisqs,scales,e_scales,lumis = self.search()
+        self.assertTrue(decorators.get_pool(2) is pool)
+        self.assertTrue(np.all(scales==-0.5))
+        model.set_defaults(z=0.3)
+        self.assertTrue(np.all(self.search()[1]==0.3))
+
+    def testCustomFilters(self):
+        """ Added custom filters reach the workers of a running pool """
+        N = len(filters.custom_filters)
+        filters.custom_filters['TEST.FILTER'] = \
+                dict(response=(np.arange(10.),np.ones(10)))
+        self.assertTrue(np.all(self.search()[3]==N+1))
+        filters.custom_filters.pop('TEST.FILTER')
+        self.assertTrue(np.all(self.search()[3]==N))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -804,161 +804,251 @@ def convert(_from,_to,*args,**kwargs):
     @return: converted value
     @rtype: float
     """
-    #-- remember if user wants to unpack the results to have no trace of
-    #   uncertainties, or wants to get uncertainty objects back
-    unpack = kwargs.pop('unpack',True)
+    return get_converter(_from,_to)(*args,**kwargs)
+
+
+def get_converter(_from,_to,**kwargs):
+    """
+    Compile the conversion from one unit to another.
     
-    #-- get the input arguments: if only one is given, it is either an
-    #   C{uncertainty} from the C{uncertainties} package, or it is just a float
-    if len(args)==1:
-        start_value = args[0]
-    #   if two arguments are given, we assume the first is the actual value and
-    #   the second is the error on the value
-    elif len(args)==2:
-        start_value = unumpy.uarray([args[0],args[1]])
-    else:
-        raise ValueError('illegal input')
+    The unit strings are parsed once, and the factors and change-of-base
+    function that are needed are looked up once (see L{ConversionPlan}). The
+    returned function takes the same positional and keyword arguments as
+    L{convert}, i.e. a value (and error), extra information such as C{wave},
+    C{freq} or C{photband}, and C{unpack}:
     
-    #-- (un)logarithmicize (denoted by '[]')
-    m_in = re.search(r'\[(.*)\]',_from)
-    m_out = re.search(r'\[(.*)\]',_to)
+    >>> to_fnu = get_converter('erg/s/cm2/AA','erg/s/cm2/Hz')
+    >>> print(to_fnu(1e-10,wave=(10000.,'AA')))
+    3.33564095198e-21
     
-    if m_in is not None:
-        _from = m_in.group(1)
-        start_value = 10**start_value
-    if m_out is not None:
-        _to = m_out.group(1)
-        
-    #-- It is possible the user gave a convention for either the from or to
-    #   units (but not both!)
-    #-- break down the from and to units to their basic elements
-    if _from in _conventions:
-        _from = change_convention(_from,_to)
-    elif _to in _conventions:
-        _to = change_convention(_to,_from)
-    fac_from,uni_from = breakdown(_from)
-    fac_to,uni_to = breakdown(_to)
-    
-    #-- convert the kwargs to SI units if they are tuples (make a distinction
-    #   when uncertainties are given)
-    if uni_from!=uni_to and is_basic_unit(uni_from,'length') and not ('wave' in kwargs):# or 'freq' in kwargs_SI or 'photband' in kwargs_SI):
-        kwargs['wave'] = (start_value,_from)
-        logger.warning('Assumed input value to serve also for "wave" key')
-    elif uni_from!=uni_to and is_type(uni_from,'frequency') and not ('freq' in kwargs):# or 'freq' in kwargs_SI or 'photband' in kwargs_SI):
-        kwargs['freq'] = (start_value,_from)
-        logger.warning('Assumed input value to serve also for "freq" key')
+    Keyword arguments given here are bound to the returned function, and
+    converted to SI units only once:
+    
+    >>> to_jy = get_converter('erg/s/cm2/AA','Jy',wave=(10000.,'AA'))
+    >>> print(to_jy(1e-10))
+    333.564095198
+    
+    Without keyword arguments, the same function is returned for the same 
+    units. L{convert} uses this function.
+    
+    @param _from: units to convert from
+    @type _from: str
+    @param _to: units to convert to
+    @type _to: str
+    @return: the conversion function
+    @rtype: callable
+    """
+    if kwargs:
+        return _make_converter(_from,_to,_kwargs_to_SI(kwargs))
+    if not (_from,_to) in _converters:
+        _converters[(_from,_to)] = _make_converter(_from,_to,{})
+    return _converters[(_from,_to)]
+
+
+def _kwargs_to_SI(kwargs):
+    """
+    Convert the extra keyword arguments of a conversion to SI units if they are
+    tuples (value(,error),'unit').
+    """
     kwargs_SI = {}
     for key in kwargs:
         if isinstance(kwargs[key],tuple):
             kwargs_SI[key] = convert(kwargs[key][-1],'SI',*kwargs[key][:-1],unpack=False)
         else:
             kwargs_SI[key] = kwargs[key]
-    #-- add some default values if necessary
-    logger.debug('Convert %s to %s, fac_from-start_value %s/%s'%(uni_from,uni_to,fac_from,start_value))
+    return kwargs_SI
+
+
+def _make_converter(_from,_to,bound_SI):
+    """
+    Make the conversion function returned by L{get_converter}, with the keyword
+    arguments C{bound_SI} (already in SI units) bound to it.
+    """
+    def converter(*args,**kwargs):
+        #-- remember if user wants to unpack the results to have no trace of
+        #   uncertainties, or wants to get uncertainty objects back
+        unpack = kwargs.pop('unpack',True)
+        
+        #-- get the input arguments: if only one is given, it is either an
+        #   C{uncertainty} from the C{uncertainties} package, or it is just a float
+        if len(args)==1:
+            start_value = args[0]
+        #   if two arguments are given, we assume the first is the actual value and
+        #   the second is the error on the value
+        elif len(args)==2:
+            start_value = unumpy.uarray([args[0],args[1]])
+        else:
+            raise ValueError('illegal input')
+        
+        #-- get the plan, which depends on the extra information that is given
+        keys = frozenset(bound_SI.keys()+kwargs.keys())
+        if not (_from,_to,keys) in _plans:
+            _plans[(_from,_to,keys)] = ConversionPlan(_from,_to,keys)
+        kwargs_SI = dict(bound_SI)
+        kwargs_SI.update(_kwargs_to_SI(kwargs))
+        ret_value = _plans[(_from,_to,keys)](start_value,kwargs_SI)
+            
+        #-- unpack the uncertainties if: 
+        #    1. the input was not given as an uncertainty
+        #    2. the input was without uncertainties, but extra keywords had uncertainties
+        #    3. the input was with uncertainties (float or array) and unpack==True
+        unpack_case1 = len(args)==2
+        unpack_case2 = len(args)==1 and isinstance(ret_value,AffineScalarFunc)
+        unpack_case3 = len(args)==1 and isinstance(ret_value,np.ndarray) and isinstance(ret_value[0],AffineScalarFunc)
+        if unpack and (unpack_case1 or unpack_case2):
+            ret_value = unumpy.nominal_values(ret_value),unumpy.std_devs(ret_value)
+            #-- convert to real floats if real floats were given
+            if not ret_value[0].shape:
+                ret_value = np.asscalar(ret_value[0]),np.asscalar(ret_value[1])    
+        
+        return ret_value
     
-    #-- conversion is easy if same units
-    ret_value = 1.
+    return converter
+
+
+class ConversionPlan(object):
+    """
+    The precomputed conversion between two units, given the names of the extra
+    keyword arguments.
     
-    if uni_from==uni_to:
-        #-- if nonlinear conversions from or to:
-        if isinstance(fac_from,NonLinearConverter):
-            ret_value *= fac_from(start_value,**kwargs_SI)
-        else:
-            try:
-                ret_value *= fac_from*start_value
-            except TypeError:
-                raise TypeError('Cannot multiply value with a float; probably argument is a tuple (value,error), please expand with *(value,error)')
+    At construction, the units are broken down to their base units, and the
+    factors, nonlinear converters and change-of-base function (see C{_switch})
+    are looked up. Calling the plan only applies them to the value.
     
-    #-- otherwise a little bit more complicated
-    else:
-        #-- first check where the unit differences are
-        uni_from_ = uni_from.split()
-        uni_to_ = uni_to.split()
-        only_from_c,only_to_c = sorted(list(set(uni_from_) - set(uni_to_))),sorted(list(set(uni_to_) - set(uni_from_)))
-        only_from_c,only_to_c = [list(components(i))[1:] for i in only_from_c],[list(components(i))[1:] for i in only_to_c]
-        #-- push them all bach to the left side (change sign of right hand side components)
-        left_over = " ".join(['%s%d'%(i,j) for i,j in only_from_c])
-        left_over+= " "+" ".join(['%s%d'%(i,-j) for i,j in only_to_c])
-        left_over = breakdown(left_over)[1]
-        #-- but be sure to convert everything to SI units so that the switch
-        #   can be interpreted.
-        left_over = [change_convention('SI',ilo) for ilo in left_over.split()]
-        only_from = "".join(left_over)
-        only_to = ''
-
-        #-- first we remove any differences concerning (ster)radians
-        #   we recently added fac_from* to all these things, maybe this needs to 
-        #   change?
-        #if 'rad2' in only_from:
-        #    start_value = fac_from*_switch['rad2_to_'](start_value,**kwargs_SI)
-        #    only_from = only_from.replace('rad2','')
-        #    logger.debug('Switching to /sr')
-        #    fac_from = 1.
-        #elif 'rad-2' in only_from:
-        #    start_value = fac_from*_switch['rad-2_to_'](start_value,**kwargs_SI)
-        #    only_from = only_from.replace('rad-2','')
-        #    logger.debug('Switching from /sr')
-        #    fac_from = 1.
-        #elif 'rad1' in only_from:
-        #    start_value = fac_from*_switch['rad1_to_'](start_value,**kwargs_SI)
-        #    only_from = only_from.replace('rad1','')
-        #    logger.debug('Switching to /rad')
-        #    fac_from = 1.
-        #elif 'rad-1' in only_from:
-        #    start_value = fac_from*_switch['rad-1_to_'](start_value,**kwargs_SI)
-        #    only_from = only_from.replace('rad-1','')
-        #    logger.debug('Switching from /rad')
-        #    fac_from = 1.
+    Plans are cached in C{_plans}, and cleared when the convention changes (see
+    L{set_convention}).
+    """
+    def __init__(self,_from,_to,keys):
+        """
+        Compile the conversion.
         
-        #-- then we do what is left over (if anything is left over)
-        if only_from or only_to:
-            logger.debug("Convert %s to %s"%(only_from,only_to))
+        @param _from: units to convert from
+        @type _from: str
+        @param _to: units to convert to
+        @type _to: str
+        @param keys: names of the extra keyword arguments
+        @type keys: set of str
+        """
+        #-- (un)logarithmicize (denoted by '[]')
+        m_in = re.search(r'\[(.*)\]',_from)
+        m_out = re.search(r'\[(.*)\]',_to)
+        self.log_in = m_in is not None
+        self.log_out = m_out is not None
+        if m_in is not None:
+            _from = m_in.group(1)
+        if m_out is not None:
+            _to = m_out.group(1)
+        
+        #-- It is possible the user gave a convention for either the from or to
+        #   units (but not both!)
+        #-- break down the from and to units to their basic elements
+        if _from in _conventions:
+            _from = change_convention(_from,_to)
+        elif _to in _conventions:
+            _to = change_convention(_to,_from)
+        fac_from,uni_from = breakdown(_from)
+        fac_to,uni_to = breakdown(_to)
+        self._from,self.uni_from,self.uni_to = _from,uni_from,uni_to
+        self.fac_from,self.fac_to = fac_from,fac_to
+        
+        #-- the input value also serves as the "wave" or "freq" key if needed
+        self.assume = None
+        if uni_from!=uni_to and is_basic_unit(uni_from,'length') and not ('wave' in keys):
+            self.assume = 'wave'
+        elif uni_from!=uni_to and is_type(uni_from,'frequency') and not ('freq' in keys):
+            self.assume = 'freq'
+        
+        #-- find the change-of-base function if the units differ
+        self.switch = None
+        self.inverse = False
+        if uni_from!=uni_to:
+            #-- first check where the unit differences are
+            uni_from_ = uni_from.split()
+            uni_to_ = uni_to.split()
+            only_from_c,only_to_c = sorted(list(set(uni_from_) - set(uni_to_))),sorted(list(set(uni_to_) - set(uni_from_)))
+            only_from_c,only_to_c = [list(components(i))[1:] for i in only_from_c],[list(components(i))[1:] for i in only_to_c]
+            #-- push them all bach to the left side (change sign of right hand side components)
+            left_over = " ".join(['%s%d'%(i,j) for i,j in only_from_c])
+            left_over+= " "+" ".join(['%s%d'%(i,-j) for i,j in only_to_c])
+            left_over = breakdown(left_over)[1]
+            #-- but be sure to convert everything to SI units so that the switch
+            #   can be interpreted.
+            left_over = [change_convention('SI',ilo) for ilo in left_over.split()]
+            only_from = "".join(left_over)
+            only_to = ''
             
-            #-- nonlinear conversions need a little tweak
-            try:
+            #-- then we do what is left over (if anything is left over)
+            if only_from or only_to:
+                logger.debug("Convert %s to %s"%(only_from,only_to))
                 key = '%s_to_%s'%(only_from,only_to)
-                logger.debug('Switching from {} to {} via {:s}'.format(only_from,only_to,_switch[key].__name__))
-                if isinstance(fac_from,NonLinearConverter):
-                    ret_value *= _switch[key](fac_from(start_value,**kwargs_SI),**kwargs_SI)
-                #-- linear conversions are easy
-                else:
-                    logger.debug('fac_from=%s, start_value=%s with kwargs %s'%(fac_from,start_value,kwargs_SI))
-                    ret_value *= _switch[key](fac_from*start_value,**kwargs_SI)
-            except KeyError:
+                if key in _switch:
+                    self.switch = _switch[key]
+                    logger.debug('Switching from {} to {} via {:s}'.format(only_from,only_to,_switch[key].__name__))
                 #-- try to be smart an reverse the units:
-                if not (Unit(1.,uni_from)*Unit(1.,uni_to))[1]:
-                    ret_value *= period2freq(fac_from*start_value,**kwargs_SI)
-                    logger.warning('It is assumed that the "from" unit is the inverse of the "to" unit')
+                elif not (Unit(1.,uni_from)*Unit(1.,uni_to))[1]:
+                    self.switch = period2freq
+                    self.inverse = True
                 else:
                     logger.critical('cannot convert %s to %s: no %s definition in dict _switch'%(_from,_to,key))
-                    raise
+                    raise KeyError(key)
+    
+    def __call__(self,start_value,kwargs_SI):
+        """
+        Convert a value.
+        
+        @param start_value: value to convert (float, array or uncertainties)
+        @param kwargs_SI: extra information in SI units (wave, freq, photband...)
+        @type kwargs_SI: dict
+        @return: converted value
+        """
+        fac_from,fac_to = self.fac_from,self.fac_to
+        if self.log_in:
+            start_value = 10**start_value
+        if self.assume is not None:
+            kwargs_SI[self.assume] = convert(self._from,'SI',start_value,unpack=False)
+            logger.warning('Assumed input value to serve also for "%s" key'%(self.assume))
+        #-- add some default values if necessary
+        #   (messages are formatted lazily: formatting arrays is expensive)
+        logger.debug('Convert %s to %s, fac_from-start_value %s/%s',self.uni_from,self.uni_to,fac_from,start_value)
+        
+        #-- conversion is easy if same units
+        ret_value = 1.
+        
+        if self.uni_from==self.uni_to:
+            #-- if nonlinear conversions from or to:
+            if isinstance(fac_from,NonLinearConverter):
+                ret_value *= fac_from(start_value,**kwargs_SI)
+            else:
+                try:
+                    ret_value *= fac_from*start_value
+                except TypeError:
+                    raise TypeError('Cannot multiply value with a float; probably argument is a tuple (value,error), please expand with *(value,error)')
+        
+        #-- otherwise a little bit more complicated
+        elif self.inverse:
+            ret_value *= period2freq(fac_from*start_value,**kwargs_SI)
+            logger.warning('It is assumed that the "from" unit is the inverse of the "to" unit')
+        elif self.switch is not None:
+            #-- nonlinear conversions need a little tweak
+            if isinstance(fac_from,NonLinearConverter):
+                ret_value *= self.switch(fac_from(start_value,**kwargs_SI),**kwargs_SI)
+            #-- linear conversions are easy
+            else:
+                logger.debug('fac_from=%s, start_value=%s with kwargs %s',fac_from,start_value,kwargs_SI)
+                ret_value *= self.switch(fac_from*start_value,**kwargs_SI)
         else:
             ret_value *= start_value
-    #-- final step: convert to ... (again distinction between linear and
-    #   nonlinear converters)
-    if isinstance(fac_to,NonLinearConverter):
-        ret_value = fac_to(ret_value,inv=True,**kwargs_SI)
-    else:
-        ret_value /= fac_to
-    
-    #-- logarithmicize
-    if m_out is not None:
-        ret_value = log10(ret_value)
+        #-- final step: convert to ... (again distinction between linear and
+        #   nonlinear converters)
+        if isinstance(fac_to,NonLinearConverter):
+            ret_value = fac_to(ret_value,inv=True,**kwargs_SI)
+        else:
+            ret_value /= fac_to
         
-    #-- unpack the uncertainties if: 
-    #    1. the input was not given as an uncertainty
-    #    2. the input was without uncertainties, but extra keywords had uncertainties
-    #    3. the input was with uncertainties (float or array) and unpack==True
-    unpack_case1 = len(args)==2
-    unpack_case2 = len(args)==1 and isinstance(ret_value,AffineScalarFunc)
-    unpack_case3 = len(args)==1 and isinstance(ret_value,np.ndarray) and isinstance(ret_value[0],AffineScalarFunc)
-    if unpack and (unpack_case1 or unpack_case2):
-        ret_value = unumpy.nominal_values(ret_value),unumpy.std_devs(ret_value)
-        #-- convert to real floats if real floats were given
-        if not ret_value[0].shape:
-            ret_value = np.asscalar(ret_value[0]),np.asscalar(ret_value[1])    
-    
-    return ret_value
+        #-- logarithmicize
+        if self.log_out:
+            ret_value = log10(ret_value)
+        return ret_value
 
 
 def nconvert(_froms,_tos,*args,**kwargs):
@@ -1093,6 +1183,8 @@ def set_convention(units='SI',values='standard',frequency='rad'):
         _switch['rad-1_to_'] = do_nothing
         constants._current_frequency = frequency.lower()
         logger.debug('Changed frequency convention to {0}'.format(frequency))
+    #-- compiled conversions are no longer valid
+    _plans.clear()
         
     if to_return[:2]==(units,values):
         return to_return
@@ -1170,6 +1262,7 @@ def set_convention(units='SI',values='standard',frequency='rad'):
         
     constants._current_convention = units
     constants._current_values = values
+    _plans.clear()
     #-- when we set everything back to SI, make sure we have no rounding errors:
     if units=='SI' and values=='standard' and frequency=='rad':
         reload(constants)
@@ -3702,6 +3795,11 @@ _aliases = [('micron','mum'),('au','AU'),('lbs','lb'),
             ('pk','hp'),('mph','mi/h'),('f.u.','fu')
             ]
  
+#-- Compiled conversions: conversion functions without bound keywords per
+#   (from,to), and conversion plans per (from,to,keywords)
+_converters = {}
+_plans = {}
+
 #-- Change-of-base function definitions
 _switch = {'s1_to_':       distance2velocity, # switch from wavelength to velocity
            's-1_to_':      velocity2distance, # switch from wavelength to velocity
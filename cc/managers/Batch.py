@@ -0,0 +1,1178 @@
+# -*- coding: utf-8 -*-
+
+"""
+Interface for running Sphinx models through a batch scheduler.
+
+The Batch manager collects the transitions of a model, stages the required
+files to the cluster, and queues them as an array job. The scheduler itself is
+handled by a backend: a local process pool, SLURM, PBS, or a fake scheduler
+for testing.
+
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import subprocess
+from glob import glob
+from time import gmtime, sleep
+
+import cc.path
+from cc.tools.io import DataIO
+from cc.modeling.codes import Gastronoom
+
+
+
+def makeBackend(scheduler,**kwargs):
+
+    '''
+    Create a batch backend for a given scheduler.
+
+    @param scheduler: The scheduler: 'local', 'slurm', 'pbs' or 'fake'
+    @type scheduler: string
+
+    @keyword kwargs: Passed on to the backend. See Backend() and its
+                     subclasses.
+    @type kwargs: dict
+
+    @return: The backend
+    @rtype: Backend()
+
+    '''
+
+    backends = {'local': LocalBackend, 'slurm': SlurmBackend,\
+                'pbs': PbsBackend, 'fake': FakeBackend}
+    if not backends.has_key(scheduler.lower()):
+        raise IOError('Batch scheduler %s unknown. Choose from %s.'\
+                      %(scheduler,', '.join(sorted(backends.keys()))))
+    return backends[scheduler.lower()](**kwargs)
+
+
+
+def formatWalltime(minutes):
+
+    '''
+    Format a walltime in minutes as HH:MM:SS.
+
+    @param minutes: The walltime in minutes
+    @type minutes: float
+
+    @return: The formatted walltime
+    @rtype: string
+
+    '''
+
+    minutes = int(minutes+0.999)
+    return '%.2i:%.2i:00'%(minutes/60,minutes%60)
+
+
+
+def runArrayTask(script,task):
+
+    '''
+    Run one task of an array job on the local machine.
+
+    @param script: The job script
+    @type script: string
+    @param task: The index of the task in the array, starting from 1
+    @type task: int
+
+    @return: The return code of the job script
+    @rtype: int
+
+    '''
+
+    return subprocess.call(['bash',script,str(task)],\
+                           cwd=os.path.split(script)[0])
+
+
+
+class Backend(object):
+
+    """
+    A batch-scheduler backend.
+
+    Commands are executed on a login node through ssh, or on the local machine
+    if no host is given. Files are staged to and from the cluster with one tar
+    or rsync stream per call.
+
+    Subclasses implement submit() and poll() for a specific scheduler.
+
+    """
+
+    def __init__(self,remote_path,host='',account=None,transfer='tar'):
+
+        """
+        Initializing a Backend instance.
+
+        @param remote_path: The working folder on the cluster. Must contain
+                            a data/ folder with the GASTRoNOoM data files.
+        @type remote_path: string
+
+        @keyword host: The login node, eg user@login.hpc.kuleuven.be. If
+                       empty, commands are executed on the local machine.
+
+                       (default: '')
+        @type host: string
+        @keyword account: The credits account to be charged. If None, the
+                          default account of the user is charged.
+
+                          (default: None)
+        @type account: string
+        @keyword transfer: The program used for staging files: 'tar' or
+                           'rsync'
+
+                           (default: 'tar')
+        @type transfer: string
+
+        """
+
+        if not transfer in ['tar','rsync']:
+            raise IOError('File transfer for the batch backend must be tar '+\
+                          'or rsync.')
+        self.remote_path = remote_path
+        self.host = host
+        self.account = account if account else None
+        self.transfer = transfer
+
+
+
+    def execute(self,command):
+
+        '''
+        Execute a shell command on the cluster.
+
+        @param command: The command
+        @type command: string
+
+        @return: The return code and the output of the command
+        @rtype: (int,string)
+
+        '''
+
+        process = subprocess.Popen(self.__shell(command),\
+                                   stdout=subprocess.PIPE,\
+                                   stderr=subprocess.PIPE)
+        output, error = process.communicate()
+        if process.returncode:
+            print 'Batch command failed: %s'%command
+            print error
+        return process.returncode, output
+
+
+
+    def stage(self,local_folder,remote_folder):
+
+        '''
+        Copy the contents of a local folder to the cluster in one stream.
+
+        Symbolic links are followed, so a staging folder can be made of links
+        to the original files.
+
+        @param local_folder: The local folder
+        @type local_folder: string
+        @param remote_folder: The remote folder, created if needed.
+        @type remote_folder: string
+
+        @return: Success?
+        @rtype: bool
+
+        '''
+
+        if self.transfer == 'rsync':
+            dest = self.host and '%s:%s/'%(self.host,remote_folder) \
+                             or '%s/'%remote_folder
+            args = ['rsync','-aL','--rsync-path',\
+                    'mkdir -p %s && rsync'%remote_folder,\
+                    '%s/'%local_folder.rstrip('/'),dest]
+            return not subprocess.call(args)
+        tar = subprocess.Popen(['tar','-C',local_folder,'-chf','-','.'],\
+                               stdout=subprocess.PIPE)
+        untar = subprocess.Popen(self.__shell('mkdir -p %s && tar -C %s -xf -'\
+                                              %(remote_folder,remote_folder)),\
+                                 stdin=tar.stdout)
+        tar.stdout.close()
+        untar.communicate()
+        tar.wait()
+        return not (tar.returncode or untar.returncode)
+
+
+
+    def fetch(self,remote_folder,patterns,local_folder):
+
+        '''
+        Copy files matching a set of patterns from the cluster in one stream.
+
+        @param remote_folder: The remote folder
+        @type remote_folder: string
+        @param patterns: Shell patterns relative to the remote folder, eg
+                         'output/*/sph*'. The relative paths are kept.
+        @type patterns: list[string]
+        @param local_folder: The local folder, created if needed.
+        @type local_folder: string
+
+        @return: Success?
+        @rtype: bool
+
+        '''
+
+        if not os.path.isdir(local_folder):
+            os.makedirs(local_folder)
+        if self.transfer == 'rsync':
+            src = self.host and '%s:%s/'%(self.host,remote_folder) \
+                            or '%s/'%remote_folder
+            args = ['rsync','-am',"--include=*/"] \
+                 + ['--include=%s'%p for p in patterns] \
+                 + ['--exclude=*',src,'%s/'%local_folder.rstrip('/')]
+            return not subprocess.call(args)
+        tar = subprocess.Popen(self.__shell('cd %s && ls -d %s 2>/dev/null '\
+                                            %(remote_folder,' '.join(patterns))\
+                                            + '| tar -cf - -T -'),\
+                               stdout=subprocess.PIPE)
+        untar = subprocess.Popen(['tar','-C',local_folder,'-xf','-'],\
+                                 stdin=tar.stdout)
+        tar.stdout.close()
+        untar.communicate()
+        tar.wait()
+        return not (tar.returncode or untar.returncode)
+
+
+
+    def remove(self,remote_folder):
+
+        '''
+        Remove a folder on the cluster.
+
+        @param remote_folder: The remote folder
+        @type remote_folder: string
+
+        '''
+
+        self.execute('rm -rf %s'%remote_folder)
+
+
+
+    def submit(self,script,num_tasks,walltime,name):
+
+        '''
+        Submit an array job.
+
+        The job script finds its task index in the array from the environment
+        variable of the scheduler, or as its first argument.
+
+        @param script: The job script on the cluster
+        @type script: string
+        @param num_tasks: The number of tasks in the array
+        @type num_tasks: int
+        @param walltime: The walltime per task in minutes
+        @type walltime: float
+        @param name: The name of the job
+        @type name: string
+
+        @return: The job id, None if the submission failed
+        @rtype: string
+
+        '''
+
+        raise NotImplementedError('Use a subclass of Backend().')
+
+
+
+    def poll(self):
+
+        '''
+        Return the ids of all jobs of the user that are still queued or
+        running, in one call to the scheduler.
+
+        If the scheduler cannot be queried, eg when the ssh connection drops,
+        or its output cannot be parsed, None is returned: the jobs may still
+        be running.
+
+        @return: The job ids, None if the query failed
+        @rtype: set(string)
+
+        '''
+
+        raise NotImplementedError('Use a subclass of Backend().')
+
+
+
+    def __shell(self,command):
+
+        '''
+        Return the arguments for running a shell command on the cluster.
+
+        @param command: The command
+        @type command: string
+
+        @return: The arguments for subprocess
+        @rtype: list[string]
+
+        '''
+
+        if self.host:
+            return ['ssh',self.host,command]
+        return ['sh','-c',command]
+
+
+
+class SlurmBackend(Backend):
+
+    """
+    A backend for the SLURM scheduler.
+
+    """
+
+    def submit(self,script,num_tasks,walltime,name):
+
+        '''
+        Submit an array job through sbatch. See Backend.submit().
+
+        '''
+
+        folder = os.path.split(script)[0]
+        options = ['--parsable','--array=1-%i'%num_tasks,\
+                   '--time=%s'%formatWalltime(walltime),\
+                   '--job-name=%s'%name,\
+                   '--output=%s'%os.path.join(folder,'slurm_%A_%a.log')]
+        if not self.account is None:
+            options.append('--account=%s'%self.account)
+        code, output = self.execute('cd %s && sbatch %s %s'\
+                                    %(folder,' '.join(options),script))
+        if code or not output.strip(): return None
+        return output.strip().split(';')[0]
+
+
+
+    def poll(self):
+
+        '''
+        Return the ids of the jobs in squeue. See Backend.poll().
+
+        '''
+
+        code, output = self.execute('squeue -h -u $(whoami) -o %F')
+        ids = [line.strip() for line in output.split('\n') if line.strip()]
+        if code or [i for i in ids if not i.isdigit()]:
+            print 'Polling squeue failed.'
+            return None
+        return set(ids)
+
+
+
+class PbsBackend(Backend):
+
+    """
+    A backend for the PBS/Torque scheduler.
+
+    """
+
+    def __init__(self,array_option='-t',**kwargs):
+
+        """
+        Initializing a PbsBackend instance.
+
+        @keyword array_option: The qsub option for array jobs: '-t' for
+                               Torque, '-J' for PBS Pro.
+
+                               (default: '-t')
+        @type array_option: string
+        @keyword kwargs: Passed on to Backend()
+        @type kwargs: dict
+
+        """
+
+        super(PbsBackend,self).__init__(**kwargs)
+        self.array_option = array_option
+
+
+
+    def submit(self,script,num_tasks,walltime,name):
+
+        '''
+        Submit an array job through qsub. See Backend.submit().
+
+        '''
+
+        folder = os.path.split(script)[0]
+        options = ['%s 1-%i'%(self.array_option,num_tasks),\
+                   '-l walltime=%s'%formatWalltime(walltime),\
+                   '-N %s'%name[:15],'-j oe','-o %s'%folder]
+        if not self.account is None:
+            options.append('-A %s'%self.account)
+        code, output = self.execute('cd %s && qsub %s %s'\
+                                    %(folder,' '.join(options),script))
+        if code or not output.strip(): return None
+        return self.__jobId(output.strip())
+
+
+
+    def poll(self):
+
+        '''
+        Return the ids of the jobs in qstat. See Backend.poll().
+
+        '''
+
+        code, output = self.execute('qstat -u $(whoami)')
+        ids = [line.split()[0]
+               for line in output.split('\n')
+               if line.strip() and line.strip()[0].isdigit()]
+        #-- Without jobs, qstat prints nothing at all
+        if code or (output.strip() and not ids):
+            print 'Polling qstat failed.'
+            return None
+        return set([self.__jobId(i) for i in ids])
+
+
+
+    def __jobId(self,job):
+
+        '''
+        Return the numerical part of a PBS job id, eg 1234 for 1234[].server.
+
+        @param job: The job id
+        @type job: string
+
+        @return: The numerical job id
+        @rtype: string
+
+        '''
+
+        match = re.match('\d+',job)
+        return match and match.group() or job
+
+
+
+class LocalBackend(Backend):
+
+    """
+    A backend running the array tasks in a process pool on the local machine.
+
+    The remote path is a local folder.
+
+    """
+
+    def __init__(self,remote_path,num_workers=1,**kwargs):
+
+        """
+        Initializing a LocalBackend instance.
+
+        @param remote_path: The local working folder. See Backend().
+        @type remote_path: string
+
+        @keyword num_workers: The number of processes in the pool.
+
+                              (default: 1)
+        @type num_workers: int
+        @keyword kwargs: Passed on to Backend(). The host is ignored.
+        @type kwargs: dict
+
+        """
+
+        kwargs['host'] = ''
+        super(LocalBackend,self).__init__(remote_path=remote_path,**kwargs)
+        #-- Only needed when the pool is used. Requires the futures package.
+        from concurrent import futures
+        self.executor = futures.ProcessPoolExecutor(max_workers=\
+                                                        int(num_workers))
+        self.jobs = dict()
+
+
+
+    def submit(self,script,num_tasks,walltime,name):
+
+        '''
+        Submit the tasks of an array job to the pool. See Backend.submit().
+
+        The walltime is not enforced.
+
+        '''
+
+        job_id = 'local%i'%(len(self.jobs)+1)
+        self.jobs[job_id] = [self.executor.submit(runArrayTask,script,i+1)
+                             for i in range(num_tasks)]
+        return job_id
+
+
+
+    def poll(self):
+
+        '''
+        Return the ids of the jobs with unfinished tasks. See Backend.poll().
+
+        '''
+
+        return set([job_id
+                    for job_id,tasks in self.jobs.items()
+                    if [t for t in tasks if not t.done()]])
+
+
+
+class FakeBackend(Backend):
+
+    """
+    A fake scheduler on the local machine for testing.
+
+    Jobs stay in the queue for a number of polls, after which their tasks are
+    ran one by one. Submissions and polls are remembered, so they can be
+    inspected. Combine with a fake sphinx executable to test the Batch manager
+    without GASTRoNOoM.
+
+    """
+
+    def __init__(self,remote_path,delay=1,run_tasks=1,fail_polls=0,**kwargs):
+
+        """
+        Initializing a FakeBackend instance.
+
+        @param remote_path: The local working folder. See Backend().
+        @type remote_path: string
+
+        @keyword delay: The number of polls a job stays in the queue
+
+                        (default: 1)
+        @type delay: int
+        @keyword run_tasks: Run the job scripts when the jobs leave the queue.
+                            If 0, the jobs just disappear from the queue.
+
+                            (default: 1)
+        @type run_tasks: bool
+        @keyword fail_polls: The number of polls that fail, as if the 
+                             scheduler cannot be reached. The queue does not 
+                             change during a failed poll.
+
+                             (default: 0)
+        @type fail_polls: int
+        @keyword kwargs: Passed on to Backend(). The host is ignored.
+        @type kwargs: dict
+
+        """
+
+        kwargs['host'] = ''
+        super(FakeBackend,self).__init__(remote_path=remote_path,**kwargs)
+        self.delay = int(delay)
+        self.run_tasks = int(run_tasks)
+        self.fail_polls = int(fail_polls)
+        self.submitted = []
+        self.queue = dict()
+        self.num_polls = 0
+
+
+
+    def submit(self,script,num_tasks,walltime,name):
+
+        '''
+        Put an array job in the fake queue. See Backend.submit().
+
+        '''
+
+        job_id = 'fake%i'%(len(self.submitted)+1)
+        self.submitted.append(dict([('job_id',job_id),('script',script),\
+                                    ('num_tasks',num_tasks),\
+                                    ('walltime',walltime),('name',name)]))
+        self.queue[job_id] = (script,num_tasks,self.delay)
+        return job_id
+
+
+
+    def poll(self):
+
+        '''
+        Return the ids of the jobs in the fake queue, and run the jobs that
+        leave the queue. See Backend.poll().
+
+        '''
+
+        self.num_polls += 1
+        if self.fail_polls:
+            self.fail_polls -= 1
+            return None
+        for job_id,(script,num_tasks,delay) in self.queue.items():
+            if delay > 1:
+                self.queue[job_id] = (script,num_tasks,delay-1)
+                continue
+            if self.run_tasks:
+                for i in range(num_tasks):
+                    runArrayTask(script,i+1)
+            del self.queue[job_id]
+        return set(self.queue.keys())
+
+
+
+class Batch():
+
+    """
+    A batch manager which runs sphinx models through a batch scheduler and
+    updates the modeling results on the home disk.
+
+    For every cooling model, the transitions are added, and the model is
+    queued as a single array job. The transitions are grouped in array tasks
+    based on the expected time per sphinx model.
+
+    """
+
+    def __init__(self,backend,path='runTest',time_per_sphinx=30,\
+                 task_walltime=240,sphinx='sphinx',setup=[],\
+                 recover_sphinxfiles=0):
+
+        """
+        Initializing a Batch instance.
+
+        @param backend: The scheduler backend
+        @type backend: Backend()
+
+        @keyword path: The output folder in the GASTRoNOoM home folder
+
+                       (default: 'runTest')
+        @type path: string
+        @keyword time_per_sphinx: the expected calculation time for one sphinx
+                                  model in minutes
+
+                                  (default: 30)
+        @type time_per_sphinx: float
+        @keyword task_walltime: The maximum walltime of a single array task in
+                                minutes. Determines how many transitions are
+                                calculated in one task.
+
+                                (default: 240)
+        @type task_walltime: float
+        @keyword sphinx: The sphinx executable on the cluster
+
+                         (default: 'sphinx')
+        @type sphinx: string
+        @keyword setup: Shell commands ran at the start of each task, eg to
+                        load modules
+
+                        (default: [])
+        @type setup: list[string]
+        @keyword recover_sphinxfiles: Try to recover sphinx files from the
+                                      cluster in case they were correctly
+                                      calculated, but not saved to the database
+                                      for one reason or another.
+
+                                      (default: 0)
+        @type recover_sphinxfiles: bool
+
+        """
+
+        self.backend = backend
+        self.path = path
+        self.time_per_sphinx = float(time_per_sphinx)
+        self.task_walltime = float(task_walltime)
+        self.sphinx = sphinx
+        self.setup = list(setup)
+        self.recover_sphinxfiles = recover_sphinxfiles
+        self.remote_data = os.path.join(self.backend.remote_path,'data')
+        self.finished = dict()
+        self.failed = dict()
+        self.models = dict()
+        self.command_lists = dict()
+        self.transitions = dict()
+        self.sphinx_model_ids = dict()
+        self.jobs = dict()
+        self.trans_in_progress = []
+        self.current_model = 0
+        self.sph_db = None
+
+
+
+    def setSphinxDb(self,sph_db):
+
+        '''
+        Set the Sphinx db for this Batch instance.
+
+        @param sph_db: The sphinx database
+        @type sph_db: Database()
+
+        '''
+
+        self.sph_db = sph_db
+
+
+
+    def updateLineSpec(self):
+
+        '''
+        Update the telescope.spec files in the data folder on the cluster.
+
+        '''
+
+        staging = tempfile.mkdtemp()
+        try:
+            for fn in glob(os.path.join(cc.path.gdata,'*spec')):
+                self.__link(fn,os.path.join(staging,'data'))
+            self.backend.stage(staging,self.backend.remote_path)
+        finally:
+            shutil.rmtree(staging)
+
+
+
+    def addModel(self,model_id,command_list):
+
+        '''
+        Add model to the list of to be processed models.
+
+        Every entry in the dictionaries has an index number associated with
+        it to uniquely identify a modeling session across the batch manager.
+
+        The current_model index is the same between a call to addModel() and
+        queueModel() OR reset(). queueModel() will move to the next index
+        value, while reset() will reset the current index number.
+
+        @param model_id: The cooling model_id
+        @type model_id: string
+        @param command_list: The parameters for this GASTRoNOoM model
+        @type command_list: dict()
+
+        '''
+
+        if self.models.has_key(self.current_model):
+            raise IOError('Batch().addModel() is trying to add a model_id ' +\
+                          'to a session that was already assigned an id. ' +\
+                          'Reset or queue the previous model first.')
+        self.models[self.current_model] = model_id
+        self.command_lists[self.current_model] = command_list
+        self.transitions[self.current_model] = []
+        self.failed[self.current_model] = []
+        self.finished[self.current_model] = []
+
+
+
+    def addTransInProgress(self,trans):
+
+        '''
+        Add a transition to the list of transitions in progress. They will be
+        checked at the end of the session to see if they have been correctly
+        calculated.
+
+        This concerns transitions that are requested, but are already present
+        in the sphinx database with an "IN_PROGRESS" keyword included in the
+        transition dictionary.
+
+        @param trans: The transition
+        @type trans: Transition()
+
+        '''
+
+        self.trans_in_progress.append(trans)
+
+
+
+    def addTrans(self,trans):
+
+        '''
+        Add a transition to be calculated for the current model.
+
+        @param trans: The transition
+        @type trans: Transition()
+
+        '''
+
+        self.transitions[self.current_model].append(trans)
+
+
+
+    def queueModel(self):
+
+        '''
+        Queue the current model: the input files are made, all files needed
+        are staged to the cluster in one stream, and the transitions are
+        submitted as a single array job.
+
+        The current model index number is increased by one afterwards.
+
+        '''
+
+        self.sphinx_model_ids[self.current_model] \
+            = sorted(set([trans.getModelId()
+                          for trans in self.transitions[self.current_model]]))
+        if not self.recover_sphinxfiles:
+            self.submitModel()
+        self.current_model += 1
+
+
+
+    def reset(self):
+
+        '''
+        If a model has been added, and no transitions were required to be
+        calculated, remove that model entry here.
+
+        '''
+
+        del self.models[self.current_model]
+        del self.transitions[self.current_model]
+
+
+
+    def getRemoteFolder(self,current_model):
+
+        '''
+        Return the folder on the cluster for a queued model.
+
+        @param current_model: The index of the model in the batch manager
+        @type current_model: int
+
+        @return: The remote folder
+        @rtype: string
+
+        '''
+
+        return os.path.join(self.backend.remote_path,'%s_%i'\
+                            %(self.models[current_model],current_model))
+
+
+
+    def getLocalFolder(self,current_model):
+
+        '''
+        Return the local folder for staging and logs of a queued model.
+
+        @param current_model: The index of the model in the batch manager
+        @type current_model: int
+
+        @return: The local folder
+        @rtype: string
+
+        '''
+
+        return os.path.join(cc.path.gastronoom,self.path,'models',\
+                            self.models[current_model],\
+                            'batch_%i'%current_model)
+
+
+
+    def submitModel(self):
+
+        '''
+        Make the input files and the job script for the current model, stage
+        them to the cluster and submit the array job.
+
+        '''
+
+        cm = self.current_model
+        model_id = self.models[cm]
+        remote = self.getRemoteFolder(cm)
+        staging = tempfile.mkdtemp()
+        local = os.path.join(staging,os.path.split(remote)[1])
+        try:
+            infiles = self.makeInputFiles(local,remote,staging)
+            if not infiles: return
+            per_task = max(1,int(self.task_walltime/self.time_per_sphinx))
+            tasks = [infiles[i:i+per_task]
+                     for i in range(0,len(infiles),per_task)]
+            DataIO.writeFile(os.path.join(local,'tasks.txt'),\
+                             [' '.join(t) for t in tasks])
+            script = os.path.join(remote,'job.sh')
+            DataIO.writeFile(os.path.join(local,'job.sh'),\
+                             self.makeJobScript(remote))
+            if not self.backend.stage(staging,self.backend.remote_path):
+                print 'Staging files to the cluster failed for %s.'%model_id
+                return
+        finally:
+            shutil.rmtree(staging)
+        walltime = min(per_task,len(infiles))*self.time_per_sphinx
+        self.jobs[cm] = self.backend.submit(script=script,\
+                                            num_tasks=len(tasks),\
+                                            walltime=walltime,\
+                                            name='cc%s'%model_id[-10:])
+        print 'Running %i transitions in %i tasks for ID %s (job %s).'\
+              %(len(infiles),len(tasks),model_id,self.jobs[cm])
+
+
+
+    def makeInputFiles(self,local,remote,staging):
+
+        '''
+        Make the input files for all transitions of the current model, and
+        link the files they need in the staging folder.
+
+        The staging folder is extracted in the remote working folder: The
+        model files end up in the remote model folder, the opacity files in
+        the remote data folder.
+
+        @param local: The model folder in the staging folder
+        @type local: string
+        @param remote: The remote model folder
+        @type remote: string
+        @param staging: The staging folder
+        @type staging: string
+
+        @return: The input filenames, relative to the model folder
+        @rtype: list[string]
+
+        '''
+
+        cm = self.current_model
+        command_list = self.command_lists[cm]
+        infiles = []
+        for model_id_sphinx in self.sphinx_model_ids[cm]:
+            these_trans = [trans
+                           for trans in self.transitions[cm]
+                           if trans.getModelId() == model_id_sphinx]
+            if not these_trans: continue
+
+            #-- Link the cooling and mline output needed by sphinx
+            local_folder = os.path.join(cc.path.gastronoom,self.path,\
+                                        'models',model_id_sphinx)
+            output = os.path.join(local,'output',model_id_sphinx)
+            molecs = set(['sampling'] + [trans.molecule.molecule
+                                         for trans in these_trans])
+            patterns = ['coolfgr*','input%s.dat'%model_id_sphinx]
+            patterns.extend(['cool*_%s.dat'%molec for molec in molecs])
+            patterns.extend(['ml*_%s.dat'%molec
+                             for molec in molecs
+                             if molec != 'sampling'])
+            for pattern in patterns:
+                for fn in glob(os.path.join(local_folder,pattern)):
+                    self.__link(fn,output)
+
+            for i,trans in enumerate(these_trans):
+                acl = command_list.copy()
+                acl['DATA_DIRECTORY'] = '"%s/"'%self.remote_data
+                acl['OUTPUT_DIRECTORY'] = '"%s/"'\
+                        %os.path.join(remote,'output',model_id_sphinx)
+                acl['PARAMETER_FILE'] = '"%s"'\
+                        %os.path.join(remote,'output',model_id_sphinx,\
+                                      'parameter_file_%s.dat'%model_id_sphinx)
+                acl['OUTPUT_SUFFIX'] = model_id_sphinx
+                opacity = acl['TEMDUST_FILENAME'].strip('"')
+                if opacity != 'temdust.kappa':
+                    self.__link(os.path.join(cc.path.gdata,opacity),\
+                                os.path.join(staging,'data'))
+                if int(acl.get('KEYWORD_DUST_TEMPERATURE_TABLE',0)):
+                    homefile = acl['DUST_TEMPERATURE_FILENAME'].strip('"')
+                    self.__link(homefile,os.path.join(local,'dust_files'))
+                    acl['DUST_TEMPERATURE_FILENAME'] = '"%s"'\
+                            %os.path.join(remote,'dust_files',\
+                                          os.path.split(homefile)[1])
+
+                #-- Custom input files of the molecule
+                custom = os.path.join(remote,'CustomFiles')
+                molec_dict = trans.molecule.makeDict(custom)
+                for key,fkey in [('enhance_abundance_factor',\
+                                  'abundance_filename'),\
+                                 ('set_keyword_change_abundance',\
+                                  'change_fraction_filename'),\
+                                 ('set_keyword_change_temperature',\
+                                  'new_temperature_filename'),\
+                                 ('starfile','starfile')]:
+                    if getattr(trans.molecule,key):
+                        self.__link(getattr(trans.molecule,fkey),\
+                                    os.path.join(local,'CustomFiles'))
+
+                commandfile = \
+                     ['%s=%s'%(k,v)
+                      for k,v in sorted(acl.items())
+                      if k != 'R_POINTS_MASS_LOSS'] + ['####'] + \
+                     ['%s=%s'%(k,v)
+                      for k,v in sorted(molec_dict.items())] + ['####'] + \
+                     ['%s=%s'%(k,v)
+                      for k,v in sorted(trans.makeDict().items())] + \
+                     ['######']
+                if acl.has_key('R_POINTS_MASS_LOSS'):
+                    commandfile.extend(['%s=%s'%('R_POINTS_MASS_LOSS',v)
+                                        for v in acl['R_POINTS_MASS_LOSS']] +\
+                                       ['####'])
+                infile = 'gastronoom_%s_%i.inp'%(model_id_sphinx,i+1)
+                DataIO.writeFile(os.path.join(local,infile),commandfile)
+                infiles.append(infile)
+        return infiles
+
+
+
+    def makeJobScript(self,remote):
+
+        '''
+        Make the job script for an array job.
+
+        Every task runs sphinx for the input files on its line in tasks.txt.
+        The task index is taken from the scheduler's environment variable, or
+        from the first argument of the script.
+
+        @param remote: The remote model folder
+        @type remote: string
+
+        @return: The lines of the job script
+        @rtype: list[string]
+
+        '''
+
+        return ['#!/bin/bash -l'] + self.setup + \
+               ['TASK=${SLURM_ARRAY_TASK_ID:-${PBS_ARRAYID:-'+\
+                '${PBS_ARRAY_INDEX:-$1}}}',\
+                'cd %s'%remote,\
+                'for INP in $(sed -n "${TASK}p" tasks.txt) ; do',\
+                '    echo %s/$INP | %s > ${INP%%.inp}.log 2>&1'\
+                %(remote,self.sphinx),\
+                'done']
+
+
+
+    def checkProgress(self,wait_qstat=0):
+
+        '''
+        Check progress on all queued models with a single poll of the
+        scheduler.
+
+        The output of models that left the queue is fetched in one stream per
+        model, the sphinx database is updated, and the remote model folder is
+        removed. If the poll fails, no model is finalized until the next 
+        check.
+
+        @keyword wait_qstat: wait 10 seconds before polling the scheduler, in
+                             order to make sure newly submitted jobs show up.
+
+                             (default: 0)
+        @type wait_qstat: bool
+
+        @return: Are there models still in progress?
+        @rtype: bool
+
+        '''
+
+        if wait_qstat:
+            sleep(10)
+        active = self.backend.poll()
+        if active is None:
+            print 'Could not poll the scheduler. Checking again later.'
+            return bool(self.transitions)
+        for current_model in sorted(self.transitions.keys()):
+            if self.jobs.get(current_model) in active:
+                continue
+            self.finalizeModel(current_model)
+        self.sph_db.sync()
+        return bool(self.transitions)
+
+
+
+    def finalizeModel(self,current_model):
+
+        '''
+        Fetch the output of a model that is no longer queued, and check the
+        sphinx output of its transitions.
+
+        @param current_model: The index of the model in the batch manager
+        @type current_model: int
+
+        '''
+
+        model_id = self.models[current_model]
+        print 'Currently checking %s...'%model_id
+        remote = self.getRemoteFolder(current_model)
+        local = self.getLocalFolder(current_model)
+        self.backend.fetch(remote,['output/*/sph*','*.log'],local)
+        for model_id_sphinx in self.sphinx_model_ids[current_model]:
+            heresph = os.path.join(cc.path.gastronoom,self.path,'models',\
+                                   model_id_sphinx)
+            for fn in glob(os.path.join(local,'output',model_id_sphinx,'sph*')):
+                dest = os.path.join(heresph,os.path.split(fn)[1])
+                if os.path.lexists(dest): os.remove(dest)
+                shutil.move(fn,dest)
+            gas_session = Gastronoom.Gastronoom(path_gastronoom=self.path,\
+                                                sph_db=self.sph_db)
+            gas_session.model_id = model_id
+            gas_session.trans_list \
+                = [trans
+                   for trans in self.transitions[current_model]
+                   if trans.getModelId() == model_id_sphinx]
+            for trans in gas_session.trans_list:
+                gas_session.checkSphinxOutput(trans)
+            gas_session.finalizeSphinx()
+            self.finished[current_model].extend(\
+                        [trans
+                         for trans in gas_session.trans_list
+                         if trans.getModelId()])
+            self.failed[current_model].extend(\
+                        [trans
+                         for trans in gas_session.trans_list
+                         if not trans.getModelId()])
+        if os.path.isdir(os.path.join(local,'output')):
+            shutil.rmtree(os.path.join(local,'output'))
+        del self.transitions[current_model]
+        self.backend.remove(remote)
+
+
+
+    def finalizeBatch(self):
+
+        '''
+        Finalize the modeling through the batch manager: successful and failed
+        results are printed to a file, including the transitions.
+
+        '''
+
+        for trans in self.trans_in_progress:
+            filename = os.path.join(cc.path.gastronoom,\
+                                    self.path,'models',trans.getModelId(),\
+                                    trans.makeSphinxFilename(2))
+            if not os.path.isfile(filename):
+                trans.setModelId('')
+        if not self.models.keys():
+            return
+        time_stamp = '%.4i-%.2i-%.2ih%.2i:%.2i:%.2i' \
+                     %(gmtime()[0],gmtime()[1],gmtime()[2],\
+                       gmtime()[3],gmtime()[4],gmtime()[5])
+        results = ['# Successfully calculated models:'] \
+                + [self.models[cm]
+                   for cm in self.models.keys()
+                   if not self.failed.get(cm)] \
+                + ['# Unsuccessfully calculated models (see the logfiles '+ \
+                   'for these models):'] \
+                + [self.models[cm]
+                   for cm in self.models.keys()
+                   if self.failed.get(cm)]
+        DataIO.writeFile(os.path.join(cc.path.gastronoom,self.path,\
+                                      'batch_results','log_' + time_stamp),\
+                         results)
+        for cm,model_id in self.models.items():
+            model_results = ['# Successfully calculated transitions:'] + \
+                ['Sphinx %s: %s' %(trans.getModelId(),str(trans))
+                 for trans in self.finished[cm]] + \
+                ['# Unsuccessfully calculated transitions (see %s '\
+                 %self.getLocalFolder(cm) + 'for the logfiles):'] + \
+                ['Sphinx %s: %s' %(trans.getModelId(),str(trans))
+                 for trans in self.failed[cm]]
+            DataIO.writeFile(os.path.join(cc.path.gastronoom,self.path,\
+                                          'batch_results','log_results%s_%i'\
+                                          %(time_stamp,cm)),\
+                             model_results)
+
+
+
+    def getQueue(self):
+
+        '''
+        Get a list of unique queue number + cooling model_id for those models
+        that are still in progress.
+
+        @return: The queue numbers and model_ids still in progress.
+        @rtype: list[(int,string)]
+
+        '''
+
+        return [(k,v)
+                for k,v in self.models.items()
+                if self.transitions.has_key(k)]
+
+
+
+    def __link(self,filename,folder):
+
+        '''
+        Link a file in a staging folder, which is created if needed.
+
+        @param filename: The file
+        @type filename: string
+        @param folder: The staging folder
+        @type folder: string
+
+        '''
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        dest = os.path.join(folder,os.path.split(filename)[1])
+        if not os.path.lexists(dest):
+            os.symlink(os.path.abspath(filename),dest)
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+"""
+Interface for running GASTRoNOoM subcodes in parallel on the local machine.
+
+"""
+
+import os
+import subprocess
+
+from cc.tools.io import DataIO
+
+
+
+def runSubcode(subcode,filename,workdir):
+
+    '''
+    Run a GASTRoNOoM subcode in a worker process.
+
+    The subcode is ran in its own working directory, and its output to the
+    shell is written to a log file in that directory.
+
+    @param subcode: one of ['cooling','mline','sphinx'], the code to run
+    @type subcode: string
+    @param filename: the full path+filename of the inputfile
+    @type filename: string
+    @param workdir: The working directory
+    @type workdir: string
+
+    @return: The return code of the subcode
+    @rtype: int
+
+    '''
+
+    fn = os.path.splitext(os.path.split(filename)[1])[0]
+    logfn = os.path.join(workdir,'%s_%s.log'%(subcode.lower(),fn))
+    logfile = open(logfn,'w')
+    try:
+        return subprocess.call(['echo %s | %s'%(filename,subcode.lower())],\
+                               shell=True,cwd=workdir,stdout=logfile,\
+                               stderr=subprocess.STDOUT)
+    finally:
+        logfile.close()
+
+
+
+class LocalPool():
+
+    """
+    A local scheduler that runs GASTRoNOoM subcodes in a process pool.
+
+    Subcode runs are added as tasks, which can depend on other tasks: cooling,
+    then mline per molecule, then sphinx per transition. A task is dispatched
+    to the pool once all tasks it depends on were finished successfully.
+
+    The database bookkeeping of a task is done through its finalize functions,
+    which are called in the main process when the task is finished. If a task
+    it depends on failed, the task is not ran, but its finalize functions are
+    still called, such that the IN_PROGRESS entries are removed from the
+    databases.
+
+    """
+
+    def __init__(self,num_workers=1):
+
+        """
+        Initializing a LocalPool instance.
+
+        @keyword num_workers: The number of processes in the pool, ie the
+                              number of subcodes running at the same time.
+
+                              (default: 1)
+        @type num_workers: int
+
+        """
+
+        #-- Only needed when the pool is used. Requires the futures package.
+        from concurrent import futures
+        self.futures = futures
+        self.num_workers = int(num_workers)
+        self.executor = futures.ProcessPoolExecutor(max_workers=\
+                                                        self.num_workers)
+        self.tasks = dict()
+        self.waiting = []
+        self.running = dict()
+        self.reserved = dict()
+        self.current_task = 0
+
+
+
+    def addTask(self,subcode,filename,workdir,finalize=None,prepare=None,\
+                depends=[],reservation=None):
+
+        '''
+        Add a subcode run to the pool.
+
+        @param subcode: one of ['cooling','mline','sphinx'], the code to run
+        @type subcode: string
+        @param filename: the full path+filename of the inputfile
+        @type filename: string
+        @param workdir: The working directory of the subcode, ie the model
+                        folder
+        @type workdir: string
+
+        @keyword finalize: Called in the main process without arguments once
+                           the task is finished or cannot be ran anymore.
+                           Returns the success of the task. The task is
+                           successful if the subcode returns 0 and all its
+                           finalize functions return True.
+
+                           (default: None)
+        @type finalize: function
+        @keyword prepare: Called in the main process without arguments just
+                          before the task is dispatched, eg to link the output
+                          of the tasks it depends on.
+
+                          (default: None)
+        @type prepare: function
+        @keyword depends: The ids of the tasks that have to be finished first.
+                          None values are ignored.
+
+                          (default: [])
+        @type depends: list[int]
+        @keyword reservation: The database entry reserved for this task, eg
+                              ('mline',cooling id, molec id, molecule). Used
+                              by other models to depend on this task, see
+                              getReservation().
+
+                              (default: None)
+        @type reservation: tuple
+
+        @return: The id of the task
+        @rtype: int
+
+        '''
+
+        if not subcode.lower() in ['cooling','mline','sphinx']:
+            raise IOError('Subcode of GASTRoNOoM wrongly specified.')
+        self.current_task += 1
+        task_id = self.current_task
+        task = dict([('subcode',subcode.lower()),('filename',filename),\
+                     ('workdir',workdir),('prepare',prepare),\
+                     ('finalize',[] if finalize is None else [finalize]),\
+                     ('depends',[d for d in depends if not d is None]),\
+                     ('status','waiting'),('reservation',reservation)])
+        self.tasks[task_id] = task
+        self.waiting.append(task_id)
+        if not reservation is None:
+            self.reserved[reservation] = task_id
+        self.__dispatch()
+        return task_id
+
+
+
+    def addFinalize(self,task_id,finalize):
+
+        '''
+        Add a finalize function to a task, eg for a model reusing a database
+        entry reserved by the task.
+
+        If the task is already finished, the function is called right away.
+
+        @param task_id: The id of the task
+        @type task_id: int
+        @param finalize: Called without arguments in the main process when the
+                         task is finished. Returns the success of the task.
+        @type finalize: function
+
+        '''
+
+        if self.tasks[task_id]['status'] in ['done','failed']:
+            self.__call(self.tasks[task_id],finalize)
+        else:
+            self.tasks[task_id]['finalize'].append(finalize)
+
+
+
+    def getReservation(self,reservation):
+
+        '''
+        Return the id of the unfinished task that reserved a database entry.
+
+        @param reservation: The database entry, see addTask()
+        @type reservation: tuple
+
+        @return: The task id, None if no unfinished task reserved the entry
+        @rtype: int
+
+        '''
+
+        task_id = self.reserved.get(reservation)
+        if task_id is None or self.tasks[task_id]['status'] \
+                in ['done','failed']:
+            return None
+        return task_id
+
+
+
+    def checkProgress(self,timeout=0):
+
+        '''
+        Finalize the finished tasks, and dispatch the tasks that are ready.
+
+        @keyword timeout: Wait this many seconds for at least one task to
+                          finish. No waiting if 0. Wait indefinitely if None.
+
+                          (default: 0)
+        @type timeout: float
+
+        @return: Are there tasks left?
+        @rtype: bool
+
+        '''
+
+        if self.running:
+            done = self.futures.wait(self.running.keys(),timeout=timeout,\
+                                     return_when=self.futures.FIRST_COMPLETED)\
+                               .done
+            for future in done:
+                task_id = self.running.pop(future)
+                try:
+                    code = future.result()
+                except Exception, e:
+                    print 'Task %i (%s) raised an error: %s'\
+                          %(task_id,self.tasks[task_id]['subcode'],str(e))
+                    code = 1
+                self.__finalize(task_id,code)
+        self.__dispatch()
+        return bool(self.running or self.waiting)
+
+
+
+    def wait(self,task_ids=None):
+
+        '''
+        Wait until tasks are finished.
+
+        @keyword task_ids: The ids of the tasks to wait for. None values are
+                           ignored. If None, all tasks are waited for.
+
+                           (default: None)
+        @type task_ids: list[int]
+
+        '''
+
+        if task_ids is None:
+            while self.checkProgress(timeout=None): pass
+            return
+        task_ids = [t for t in task_ids if not t is None]
+        while [t
+               for t in task_ids
+               if self.tasks[t]['status'] not in ['done','failed']]:
+            self.checkProgress(timeout=None)
+
+
+
+    def finalizePool(self):
+
+        '''
+        Wait for all tasks to finish and shut down the pool.
+
+        '''
+
+        if self.running or self.waiting:
+            print '** Waiting for %i local subcode runs to finish.'\
+                  %(len(self.running)+len(self.waiting))
+        self.wait()
+        self.executor.shutdown()
+
+
+
+    def getQueue(self):
+
+        '''
+        Return the number of running and waiting tasks.
+
+        @return: The number of running and waiting tasks
+        @rtype: (int,int)
+
+        '''
+
+        return len(self.running), len(self.waiting)
+
+
+
+    def __dispatch(self):
+
+        '''
+        Submit the waiting tasks of which all dependencies are done, and
+        finalize those of which a dependency failed.
+
+        '''
+
+        changed = True
+        while changed:
+            changed = False
+            for task_id in list(self.waiting):
+                task = self.tasks[task_id]
+                status = [self.tasks[d]['status'] for d in task['depends']]
+                if 'failed' in status:
+                    self.waiting.remove(task_id)
+                    print 'Not running %s for %s: a task it depends on failed.'\
+                          %(task['subcode'],task['filename'])
+                    self.__finalize(task_id,None)
+                    changed = True
+                elif set(status) <= set(['done']):
+                    self.waiting.remove(task_id)
+                    if not task['prepare'] is None: task['prepare']()
+                    DataIO.testFolderExistence(task['workdir'])
+                    future = self.executor.submit(runSubcode,task['subcode'],\
+                                                  task['filename'],\
+                                                  task['workdir'])
+                    self.running[future] = task_id
+                    task['status'] = 'running'
+
+
+
+    def __finalize(self,task_id,code):
+
+        '''
+        Call the finalize functions of a task and set its status.
+
+        @param task_id: The id of the task
+        @type task_id: int
+        @param code: The return code of the subcode, None if it was not ran
+        @type code: int
+
+        '''
+
+        task = self.tasks[task_id]
+        #-- All finalize functions are called, to clean up every database
+        success = [self.__call(task,f) for f in task['finalize']]
+        task['status'] = 'done' if code == 0 and all(success) else 'failed'
+        print '** %s %s for %s. %i running, %i waiting.'\
+              %(task['subcode'].capitalize(),\
+                'finished' if task['status'] == 'done' else 'failed',\
+                os.path.split(task['filename'])[1],len(self.running),\
+                len(self.waiting))
+
+
+
+    def __call(self,task,finalize):
+
+        '''
+        Call a finalize function of a task. An error raised by the function
+        is reported, and counts as a failure of the task.
+
+        @param task: The task
+        @type task: dict
+        @param finalize: The finalize function
+        @type finalize: function
+
+        @return: The success returned by the function, False if it raised an
+                 error
+        @rtype: bool
+
+        '''
+
+        try:
+            return bool(finalize())
+        except Exception, e:
+            print 'Finalizing %s for %s raised an error: %s'\
+                  %(task['subcode'],task['filename'],str(e))
+            return False
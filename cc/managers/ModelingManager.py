@@ -8,11 +8,15 @@ Author: R. Lombaert
 """
 
 import os, time
+from copy import copy
 
 import cc.path
 from cc.modeling.codes.MCMax import MCMax
 from cc.modeling.codes.Gastronoom import Gastronoom
+from cc.modeling.objects.Star import Star
 from cc.tools.io import Database
+from cc.managers.LocalPool import LocalPool
+from cc.managers.Planner import Planner
 
 
 
@@ -25,9 +29,10 @@ class ModelingManager():
     
     def __init__(self,var_pars,processed_input,iterations=1,\
                  mcmax=0,gastronoom=0,sphinx=0,iterative=0,\
-                 num_model_sessions=1,vic_manager=None,replace_db_entry=0,\
+                 num_model_sessions=1,batch_manager=None,replace_db_entry=0,\
                  path_gastronoom='runTest',path_mcmax='runTest',\
-                 skip_cooling=0,recover_sphinxfiles=0,single_session=0):
+                 skip_cooling=0,recover_sphinxfiles=0,single_session=0,\
+                 db_engine=None,num_local_workers=0):
         
         """ 
         Initializing a ModelingManager instance.
@@ -63,10 +68,11 @@ class ModelingManager():
         
                                      (default: 1)
         @type num_model_sessions: int
-        @keyword vic_manager: the vic manager to run models (sphinx) on VIC3
+        @keyword batch_manager: the batch manager to run models (sphinx) 
+                                through a batch scheduler
         
-                              (default: None)
-        @type vic_manager: Vic()
+                                (default: None)
+        @type batch_manager: Batch()
         @keyword replace_db_entry: replace an entry in the database with a 
                                    newly calculated model with a new model id 
                                    (eg if some general data not included in 
@@ -100,6 +106,23 @@ class ModelingManager():
                                  
                                  (default: 0)
         @type single_session: bool
+        @keyword db_engine: The storage engine of the databases, see 
+                            Database.openDatabase(). If None, the engine is 
+                            determined from the files present on the disk.
+                            
+                            (default: None)
+        @type db_engine: str
+        @keyword num_local_workers: The number of GASTRoNOoM subcodes ran in
+                                    parallel on the local machine. If 0, they 
+                                    are ran one by one, as soon as needed. 
+                                    Otherwise, they are queued in a LocalPool 
+                                    that respects the dependencies between 
+                                    cooling, mline and sphinx models across 
+                                    the grid. Not used if a batch manager is
+                                    given.
+                                    
+                                    (default: 0)
+        @type num_local_workers: int
         
         """
         
@@ -110,7 +133,7 @@ class ModelingManager():
         self.input_dict = processed_input
         self.iterative = int(iterative)
         self.star_grid_old = [[] for i in xrange(num_model_sessions)]
-        self.vic = vic_manager
+        self.batch = batch_manager
         self.replace_db_entry = replace_db_entry
         self.new_entries_mcmax = []
         self.new_entries_cooling = []
@@ -121,6 +144,13 @@ class ModelingManager():
         self.path_gastronoom = path_gastronoom
         self.recover_sphinxfiles = recover_sphinxfiles
         self.single_session = single_session
+        self.db_engine = db_engine
+        self.num_local_workers = int(num_local_workers)
+        if self.gastronoom and self.num_local_workers and self.batch is None:
+            self.pool = LocalPool(num_workers=self.num_local_workers)
+        else:
+            self.pool = None
+        self.plan = None
         
         #-- Convenience paths
         cc.path.gout = os.path.join(cc.path.gastronoom,self.path_gastronoom)
@@ -146,14 +176,205 @@ class ModelingManager():
                                       'GASTRoNOoM_mline_models.db')
             sph_db_path = os.path.join(cc.path.gout,\
                                        'GASTRoNOoM_sphinx_models.db')
-            self.cool_db = Database.Database(db_path=cool_db_path)
-            self.ml_db = Database.Database(db_path=ml_db_path)
-            self.sph_db = Database.Database(db_path=sph_db_path)       
+            self.cool_db = Database.openDatabase(db_path=cool_db_path,\
+                                                 engine=self.db_engine)
+            self.ml_db = Database.openDatabase(db_path=ml_db_path,\
+                                               engine=self.db_engine)
+            self.sph_db = Database.openDatabase(db_path=sph_db_path,\
+                                                engine=self.db_engine)
         if self.mcmax:
             mcmax_db_path = os.path.join(cc.path.mout,'MCMax_models.db')
-            self.mcmax_db = Database.Database(db_path=mcmax_db_path)
-        if not self.vic is None:
-            self.vic.setSphinxDb(self.sph_db)
+            self.mcmax_db = Database.openDatabase(db_path=mcmax_db_path,\
+                                                  engine=self.db_engine)
+        if not self.batch is None:
+            self.batch.setSphinxDb(self.sph_db)
+        
+        
+        
+    def finalizePool(self):
+        
+        '''
+        Wait for all models in the local pool to be finished, and update the 
+        databases.
+        
+        The trans bools of the models are not updated, as they only indicate 
+        if a transition was calculated in this session. 
+        
+        '''
+        
+        if self.pool is None: return
+        self.pool.finalizePool()
+        
+        
+        
+    def planModeling(self,star_grid,time_per_model=dict()):
+        
+        '''
+        Make the execution plan of the grid.
+        
+        The command lists of all models in the grid are set up front, and 
+        resolved against the databases in one pass. The databases are 
+        synchronized once, and locked for the duration of the pass. 
+        
+        The sub-models are followed through the iterations the same way as in
+        startModeling(), on copies of the parameter sets. The mutable 
+        parameters of a parameter set are only updated from the output of 
+        models that are done. Sub-models of new models are new. 
+        
+        Once made, models the plan found in the databases are retrieved by
+        the modeling sessions without checking the databases again.
+        
+        @param star_grid: The parameter sets in the grid
+        @type star_grid: list[Star()] or StarGrid()
+        
+        @keyword time_per_model: The expected calculation time of one model 
+                                 per (sub)code, in minutes. See Planner().
+        
+                                 (default: dict())
+        @type time_per_model: dict(str: float)
+        
+        @return: The execution plan
+        @rtype: Planner()
+        
+        '''
+        
+        skip_codes = []
+        if self.skip_cooling: skip_codes.append('cooling')
+        if not self.sphinx: skip_codes.append('sphinx')
+        plan = Planner(num_stars=len(star_grid),\
+                       time_per_model=time_per_model,skip_codes=skip_codes)
+        dbs = []
+        dust_session, gas_session = None, None
+        if self.mcmax:
+            dust_session = MCMax(path_mcmax=self.path_mcmax,db=self.mcmax_db,\
+                                 replace_db_entry=self.replace_db_entry,\
+                                 single_session=1)
+            dbs.append(self.mcmax_db)
+        if self.gastronoom:
+            gas_session = Gastronoom(path_gastronoom=self.path_gastronoom,\
+                                     cool_db=self.cool_db,ml_db=self.ml_db,\
+                                     sph_db=self.sph_db,sphinx=self.sphinx,\
+                                     replace_db_entry=self.replace_db_entry,\
+                                     single_session=1)
+            dbs.extend([self.cool_db,self.ml_db,self.sph_db])
+        
+        #-- Synchronize once, then lock all databases during the pass.
+        for db in dbs: 
+            db.sync()
+        dbfiles = [db._open('r') for db in dbs]
+        try:
+            for star_index,star in enumerate(star_grid):
+                self.__planStar(plan,star,star_index,dust_session,gas_session)
+        finally:
+            for dbfile in dbfiles:
+                dbfile.close()
+        self.plan = plan
+        return plan
+        
+        
+        
+    def __planStar(self,plan,star,star_index,dust_session,gas_session):
+    
+        '''
+        Add the sub-models of one parameter set to the execution plan.
+        
+        @param plan: The execution plan
+        @type plan: Planner()
+        @param star: The parameter set
+        @type star: Star()
+        @param star_index: The index of the parameter set in the grid
+        @type star_index: int
+        @param dust_session: The MCMax session used for the command lists
+        @type dust_session: MCMax()
+        @param gas_session: The GASTRoNOoM session used for the command lists
+        @type gas_session: Gastronoom()
+        
+        '''
+        
+        #-- The parameter set is copied, as are the molecules, since mutable
+        #   parameters are updated along the way.
+        pstar = Star(path_gastronoom=self.path_gastronoom,\
+                     path_mcmax=self.path_mcmax,example_star=star,\
+                     print_check_t=0)
+        if self.gastronoom:
+            pstar['GAS_LIST'] = [copy(molec) for molec in star['GAS_LIST']]
+        lookup = not self.replace_db_entry
+        
+        #-- The model the next one depends on: its id if it is done, its plan
+        #   key otherwise. 
+        parent = ''
+        for i in range(self.iterations):
+            if self.mcmax:
+                dust_session.setCommandList(pstar)
+                done = not isinstance(parent,tuple)
+                model_id = done and lookup and dust_session.findModel() or ''
+                ip = model_id \
+                        and self.mcmax_db[model_id].has_key('IN_PROGRESS')
+                parent = plan.addModel('mcmax',star_index,\
+                                       dust_session.command_list,\
+                                       path=not done and (parent,) or (),\
+                                       model_id=model_id,in_progress=ip)
+                if not isinstance(parent,tuple):
+                    pstar['LAST_MCMAX_MODEL'] = parent
+                    pstar.removeMutableMCMax(dust_session.mutable,\
+                                             self.var_pars)
+                    pstar.update(self.input_dict)
+            
+            if not self.gastronoom \
+                    or ((i+1 == self.iterations) and not pstar['GAS_LIST']):
+                continue
+            gas_session.model_id = gas_session.makeNewId()
+            gas_session.setCommandList(pstar)
+            molec_dict = gas_session.setCoolingMolecules(pstar)[2]
+            query = gas_session.command_list.copy()
+            query.update(molec_dict)
+            done = not isinstance(parent,tuple)
+            model_id = done and lookup \
+                            and gas_session.findCoolingModel(molec_dict) or ''
+            ip = model_id and self.cool_db[model_id].has_key('IN_PROGRESS')
+            parent = plan.addModel('cooling',star_index,query,\
+                                   keywords=gas_session.cooling_keywords,\
+                                   path=not done and (parent,) or (),\
+                                   model_id=model_id,in_progress=ip)
+            if not isinstance(parent,tuple):
+                pstar['LAST_GASTRONOOM_MODEL'] = parent
+                pstar.removeMutableGastronoom(gas_session.mutable,\
+                                              self.var_pars)
+                pstar.update(self.input_dict)
+                pstar.updateMolecules(parlist=gas_session.mutable)
+            if i+1 != self.iterations:
+                continue
+            
+            #-- Mline and sphinx are only calculated in the last iteration. 
+            #   They are nested in the cooling model and the mline model 
+            #   respectively.
+            done = not isinstance(parent,tuple)
+            molec_ids = dict()
+            for molec in pstar['GAS_LIST']:
+                model_id = done and lookup \
+                            and gas_session.findMlineModel(parent,molec) or ''
+                ip = model_id and self.ml_db[parent][model_id]\
+                                            [molec.molecule]\
+                                            .has_key('IN_PROGRESS')
+                kws = gas_session.getMlineIndex(molec)[0]
+                molec_ids[molec.molecule] \
+                        = plan.addModel('mline',star_index,molec.makeDict(),\
+                                        keywords=kws,\
+                                        path=(parent,molec.molecule),\
+                                        model_id=model_id,in_progress=ip)
+            for trans in pstar['GAS_LINES']:
+                molec_id = molec_ids[trans.molecule.molecule]
+                model_id = ''
+                if done and lookup and not isinstance(molec_id,tuple):
+                    model_id = gas_session.findSphinxModel(parent,molec_id,\
+                                                           trans)
+                ip = model_id and self.sph_db[parent][molec_id][model_id]\
+                                             [str(trans)]\
+                                             .has_key('IN_PROGRESS')
+                plan.addModel('sphinx',star_index,trans.makeDict(),\
+                              keywords=gas_session.sphinx_keywords,\
+                              path=(parent,molec_id,str(trans)),\
+                              model_id=model_id,in_progress=ip)
         
         
         
@@ -193,7 +414,8 @@ class ModelingManager():
                                          db=self.mcmax_db,\
                                          new_entries=self.new_entries_mcmax,\
                                          replace_db_entry=self.replace_db_entry,\
-                                         single_session=self.single_session)
+                                         single_session=self.single_session,\
+                                         plan=self.plan)
                 self.mcmax_done = False
                 dust_session.doMCMax(star)
                 if dust_session.mcmax_done: 
@@ -230,7 +452,8 @@ class ModelingManager():
                 if i+1 == self.iterations or self.iterative:
                     dust_session.rayTrace(star)
                      
-                #-- Remember every iteration if iterative==True.
+                #-- Remember every iteration if iterative==True. A copy is
+                #   needed, since the star is changed in the next iteration.
                 if self.iterative:
                     self.star_grid_old[star_index].append(star.copy())
                 
@@ -246,7 +469,7 @@ class ModelingManager():
             if self.gastronoom:    
                 #- Initiate a gas session which is used for every iteration
                 if i == 0: 
-                    gas_session = Gastronoom(vic=self.vic,\
+                    gas_session = Gastronoom(batch=self.batch,\
                                         path_gastronoom=self.path_gastronoom,\
                                         cool_db=self.cool_db,\
                                         ml_db=self.ml_db,\
@@ -256,7 +479,8 @@ class ModelingManager():
                                         replace_db_entry=self.replace_db_entry,\
                                         new_entries=self.new_entries_cooling,\
                                         recover_sphinxfiles=self.recover_sphinxfiles,\
-                                        single_session=self.single_session)
+                                        single_session=self.single_session,\
+                                        pool=self.pool,plan=self.plan)
                     self.mline_done = False
                 #if self.mcmax_done:
                     #-- MCMax was ran successfully, in other words, quite a bit 
@@ -277,6 +501,11 @@ class ModelingManager():
                 #-- Otherwise, run cooling and do the rest of the loop
                 gas_session.doGastronoom(star)
                 
+                #-- The next iteration requires the cooling model, so wait for
+                #   it in case it was added to the local pool
+                if not self.pool is None and i+1 != self.iterations:
+                    self.pool.wait([gas_session.cool_task])
+                
                 #-- In case a cooling model was in progress, wait until 
                 #   finished. 
                 while gas_session.in_progress:
@@ -374,6 +603,11 @@ class ModelingManager():
                         gas_session.doSphinx(star)
                 print '***********************************'
         
+        #-- Check on the models in the local pool, and start those whose 
+        #   cooling and mline models are finished. 
+        if not self.pool is None:
+            self.pool.checkProgress()
+        
         #- remember trans bools if sphinx is enabled, so you can trace which 
         #- models have been calculated in this session and which were retrieved 
         #- from database. Also remember if mline was required to be ran this 
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+"""
+Execution plans for a grid of models.
+
+"""
+
+from cc.tools.io import Database
+
+
+
+class Planner():
+
+    """
+    The execution plan of a grid of models.
+
+    Every sub-model of every parameter set in the grid (MCMax, cooling, mline
+    and sphinx) is added to the plan with its database status: done, in
+    progress in a different session, or new. Identical sub-models shared by
+    several parameter sets are added only once.
+
+    A sub-model is identified by its (sub)code, the fingerprint of its
+    parameters (see Database.makeFingerprint()) and the path of the models it
+    depends on. If those are present in the databases, the path holds their
+    ids, as in the databases. Otherwise, it holds the plan key of the new model
+    it depends on. Sub-models of new models are new by definition.
+
+    The plan is made by ModelingManager.planModeling().
+
+    """
+
+    codes = ['mcmax','cooling','mline','sphinx']
+
+    def __init__(self,num_stars=0,time_per_model=dict(),skip_codes=[]):
+
+        """
+        Initializing a Planner instance.
+
+        @keyword num_stars: The number of parameter sets in the grid
+
+                            (default: 0)
+        @type num_stars: int
+        @keyword time_per_model: The expected calculation time of one model
+                                 per (sub)code, in minutes. Codes that are not
+                                 included are not accounted for in the cost.
+
+                                 (default: dict())
+        @type time_per_model: dict(str: float)
+        @keyword skip_codes: The (sub)codes for which new models are not
+                             calculated, eg sphinx when SPHINX=0.
+
+                             (default: [])
+        @type skip_codes: list[str]
+
+        """
+
+        self.time_per_model = time_per_model
+        self.skip_codes = skip_codes
+        self.models = dict()
+        self.order = []
+        self.known = dict()
+        self.stars = [[] for i in xrange(num_stars)]
+
+
+
+    def addModel(self,code,star_index,pars,keywords=None,path=(),\
+                 model_id='',in_progress=0):
+
+        '''
+        Add a sub-model of a parameter set to the plan.
+
+        @param code: The (sub)code of the model
+        @type code: string
+        @param star_index: The index of the parameter set in the grid
+        @type star_index: int
+        @param pars: The parameters of the model
+        @type pars: dict
+
+        @keyword keywords: The keywords that define the model. All if None.
+
+                           (default: None)
+        @type keywords: list[str]
+        @keyword path: The ids or plan keys of the models this model depends on
+
+                       (default: ())
+        @type path: tuple
+        @keyword model_id: The id of the model in the database, empty if it was
+                           not found.
+
+                           (default: '')
+        @type model_id: string
+        @keyword in_progress: The model is being calculated in a different
+                              session.
+
+                              (default: 0)
+        @type in_progress: bool
+
+        @return: The model id if the model is done, its plan key otherwise
+        @rtype: string or tuple
+
+        '''
+
+        key = (code,tuple(path),Database.makeFingerprint(pars,keywords))
+        if not self.models.has_key(key):
+            if not model_id:
+                status = 'new'
+            elif in_progress:
+                status = 'in_progress'
+            else:
+                status = 'done'
+                self.known[key] = model_id
+            self.models[key] = dict([('code',code),('model_id',model_id),\
+                                     ('status',status),('stars',[])])
+            self.order.append(key)
+        entry = self.models[key]
+        if star_index not in entry['stars']:
+            entry['stars'].append(star_index)
+            self.stars[star_index].append(key)
+        if entry['status'] == 'done':
+            return entry['model_id']
+        return key
+
+
+
+    def getModelId(self,code,pars,keywords=None,path=()):
+
+        '''
+        Get the id of a model that is done according to the plan.
+
+        @param code: The (sub)code of the model
+        @type code: string
+        @param pars: The parameters of the model
+        @type pars: dict
+
+        @keyword keywords: The keywords that define the model. All if None.
+
+                           (default: None)
+        @type keywords: list[str]
+        @keyword path: The ids of the models this model depends on
+
+                       (default: ())
+        @type path: tuple
+
+        @return: The model id, empty if the model is not done
+        @rtype: string
+
+        '''
+
+        key = (code,tuple(path),Database.makeFingerprint(pars,keywords))
+        return self.known.get(key,'')
+
+
+
+    def isDone(self,star_index):
+
+        '''
+        Are all sub-models of a parameter set done?
+
+        @param star_index: The index of the parameter set in the grid
+        @type star_index: int
+
+        @return: Nothing has to be calculated for this parameter set
+        @rtype: bool
+
+        '''
+
+        return not [key
+                    for key in self.stars[star_index]
+                    if self.models[key]['status'] != 'done']
+
+
+
+    def getCounts(self,status='new'):
+
+        '''
+        Count the unique sub-models in the plan with a given status per code.
+
+        @keyword status: The status: 'done', 'in_progress' or 'new'
+
+                         (default: 'new')
+        @type status: string
+
+        @return: The number of models per (sub)code
+        @rtype: dict(str: int)
+
+        '''
+
+        counts = dict([(code,0) for code in self.codes])
+        for key in self.order:
+            if self.models[key]['status'] == status:
+                counts[self.models[key]['code']] += 1
+        return counts
+
+
+
+    def getCost(self):
+
+        '''
+        Estimate the calculation time of the new models in the plan.
+
+        @return: The calculation time per (sub)code in minutes
+        @rtype: dict(str: float)
+
+        '''
+
+        counts = self.getCounts()
+        return dict([(code,counts[code]*self.time_per_model[code])
+                     for code in self.codes
+                     if self.time_per_model.has_key(code) \
+                        and code not in self.skip_codes])
+
+
+
+    def printPlan(self):
+
+        '''
+        Print an overview of the plan.
+
+        '''
+
+        done = self.getCounts('done')
+        in_progress = self.getCounts('in_progress')
+        new = self.getCounts('new')
+        cost = self.getCost()
+        print '***********************************'
+        print '** Execution plan for %i requested models.'%len(self.stars)
+        print '** %-8s %8s %12s %8s %8s %12s'\
+              %('Code','Done','In progress','New','Shared','Time [h]')
+        for code in self.codes:
+            keys = [key for key in self.order if key[0] == code]
+            if not keys: continue
+            shared = len([key
+                          for key in keys
+                          if self.models[key]['status'] == 'new' \
+                            and len(self.models[key]['stars']) > 1])
+            if code in self.skip_codes:
+                time = 'skipped'
+            elif cost.has_key(code):
+                time = '%.1f'%(cost[code]/60.)
+            else:
+                time = '-'
+            print '** %-8s %8i %12i %8i %8i %12s'\
+                  %(code,done[code],in_progress[code],new[code],shared,time)
+        print '** Total calculation time of new models: %.1f hours.'\
+              %(sum(cost.values())/60.)
+        todo = [i+1 for i in xrange(len(self.stars)) if not self.isDone(i)]
+        print '** %i out of %i requested models need calculations%s'\
+              %(len(todo),len(self.stars),todo and ':' or '.')
+        if todo:
+            print '** ' + ', '.join(['#%i'%i for i in todo])
+        print '***********************************'
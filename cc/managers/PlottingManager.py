@@ -144,7 +144,7 @@ class PlottingManager():
         (i.e. gastronoom and/or mcmax).
         
         @param star_grid: list of stars to be plotted
-        @type star_grid: list[Star()]
+        @type star_grid: list[Star()] or StarGrid()
         
         @keyword iterative: if true the old grids are plotted on a 
                             model_iteration per model_iteration basis, only
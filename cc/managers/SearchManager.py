@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+
+"""
+Adaptive refinement of a model grid around the best fit.
+
+"""
+
+import numpy as np
+
+from cc.modeling.objects.Star import StarGrid
+
+
+
+def getAxisScale(values):
+
+    '''
+    Determine the scale of a grid axis: logarithmic if its values are
+    positive and evenly spaced in logspace, linear otherwise.
+
+    Grids made with Gridding.makeGrid() do not remember if they were made in
+    logspace, so it is derived from the values.
+
+    @param values: The values on the axis
+    @type values: list[float]
+
+    @return: 'log' or 'lin'
+    @rtype: string
+
+    '''
+
+    values = np.sort(np.array(values,dtype=float))
+    if len(values) < 3 or values[0] <= 0:
+        return 'lin'
+    dlin = np.diff(values)
+    dlog = np.diff(np.log10(values))
+    if np.allclose(dlin,dlin[0],rtol=1e-3):
+        return 'lin'
+    if np.allclose(dlog,dlog[0],rtol=1e-3):
+        return 'log'
+    return 'lin'
+
+
+
+def refineAxis(value,coarse,level,scale='lin',make_int=0):
+
+    '''
+    Get the values around a point on a grid axis at the next refinement level.
+
+    The coarse cells on either side of the value are halved level+1 times.
+    Values outside the range of the coarse axis are not included.
+
+    @param value: The value of the point on the axis
+    @type value: float
+    @param coarse: The sorted values of the coarse axis
+    @type coarse: list[float]
+    @param level: The refinement level of the point. 0 for the coarse grid.
+    @type level: int
+
+    @keyword scale: 'lin' or 'log', the scale of the axis
+
+                    (default: 'lin')
+    @type scale: string
+    @keyword make_int: Round the values to integers
+
+                       (default: 0)
+    @type make_int: bool
+
+    @return: The values at the next level, including the value itself
+    @rtype: list[float]
+
+    '''
+
+    tf = scale == 'log' and np.log10 or (lambda x: x)
+    itf = scale == 'log' and (lambda x: 10**x) or (lambda x: x)
+    t = tf(value)
+    tc = tf(np.array(coarse,dtype=float))
+    eps = 1e-8*(tc[-1]-tc[0] or 1.)
+    values = [value]
+    for side in [-1,1]:
+        #-- The coarse cell on this side of the value
+        if side == -1:
+            i = np.searchsorted(tc,t-eps)
+            if i == 0: continue
+        else:
+            i = np.searchsorted(tc,t+eps,side='right')
+            if i == len(tc): continue
+        new = itf(t+side*(tc[i]-tc[i-1])/2.**(level+1))
+        #-- Rounded, so points reached from different cells are identical
+        if make_int:
+            new = int(round(new))
+        else:
+            new = float('%.10g'%new)
+        if new != value and new not in values:
+            values.append(new)
+    return sorted(values)
+
+
+
+class SearchManager():
+
+    """
+    An iterative search for the best fit model.
+
+    A coarse grid is ran and scored with the statistics modules of the
+    ComboCode session. The cells around the best fit models are then refined
+    recursively: the grid spacing of every multiplicative axis is halved around
+    the best points, and only the new points are calculated. The model
+    databases are used as always, so points that were calculated before are
+    retrieved rather than calculated.
+
+    Models are scored with the chi^2 of the SED and unresolved line
+    statistics, or with the loglikelihood of the resolved lines (lower scores
+    are better).
+
+    """
+
+    def __init__(self,session,levels=3,num_best=1,stat='chi2'):
+
+        """
+        Initializing a SearchManager instance.
+
+        @param session: The ComboCode session. Its star_grid is the coarse grid
+        @type session: ComboCode()
+
+        @keyword levels: The number of refinement levels after the coarse grid
+
+                         (default: 3)
+        @type levels: int
+        @keyword num_best: The number of best fit models refined per level
+
+                           (default: 1)
+        @type num_best: int
+        @keyword stat: The score of a model: 'chi2' for the sum of the SED and
+                       unresolved line chi^2, 'lll' for the loglikelihood of
+                       the resolved lines.
+
+                       (default: 'chi2')
+        @type stat: string
+
+        """
+
+        self.session = session
+        self.levels = int(levels)
+        self.num_best = int(num_best)
+        self.stat = stat.lower()
+        if self.stat not in ['chi2','lll']:
+            raise IOError('SEARCH_STAT must be chi2 or lll.')
+        grid = session.star_grid
+        self.base_star = grid.base_star
+        self.additive = grid.additive
+        self.keys = [k for k,v in grid.axes]
+        self.coarse = [sorted(v) for k,v in grid.axes]
+        self.scales = [getAxisScale(v) for v in self.coarse]
+        #-- Linear axes with integer values stay integer when refined
+        self.make_int = [scale == 'lin' \
+                            and all([float(vi).is_integer() for vi in v])
+                         for v,scale in zip(self.coarse,self.scales)]
+        self.star_pars = grid.star_pars
+
+        #-- The evaluated points: key is (additive index, axis values), value
+        #   is a list with the Star(), its score and the refinement level. The
+        #   level of a point increases every time its cells are refined.
+        self.points = dict()
+        self.order = []
+        self.num_db = 0
+        self.num_levels = 0
+
+
+
+    def startSearch(self):
+
+        '''
+        Run the search: the coarse grid, followed by the refinement levels.
+
+        The star_grid of the session is set to all evaluated models when the
+        search is done.
+
+        '''
+
+        coarse = [(a,) + tuple(vals)
+                  for a in xrange(len(self.additive))
+                  for vals in self.__product(self.coarse)]
+        self.evaluatePoints(coarse)
+        for level in xrange(1,self.levels+1):
+            new = dict()
+            for point in self.getBestPoints():
+                plevel = self.points[point][2]
+                for p in self.refinePoint(point):
+                    if not self.points.has_key(p) and not new.has_key(p):
+                        new[p] = plevel+1
+                self.points[point][2] = plevel+1
+            if not new:
+                print 'No new points to refine. Stopping the search.'
+                break
+            self.evaluatePoints(sorted(new.keys()),levels=new)
+            self.num_levels = level
+        self.session.star_grid = [self.points[p][0] for p in self.order]
+        self.printSearch()
+
+
+
+    def evaluatePoints(self,points,levels=dict()):
+
+        '''
+        Calculate and score the models for a list of points in the grid.
+
+        @param points: The points: (additive index, axis values)
+        @type points: list[tuple]
+
+        @keyword levels: The refinement level per point. 0 if not included.
+
+                         (default: dict())
+        @type levels: dict
+
+        '''
+
+        print '***********************************'
+        print '** Search: calculating %i models.'%len(points)
+        print '***********************************'
+        sets = [dict(self.additive[p[0]],**dict(zip(self.keys,p[1:])))
+                for p in points]
+        session = self.session
+        session.star_grid = StarGrid(base_star=self.base_star,additive=sets,\
+                                     **self.star_pars)
+        session.setBatchManager()
+        session.setModelManager()
+        session.planModelManager()
+        plan = session.model_manager.plan
+        if not plan is None:
+            self.num_db += len([i for i in xrange(len(points)) 
+                                if plan.isDone(i)])
+        session.runModelManager()
+        session.finalizeBatch()
+        session.runStatistics()
+        stars = list(session.star_grid)
+        scores = self.getScores(stars)
+        for p,star,score in zip(points,stars,scores):
+            self.points[p] = [star,score,levels.get(p,0)]
+            self.order.append(p)
+
+
+
+    def getScores(self,stars):
+
+        '''
+        Get the scores of the models from the statistics of the session.
+
+        Models without statistics get an infinite score. This includes models
+        without integrated fluxes to compare with the unresolved data, which
+        get a chi2 of 0 from UnresoStats.
+
+        @param stars: The models
+        @type stars: list[Star()]
+
+        @return: The scores, lower is better
+        @rtype: array
+
+        '''
+
+        session = self.session
+        scores = np.zeros(len(stars))
+        found = np.zeros(len(stars),dtype=bool)
+        index = dict([(id(s),i) for i,s in enumerate(stars)])
+        if self.stat == 'chi2':
+            for ss in session.sedstats.values():
+                for s,chi2 in zip(ss.star_grid,ss.chi2):
+                    i = index[id(s)]
+                    scores[i] += chi2
+                    found[i] = True
+            for ss in session.unresostats:
+                instr = ss.instrument.instrument.upper()
+                for i,s in enumerate(stars):
+                    #-- A chi2 of 0 means no integrated fluxes were available
+                    #   for this model: not a perfect fit.
+                    chi2 = ss.chi2_inttot.get(s['LAST_%s_MODEL'%instr])
+                    if not chi2: continue
+                    scores[i] += chi2
+                    found[i] = True
+        else:
+            for ss in session.resostats.values():
+                for st,llls in ss.loglikelihood.items():
+                    for s,lll in zip(ss.star_selection[st],llls):
+                        i = index[id(s)]
+                        scores[i] -= lll
+                        found[i] = True
+        scores[~found] = np.inf
+        return scores
+
+
+
+    def getBestPoints(self):
+
+        '''
+        Get the best points evaluated so far.
+
+        @return: The points with the lowest scores
+        @rtype: list[tuple]
+
+        '''
+
+        ranked = sorted([p for p in self.order
+                         if np.isfinite(self.points[p][1])],\
+                        key=lambda p: self.points[p][1])
+        return ranked[:self.num_best]
+
+
+
+    def refinePoint(self,point):
+
+        '''
+        Get the points of the refined cells around a point.
+
+        @param point: The point: (additive index, axis values)
+        @type point: tuple
+
+        @return: The points at the next level, including the point itself
+        @rtype: list[tuple]
+
+        '''
+
+        level = self.points[point][2]
+        axes = [refineAxis(v,c,level,scale,make_int)
+                for v,c,scale,make_int in zip(point[1:],self.coarse,\
+                                              self.scales,self.make_int)]
+        return [(point[0],) + tuple(vals) for vals in self.__product(axes)]
+
+
+
+    def getFineGridSize(self):
+
+        '''
+        Get the size of the full grid at the finest resolution reached by the
+        search.
+
+        @return: The number of models in the fine grid
+        @rtype: int
+
+        '''
+
+        level = max([v[2] for v in self.points.values()] or [0])
+        size = len(self.additive)
+        for c,make_int in zip(self.coarse,self.make_int):
+            n = (len(c)-1)*2**level+1
+            if make_int:
+                n = min(n,int(round(max(c)-min(c)))+1)
+            size *= n
+        return size
+
+
+
+    def printSearch(self):
+
+        '''
+        Print the best fit model and the number of runs saved with respect to
+        the full grid at the finest resolution.
+
+        '''
+
+        fine = self.getFineGridSize()
+        done = len(self.order)
+        print '***********************************'
+        print '** Search finished after %i refinement levels.'%self.num_levels
+        best = self.getBestPoints()
+        if best:
+            p = best[0]
+            print '** Best fit model (score %.4g):'%self.points[p][1]
+            for k,v in zip(self.keys,p[1:]):
+                print '** %s = %s'%(k,v)
+            if len(self.additive) > 1:
+                print '** Additive parameter set #%i'%(p[0]+1)
+        print '** %i models evaluated, of which %i were fully retrieved '\
+              %(done,self.num_db) + 'from the databases.'
+        print '** The full grid at this resolution has %i models: %i runs '\
+              %(fine,fine-done) + 'saved (%.1f%%).'\
+              %(100.*(fine-done)/fine)
+        print '***********************************'
+
+
+
+    def __product(self,axes):
+
+        '''
+        The Cartesian product of axis values, last axis varying fastest.
+
+        @param axes: The values per axis
+        @type axes: list[list]
+
+        @return: The combinations
+        @rtype: list[tuple]
+
+        '''
+
+        combos = [()]
+        for values in axes:
+            combos = [c + (v,) for c in combos for v in values]
+        return combos
@@ -0,0 +1,87 @@
+"""
+Unit test covering the polling of the scheduler in managers.Batch.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import cc.path
+from cc.managers import Batch
+
+
+
+class SphinxDb(object):
+
+    """A sphinx database that is only synced, as Database()"""
+
+    def __init__(self):
+        self.num_syncs = 0
+
+    def sync(self):
+        self.num_syncs += 1
+
+
+
+class PollTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.gastronoom = cc.path.gastronoom
+        cc.path.gastronoom = os.path.join(self.path,'home')
+        self.backend = Batch.FakeBackend(os.path.join(self.path,'cluster'),\
+                                         delay=2,run_tasks=0)
+        self.batch = Batch.Batch(self.backend)
+        self.batch.setSphinxDb(SphinxDb())
+
+        #-- A model with a job in the queue, and its folder on the cluster
+        self.batch.addModel('model_2015-01-01h10-00-00',{})
+        self.batch.queueModel()
+        self.remote = self.batch.getRemoteFolder(0)
+        os.makedirs(self.remote)
+        self.batch.jobs[0] = self.backend.submit(script='job.sh',\
+                                                 num_tasks=1,walltime=30,\
+                                                 name='test')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        cc.path.gastronoom = self.gastronoom
+
+    def testFailedPoll(self):
+        """ Models are not finalized when the scheduler cannot be polled """
+        self.backend.fail_polls = 2
+        self.assertTrue(self.batch.checkProgress())
+        self.assertTrue(self.batch.checkProgress())
+        self.assertEqual(self.batch.getQueue(),[(0,self.batch.models[0])])
+        self.assertTrue(os.path.isdir(self.remote))
+        #-- The job is still in the queue once the scheduler is back
+        self.assertTrue(self.batch.checkProgress())
+        self.assertTrue(os.path.isdir(self.remote))
+        self.assertFalse(self.batch.checkProgress())
+        self.assertEqual(self.batch.getQueue(),[])
+        self.assertFalse(os.path.isdir(self.remote))
+        self.assertEqual(self.backend.num_polls,4)
+
+    def testSchedulerDown(self):
+        """ Failed or unparseable scheduler output is not an empty queue """
+        for backend in [Batch.SlurmBackend,Batch.PbsBackend]:
+            down = backend(remote_path=self.path)
+            down.execute = lambda command: (255,'')
+            self.assertTrue(down.poll() is None)
+            down.execute = lambda command: (0,'Connection closed\n')
+            self.assertTrue(down.poll() is None)
+            down.execute = lambda command: (0,'')
+            self.assertEqual(down.poll(),set())
+        slurm = Batch.SlurmBackend(remote_path=self.path)
+        slurm.execute = lambda command: (0,'1234\n1240\n')
+        self.assertEqual(slurm.poll(),set(['1234','1240']))
+        pbs = Batch.PbsBackend(remote_path=self.path)
+        pbs.execute = lambda command: (0,'\nJob ID  Username\n-----\n'+\
+                                         '1234[].server  user\n')
+        self.assertEqual(pbs.poll(),set(['1234']))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+Unit test covering the finalization of tasks in managers.LocalPool.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cc.managers import LocalPool
+
+#-- Stand-ins for the GASTRoNOoM subcodes: cooling succeeds, mline fails
+STUB_SUBCODES = [('cooling','#!/bin/sh\nexit 0\n'),\
+                 ('mline','#!/bin/sh\nexit 1\n')]
+
+
+
+class Finalize(object):
+
+    """A finalize function that records its calls, and returns success"""
+
+    def __init__(self,success=True,error=None):
+        self.success = success
+        self.error = error
+        self.num_calls = 0
+
+    def __call__(self):
+        self.num_calls += 1
+        if not self.error is None:
+            raise self.error
+        return self.success
+
+
+
+class FinalizeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for subcode,script in STUB_SUBCODES:
+            fn = os.path.join(self.path,subcode)
+            with open(fn,'w') as f:
+                f.write(script)
+            os.chmod(fn,0755)
+        self.environ_path = os.environ['PATH']
+        os.environ['PATH'] = os.pathsep.join([self.path,self.environ_path])
+        self.pool = LocalPool.LocalPool(num_workers=1)
+
+    def tearDown(self):
+        self.pool.finalizePool()
+        os.environ['PATH'] = self.environ_path
+        shutil.rmtree(self.path)
+
+    def addTask(self,subcode='cooling',**kwargs):
+        return self.pool.addTask(subcode=subcode,\
+                                 filename=os.path.join(self.path,'model.inp'),\
+                                 workdir=self.path,**kwargs)
+
+    def testSuccess(self):
+        """ A task is done if the subcode and all finalize functions are """
+        finalize = [Finalize(),Finalize()]
+        task_id = self.addTask(finalize=finalize[0])
+        self.pool.addFinalize(task_id,finalize[1])
+        self.pool.wait()
+        self.assertEqual(self.pool.tasks[task_id]['status'],'done')
+        self.assertEqual([f.num_calls for f in finalize],[1,1])
+
+    def testFailedSubcode(self):
+        """ A task fails if the subcode does, whatever the finalize returns """
+        finalize = Finalize()
+        task_id = self.addTask(subcode='mline',finalize=finalize)
+        self.pool.wait()
+        self.assertEqual(self.pool.tasks[task_id]['status'],'failed')
+        self.assertEqual(finalize.num_calls,1)
+
+    def testFailedFinalize(self):
+        """ A task fails if its second finalize function fails """
+        finalize = [Finalize(),Finalize(success=False),Finalize()]
+        task_id = self.addTask(finalize=finalize[0])
+        self.pool.addFinalize(task_id,finalize[1])
+        self.pool.addFinalize(task_id,finalize[2])
+        dep_finalize = Finalize()
+        dep_id = self.addTask(finalize=dep_finalize,depends=[task_id])
+        self.pool.wait()
+        self.assertEqual(self.pool.tasks[task_id]['status'],'failed')
+        self.assertEqual([f.num_calls for f in finalize],[1,1,1])
+        #-- The dependent task is not ran, but still finalized
+        self.assertEqual(self.pool.tasks[dep_id]['status'],'failed')
+        self.assertEqual(dep_finalize.num_calls,1)
+
+    def testRaisingFinalize(self):
+        """ An error in a finalize function fails the task, not the pool """
+        finalize = [Finalize(error=IOError('Database is locked.')),Finalize()]
+        task_id = self.addTask(finalize=finalize[0])
+        self.pool.addFinalize(task_id,finalize[1])
+        other_id = self.addTask()
+        self.pool.wait()
+        self.assertEqual(self.pool.tasks[task_id]['status'],'failed')
+        self.assertEqual(self.pool.tasks[other_id]['status'],'done')
+        self.assertEqual([f.num_calls for f in finalize],[1,1])
+        #-- Also when added to a task that is already finished
+        late = Finalize(error=ValueError('No such entry.'))
+        self.pool.addFinalize(other_id,late)
+        self.assertEqual(late.num_calls,1)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
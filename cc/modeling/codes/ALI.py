@@ -8,7 +8,11 @@ Author: R. Lombaert
 """
 
 import os
+import time
+import signal
+import cPickle
 import subprocess      
+import numpy as np
 
 import cc.path
 from cc.tools.io import DataIO
@@ -17,7 +21,9 @@ from cc.modeling.physics import EnergyBalance as EB
 
 
 def runEB_ALI(afn,ai=0,ei=0,iTmax=200,iter_conv=0,ALI_args=[],iterT_kwargs={},\
-              runALIinit=0,iter_texguess=0.9,eb=None,*args,**kwargs):
+              runALIinit=0,iter_texguess=0.9,eb=None,accel='none',\
+              accel_depth=3,adapt_damping=0,checkpoint=0,resume=0,\
+              ALI_workers=0,*args,**kwargs):
 
     '''
     Run the energy balance module concurrently with the ALI RT code. 
@@ -73,6 +79,34 @@ def runEB_ALI(afn,ai=0,ei=0,iTmax=200,iter_conv=0,ALI_args=[],iterT_kwargs={},\
     this function, you can also pass this, and the method will continue with 
     that object instead. Make sure to adapt your iTmax and such to this object.
     
+    The ALI + EB iteration is a fixed-point iteration of T(r). It can be 
+    accelerated with Anderson mixing of the successive T(r) profiles (in 
+    log(T)): the profile for the next ALI run and EB iteration combines the 
+    last accel_depth EB results so as to minimize the residual between EB 
+    input and output (see Mixer). The mixing history is restarted when the 
+    residual grows. The accelerated iteration stops as soon as the maximum 
+    relative residual drops below the conv criterion of iterT, or when the EB
+    needs only one step to converge, as without acceleration. Next to that,
+    the damping dTmax of the EB temperature iteration can be adapted after 
+    every ALI + EB iteration based on the history of T(r) in the EB (see 
+    getDamping). The residual, the convergence rate and the damping are 
+    printed after every iteration. 
+    
+    If checkpoint is on, a checkpoint is written (ALI inputfile with 
+    '_iter.chk') after every ALI run and every EB iteration, holding the T 
+    profiles, the populations files, the iteration counters and the mixing 
+    history, and the residuals are appended to a log file (ALI inputfile with
+    '_conv.log'). If resume is on, an interrupted run is restarted from the 
+    last completed ALI run: a new EB object is made (or the given one is 
+    used), its T profile and populations are set from the checkpoint, and the
+    iteration continues. The checkpoint is removed when the iteration is 
+    done.
+    
+    The ALI runs for the different molecules are independent given T(r), and 
+    are ran concurrently, with at most ALI_workers runs at the same time (see
+    execALIs). The populations of a molecule are read in the EB as soon as its
+    ALI run finishes. 
+    
     @param afn: The inputfile name for ALI. One filename given as a string in 
                 case of one molecule, multiple filenames given as strings in a 
                 list in case of multiple molecules. 
@@ -146,6 +180,38 @@ def runEB_ALI(afn,ai=0,ei=0,iTmax=200,iter_conv=0,ALI_args=[],iterT_kwargs={},\
                  
                  (default: None)
     @type eb: EnergyBalance()
+    @keyword accel: The acceleration of the ALI + EB iteration: 'anderson', 
+                    'aitken' (Anderson mixing with depth 1, ie the vector 
+                    form of Aitken's delta-squared method) or 'none' for the 
+                    plain fixed-point iteration.
+                    
+                    (default: 'none')
+    @type accel: str
+    @keyword accel_depth: The number of previous iterations used by the 
+                          Anderson mixing.
+                          
+                          (default: 3)
+    @type accel_depth: int
+    @keyword adapt_damping: Adapt the damping dTmax of the EB temperature 
+                            iteration after every ALI + EB iteration. The 
+                            first value is dTmax in iterT_kwargs.
+                            
+                            (default: 0)
+    @type adapt_damping: bool
+    @keyword checkpoint: Write a checkpoint after every ALI run and EB 
+                         iteration, and log the residuals.
+                         
+                         (default: 0)
+    @type checkpoint: bool
+    @keyword resume: Restart from the checkpoint if one is present. 
+    
+                     (default: 0)
+    @type resume: bool
+    @keyword ALI_workers: The maximum number of ALI runs at the same time. 
+                          Default if all molecules are ran at once.
+                          
+                          (default: 0)
+    @type ALI_workers: int
     
     @return: The EnergyBalance object is returned with all its properties.
     @rtype: EnergyBalance()
@@ -161,11 +227,26 @@ def runEB_ALI(afn,ai=0,ei=0,iTmax=200,iter_conv=0,ALI_args=[],iterT_kwargs={},\
     #-- Step 1: Calculate ALI given the pre-defined inputfile for all molecules
     if isinstance(afn,str): afn = [afn]
     if not eb is None: runALIinit = 0
+    
+    #-- Filenames for ALI input and Tkin, the checkpoint and the log
+    fnT = afn[0].replace('.inp','_iter.temp')
+    fn_new = [ifn.replace('.inp','_iter.inp') for ifn in afn]
+    fn_pop = [ifn_new.replace('.inp','.pop') for ifn_new in fn_new]
+    fn_chk = afn[0].replace('.inp','_iter.chk')
+    fn_log = afn[0].replace('.inp','_conv.log')
+    
+    #-- Check for a checkpoint to resume from
+    state = readCheckpoint(fn_chk) if resume else None
+    if not state is None: 
+        print('Resuming ALI + EB from checkpoint {} '.format(fn_chk) + \
+              '(iteration {}, after {}).'.format(state['i'],state['phase']))
+        runALIinit = 0
+    
     if runALIinit:
         print('--------------------------------------------')
         print('Running first guess for ALI.')
         print('--------------------------------------------')
-        for ifn in afn: execALI(ifn,args=ALI_args)
+        execALIs(afn,args=ALI_args,workers=ALI_workers)
     
     #-- Step 2: Set up the EnergyBalance object. 
     if eb is None:
@@ -182,22 +263,39 @@ def runEB_ALI(afn,ai=0,ei=0,iTmax=200,iter_conv=0,ALI_args=[],iterT_kwargs={},\
     else: 
         iterT_kwargs['imax'] = eb.i + ei if int(ei) else eb.i+imax
     
-    #-- Step 3: Run the EnergyBalance
-    m = 'next' if not eb is None else 'first'
-    print('--------------------------------------------')
-    print('Running {} guess of EnergyBalance (EB).'.format(m))
-    print('--------------------------------------------')
-    eb.iterT(**iterT_kwargs)
-    
-    #-- Prep step 4: Create new filenames for ALI input and Tkin
-    fnT = afn[0].replace('.inp','_iter.temp')
-    fn_new = [ifn.replace('.inp','_iter.inp') for ifn in afn]
+    #-- Step 3: Run the EnergyBalance, or restore its state from the 
+    #           checkpoint. In the latter case, the counters of the new EB 
+    #           start anew, so shift iTmax accordingly.
+    if state is None:
+        m = 'next' if not eb is None else 'first'
+        print('--------------------------------------------')
+        print('Running {} guess of EnergyBalance (EB).'.format(m))
+        print('--------------------------------------------')
+        eb.iterT(**iterT_kwargs)
+        i, x, skip_ali = 1, eb.T.eval(), 0
+        mixer = Mixer(accel=accel,depth=accel_depth)
+        dTmax = iterT_kwargs.get('dTmax',0.10)
+        history = []
+    else:
+        eb.setTProfile(state['T'])
+        if state['phase'] == 'ali':
+            for m,ifn_pop in zip(eb.molecules,state['pop']):
+                eb.updatePop(m=m,fn=ifn_pop)
+        iTmax = iTmax - state['eb_i'] + eb.i
+        i, x, skip_ali = state['i'], state['x'], state['phase'] == 'ali'
+        mixer, dTmax, history = state['mixer'], state['dTmax'], state['log']
+    
+    #-- Read the populations of a molecule when its ALI run is done
+    def readPop(j): 
+        eb.updatePop(m=eb.molecules[j],fn=fn_pop[j])
     
     #-- Step 4: Iterate between steps 2 and 3 until the temperature iteration
-    #           needs only 1 step to converge. Note that ei cannot be 1 for this
-    #           to work.
+    #           needs only 1 step to converge, or until the residual of the 
+    #           accelerated iteration is small enough. Note that ei cannot be 1 
+    #           for this to work.
     ei = 2 if int(ei) == 1 else int(ei)    
-    i, iT, iter_texguess = 1, -2, float(iter_texguess)
+    iT, iter_texguess = -2, float(iter_texguess)
+    conv = iterT_kwargs.get('conv',0.01)
     while eb.i != iT + 1 and eb.i <= iTmax:
         print('--------------------------------------------')
         print('Running iteration {} of ALI + EB. Current EB'.format(i) + \
@@ -207,31 +305,60 @@ def runEB_ALI(afn,ai=0,ei=0,iTmax=200,iter_conv=0,ALI_args=[],iterT_kwargs={},\
         #-- Remember the current temperature iteration
         iT = eb.i
         
-        #-- Step 2':
+        #-- Step 2' and 3':
         #-- Update the ALI inputfiles and run. This overwrites the previous temp
         #   and pop files. You have access to both pops and temps of all 
         #   iterations through eb.pop[i] and eb.T_iter[i], respectively, with i  
         #   the iteration. Also sets the (maybe) new convergence criterion, new 
-        #   Tkin/pop filename, and TexGuess to -1.
-        DataIO.writeCols(filename=fnT,cols=[eb.r,eb.T.eval()])
-        for ifn,ifn_new in zip(afn,fn_new):
-            updateInputfile(fn=ifn,fnT=fnT,ai=ai,conv=iter_conv,\
-                            texguess=iter_texguess,fn_new=ifn_new)
-            execALI(ifn_new,args=ALI_args)
-        
-        #-- Step 3':
-        #-- Update the level populations for all molecules. 
-        for m,ifn_new in zip(eb.molecules,fn_new):
-            eb.updatePop(m=m,fn=ifn_new.replace('.inp','.pop'))
+        #   Tkin/pop filename, and TexGuess to -1. The temperature is the 
+        #   mixed profile if the iteration is accelerated. The level 
+        #   populations are updated for every molecule as its run finishes. 
+        #   When resuming after the ALI runs, they were read already.
+        if not skip_ali:
+            DataIO.writeCols(filename=fnT,cols=[eb.r,x])
+            for ifn,ifn_new in zip(afn,fn_new):
+                updateInputfile(fn=ifn,fnT=fnT,ai=ai,conv=iter_conv,\
+                                texguess=iter_texguess,fn_new=ifn_new)
+            execALIs(fn_new,args=ALI_args,workers=ALI_workers,callback=readPop)
+            if checkpoint:
+                writeCheckpoint(fn_chk,phase='ali',i=i,eb_i=eb.i,\
+                                T=eb.T.eval(),x=x,pop=fn_pop,mixer=mixer,\
+                                dTmax=dTmax,log=history)
+        skip_ali = 0
         
         #-- Only if ei is not zero, limit the maximum amount of iterations.
         #   Otherwise set it to imax or the default of imax, in addition to the
         #   current iteration
         iterT_kwargs['imax'] = eb.i+ei if int(ei) else eb.i+imax
+        if adapt_damping: iterT_kwargs['dTmax'] = dTmax
+        
+        #-- The EB starts from the mixed profile if the iteration is 
+        #   accelerated, so its output is a function of that profile only.
+        if mixer.accel != 'none': eb.setTProfile(x)
         eb.iterT(**iterT_kwargs)
-
+        
+        #-- The residual of this iteration, and the T profile for the next one
+        g = eb.T.eval()
+        res = np.max(np.abs(1.-g/x))
+        x = mixer.update(x,g)
+        if adapt_damping: dTmax = getDamping(eb,iT,dTmax)
+        rate = res/history[-1][1] if history and history[-1][1] else np.nan
+        history.append((i,res,rate,dTmax,mixer.getDepth()))
+        line = 'ALI + EB iteration {}: residual {:.3e}, rate {:.3f}, '\
+               .format(i,res,rate) + 'EB damping {:.3f}, '.format(dTmax) + \
+               'mixing depth {}.'.format(mixer.getDepth())
+        print(line)
+        if checkpoint:
+            DataIO.writeFile(filename=fn_log,input_lines=[line+'\n'],mode='a',\
+                             delimiter='')
+        
         #-- Increase the EB+ALI iteration index.
         i += 1
+        if checkpoint:
+            writeCheckpoint(fn_chk,phase='eb',i=i,eb_i=eb.i,T=g,x=x,\
+                            pop=fn_pop,mixer=mixer,dTmax=dTmax,log=history)
+        if mixer.accel != 'none' and res < conv:
+            break
     
     #-- If the temperature iteration reaches convergence, run the original ALI
     #   inputfile again, with updated T and pop files (ie with the original 
@@ -242,12 +369,201 @@ def runEB_ALI(afn,ai=0,ei=0,iTmax=200,iter_conv=0,ALI_args=[],iterT_kwargs={},\
     DataIO.writeCols(filename=fnT,cols=[eb.r,eb.T.eval()])
     for ifn,ifn_new in zip(afn,fn_new):
         updateInputfile(fn=ifn,fnT=fnT,texguess=iter_texguess,fn_new=ifn_new)
-        execALI(ifn_new,args=ALI_args)
+    execALIs(fn_new,args=ALI_args,workers=ALI_workers)
+    if checkpoint and os.path.isfile(fn_chk):
+        os.remove(fn_chk)
 
     return eb
     
     
     
+class Mixer(object):
+
+    '''
+    Anderson mixing of the successive temperature profiles of a fixed-point
+    iteration x -> g(x).
+    
+    The mixing is done in log(T), which keeps the profiles positive. The next
+    profile is the combination of the last depth results g that minimizes 
+    the linearized residual g-x in the least-squares sense. With depth 1 this 
+    is the vector form of Aitken's delta-squared method. The history is 
+    restarted if the residual grows.
+    
+    '''
+    
+    def __init__(self,accel='anderson',depth=3):
+    
+        '''
+        Initializing a Mixer instance.
+        
+        @keyword accel: 'anderson', 'aitken' (depth 1) or 'none', in which 
+                        case the next profile is simply g.
+                        
+                        (default: 'anderson')
+        @type accel: str
+        @keyword depth: The number of previous iterations used for mixing.
+        
+                        (default: 3)
+        @type depth: int
+        
+        '''
+        
+        self.accel = str(accel).lower()
+        if self.accel not in ['anderson','aitken','none']:
+            raise ValueError('accel must be anderson, aitken or none.')
+        self.depth = 1 if self.accel == 'aitken' else int(depth)
+        self.x = None
+        self.f = None
+        self.dx = []
+        self.df = []
+        
+        
+        
+    def update(self,x,g):
+    
+        '''
+        Get the next profile from the last input and output profiles.
+        
+        @param x: The input profile of the last iteration (K)
+        @type x: array
+        @param g: The output profile of the last iteration (K)
+        @type g: array
+        
+        @return: The input profile for the next iteration (K)
+        @rtype: array
+        
+        '''
+        
+        if self.accel == 'none':
+            return g
+        lx, f = np.log(x), np.log(g)-np.log(x)
+        if not self.f is None:
+            if np.linalg.norm(f) > np.linalg.norm(self.f):
+                self.dx, self.df = [], []
+            else:
+                self.dx.append(lx-self.x)
+                self.df.append(f-self.f)
+                self.dx, self.df = self.dx[-self.depth:], self.df[-self.depth:]
+        self.x, self.f = lx, f
+        
+        #-- The plain step, corrected with the least-squares combination of 
+        #   the previous steps.
+        lnew = lx + f
+        if self.df:
+            DF = np.array(self.df).T
+            DX = np.array(self.dx).T
+            #-- rcond=-1: machine precision, valid for all numpy versions
+            gamma = np.linalg.lstsq(DF,f,rcond=-1)[0]
+            lnew = lnew - np.dot(DX+DF,gamma)
+        return np.exp(lnew)
+        
+        
+        
+    def getDepth(self):
+    
+        '''
+        Get the number of previous iterations used in the last mixing step.
+        
+        @return: The current depth
+        @rtype: int
+        
+        '''
+        
+        return len(self.df)
+        
+        
+        
+def getDamping(eb,i0,dTmax,dTmin=0.01):
+
+    '''
+    Adapt the damping of the EB temperature iteration based on the history of
+    T(r) kept in the EB since a given iteration. 
+    
+    The damping is halved if the last change of T(r) in the EB grew with 
+    respect to the one before, or if it reversed sign in most radial points 
+    (oscillation). It is increased by 50% if the change decreased by more than
+    half. 
+    
+    @param eb: The EnergyBalance object
+    @type eb: EnergyBalance()
+    @param i0: The first EB iteration taken into account
+    @type i0: int
+    @param dTmax: The current damping
+    @type dTmax: float
+    
+    @keyword dTmin: The minimum damping
+    
+                    (default: 0.01)
+    @type dTmin: float
+    
+    @return: The new damping, between dTmin and 1
+    @rtype: float
+    
+    '''
+    
+    its = sorted([k for k in eb.T_iter.keys() if k >= i0-1])
+    if len(its) < 3: 
+        return dTmax
+    T = np.array([eb.T_iter[k].eval(inner_eps=eb.inner_eps,warn=0) 
+                  for k in its[-3:]])
+    d = np.diff(np.log(T),axis=0)
+    n = np.max(np.abs(d),axis=1)
+    flips = np.mean(d[0]*d[1] < 0)
+    if n[1] > n[0] or flips > 0.5:
+        return max(dTmin,0.5*dTmax)
+    if n[1] < 0.5*n[0]:
+        return min(1.,1.5*dTmax)
+    return dTmax
+    
+    
+
+def writeCheckpoint(fn,**state):
+
+    '''
+    Write the state of the ALI + EB iteration to a checkpoint file. 
+    
+    The file is written to a temporary file first, and then moved in place, 
+    so an interrupted write never leaves a broken checkpoint.
+    
+    @param fn: The checkpoint filename
+    @type fn: str
+    
+    @keyword state: The state of the iteration. See runEB_ALI.
+    @type state: dict
+    
+    '''
+    
+    tmpfn = '{}_{}'.format(fn,os.getpid())
+    tfile = open(tmpfn,'wb')
+    cPickle.dump(state,tfile,cPickle.HIGHEST_PROTOCOL)
+    tfile.close()
+    os.rename(tmpfn,fn)
+    
+    
+
+def readCheckpoint(fn):
+
+    '''
+    Read the state of the ALI + EB iteration from a checkpoint file.
+    
+    @param fn: The checkpoint filename
+    @type fn: str
+    
+    @return: The state of the iteration, None if there is no checkpoint
+    @rtype: dict
+    
+    '''
+    
+    if not os.path.isfile(fn):
+        return None
+    tfile = open(fn,'rb')
+    try:
+        return cPickle.load(tfile)
+    finally:
+        tfile.close()
+        
+
+
 def updateInputfile(fn,fnT,ai=0,conv=0,texguess=0.9,fn_new=None):
 
     '''
@@ -335,10 +651,136 @@ def execALI(fn,args=[]):
     
     '''
     
-    if isinstance(args,str): args = [args]
     os.chdir(cc.path.ali)
+    subprocess.call([getCommand(fn,args)],shell=True)
+
+
+
+def getCommand(fn,args=[]):
+
+    '''
+    Get the shell command that runs ALI for a given filename in the ALI home 
+    folder. 
+    
+    @param fn: The full ALI inputfilename.
+    @type fn: str
+    
+    @keyword args: Additional arguments that are appended to the execute command
+                   separated by spaces. If a single string is given, only that
+                   string is added to the command.
+                   
+                   (default: [])
+    @type args: list[str]
+    
+    @return: The command
+    @rtype: str
+    
+    '''
+    
+    if isinstance(args,str): args = [args]
     fncut = os.path.split(fn.replace('.inp',''))[1]
-    subprocess.call(['./ali {}'.format(fncut)+' '.join(args)],shell=True)
+    return ' '.join(['./ali',fncut] + list(args))
+
+
+
+def execALIs(fns,args=[],workers=0,callback=None):
+
+    '''
+    Call the ALI executable for several filenames concurrently. 
+    
+    Every run is a separate process in the ALI home folder (given in 
+    usr/Path.dat), with at most workers runs at the same time. ALI names its 
+    output files after the inputfile, so the inputfiles must have different
+    names. The terminal output of each run goes to its own log file in the ALI
+    home folder, ie the inputfile with '.log' instead of '.inp'.
+    
+    The working directory of this process is not changed. 
+    
+    A run that exits with a non-zero return code does not stop the others, 
+    but an IOError is raised when all runs are done. If the callback raises 
+    an exception or this process is interrupted, the runs that are still 
+    going are killed. 
+    
+    @param fns: The full ALI inputfilenames.
+    @type fns: list[str]
+    
+    @keyword args: Additional arguments that are appended to the execute command
+                   separated by spaces, the same for all runs. See execALI.
+                   
+                   (default: [])
+    @type args: list[str]
+    @keyword workers: The maximum number of runs at the same time. Default if 
+                      all runs are started at once.
+                      
+                      (default: 0)
+    @type workers: int
+    @keyword callback: Called with the index of the filename in fns as soon as
+                       its run finishes successfully, eg to read its output. 
+                       Default if nothing is done.
+                       
+                       (default: None)
+    @type callback: function
+    
+    @return: The return codes of the runs, in the order of fns
+    @rtype: list[int]
+    
+    '''
+    
+    if isinstance(fns,str): fns = [fns]
+    fncuts = [os.path.split(fn.replace('.inp',''))[1] for fn in fns]
+    if len(set(fncuts)) != len(fncuts):
+        raise IOError('ALI inputfiles must have different names to run '+\
+                      'concurrently: {}'.format(', '.join(fncuts)))
+    workers = int(workers) if int(workers) > 0 else len(fns)
+    
+    #-- Start runs as long as there are free workers, and collect the runs that
+    #   are done
+    queue = range(len(fns))
+    running = dict()
+    codes = [None]*len(fns)
+    try:
+        while queue or running:
+            while queue and len(running) < workers:
+                j = queue.pop(0)
+                log = open(os.path.join(cc.path.ali,fncuts[j]+'.log'),'w')
+                try:
+                    p = subprocess.Popen(getCommand(fns[j],args),shell=True,\
+                                         cwd=cc.path.ali,stdout=log,\
+                                         stderr=subprocess.STDOUT,\
+                                         preexec_fn=os.setsid)
+                except OSError:
+                    log.close()
+                    raise
+                running[j] = (p,log)
+            done = [j for j,(p,log) in running.items() if p.poll() is not None]
+            for j in sorted(done):
+                p, log = running.pop(j)
+                log.close()
+                codes[j] = p.returncode
+                if codes[j]:
+                    print('ALI run for {} failed with return code {}. '\
+                          .format(fncuts[j],codes[j]) + \
+                          'See {}.'.format(log.name))
+                elif not callback is None:
+                    callback(j)
+            if not done: 
+                time.sleep(0.1)
+    finally:
+        #-- If anything went wrong, eg in the callback or on an interrupt, 
+        #   stop the runs that are still going. Every run is a process group,
+        #   so ALI is stopped together with the shell that started it.
+        for p,log in running.values():
+            if p.poll() is None:
+                os.killpg(p.pid,signal.SIGKILL)
+            p.wait()
+            log.close()
+    
+    #-- Stop if any of the runs failed. The output of successful runs has been
+    #   handled already.
+    failed = [fncut for fncut,code in zip(fncuts,codes) if code]
+    if failed: 
+        raise IOError('ALI failed for: {}'.format(', '.join(failed)))
+    return codes
 
 
 
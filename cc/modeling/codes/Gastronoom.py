@@ -10,12 +10,14 @@ Author: R. Lombaert
 import os
 import cPickle 
 from glob import glob
+from functools import partial
 import subprocess      
 from scipy import array
 
 import cc.path
 from cc.tools.io import DataIO
 from cc.tools.io import Atmosphere
+from cc.tools.io import Database
 from cc.modeling.codes.ModelingSession import ModelingSession
 from cc.modeling.objects.Molecule import Molecule
 
@@ -28,10 +30,10 @@ class Gastronoom(ModelingSession):
     
     """
         
-    def __init__(self,path_gastronoom='runTest',vic=None,sphinx=0,\
+    def __init__(self,path_gastronoom='runTest',batch=None,sphinx=0,\
                  replace_db_entry=0,cool_db=None,ml_db=None,sph_db=None,\
                  skip_cooling=0,recover_sphinxfiles=0,\
-                 new_entries=[],single_session=0):
+                 new_entries=[],single_session=0,pool=None,plan=None):
     
         """ 
         Initializing an instance of a GASTRoNOoM modeling session.
@@ -43,10 +45,11 @@ class Gastronoom(ModelingSession):
         
                                   (default: 'runTest')
         @type path_gastronoom: string
-        @keyword vic: the vic manager for running sphinx models on VIC3 
+        @keyword batch: the batch manager for running sphinx models through a
+                        batch scheduler
         
-                      (default: None)
-        @type vic: Vic()
+                        (default: None)
+        @type batch: Batch()
         @keyword sphinx: Running Sphinx?
         
                          (default: 0)
@@ -94,6 +97,16 @@ class Gastronoom(ModelingSession):
                                  
                                  (default: 0)
         @type single_session: bool
+        @keyword pool: The local pool for running the subcodes in parallel. If
+                       None, the subcodes are ran one by one. 
+                       
+                       (default: None)
+        @type pool: LocalPool()
+        @keyword plan: The execution plan of the grid. Models it found in the 
+                       databases are retrieved without a database check. 
+                       
+                       (default: None)
+        @type plan: Planner()
                 
         """
         
@@ -101,10 +114,12 @@ class Gastronoom(ModelingSession):
                                         path=path_gastronoom,\
                                         replace_db_entry=replace_db_entry,\
                                         new_entries=new_entries,\
-                                        single_session=single_session)
+                                        single_session=single_session,\
+                                        plan=plan)
         #-- Convenience path
         cc.path.gout = os.path.join(cc.path.gastronoom,self.path)
-        self.vic = vic
+        self.batch = batch
+        self.pool = pool
         self.sphinx = sphinx
         cool_keys = os.path.join(cc.path.aux,'Input_Keywords_Cooling.dat')
         ml_keys = os.path.join(cc.path.aux,'Input_Keywords_Mline.dat')
@@ -129,6 +144,9 @@ class Gastronoom(ModelingSession):
         self.molec_in_progress = []
         #-- Transitions in progress are simply ignored.
         self.trans_in_progress = []
+        #-- Tasks in the local pool that the models in this session depend on.
+        self.cool_task = None
+        self.mline_tasks = dict()
         self.cooling_molec_keys = ['ENHANCE_ABUNDANCE_FACTOR',\
                                    'ABUNDANCE_FILENAME',\
                                    'NUMBER_INPUT_ABUNDANCE_VALUES',\
@@ -146,6 +164,19 @@ class Gastronoom(ModelingSession):
         self.cool_db = cool_db
         self.ml_db = ml_db
         self.sph_db = sph_db
+        #-- Fingerprint indices speed up the database checks. They are kept 
+        #   on the disk next to the databases.
+        self.no_ab_keywords = [k 
+                               for k in self.mline_keywords
+                               if k not in ['ABUN_MOLEC','ABUN_MOLEC_RINNER',\
+                                            'ABUN_MOLEC_RE','RMAX_MOLEC']]
+        if not self.cool_db is None:
+            self.cool_db.addIndex('cooling',keywords=self.cooling_keywords)
+        if not self.ml_db is None:
+            self.ml_db.addIndex('mline',keywords=self.mline_keywords)
+            self.ml_db.addIndex('mline_noabun',keywords=self.no_ab_keywords)
+        if not self.sph_db is None:
+            self.sph_db.addIndex('sphinx',keywords=self.sphinx_keywords)
         #self.pacs_db = pacs_db
         
 
@@ -154,7 +185,7 @@ class Gastronoom(ModelingSession):
         
         '''
         Remember a transition in progress. They will be checked at the 
-        end of a VIC run to see if they have been correctly calculated. If being
+        end of a batch run to see if they have been correctly calculated. If being
         calculated in another CC session, they will not be checked. But the user
         can always reload.
         
@@ -250,6 +281,34 @@ class Gastronoom(ModelingSession):
         
 
 
+    def isCalculated(self,db,path):
+        
+        '''
+        Check if a model is present in a database and not in progress. 
+        
+        Used for the models the execution plan found, since the plan may be 
+        out of date, eg when a failed model was removed from the database.
+        
+        @param db: The database
+        @type db: Database()
+        @param path: The keys of the model in the database, eg the cooling 
+                     id, molecule id and molecule for an mline model
+        @type path: tuple
+        
+        @return: Is the model calculated?
+        @rtype: bool
+        
+        '''
+        
+        entry = db
+        for key in path:
+            if not isinstance(entry,dict) or not entry.has_key(key):
+                return False
+            entry = entry[key]
+        return isinstance(entry,dict) and not entry.has_key('IN_PROGRESS')
+        
+        
+        
     def deleteCoolingId(self,model_id):
         
         '''
@@ -289,6 +348,18 @@ class Gastronoom(ModelingSession):
         
         """
         
+        #-- Models the execution plan found in the database are finished. They
+        #   are retrieved without locking and synchronizing the database.
+        query = self.command_list.copy()
+        query.update(molec_dict)
+        model_id = self.getPlannedId('cooling',query,self.cooling_keywords)
+        if model_id and self.isCalculated(self.cool_db,(model_id,)):
+            print 'GASTRoNOoM cooling model has been calculated ' + \
+                  'before with ID %s.'%model_id
+            self.model_id = model_id
+            self.updateModel()
+            return 1
+        
         #-- Lock the cooling database by opening it in read mode. It's closed
         #   once the database check is finalised. Note that in a case of a crash
         #   during the for loop, the python shell must be exited to unlock the 
@@ -296,12 +367,29 @@ class Gastronoom(ModelingSession):
         #   end since the file on the disk will not change.
         if not self.single_session: self.cool_db.sync()
         cool_dbfile = self.cool_db._open('r')        
-        for i,model_id in enumerate(sorted(self.cool_db.keys())):
+        
+        #-- Only models that can match are checked. Depending on the database
+        #   engine, this is a preselection, or simply all models in the db.
+        model_ids = [p[0] 
+                     for p in self.cool_db.selectKeys(query=query,\
+                                            keywords=self.cooling_keywords,\
+                                            index='cooling')]
+        for i,model_id in enumerate(model_ids):
             cool_dict = self.cool_db[model_id]
             model_bool = self.cCL(self.command_list.copy(),cool_dict,'cooling',\
                                   extra_dict=molec_dict)
             if model_bool:
-                if cool_dict.has_key('IN_PROGRESS'):
+                if cool_dict.has_key('IN_PROGRESS') and not self.pool is None\
+                        and self.pool.getReservation(('cooling',model_id)):
+                    self.cool_task = self.pool.getReservation(('cooling',\
+                                                               model_id))
+                    print 'Cooling model is currently being calculated in ' +\
+                          'the local pool with ID %s.'%(model_id)
+                    self.model_id = model_id
+                    self.updateModel()
+                    finished = 1
+                    break
+                elif cool_dict.has_key('IN_PROGRESS'):
                     self.in_progress = True
                     print 'Cooling model is currently being calculated in a ' +\
                           'different CC modeling session with ID %s.'\
@@ -328,13 +416,13 @@ class Gastronoom(ModelingSession):
             #-- Reached the end of db without match. Make new entry in db, in
             #   progress. Cant combine this with next line in case the last
             #   model gives a match.
-            if i == len(self.cool_db)-1:
+            if i == len(model_ids)-1:
                 print 'No match found in GASTRoNOoM cooling database. ' + \
                       'Calculating new model.'
                 finished = 0
         
         #-- In case of an empty db, the above loop is not accessed.
-        if not self.cool_db.keys():
+        if not model_ids:
             print 'No match found in GASTRoNOoM cooling database. ' + \
                   'Calculating new model.'
             finished = 0
@@ -366,6 +454,25 @@ class Gastronoom(ModelingSession):
         
         """
         
+        #-- Models the execution plan found in the database are finished. They
+        #   are retrieved without locking and synchronizing the database, if 
+        #   this is the case for all molecules, and they are all still in the
+        #   database.
+        planned = [self.getPlannedId('mline',molec.makeDict(),\
+                                     self.getMlineIndex(molec)[0],\
+                                     (self.model_id,molec.molecule))
+                   for molec in self.molec_list]
+        if self.molec_list and '' not in planned \
+                and not [molec_id 
+                         for molec,molec_id in zip(self.molec_list,planned)
+                         if not self.isCalculated(self.ml_db,(self.model_id,\
+                                                  molec_id,molec.molecule))]:
+            for molec,molec_id in zip(self.molec_list,planned):
+                molec.setModelId(molec_id)
+                print 'Mline model has been calculated before for '\
+                      '%s with ID %s.'%(molec.molecule,molec_id)
+            return [True]*len(self.molec_list)
+        
         #-- Lock the mline database by opening it in read mode. It's closed
         #   once the database check is finalised. Note that in a case of a crash
         #   during the for loop, the python shell must be exited to unlock the 
@@ -387,8 +494,12 @@ class Gastronoom(ModelingSession):
 
         model_bools = []
         for molec in self.molec_list:
-            for molec_id in [k for k,v in sorted(self.ml_db[self.model_id].items())
-                               if molec.molecule in v.keys()]:
+            kws, index = self.getMlineIndex(molec)
+            ml_paths = self.ml_db.selectKeys(query=molec.makeDict(),\
+                                             keywords=kws,\
+                                             path=(self.model_id,),\
+                                             index=index)
+            for molec_id in [k for k,m in ml_paths if m == molec.molecule]:
                 db_molec_dict = self.ml_db[self.model_id][molec_id]\
                                           [molec.molecule]
                 if self.cCL(this_list=molec.makeDict(),\
@@ -397,7 +508,16 @@ class Gastronoom(ModelingSession):
                             ignoreAbun=molec.molecule in self.no_ab_molecs):
                     molec.setModelId(molec_id)
                     model_bools.append(True)
-                    if db_molec_dict.has_key('IN_PROGRESS'):
+                    res = ('mline',self.model_id,molec_id,molec.molecule)
+                    if db_molec_dict.has_key('IN_PROGRESS') \
+                            and not self.pool is None \
+                            and self.pool.getReservation(res):
+                        self.mline_tasks[molec_id,molec.molecule] \
+                                = self.pool.getReservation(res)
+                        print 'Mline model is currently being calculated ' + \
+                              'in the local pool for %s with ID %s.'\
+                              %(molec.molecule,molec.getModelId())
+                    elif db_molec_dict.has_key('IN_PROGRESS'):
                         self.addMolecInProgress(molec)
                         print 'Mline model is currently being ' + \
                               'calculated in a different CC modeling '+\
@@ -459,7 +579,10 @@ class Gastronoom(ModelingSession):
                         else:                         
                             k = self.makeNewId()
                             self.makeIdLog(new_id=k)
-                            self.copyOutput(molec,self.model_id,k)
+                            #-- The local pool links the output once the
+                            #   cooling model is finished.
+                            if self.pool is None:
+                                self.copyOutput(molec,self.model_id,k)
                         self.ml_db[self.model_id][k] = dict()
                 
                 #-- It is possible cool_dbd is actually empty. Then use the
@@ -488,6 +611,167 @@ class Gastronoom(ModelingSession):
 
 
 
+    def getMlineIndex(self,molec):
+    
+        '''
+        Get the keywords and the name of the fingerprint index that define the
+        mline model of a molecule.
+        
+        The abundance keywords are not included for molecules that have no
+        abundance profile.
+        
+        @param molec: The molecule
+        @type molec: Molecule()
+        
+        @return: The keywords and the name of the index
+        @rtype: (list[str],str)
+        
+        '''
+        
+        if molec.molecule in self.no_ab_molecs:
+            return self.no_ab_keywords, 'mline_noabun'
+        return self.mline_keywords, 'mline'
+        
+        
+        
+    def findCoolingModel(self,molec_dict):
+    
+        '''
+        Find the cooling model matching the command list in the database.
+        
+        Unlike checkCoolingDatabase(), the database is not synchronized, locked
+        or changed. 
+        
+        @param molec_dict: molecule info for this cooling model, ie CO and H2O
+        @type molec_dict: dict()
+        
+        @return: The model id, empty if no match is found
+        @rtype: string
+        
+        '''
+        
+        query = self.command_list.copy()
+        query.update(molec_dict)
+        model_ids = [p[0] 
+                     for p in self.cool_db.selectKeys(query=query,\
+                                            keywords=self.cooling_keywords,\
+                                            index='cooling')]
+        for model_id in model_ids:
+            if self.cCL(self.command_list.copy(),self.cool_db[model_id],\
+                        'cooling',extra_dict=molec_dict):
+                return model_id
+        return ''
+        
+        
+        
+    def findMlineModel(self,model_id,molec):
+    
+        '''
+        Find the mline model of a molecule for a cooling model in the database.
+        
+        Unlike checkMlineDatabase(), the database is not synchronized, locked or
+        changed. 
+        
+        @param model_id: The cooling model id
+        @type model_id: string
+        @param molec: The molecule
+        @type molec: Molecule()
+        
+        @return: The molec id, empty if no match is found
+        @rtype: string
+        
+        '''
+        
+        if not self.ml_db.has_key(model_id):
+            return ''
+        kws, index = self.getMlineIndex(molec)
+        ml_paths = self.ml_db.selectKeys(query=molec.makeDict(),keywords=kws,\
+                                         path=(model_id,),index=index)
+        for molec_id in [k for k,m in ml_paths if m == molec.molecule]:
+            if self.cCL(this_list=molec.makeDict(),\
+                        modellist=self.ml_db[model_id][molec_id]\
+                                            [molec.molecule],\
+                        code='mline',\
+                        ignoreAbun=molec.molecule in self.no_ab_molecs):
+                return molec_id
+        return ''
+        
+        
+        
+    def findSphinxModel(self,model_id,molec_id,trans):
+    
+        '''
+        Find the sphinx model of a transition for an mline model in the 
+        database.
+        
+        Unlike checkSphinxDatabase(), the database is not synchronized, locked
+        or changed. 
+        
+        @param model_id: The cooling model id
+        @type model_id: string
+        @param molec_id: The mline model id
+        @type molec_id: string
+        @param trans: The transition
+        @type trans: Transition()
+        
+        @return: The trans id, empty if no match is found
+        @rtype: string
+        
+        '''
+        
+        if not self.sph_db.has_key(model_id) \
+                or not self.sph_db[model_id].has_key(molec_id):
+            return ''
+        tr_paths = self.sph_db.selectKeys(query=trans.makeDict(),\
+                                          keywords=self.sphinx_keywords,\
+                                          path=(model_id,molec_id),\
+                                          index='sphinx')
+        for trans_id in [k for k,t in tr_paths if t == str(trans)]:
+            if self.cCL(this_list=trans.makeDict(),\
+                        modellist=self.sph_db[model_id][molec_id][trans_id]\
+                                             [str(trans)],\
+                        code='sphinx'):
+                return trans_id
+        return ''
+        
+        
+        
+    def verifyIndices(self,max_queries=None):
+    
+        '''
+        Verify that the fingerprint indices on the cooling, mline and sphinx 
+        databases agree with a linear scan of the databases.
+        
+        See Database.verifyIndex().
+        
+        @keyword max_queries: Only check this many entries per database. All
+                              are checked if None. 
+                              
+                              (default: None)
+        @type max_queries: int
+        
+        @return: The disagreements between index and linear scan per index
+        @rtype: dict(str: list[tuple])
+        
+        '''
+        
+        checks = [('cooling',self.cool_db,\
+                   lambda q,m: self.cCL(q,m,'cooling')),\
+                  ('mline',self.ml_db,\
+                   lambda q,m: self.cCL(q,m,'mline')),\
+                  ('mline_noabun',self.ml_db,\
+                   lambda q,m: self.cCL(q,m,'mline',ignoreAbun=1)),\
+                  ('sphinx',self.sph_db,\
+                   lambda q,m: self.cCL(q,m,'sphinx'))]
+        disagree = dict()
+        for index,db,compare in checks:
+            if db is None: continue
+            n, disagree[index] = Database.verifyIndex(db,index,compare,\
+                                                      max_queries=max_queries)
+        return disagree
+        
+        
+        
     def checkSphinxDatabase(self):
         
         """
@@ -498,6 +782,29 @@ class Gastronoom(ModelingSession):
         
         """
         
+        #-- Models the execution plan found in the database are finished. They
+        #   are retrieved without locking and synchronizing the database, if 
+        #   this is the case for all transitions, and they are all still in 
+        #   the database.
+        planned = [self.getPlannedId('sphinx',trans.makeDict(),\
+                                     self.sphinx_keywords,\
+                                     (self.model_id,\
+                                      trans.molecule.getModelId(),str(trans)))
+                   for trans in self.trans_list]
+        if self.trans_list and '' not in planned \
+                and not [trans_id 
+                         for trans,trans_id in zip(self.trans_list,planned)
+                         if not self.isCalculated(self.sph_db,\
+                                    (self.model_id,trans.molecule.getModelId(),\
+                                     trans_id,str(trans)))]:
+            for trans,trans_id in zip(self.trans_list,planned):
+                trans.setModelId(trans_id)
+                self.trans_bools.append(True)
+                print 'Sphinx model has been calculated before for %s of '\
+                      %(str(trans)) + '%s with ID %s.'\
+                      %(trans.molecule.molecule,trans_id)
+            return
+        
         #-- Remember which molecules have been added to new id, if applicable
         copied_molecs = []    
 
@@ -523,9 +830,11 @@ class Gastronoom(ModelingSession):
                 self.sph_db.addChangedKey(self.model_id)
                 self.trans_bools.append(False)
             else:    
-                tdb = self.sph_db[self.model_id][molec_id]
-                gd_ids = [k for k,v in sorted(tdb.items())
-                            if str(trans) in v.keys()]
+                tr_paths = self.sph_db.selectKeys(query=trans.makeDict(),\
+                                            keywords=self.sphinx_keywords,\
+                                            path=(self.model_id,molec_id),\
+                                            index='sphinx')
+                gd_ids = [k for k,t in tr_paths if t == str(trans)]
                 for trans_id in gd_ids:
                     db_trans_dict = self.sph_db[self.model_id][molec_id]\
                                                [trans_id][str(trans)].copy()
@@ -533,14 +842,23 @@ class Gastronoom(ModelingSession):
                                 modellist=db_trans_dict,code='sphinx'):
                         trans.setModelId(trans_id)
                         self.trans_bools.append(True)
-                        if not self.vic is None \
+                        res = ('sphinx',self.model_id,molec_id,trans_id,\
+                               str(trans))
+                        if not self.pool is None \
+                                and db_trans_dict.has_key('IN_PROGRESS') \
+                                and self.pool.getReservation(res):
+                            print 'Sphinx model is currently being '+\
+                                  'calculated in the local pool for %s of '\
+                                  %(str(trans)) + '%s with ID %s.'\
+                                  %(molec.molecule,trans.getModelId())
+                        elif not self.batch is None \
                                 and db_trans_dict.has_key('IN_PROGRESS'):
-                            self.vic.addTransInProgress(trans)
+                            self.batch.addTransInProgress(trans)
                             print 'Sphinx model is currently being '+\
                                   'calculated for %s of %s with ID %s.'\
                                   %(str(trans),molec.molecule,\
                                     trans.getModelId())                                 
-                        elif self.vic is None \
+                        elif self.batch is None \
                               and db_trans_dict.has_key('IN_PROGRESS'):
                             self.addTransInProgress(trans)
                             print 'Sphinx model is currently being ' + \
@@ -623,7 +941,8 @@ class Gastronoom(ModelingSession):
                     #   You only want to do this once per session for each 
                     #   molecule, because ls/ln checks add a lot of overhead. 
                     #   copyOutput double checks if links already exist
-                    if (molec.molecule,k) not in copied_molecs:
+                    if (molec.molecule,k) not in copied_molecs \
+                            and self.pool is None:
                         self.copyOutput(trans,molec_id,k)
                         copied_molecs.append((molec.molecule,k)) 
                     td = trans.makeDict(1)
@@ -689,16 +1008,21 @@ class Gastronoom(ModelingSession):
 
 
 
-    def doCooling(self,star):
+    def setCoolingMolecules(self,star):
         
         """
-        Run Cooling.
-
-        First, database is checked for retrieval of old model. 
-
+        Collect the CO and H2O information for the cooling model.
+        
+        F_H2O is removed from the command list if an abundance file is given 
+        for H2O.
+        
         @param star: The parameter set for this session
         @type star: Star()
         
+        @return: The CO and H2O molecule dictionaries, and the H2O information
+                 that defines the cooling model
+        @rtype: (dict,dict,dict)
+        
         """
         
         #-- Collect H2O and CO molecule definitions for inclusion in the 
@@ -726,11 +1050,35 @@ class Gastronoom(ModelingSession):
         molec_dict = dict([(k,h2o_dict[k]) 
                             for k in self.cooling_molec_keys 
                             if h2o_dict.has_key(k)])
+        return co_dict, h2o_dict, molec_dict
+        
+        
+        
+    def doCooling(self,star):
+        
+        """
+        Run Cooling.
+
+        First, database is checked for retrieval of old model. 
+
+        @param star: The parameter set for this session
+        @type star: Star()
+        
+        """
+        
+        co_dict, h2o_dict, molec_dict = self.setCoolingMolecules(star)
 
         #-- Check database: only include H2O extra keywords if 
         #   abundance_filename is present. CO can't have this anyway.
         model_bool = self.checkCoolingDatabase(molec_dict=molec_dict.copy())    
         
+        #-- The cooling model is being calculated in the local pool for another
+        #   model in the grid: reset the star if it fails.
+        if model_bool and not self.cool_task is None:
+            self.pool.addFinalize(self.cool_task,\
+                                  partial(self.checkCoolingId,\
+                                          model_id=self.model_id,star=star))
+        
         #- Run cooling if above is False
         if not model_bool:
             DataIO.testFolderExistence(os.path.join(cc.path.gout,'models',\
@@ -751,24 +1099,94 @@ class Gastronoom(ModelingSession):
             filename = os.path.join(cc.path.gout,'models',\
                                     'gastronoom_' + self.model_id + '.inp')
             DataIO.writeFile(filename,commandfile)
+            if not self.skip_cooling and not self.pool is None:
+                #-- The output is checked once the pool finished the model
+                workdir = os.path.join(cc.path.gout,'models',self.model_id)
+                finalize = partial(self.finalizeCooling,\
+                                   model_id=self.model_id,star=star)
+                self.cool_task = self.pool.addTask(subcode='cooling',\
+                                        filename=filename,workdir=workdir,\
+                                        finalize=finalize,\
+                                        reservation=('cooling',self.model_id))
+                self.cool_done = True
+                return
             if not self.skip_cooling:
                 self.execGastronoom(subcode='cooling',filename=filename)
                 self.cool_done = True
-            if os.path.isfile(os.path.join(cc.path.gout,'models',\
-                                           self.model_id,'coolfgr_all%s.dat'\
-                                           %self.model_id)):
-                #-- Note that there is no need to create a log parameter file
-                #   since the inputfiles are still available, and they always
-                #   contain all cooling keywords. (maybe change for h2o cooling)
-                if self.cool_db[self.model_id].has_key('IN_PROGRESS'):
-                    del self.cool_db[self.model_id]['IN_PROGRESS']
-                    self.cool_db.addChangedKey(self.model_id)
-            else:
-                print 'Cooling model calculation failed. No entry is added '+ \
-                      'to the database.'
-                del self.cool_db[self.model_id]    
+            self.finalizeCooling(self.model_id)
+
+
+
+    def finalizeCooling(self,model_id,star=None):
+        
+        '''
+        Check if the cooling output is complete and update the database.
+        
+        If the model failed, it is removed from the database. 
+        
+        @param model_id: The cooling model id
+        @type model_id: string
+        
+        @keyword star: The parameter set for this session. Its 
+                       LAST_GASTRONOOM_MODEL is reset if the model failed. Only
+                       needed if the model was calculated in the local pool. 
+                       
+                       (default: None)
+        @type star: Star()
+        
+        @return: Was the cooling model calculated successfully?
+        @rtype: bool
+        
+        '''
+        
+        if os.path.isfile(os.path.join(cc.path.gout,'models',model_id,\
+                                       'coolfgr_all%s.dat'%model_id)):
+            #-- Note that there is no need to create a log parameter file
+            #   since the inputfiles are still available, and they always
+            #   contain all cooling keywords. (maybe change for h2o cooling)
+            if self.cool_db[model_id].has_key('IN_PROGRESS'):
+                del self.cool_db[model_id]['IN_PROGRESS']
+                self.cool_db.addChangedKey(model_id)
+            success = True
+        else:
+            print 'Cooling model calculation failed for %s. '%model_id + \
+                  'No entry is added to the database.'
+            del self.cool_db[model_id]    
+            if self.model_id == model_id:
                 self.model_id = ''
-            if not self.single_session: self.cool_db.sync()                    
+            self.checkCoolingId(model_id,star)
+            success = False
+        if not self.single_session: self.cool_db.sync()                    
+        return success
+        
+        
+        
+    def checkCoolingId(self,model_id,star=None):
+        
+        '''
+        Check if a cooling model id is still present in the database, and reset
+        LAST_GASTRONOOM_MODEL of a star if not. 
+        
+        Used for models calculated in the local pool.
+        
+        @param model_id: The cooling model id
+        @type model_id: string
+        
+        @keyword star: The parameter set that uses the cooling model.
+        
+                       (default: None)
+        @type star: Star()
+        
+        @return: Is the cooling model id present in the database? 
+        @rtype: bool
+        
+        '''
+        
+        if self.cool_db.has_key(model_id):
+            return True
+        if not star is None and star['LAST_GASTRONOOM_MODEL'] == model_id:
+            star['LAST_GASTRONOOM_MODEL'] = ''
+        return False
 
 
 
@@ -808,44 +1226,29 @@ class Gastronoom(ModelingSession):
                 filename = os.path.join(cc.path.gout,'models',\
                                         'gastronoom_%s.inp'%molec.getModelId())
                 DataIO.writeFile(filename,commandfile)                
-                self.execGastronoom(subcode='mline',filename=filename)
                 self.mline_done=True
-                path = os.path.join(cc.path.gout,'models',molec.getModelId())
-                fns = 'ml*{}_{}.dat'.format(molec.getModelId(),molec.molecule)
-                if len(glob(os.path.join(path,fns))) == 3:
-                    #-- Remove in-progress entry.
-                    if self.ml_db[self.model_id][molec.getModelId()]\
-                            [molec.molecule].has_key('IN_PROGRESS'):
-                        del self.ml_db[self.model_id][molec.getModelId()]\
-                                      [molec.molecule]['IN_PROGRESS']
-                    
-                    #-- Write mline keywords not included in sph files but used 
-                    #   in the database in an extra log file. Only do this if it
-                    #   doesn't already exist. The parameters should be the same
-                    #   for all transitions with this model id.
-                    mlfn = 'mline_parameters_{}.log'.format(molec.molecule)
-                    mlfn = os.path.join(path,mlfn)
-                    if not os.path.isfile(mlfn):
-                        #-- Add MOLECULE too. Cuz, why not. For TRANSITION, that
-                        #   info is recreated from sph files. Not so for mline.
-                        mlfile = ['{}={}'.format(k,v)
-                                  for k,v in sorted(molec.makeDict().items())]
-                        DataIO.writeFile(mlfn,mlfile)
-                else:
-                    del self.ml_db[self.model_id][molec.getModelId()]\
-                                  [molec.molecule] 
-                    #-- Remove the molecule id if it does not contain molecules
-                    #   anymore. The id is thus unused.
-                    if not self.ml_db[self.model_id][molec.getModelId()].keys():
-                        del self.ml_db[self.model_id][molec.getModelId()]
-                    print 'Mline model calculation failed for'\
-                          '%s. No entry is added to the database.'\
-                          %(molec.molecule)
-                    molec.setModelId('')
-                    
-                #-- Synchronize db: Both when successful or failure. 
-                self.ml_db.addChangedKey(self.model_id)
-                if not self.single_session: self.ml_db.sync()
+                if not self.pool is None:
+                    #-- Runs after the cooling model, in case that is still
+                    #   being calculated. The output of the cooling model is 
+                    #   linked to the mline id once it is available.
+                    mid = molec.getModelId()
+                    workdir = os.path.join(cc.path.gout,'models',mid)
+                    finalize = partial(self.finalizeMline,molec=molec,\
+                                       model_id=self.model_id)
+                    prepare = partial(self.copyOutput,entry=molec,\
+                                      old_id=self.model_id,new_id=mid)
+                    res = ('mline',self.model_id,mid,molec.molecule)
+                    task = self.pool.addTask(subcode='mline',\
+                                             filename=filename,\
+                                             workdir=workdir,\
+                                             finalize=finalize,\
+                                             prepare=prepare,\
+                                             depends=[self.cool_task],\
+                                             reservation=res)
+                    self.mline_tasks[mid,molec.molecule] = task
+                    continue
+                self.execGastronoom(subcode='mline',filename=filename)
+                self.finalizeMline(molec,self.model_id)
                 
                 
         if set([molec.getModelId() for molec in self.molec_list]) == set(['']):  
@@ -855,14 +1258,75 @@ class Gastronoom(ModelingSession):
                   'molecules. Stopping GASTRoNOoM here!'
         else:        
             #- at least one molecule was successfully calculated, so start  
-            #- Sphinx, hence if vic is requested, the cooling model_id can now  
-            #- be added to the models list
-            if not self.vic is None and self.sphinx: 
-                #- add the command list to the vic models list
-                self.vic.addModel(self.model_id,self.command_list)
+            #- Sphinx, hence if batch is requested, the cooling model_id can 
+            #- now be added to the models list
+            if not self.batch is None and self.sphinx: 
+                #- add the command list to the batch models list
+                self.batch.addModel(self.model_id,self.command_list)
             
    
 
+    def finalizeMline(self,molec,model_id):
+        
+        '''
+        Check if the mline output is complete for a molecule and update the 
+        database.
+        
+        If the model failed, the molecule is removed from the database and 
+        its model id is reset. 
+        
+        @param molec: The molecule
+        @type molec: Molecule()
+        @param model_id: The cooling model id
+        @type model_id: string
+        
+        @return: Was the mline model calculated successfully?
+        @rtype: bool
+        
+        '''
+        
+        molec_id = molec.getModelId()
+        path = os.path.join(cc.path.gout,'models',molec_id)
+        fns = 'ml*{}_{}.dat'.format(molec_id,molec.molecule)
+        if len(glob(os.path.join(path,fns))) == 3:
+            #-- Remove in-progress entry.
+            if self.ml_db[model_id][molec_id][molec.molecule]\
+                    .has_key('IN_PROGRESS'):
+                del self.ml_db[model_id][molec_id][molec.molecule]\
+                              ['IN_PROGRESS']
+            
+            #-- Write mline keywords not included in sph files but used 
+            #   in the database in an extra log file. Only do this if it
+            #   doesn't already exist. The parameters should be the same
+            #   for all transitions with this model id.
+            mlfn = 'mline_parameters_{}.log'.format(molec.molecule)
+            mlfn = os.path.join(path,mlfn)
+            if not os.path.isfile(mlfn):
+                #-- Add MOLECULE too. Cuz, why not. For TRANSITION, that
+                #   info is recreated from sph files. Not so for mline.
+                mlfile = ['{}={}'.format(k,v)
+                          for k,v in sorted(molec.makeDict().items())]
+                DataIO.writeFile(mlfn,mlfile)
+            success = True
+        else:
+            del self.ml_db[model_id][molec_id][molec.molecule] 
+            #-- Remove the molecule id if it does not contain molecules
+            #   anymore. The id is thus unused.
+            if not self.ml_db[model_id][molec_id].keys():
+                del self.ml_db[model_id][molec_id]
+            print 'Mline model calculation failed for'\
+                  '%s. No entry is added to the database.'\
+                  %(molec.molecule)
+            molec.setModelId('')
+            success = False
+            
+        #-- Synchronize db: Both when successful or failure. 
+        self.ml_db.addChangedKey(model_id)
+        if not self.single_session: self.ml_db.sync()
+        return success
+        
+        
+
     def doSphinx(self,star):
         
         """
@@ -888,9 +1352,9 @@ class Gastronoom(ModelingSession):
                                    [trans.getModelId()][str(trans)]
                     self.sph_db.addChangedKey(self.model_id)
                     trans.setModelId('')
-                elif not self.vic is None:
-                    #- add transition to the vic translist for this cooling id
-                    self.vic.addTrans(trans)
+                elif not self.batch is None:
+                    #- add transition to the batch translist for this cooling id
+                    self.batch.addTrans(trans)
                 elif self.recover_sphinxfiles: 
                     self.checkSphinxOutput(trans)
                 else:
@@ -915,6 +1379,9 @@ class Gastronoom(ModelingSession):
                                             'gastronoom_%s.inp'\
                                             %trans.getModelId())
                     DataIO.writeFile(filename,commandfile)                
+                    if not self.pool is None:
+                        self.addSphinxTask(trans,filename)
+                        continue
                     print 'Starting calculation for transition %i out of %i.'\
                           %(i+1,len(self.trans_bools))
                     self.execGastronoom(subcode='sphinx',filename=filename)
@@ -927,7 +1394,7 @@ class Gastronoom(ModelingSession):
         
         #-- Sync the sphinx db in case self.sphinx is False or 
         #   self.recover_sphinxfiles is True, to make sure sph_db is up-to-date.
-        #   In case models are calculated or vic is ran this is done in other
+        #   In case models are calculated or batch is ran this is done in other
         #   places in the code.
         if not self.sphinx or self.recover_sphinxfiles:
             self.sph_db.sync()
@@ -937,15 +1404,70 @@ class Gastronoom(ModelingSession):
                                                             self.trans_list) 
                                    if not boolean])  \
                               == set([''])
-        if not self.vic is None and self.sphinx and (False in self.trans_bools \
-              and not mline_not_available):
-            self.vic.queueModel()
-        elif not self.vic is None and self.sphinx and (False not in self.trans_bools\
-              or mline_not_available):
-            self.vic.reset()
+        if not self.batch is None and self.sphinx \
+                and (False in self.trans_bools and not mline_not_available):
+            self.batch.queueModel()
+        elif not self.batch is None and self.sphinx \
+                and (False not in self.trans_bools or mline_not_available):
+            self.batch.reset()
             
  
  
+    def addSphinxTask(self,trans,filename):
+        
+        '''
+        Add a sphinx run for a transition to the local pool. 
+        
+        The task runs after the cooling and mline models it depends on, and the
+        output of those models is linked to the sphinx id once available.
+        
+        @param trans: The transition
+        @type trans: Transition()
+        @param filename: the full path+filename of the inputfile
+        @type filename: string
+        
+        '''
+        
+        molec_id = trans.molecule.getModelId()
+        trans_id = trans.getModelId()
+        workdir = os.path.join(cc.path.gout,'models',trans_id)
+        finalize = partial(self.finalizeSphinxTask,trans=trans,\
+                           model_id=self.model_id,molec_id=molec_id)
+        prepare = partial(self.copyOutput,entry=trans,old_id=molec_id,\
+                          new_id=trans_id)
+        depends = [self.cool_task,\
+                   self.mline_tasks.get((molec_id,trans.molecule.molecule))]
+        res = ('sphinx',self.model_id,molec_id,trans_id,str(trans))
+        self.pool.addTask(subcode='sphinx',filename=filename,workdir=workdir,\
+                          finalize=finalize,prepare=prepare,depends=depends,\
+                          reservation=res)
+        
+        
+        
+    def finalizeSphinxTask(self,trans,model_id,molec_id):
+        
+        '''
+        Check the output of a sphinx run in the local pool and synchronize the
+        database.
+        
+        @param trans: The transition
+        @type trans: Transition()
+        @param model_id: The cooling model id
+        @type model_id: string
+        @param molec_id: The mline model id
+        @type molec_id: string
+        
+        @return: Was the sphinx model calculated successfully?
+        @rtype: bool
+        
+        '''
+        
+        success = self.checkSphinxOutput(trans,model_id,molec_id)
+        if not self.single_session: self.sph_db.sync()
+        return success
+        
+        
+        
     def finalizeSphinx(self):
         
         '''
@@ -967,7 +1489,7 @@ class Gastronoom(ModelingSession):
                 
 
 
-    def checkSphinxOutput(self,trans):
+    def checkSphinxOutput(self,trans,model_id=None,molec_id=None):
         
         '''
         Check if sphinx output is complete and update the database with 
@@ -978,16 +1500,35 @@ class Gastronoom(ModelingSession):
         @param trans: the transition that is being checked
         @type trans: Transition()
         
+        @keyword model_id: The cooling model id. If None, the model_id of the
+                           instance is used.
+                           
+                           (default: None)
+        @type model_id: string
+        @keyword molec_id: The mline model id. If None, the model id of the 
+                           molecule of the transition is used.
+                           
+                           (default: None)
+        @type molec_id: string
+        
+        @return: Was the sphinx model calculated successfully?
+        @rtype: bool
+        
         '''
         
+        if model_id is None: 
+            model_id = self.model_id
+        if molec_id is None:
+            molec_id = trans.molecule.getModelId()
+        
         filename = trans.makeSphinxFilename(number='*')
         path = os.path.join(cc.path.gout,'models',trans.getModelId())
         #- Sphinx puts out 2 files per transition
         if len(glob(os.path.join(path,filename))) == 2:                    
-            if self.sph_db[self.model_id][trans.molecule.getModelId()]\
+            if self.sph_db[model_id][molec_id]\
                           [trans.getModelId()][str(trans)]\
                           .has_key('IN_PROGRESS'):
-                del self.sph_db[self.model_id][trans.molecule.getModelId()]\
+                del self.sph_db[model_id][molec_id]\
                                [trans.getModelId()][str(trans)]['IN_PROGRESS']
 
             #-- Write sphinx keywords not included in sph filenames but used in
@@ -1005,21 +1546,24 @@ class Gastronoom(ModelingSession):
             print 'Sphinx model calculated successfully for '+\
                   '%s of %s with id %s.'%(str(trans),trans.molecule.molecule,\
                                           trans.getModelId())                                                             
+            success = True
         else:
-            del self.sph_db[self.model_id][trans.molecule.getModelId()]\
+            del self.sph_db[model_id][molec_id]\
                            [trans.getModelId()][str(trans)]
             #-- Remove the transition id if it does not contain transitions
             #   anymore. The id is thus unused.
-            if not self.sph_db[self.model_id][trans.molecule.getModelId()]\
+            if not self.sph_db[model_id][molec_id]\
                               [trans.getModelId()].keys():
-                del self.sph_db[self.model_id][trans.molecule.getModelId()]\
+                del self.sph_db[model_id][molec_id]\
                                [trans.getModelId()]
             print 'Sphinx model calculation failed for %s of %s with id %s.'\
                   %(str(trans),trans.molecule.molecule,trans.getModelId())
             print 'No entry is added to the Sphinx database.'
             trans.setModelId('')
+            success = False
         
-        self.sph_db.addChangedKey(self.model_id)
+        self.sph_db.addChangedKey(model_id)
+        return success
         
         
     def setCommandKey(self,comm_key,star,star_key=None,alternative=None):
@@ -1071,34 +1615,18 @@ class Gastronoom(ModelingSession):
  
 
 
-    def doGastronoom(self,star):
+    def setCommandList(self,star):
         
         """
-        Run GASTRoNOoM-cooling. 
+        Set the cooling command list for a parameter set. 
         
-        The input parameter list is prepared here.
+        The model id of the session is used for the output names.
         
         @param star: Parameter set for this session
         @type star: Star()
         
         """
-
-        print '***********************************'
-        print '** Making input file for GASTRoNOoM'
-        
-        #-- Add the previous cooling model_id to the list of new entries, so it
-        #   does not get deleted if replace_db_entry == 1. 
-        #   This id is not known in new_entries, as the new_entries are passed
-        #   for the previous models, not the current one.(ie when iterations>1)
-        if self.model_id: 
-            self.new_entries.append(self.model_id)
         
-        #-- Make sure to reset this in case an iteration between cooling and 
-        #   mline, cooling and mcmax is happening
-        self.cool_done = False
-        self.model_id = self.makeNewId()
-        self.trans_list=star['GAS_LINES']    
-        self.molec_list=star['GAS_LIST']
         self.command_list = dict()
         self.command_list['DATA_DIRECTORY'] = '"' + cc.path.gdata + '"'
         self.command_list['OUTPUT_DIRECTORY'] \
@@ -1175,6 +1703,40 @@ class Gastronoom(ModelingSession):
                         or k in self.mline_keywords + self.sphinx_keywords)]
         [self.setCommandKey(k,star,alternative=self.standard_inputfile[k]) 
          for k in add_keys]
+        
+        
+        
+    def doGastronoom(self,star):
+        
+        """
+        Run GASTRoNOoM-cooling. 
+        
+        The input parameter list is prepared here.
+        
+        @param star: Parameter set for this session
+        @type star: Star()
+        
+        """
+
+        print '***********************************'
+        print '** Making input file for GASTRoNOoM'
+        
+        #-- Add the previous cooling model_id to the list of new entries, so it
+        #   does not get deleted if replace_db_entry == 1. 
+        #   This id is not known in new_entries, as the new_entries are passed
+        #   for the previous models, not the current one.(ie when iterations>1)
+        if self.model_id: 
+            self.new_entries.append(self.model_id)
+        
+        #-- Make sure to reset this in case an iteration between cooling and 
+        #   mline, cooling and mcmax is happening
+        self.cool_done = False
+        self.cool_task = None
+        self.mline_tasks = dict()
+        self.model_id = self.makeNewId()
+        self.trans_list=star['GAS_LINES']    
+        self.molec_list=star['GAS_LIST']
+        self.setCommandList(star)
         print '** DONE!'
         print '***********************************'
         
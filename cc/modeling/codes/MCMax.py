@@ -12,18 +12,115 @@ import subprocess
 from glob import glob
 
 import cc.path
-from cc.tools.io import DataIO, Database
+from cc.tools.io import DataIO, Database, SpectrumStore
 from cc.modeling.codes.ModelingSession import ModelingSession
 
 
 
-def readModelSpectrum(dpath,rt_spec=1,fn_spec='spectrum45.0.dat'):
+def readStored(dpath,filenames,parse,store=1):
+
+    '''
+    Read model output through the spectrum store of the models folder (see
+    SpectrumStore), or parse it if it is not in the store yet. Parsed output
+    is added to the store.
+
+    @param dpath: folder that contains the MCMax outputfiles
+    @type dpath: string
+    @param filenames: The names of the files that are read. The first one is
+                      used as the key in the store.
+    @type filenames: list[str]
+    @param parse: The function that parses the files, returning the x grid,
+                  the rows on that grid and the selection values of the rows.
+                  Raises an IOError if there are no data.
+    @type parse: function
+
+    @keyword store: Use the spectrum store. If off, the files are parsed.
+
+                    (default: 1)
+    @type store: bool
+
+    @return: The x grid, the rows (2d) and the selection values
+    @rtype: (array,array,tuple)
+
+    '''
+
+    dfiles = [os.path.join(dpath,fn) for fn in filenames]
+    if not store:
+        return parse(dfiles)
+    dpath = os.path.abspath(dpath)
+    model_id = os.path.split(dpath)[1]
+    ss = SpectrumStore.getStore(os.path.split(dpath)[0])
+    stamp = SpectrumStore.getStamp(dfiles)
+    entry = ss.get(model_id,filenames[0],stamp)
+    if entry is None:
+        x,y,sel = parse(dfiles)
+        try:
+            entry = ss.add(model_id,filenames[0],stamp,x,y,sel)
+        except (IOError,OSError):
+            entry = (x,y,sel)
+    return entry
+
+
+
+def parseSpectrum(dfiles):
+
+    '''
+    Parse spectrum output files. If multiple files are given, the average
+    of their fluxes is taken on the wavelength grid of the first file.
+
+    @param dfiles: The spectrum files
+    @type dfiles: list[str]
+
+    @return: The wavelength grid, the flux (1 row) and no selection values
+    @rtype: (array,array,tuple)
+
+    '''
+
+    data = [DataIO.readCols(dfile) for dfile in dfiles]
+    if not list(data[0][0]) or not list(data[0][1]):
+        raise IOError
+    w = data[0][0]
+    f = sum([d[1] for d in data])/len(data)
+    return (w,[f],())
+
+
+
+def parseVisibilities(dfiles):
+
+    '''
+    Parse a visibility output file, as a function of either wavelength or
+    baseline.
+
+    @param dfiles: The visibility file (one file)
+    @type dfiles: list[str]
+
+    @return: The x grid, the rows (flux and the visibilities per selection
+             value) and the selection values
+    @rtype: (array,array,tuple)
+
+    '''
+
+    cols, comments = DataIO.readCols(dfiles[0],return_comments=1)
+    comments = [comment for comment in comments if comment]
+    fn_vis = os.path.split(dfiles[0])[1]
+    seltype = 'visibility' in fn_vis and 'baseline' or 'wavelength'
+    sel = [float(comment.partition(seltype)[2].partition(',')[0])
+           for comment in comments[2:]]
+    return (cols[0],cols[1:2+len(sel)],tuple(sel))
+
+
+
+def readModelSpectrum(dpath,rt_spec=1,fn_spec='spectrum45.0.dat',store=1):
      
     '''
     Read the model output spectrum.
      
     If no ray-tracing is requested or no ray-tracing output is found, the 
     average of the MC spectra is taken.
+    
+    The spectrum is read from the spectrum store of the models folder. It is
+    added to the store when the model finishes (see storeModel), or else when
+    it is read for the first time. The arrays are then read-only.
      
     @param dpath: folder that contains the MCMax outputfiles
     @type dpath: string
@@ -39,6 +136,10 @@ def readModelSpectrum(dpath,rt_spec=1,fn_spec='spectrum45.0.dat'):
                       
                       (default: spectrum45.0.dat)
     @type fn_spec: str
+    @keyword store: Use the spectrum store. If off, the files are parsed.
+    
+                    (default: 1)
+    @type store: bool
     
     @return: The wavelength and flux grids (micron,Jy)
     @rtype: (array,array)
@@ -47,31 +148,29 @@ def readModelSpectrum(dpath,rt_spec=1,fn_spec='spectrum45.0.dat'):
      
     rt_spec = int(rt_spec)
     try:    
-        if rt_spec:  
-            dfile = os.path.join(dpath,fn_spec)
-            this_data = DataIO.readCols(dfile)
-            #- if the lists are not empty
-            if list(this_data[0]) and list(this_data[1]):    
-                w = this_data[0]
-                f = this_data[1]
-            else: raise IOError
+        if rt_spec and os.path.isfile(os.path.join(dpath,fn_spec)):  
+            w,f,sel = readStored(dpath,[fn_spec],parseSpectrum,store)
         else: raise IOError                                
     except IOError:
         print 'No spectrum was found or ray-tracing is off for ' + \
               'this model. Taking average of theta-grid MCSpectra.'
-        dfiles = glob(os.path.join(dpath,'MCSpec*.dat'))
-        w = DataIO.readCols(filename=dfiles[0])[0]
-        mcy_list = [DataIO.readCols(f)[1] for f in dfiles]
-        f = sum(mcy_list)/len(mcy_list)
-    return (w,f)
+        dfiles = sorted([os.path.split(fn)[1] 
+                         for fn in glob(os.path.join(dpath,'MCSpec*.dat'))])
+        w,f,sel = readStored(dpath,dfiles,parseSpectrum,store)
+    return (w,f[0])
 
 
 
-def readVisibilities(dpath,fn_vis='visibility01.0.dat'):
+def readVisibilities(dpath,fn_vis='visibility01.0.dat',store=1):
     
     '''
     Read the model output visibilities, either as function of wavelength or
     baseline. 
+    
+    The visibilities are read from the spectrum store of the models folder.
+    They are added to the store when the model finishes (see storeModel), or 
+    else when they are read for the first time. The arrays are then 
+    read-only.
      
     @param dpath: folder that contains the MCMax outputfiles
     @type dpath: string
@@ -82,6 +181,10 @@ def readVisibilities(dpath,fn_vis='visibility01.0.dat'):
                       
                       (default: visibility01.0.dat)
     @type fn_spec: str
+    @keyword store: Use the spectrum store. If off, the file is parsed.
+    
+                    (default: 1)
+    @type store: bool
     
     @return: A dictionary containing either wavelength or baseline, the flux, 
              and the visibilities for either given baselines or wavelengths
@@ -93,8 +196,7 @@ def readVisibilities(dpath,fn_vis='visibility01.0.dat'):
     dfile = os.path.join(dpath,fn_vis)
     if not os.path.isfile(dfile):
         return dict()
-    cols, comments = DataIO.readCols(dfile,return_comments=1)
-    comments = [comment for comment in comments if comment]
+    x,y,sel = readStored(dpath,[fn_vis],parseVisibilities,store)
     
     if 'visibility' in fn_vis: 
         xtype = 'wavelength'
@@ -103,16 +205,54 @@ def readVisibilities(dpath,fn_vis='visibility01.0.dat'):
         xtype = 'baseline'
         seltype = 'wavelength'
     model = dict()
-    model[xtype] = cols[0]
-    model['flux'] = cols[1]
-    model[seltype] = dict()
-    for i,comment in enumerate(comments[2:]):
-        val = float(comment.partition(seltype)[2].partition(',')[0])
-        model[seltype][val] = cols[2+i]
+    model[xtype] = x
+    model['flux'] = y[0]
+    model[seltype] = dict(zip(sel,y[1:]))
     return model
 
 
 
+def storeModel(dpath,rt_spec=1,inclination=45.0,nosource=0):
+
+    '''
+    Add the spectrum and visibilities of a finished model to the spectrum 
+    store of the models folder (see SpectrumStore), so they are not parsed 
+    when they are first read.
+    
+    The files are named as the readers expect them for the given ray-tracing
+    settings. Files that are not there are skipped, as is the spectrum if
+    ray-tracing is off and there are no MC spectra.
+    
+    @param dpath: folder that contains the MCMax outputfiles
+    @type dpath: string
+    
+    @keyword rt_spec: If a ray-traced spectrum is requested
+     
+                      (default: 1)
+    @type rt_spec: bool
+    @keyword inclination: The inclination of the ray tracing
+                          
+                          (default: 45.0)
+    @type inclination: float
+    @keyword nosource: If the central source was removed from the model 
+                       observations
+    
+                       (default: 0)
+    @type nosource: bool
+    
+    '''
+    
+    suffix = '{:04.1f}{:s}.dat'.format(inclination,nosource and 'NOSTAR' or '')
+    fn_spec = 'spectrum' + suffix
+    #-- Only store the spectrum that readModelSpectrum reads for rt_spec
+    if (int(rt_spec) and os.path.isfile(os.path.join(dpath,fn_spec))) \
+            or glob(os.path.join(dpath,'MCSpec*.dat')):
+        readModelSpectrum(dpath,rt_spec,fn_spec)
+    for prefix in ['visibility','basevis']:
+        readVisibilities(dpath,prefix+suffix)
+    
+    
+    
 def rayTrace(rt_type,model_id='',path_mcmax='',modelfolder='',outputfolder='',\
              inputfilename='',nosource=0,redo=0,inclination=45.0):
     
@@ -245,7 +385,7 @@ class MCMax(ModelingSession):
     """
     
     def __init__(self,path_mcmax='runTest',replace_db_entry=0,db=None,\
-                 new_entries=[],single_session=0):
+                 new_entries=[],single_session=0,plan=None):
         
         """ 
         Initializing an instance of ModelingSession.
@@ -276,18 +416,28 @@ class MCMax(ModelingSession):
                                  
                                  (default: 0)
         @type single_session: bool
+        @keyword plan: The execution plan of the grid. Models it found in the 
+                       database are retrieved without a database check. 
+                       
+                       (default: None)
+        @type plan: Planner()
                 
         """
         
         super(MCMax, self).__init__(code='MCMax',path=path_mcmax,\
                                     replace_db_entry=replace_db_entry,\
                                     new_entries=new_entries,\
-                                    single_session=single_session)
+                                    single_session=single_session,\
+                                    plan=plan)
         #-- Convenience path
         cc.path.mout = os.path.join(cc.path.mcmax,self.path)
         DataIO.testFolderExistence(os.path.join(cc.path.mout,\
                                                 'data_for_gastronoom'))
         self.db = db
+        #-- A fingerprint index on all parameters, including the dust species,
+        #   speeds up the database check.
+        if not self.db is None:
+            self.db.addIndex('mcmax')
         self.mcmax_done = False
         
         #-- If an mcmax model is in progress, the model manager will hold until
@@ -321,6 +471,14 @@ class MCMax(ModelingSession):
         for obstype in obs_request: 
             rayTrace(rt_type=obstype,path_mcmax=star.path_mcmax,\
                      model_id=star['LAST_MCMAX_MODEL'],**kwargs)
+        
+        #-- The model is finished: add its output to the spectrum store. 
+        #   Output moved elsewhere is not read from the models folder.
+        if star['LAST_MCMAX_MODEL'] and not kwargs['outputfolder']:
+            dpath = os.path.join(cc.path.mcmax,star.path_mcmax,'models',\
+                                 star['LAST_MCMAX_MODEL'])
+            storeModel(dpath,star['RT_SPEC'],kwargs['inclination'],\
+                       kwargs['nosource'])
 
 
             
@@ -429,6 +587,16 @@ class MCMax(ModelingSession):
         
         """
         
+        #-- Models the execution plan found in the database are finished. They
+        #   are retrieved without locking and synchronizing the database.
+        model_id = self.getPlannedId('mcmax',self.command_list)
+        if model_id and self.db.has_key(model_id) \
+                and not self.db[model_id].has_key('IN_PROGRESS'):
+            print 'MCMax model has been calculated before with ID %s.'\
+                  %model_id
+            self.model_id = model_id
+            return 1
+        
         #-- Lock the MCMax database by opening it in read mode. It's closed
         #   once the database check is finalised. Note that in a case of a crash
         #   during the for loop, the python shell must be exited to unlock the 
@@ -436,7 +604,13 @@ class MCMax(ModelingSession):
         #   end since the file on the disk will not change.
         if not self.single_session: self.db.sync()
         mcm_dbfile = self.db._open('r')
-        db_ids = sorted(self.db.keys())
+        
+        #-- Only models that can match are checked. Depending on the database
+        #   engine, this is a preselection, or simply all models in the db.
+        kws = [k for k in self.command_list.keys() if k != 'dust_species']
+        db_ids = [p[0] 
+                  for p in self.db.selectKeys(query=self.command_list,\
+                                              keywords=kws,index='mcmax')]
         for i,model_id in enumerate(db_ids):
             mcm_dict = self.db[model_id]
             model_bool = self.compareCommandLists(self.command_list.copy(),\
@@ -467,13 +641,13 @@ class MCMax(ModelingSession):
             #-- Reached the end of db without match. Make new entry in db, in
             #   progress. Cant combine this with next line in case the last
             #   model gives a match.
-            if i == len(self.db)-1:
+            if i == len(db_ids)-1:
                 print 'No match found in MCMax database. ' + \
                       'Calculating new model.'
                 finished = 0
         
         #-- In case of an empty db, the above loop is not accessed.
-        if not self.db.keys():
+        if not db_ids:
             print 'No match found in MCMax database. Calculating new model.'
             finished = 0
         
@@ -489,25 +663,42 @@ class MCMax(ModelingSession):
         return finished
         
         
+        
+    def findModel(self):
+    
+        '''
+        Find the model matching the command list in the MCMax database.
+        
+        Unlike checkDatabase(), the database is not synchronized, locked or 
+        changed. 
+        
+        @return: The model id, empty if no match is found
+        @rtype: string
+        
+        '''
+        
+        kws = [k for k in self.command_list.keys() if k != 'dust_species']
+        db_ids = [p[0] 
+                  for p in self.db.selectKeys(query=self.command_list,\
+                                              keywords=kws,index='mcmax')]
+        for model_id in db_ids:
+            if self.compareCommandLists(self.command_list.copy(),\
+                                        self.db[model_id]):
+                return model_id
+        return ''
+        
+        
             
-    def doMCMax(self,star):
+    def setCommandList(self,star):
         
         """
-        Running MCMax.
+        Set the MCMax command list for a parameter set.
         
         @param star: The parameter set for this session
         @type star: Star()
         
         """
-
-        print '***********************************'                                       
-        #- Create the input dictionary for this MCMax run
-        print '** Making input file for MCMax'
-        #-- Add the previous model_id to the list of new entries, so it does 
-        #   not get deleted if replace_db_entry == 1. 
-        if self.model_id: 
-            self.new_entries.append(self.model_id)
-        self.model_id = ''
+        
         self.command_list = dict()
         self.command_list['photon_count'] = star['PHOTON_COUNT']
         if star['STARFILE']:
@@ -616,12 +807,34 @@ class MCMax(ModelingSession):
                 print('WARNING! %s has an old opacity file. Should replace for reproducibility.'%species)
             dust_dict[star.dust[species]['fn']] = species_dict
         self.command_list['dust_species'] = dust_dict
+        
+        
+        
+    def doMCMax(self,star):
+        
+        """
+        Running MCMax.
+        
+        @param star: The parameter set for this session
+        @type star: Star()
+        
+        """
+
+        print '***********************************'                                       
+        #- Create the input dictionary for this MCMax run
+        print '** Making input file for MCMax'
+        #-- Add the previous model_id to the list of new entries, so it does 
+        #   not get deleted if replace_db_entry == 1. 
+        if self.model_id: 
+            self.new_entries.append(self.model_id)
+        self.model_id = ''
+        self.setCommandList(star)
         print '** DONE!'
         print '***********************************'
         
         #-- Check the MCMax database if the model was calculated before
         modelbool = self.checkDatabase()
-                
+        
         #-- if no match found in database, calculate new model with new model id 
         #-- if the calculation did not fail, add entry to database for new model
         if not modelbool:
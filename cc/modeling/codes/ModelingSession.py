@@ -24,7 +24,7 @@ class ModelingSession(object):
     """
       
     def __init__(self,code,path,replace_db_entry=0,new_entries=[],\
-                 single_session=0):
+                 single_session=0,plan=None):
         
         """ 
         Initializing an instance of ModelingSession.
@@ -52,10 +52,16 @@ class ModelingSession(object):
                                  
                                  (default: 0)
         @type single_session: bool
+        @keyword plan: The execution plan of the grid. Models it found in the 
+                       databases are retrieved without a database check. 
+                       
+                       (default: None)
+        @type plan: Planner()
                   
         """
         
         self.path = path
+        self.plan = plan
         self.code = code
         self.model_id = ''
         self.replace_db_entry = replace_db_entry
@@ -88,6 +94,40 @@ class ModelingSession(object):
                   
                   
                   
+    def getPlannedId(self,code,pars,keywords=None,path=()):
+        
+        '''
+        Get the id of a model that was found in the database by the execution 
+        plan.
+        
+        See Planner.getModelId().
+        
+        @param code: The (sub)code of the model
+        @type code: string
+        @param pars: The parameters of the model
+        @type pars: dict
+        
+        @keyword keywords: The keywords that define the model. All if None.
+        
+                           (default: None)
+        @type keywords: list[str]
+        @keyword path: The ids of the models this model depends on
+        
+                       (default: ())
+        @type path: tuple
+        
+        @return: The model id, empty if the model is not known to the plan, or 
+                 if database entries are replaced
+        @rtype: string
+        
+        '''
+        
+        if self.plan is None or self.replace_db_entry:
+            return ''
+        return self.plan.getModelId(code,pars,keywords,path)
+        
+        
+        
     def setCommandKey(self,comm_key,star,key_type,star_key=None,\
                       alternative=None,make_int=0,exp_not=0):
         
@@ -0,0 +1,305 @@
+"""
+Unit test covering the ALI + EB iteration in codes.ALI.py
+"""
+
+import os
+import time
+import glob
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import cc.path
+from cc.modeling.codes import ALI
+
+#-- A stand-in for the ALI executable: the populations written for an
+#   inputfile are the temperature profile it was given.
+STUB_ALI = '''#!/bin/sh
+fnT=`grep -A1 Tkin $1.inp | tail -1 | cut -d' ' -f2`
+cp $fnT $1.pop
+'''
+
+#-- A stand-in for the ALI executable that runs as long as its inputfile says,
+#   logging when it starts and ends. Inputfiles named fail* fail.
+STUB_ALI_RUNS = '''#!/bin/sh
+echo $$ > $1.pid
+echo start $1 >> runs.txt
+case $1 in fail*) exit 3;; esac
+sleep `cat $1.inp`
+echo end $1 >> runs.txt
+'''
+
+#-- The keys in an ALI inputfile that are updated between iterations
+ALI_INPUT = ['Tkin','I temp.dat 1.0','PassBand','0 0.9 1','MaxIter',\
+             '100 0 0 0 0 1e-4']
+
+
+
+def contraction(T,Tstar,c):
+
+    '''
+    A fixed-point map that contracts T towards Tstar in log(T), with a factor
+    c per iteration.
+
+    '''
+
+    return np.exp(np.log(Tstar)+c*(np.log(T)-np.log(Tstar)))
+
+
+
+class Temperature(object):
+
+    """A temperature profile, as Temperature()"""
+
+    def __init__(self,T):
+        self.T = np.array(T)
+
+    def eval(self,*args,**kwargs):
+        return self.T
+
+
+
+class EnergyBalance(object):
+
+    """
+    The temperature iteration of an EnergyBalance(), for populations that are
+    a given temperature profile: the EB converges to a profile contracted
+    towards Tstar from that of the populations.
+
+    """
+
+    def __init__(self,r,T,Tstar,c):
+        self.r, self.Tstar, self.c = r, Tstar, c
+        self.molecules = ['m']
+        self.i = 0
+        self.T_iter = {0: Temperature(T)}
+        self.pop = T
+        self.profiles = []
+        self.starts = []
+        self.inner_eps = 0
+
+    @property
+    def T(self):
+        return self.T_iter[self.i]
+
+    def setTProfile(self,T):
+        self.profiles.append(np.array(T))
+        self.T_iter[self.i] = Temperature(T)
+
+    def updatePop(self,m,fn):
+        self.pop = np.loadtxt(fn)[:,1]
+
+    def iterT(self,conv=0.01,imax=50,dTmax=0.1,**kwargs):
+        self.starts.append((self.T.eval(),self.pop))
+        while True:
+            Tnew = contraction(self.pop,self.Tstar,self.c)
+            dT = np.max(np.abs(Tnew/self.T.eval()-1.))
+            self.i += 1
+            self.T_iter[self.i] = Temperature(Tnew)
+            if dT < conv or self.i >= imax:
+                break
+
+
+
+class MixerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.Tstar = np.logspace(3,1,50)
+        self.T0 = self.Tstar*np.exp(rng.uniform(-1,1,50))
+        self.c = np.linspace(0.5,0.9,50)
+
+    def iterate(self,mixer,n):
+        x = self.T0
+        res = []
+        for i in range(n):
+            g = contraction(x,self.Tstar,self.c)
+            res.append(np.max(np.abs(1.-g/x)))
+            x = mixer.update(x,g)
+        return x, np.array(res)
+
+    def testNone(self):
+        """ Without acceleration, the next profile is the EB output """
+        g = contraction(self.T0,self.Tstar,self.c)
+        self.assertTrue(ALI.Mixer(accel='none').update(self.T0,g) is g)
+        self.assertRaises(ValueError,ALI.Mixer,accel='broyden')
+        self.assertEqual(ALI.Mixer(accel='aitken',depth=3).depth,1)
+
+    def testAnderson(self):
+        """ Anderson mixing converges to the fixed point, faster than plain """
+        x, res = self.iterate(ALI.Mixer(accel='anderson',depth=3),12)
+        x0, res0 = self.iterate(ALI.Mixer(accel='none'),12)
+        self.assertTrue(np.allclose(x,self.Tstar,rtol=1e-2))
+        self.assertTrue(res[-1] < 0.05*res0[-1])
+        self.assertTrue(np.all(res0[1:] < res0[:-1]))
+        x1, res1 = self.iterate(ALI.Mixer(accel='aitken'),12)
+        self.assertTrue(res[-1] < res1[-1] < res0[-1])
+
+    def testRestart(self):
+        """ The history is restarted when the residual grows """
+        mixer = ALI.Mixer(accel='anderson',depth=2)
+        for i in range(4):
+            mixer.update(self.Tstar*1.1**(0.5**i),self.Tstar)
+        self.assertEqual(mixer.getDepth(),2)
+        mixer.update(self.Tstar*2,self.Tstar)
+        self.assertEqual(mixer.getDepth(),0)
+
+    def testCheckpoint(self):
+        """ The state of the iteration survives a checkpoint """
+        path = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(path,'model_iter.chk')
+            self.assertTrue(ALI.readCheckpoint(fn) is None)
+            mixer = ALI.Mixer()
+            x, res = self.iterate(mixer,3)
+            ALI.writeCheckpoint(fn,i=3,x=x,mixer=mixer)
+            state = ALI.readCheckpoint(fn)
+            self.assertEqual(os.listdir(path),['model_iter.chk'])
+            self.assertEqual(state['i'],3)
+            self.assertTrue(np.array_equal(state['x'],x))
+            g = contraction(x,self.Tstar,self.c)
+            self.assertTrue(np.array_equal(state['mixer'].update(x,g),\
+                                           mixer.update(x,g)))
+        finally:
+            shutil.rmtree(path)
+
+
+
+class RunEBALITestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ali = cc.path.ali
+        cc.path.ali = tempfile.mkdtemp()
+        fn = os.path.join(cc.path.ali,'ali')
+        with open(fn,'w') as f:
+            f.write(STUB_ALI)
+        os.chmod(fn,0755)
+        self.afn = os.path.join(cc.path.ali,'model.inp')
+        with open(self.afn,'w') as f:
+            f.write('\n'.join(ALI_INPUT)+'\n')
+        rng = np.random.RandomState(2)
+        self.r = np.logspace(14,17,40)
+        self.Tstar = np.logspace(3,1,40)
+        self.T0 = self.Tstar*np.exp(rng.uniform(-1,1,40))
+
+    def tearDown(self):
+        shutil.rmtree(cc.path.ali)
+        cc.path.ali = self.ali
+
+    def runIteration(self,**kwargs):
+        eb = EnergyBalance(self.r,self.T0,self.Tstar,0.9)
+        ALI.runEB_ALI(self.afn,eb=eb,iterT_kwargs={'conv':1e-3},**kwargs)
+        return eb
+
+    def testPlain(self):
+        """ By default, the plain iteration without any checkpoint files """
+        eb = self.runIteration()
+        self.assertEqual(eb.profiles,[])
+        self.assertTrue(np.allclose(eb.T.eval(),self.Tstar,rtol=1e-2))
+        self.assertFalse(glob.glob(os.path.join(cc.path.ali,'*_iter.chk')))
+        self.assertFalse(glob.glob(os.path.join(cc.path.ali,'*_conv.log')))
+
+    def testAnderson(self):
+        """ The EB starts from the mixed profile, which is handed to ALI """
+        eb0 = self.runIteration()
+        eb = self.runIteration(accel='anderson',checkpoint=1)
+        self.assertTrue(np.allclose(eb.T.eval(),self.Tstar,rtol=1e-2))
+        self.assertTrue(eb.i < eb0.i/2)
+        #-- Every EB iteration starts from the profile ALI was given, which 
+        #   is written with 4 significant digits
+        self.assertEqual(len(eb.profiles),len(eb.starts)-1)
+        for T,pop in eb.starts[1:]:
+            self.assertTrue(np.allclose(T,pop,rtol=1e-3))
+        log = os.path.join(cc.path.ali,'model_conv.log')
+        self.assertEqual(len(open(log).readlines()),len(eb.profiles))
+        self.assertFalse(os.path.isfile(self.afn.replace('.inp','_iter.chk')))
+
+
+
+class ExecALIsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ali = cc.path.ali
+        cc.path.ali = tempfile.mkdtemp()
+        fn = os.path.join(cc.path.ali,'ali')
+        with open(fn,'w') as f:
+            f.write(STUB_ALI_RUNS)
+        os.chmod(fn,0755)
+
+    def tearDown(self):
+        shutil.rmtree(cc.path.ali)
+        cc.path.ali = self.ali
+
+    def makeInput(self,durations):
+        fns = []
+        for name,duration in durations:
+            fns.append(os.path.join(cc.path.ali,name+'.inp'))
+            with open(fns[-1],'w') as f:
+                f.write(str(duration))
+        return fns
+
+    def getRuns(self):
+        with open(os.path.join(cc.path.ali,'runs.txt')) as f:
+            return [line.split() for line in f]
+
+    def isStopped(self,name,timeout=2.):
+        with open(os.path.join(cc.path.ali,name+'.pid')) as f:
+            pid = int(f.read())
+        t0 = time.time()
+        while time.time()-t0 < timeout:
+            try:
+                os.kill(pid,0)
+            except OSError:
+                return True
+            #-- A killed process is not necessarily reaped yet (zombie)
+            if os.path.isfile('/proc/%i/stat'%pid):
+                with open('/proc/%i/stat'%pid) as f:
+                    if f.read().rpartition(')')[2].split()[0] == 'Z':
+                        return True
+            time.sleep(0.1)
+        return False
+
+    def testOrder(self):
+        """ Runs are concurrent, and reported as soon as they finish """
+        fns = self.makeInput([('m1',0.6),('m2',0.1),('m3',0.3)])
+        done = []
+        codes = ALI.execALIs(fns,callback=done.append)
+        self.assertEqual(codes,[0,0,0])
+        self.assertEqual(done,[1,2,0])
+        self.assertEqual([run[0] for run in self.getRuns()][:3],['start']*3)
+        self.assertTrue(os.path.isfile(os.path.join(cc.path.ali,'m1.log')))
+
+    def testWorkers(self):
+        """ At most workers runs at the same time """
+        fns = self.makeInput([('m1',0.3),('m2',0.1),('m3',0.1)])
+        done = []
+        ALI.execALIs(fns,workers=1,callback=done.append)
+        self.assertEqual(done,[0,1,2])
+        self.assertEqual(self.getRuns(),[[k,'m%i'%i] for i in [1,2,3]
+                                         for k in ['start','end']])
+        self.assertRaises(IOError,ALI.execALIs,fns+[fns[0]])
+
+    def testFailure(self):
+        """ A failed run raises an IOError, after the others are done """
+        fns = self.makeInput([('m1',0.3),('fail1',0),('m2',0.1)])
+        done = []
+        self.assertRaises(IOError,ALI.execALIs,fns,callback=done.append)
+        self.assertEqual(done,[2,0])
+
+    def testCallbackError(self):
+        """ Runs that are still going are killed if the callback fails """
+        fns = self.makeInput([('m1',0.1),('m2',30)])
+        def callback(j):
+            raise ValueError('Could not read the populations.')
+        t0 = time.time()
+        self.assertRaises(ValueError,ALI.execALIs,fns,callback=callback)
+        self.assertTrue(time.time()-t0 < 10)
+        self.assertTrue(self.isStopped('m2'))
+        self.assertEqual(self.getRuns(),[['start','m1'],['start','m2'],\
+                                         ['end','m1']])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+Unit test covering the storing of finished models in codes.MCMax.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from cc.modeling.codes import MCMax
+from cc.tools.io import SpectrumStore
+
+
+
+class StoreModelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.model_id = 'model_2015-01-01h10-00-00'
+        self.dpath = os.path.join(self.path,self.model_id)
+        os.mkdir(self.dpath)
+        self.w = np.logspace(0,3,50)
+        self.writeSpectrum('spectrum45.0.dat',self.w**-1)
+
+    def tearDown(self):
+        SpectrumStore._stores.pop(os.path.abspath(self.path),None)
+        shutil.rmtree(self.path)
+
+    def writeSpectrum(self,fn,f):
+        np.savetxt(os.path.join(self.dpath,fn),np.column_stack([self.w,f]))
+
+    def getEntry(self,fn,fns=None):
+        dfiles = [os.path.join(self.dpath,dfn) for dfn in (fns or [fn])]
+        ss = SpectrumStore.getStore(self.path)
+        return ss.get(self.model_id,fn,SpectrumStore.getStamp(dfiles))
+
+    def testRayTraced(self):
+        """ The ray-traced spectrum is stored if it is requested """
+        MCMax.storeModel(self.dpath,rt_spec=1)
+        x,y,sel = self.getEntry('spectrum45.0.dat')
+        self.assertTrue(np.allclose(x,self.w))
+        self.assertTrue(np.allclose(y[0],self.w**-1))
+
+    def testNoMCSpectra(self):
+        """ Without ray-tracing nor MC spectra, no spectrum is stored """
+        MCMax.storeModel(self.dpath,rt_spec=0)
+        self.assertTrue(self.getEntry('spectrum45.0.dat') is None)
+
+    def testMCSpectra(self):
+        """ Without ray-tracing, the average of the MC spectra is stored """
+        fns = ['MCSpec1.dat','MCSpec2.dat']
+        self.writeSpectrum(fns[0],self.w**-2)
+        self.writeSpectrum(fns[1],3*self.w**-2)
+        MCMax.storeModel(self.dpath,rt_spec=0)
+        self.assertTrue(self.getEntry('spectrum45.0.dat') is None)
+        x,y,sel = self.getEntry(fns[0],fns)
+        self.assertTrue(np.allclose(y[0],2*self.w**-2))
+        w,f = MCMax.readModelSpectrum(self.dpath,rt_spec=0)
+        self.assertTrue(np.array_equal(f,y[0]))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
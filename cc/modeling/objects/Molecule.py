@@ -12,10 +12,66 @@ import re
 
 import cc.path
 from cc.tools.io import DataIO
-from cc.tools.io.Database import Database
+from cc.tools.io.Database import openDatabase
 from cc.tools.readers import RadiatReader, MlineReader
 
 
+#-- The spectroscopy read by readRadiat and readRadiatIndices, shared by all 
+#   molecules in the session: {key: data}
+_radiat = dict()
+_radiat_indices = dict()
+
+
+
+def readRadiat(fn,nline,ny):
+    
+    '''
+    Read the radiat file of a molecule. 
+    
+    The file is read once per session, and the same RadiatReader is returned
+    for every molecule that uses it. The reader is not to be changed.
+    
+    @param fn: The radiat filename, including filepath.
+    @type fn: string
+    @param nline: The number of transitions included in the spectroscopy.
+    @type nline: int
+    @param ny: The number of levels included in the spectroscopy
+    @type ny: int
+    
+    @return: The radiat reader
+    @rtype: RadiatReader()
+    
+    '''
+    
+    key = (fn,nline,ny)
+    if not _radiat.has_key(key):
+        _radiat[key] = RadiatReader.RadiatReader(fn=fn,nline=nline,ny=ny)
+    return _radiat[key]
+    
+    
+
+def readRadiatIndices(filename):
+    
+    '''
+    Read the indices file of a molecule.
+    
+    The file is read once per session, and the same list is returned for every
+    molecule that uses it. The list is not to be changed.
+    
+    @param filename: The indices filename, including filepath.
+    @type filename: string
+    
+    @return: The level index followed by the quantum numbers, for every level
+    @rtype: list[list[int]]
+    
+    '''
+    
+    if not _radiat_indices.has_key(filename):
+        rf = DataIO.readFile(filename,' ')
+        _radiat_indices[filename] = [[int(i) for i in line] for line in rf]
+    return _radiat_indices[filename]
+    
+    
 
 def makeMoleculeFromDb(molec_id,molecule,path_gastronoom='codeSep2010',\
                        mline_db=None):
@@ -57,8 +113,8 @@ def makeMoleculeFromDb(molec_id,molecule,path_gastronoom='codeSep2010',\
         model_id = molec_id
         
     if mline_db is None:
-        molec_db = Database(os.path.join(cc.path.gout,\
-                                         'GASTRoNOoM_mline_models.db'))
+        molec_db = openDatabase(os.path.join(cc.path.gout,\
+                                             'GASTRoNOoM_mline_models.db'))
     else:
         molec_db = mline_db
     
@@ -417,8 +473,8 @@ class Molecule():
             else: 
                 fn = os.path.join(cc.path.gdata,'%s_radiat.dat'%self.molecule)
 
-            self.radiat = RadiatReader.RadiatReader(fn=fn,nline=self.nline,
-                                                    ny=self.ny_up+self.ny_low)
+            self.radiat = readRadiat(fn=fn,nline=self.nline,\
+                                     ny=self.ny_up+self.ny_low)
             if self.spec_indices:
                 if self.use_indices_dat:
                     f = DataIO.getInputData(path=cc.path.usr,start_index=4,\
@@ -428,8 +484,7 @@ class Molecule():
                 else:
                     filename = os.path.join(cc.path.gdata,\
                                          '{}_indices.dat'.format(self.molecule))
-                rf = DataIO.readFile(filename,' ')
-                self.radiat_indices = [[int(i) for i in line] for line in rf]
+                self.radiat_indices = readRadiatIndices(filename)
         else:
             self.radiat = None
             self.radiat_indices = None
@@ -91,6 +91,221 @@ def makeStars(models,id_type,path,code):
       
 
     
+class StarGrid(object):
+    
+    """
+    A grid of Star() objects that are generated on demand.
+    
+    The grid is the Cartesian product of a number of parameter axes, on top of
+    a list of additive parameter sets (the <:> declarations in the inputfile)
+    and a base parameter set. Besides the base star and the values per axis,
+    only the stars that were requested are in memory. A Star() is made from 
+    its index tuple when it is first requested, with the last axis varying 
+    fastest, as in the original list.
+    
+    The grid supports len(), iteration, random access and slicing. A slice is
+    a grid as well, sharing the generated stars with the full grid, eg for 
+    sharding the grid across workers.
+    
+    Generated stars are kept by default, since the modeling results (model 
+    ids, mutable parameters, data) are stored in them. If keep is off, a new
+    Star() is made every time, and the grid can be streamed without the 
+    stars accumulating in memory. This is only useful if the stars are not 
+    needed after they were passed through once, which is not the case in a 
+    ComboCode session.
+    
+    """
+    
+    def __init__(self,base_star,additive=[],axes=[],keep=1,\
+                 path_gastronoom='',path_mcmax='',print_check_t=1):
+        
+        """
+        Initializing a StarGrid instance.
+        
+        @param base_star: The parameters shared by all models in the grid
+        @type base_star: dict or Star()
+        
+        @keyword additive: The additive parameter sets. Every set is combined 
+                           with the multiplicative axes. If empty, only the 
+                           base star is combined with them.
+        
+                           (default: [])
+        @type additive: list[dict]
+        @keyword axes: The multiplicative axes, as a list of (key,values) pairs
+                       
+                       (default: [])
+        @type axes: list[(str,list)]
+        @keyword keep: Keep the generated Star() objects.
+        
+                       (default: 1)
+        @type keep: bool
+        @keyword path_gastronoom: path in ~/GASTRoNOoM/ for modeling out/input
+                                  
+                                  (default: '')
+        @type path_gastronoom: string
+        @keyword path_mcmax: the folder in ~/MCMax/ for modeling out/input
+        
+                             (default: '')
+        @type path_mcmax: string
+        @keyword print_check_t: Print the dust temperature check automatically
+        
+                                (default: 1)
+        @type print_check_t: bool
+        
+        """
+        
+        self.base_star = base_star
+        self.additive = additive and list(additive) or [dict()]
+        self.axes = [(k,list(v)) for k,v in axes]
+        self.keep = keep
+        self.star_pars = dict([('path_gastronoom',path_gastronoom),\
+                               ('path_mcmax',path_mcmax),\
+                               ('print_check_t',print_check_t)])
+        self.shape = tuple([len(self.additive)] \
+                           + [len(v) for k,v in self.axes])
+        self.size = reduce(operator.mul,self.shape,1)
+        self.indices = xrange(self.size)
+        self.stars = dict()
+        
+        
+        
+    def __len__(self):
+        
+        """
+        The number of models in the grid.
+        
+        @return: The number of models
+        @rtype: int
+        
+        """
+        
+        return len(self.indices)
+        
+        
+        
+    def __iter__(self):
+        
+        """
+        Iterate over the Star() objects in the grid, generating them on demand.
+        
+        """
+        
+        for index in self.indices:
+            yield self.getStar(index)
+            
+            
+            
+    def __getitem__(self,item):
+        
+        """
+        Get a Star() object, or a slice of the grid.
+        
+        @param item: The position in the grid, or a slice
+        @type item: int or slice
+        
+        @return: The Star() object, or the grid for the slice
+        @rtype: Star() or StarGrid()
+        
+        """
+        
+        if isinstance(item,slice):
+            grid = StarGrid.__new__(StarGrid)
+            grid.__dict__.update(self.__dict__)
+            #-- Slices of an xrange are composed, never expanded to a list.
+            start, stop, step = item.indices(len(self.indices))
+            if isinstance(self.indices,xrange) and len(self.indices) > 1:
+                i0, di = self.indices[0], self.indices[1]-self.indices[0]
+                grid.indices = xrange(i0+start*di,i0+stop*di,step*di)
+            else:
+                grid.indices = list(self.indices)[item]
+            return grid
+        return self.getStar(self.indices[item])
+        
+        
+        
+    def getIndexTuple(self,index):
+        
+        """
+        Convert the flat index of a model in the full grid to its index tuple:
+        the index of the additive parameter set, followed by the index on each 
+        axis.
+        
+        @param index: The flat index in the full grid
+        @type index: int
+        
+        @return: The index tuple
+        @rtype: tuple[int]
+        
+        """
+        
+        if index < 0 or index >= self.size:
+            raise IndexError('StarGrid index out of range.')
+        itup = []
+        for n in reversed(self.shape):
+            index, i = divmod(index,n)
+            itup.append(i)
+        return tuple(reversed(itup))
+        
+        
+        
+    def makeStar(self,index):
+        
+        """
+        Make a new Star() object for a model in the full grid.
+        
+        @param index: The flat index in the full grid
+        @type index: int
+        
+        @return: The parameter set
+        @rtype: Star()
+        
+        """
+        
+        itup = self.getIndexTuple(index)
+        extra_input = dict(self.additive[itup[0]])
+        extra_input.update([(k,v[i]) for (k,v),i in zip(self.axes,itup[1:])])
+        star = Star(example_star=self.base_star,extra_input=extra_input,\
+                    **self.star_pars)
+        star.normalizeDustAbundances()
+        return star
+        
+        
+        
+    def getStar(self,index):
+        
+        """
+        Get the Star() object for a model in the full grid. 
+        
+        It is generated if it was not kept before.
+        
+        @param index: The flat index in the full grid
+        @type index: int
+        
+        @return: The parameter set
+        @rtype: Star()
+        
+        """
+        
+        if self.stars.has_key(index):
+            return self.stars[index]
+        star = self.makeStar(index)
+        if self.keep: 
+            self.stars[index] = star
+        return star
+        
+        
+        
+    def release(self):
+        
+        """
+        Forget all generated Star() objects kept by the grid (and its slices).
+        
+        """
+        
+        self.stars.clear()
+      
+
+    
 class Star(dict):
     
     """
@@ -325,7 +540,7 @@ class Star(dict):
         #-- Set the path, and extract the parameters dictionary from the db
         cooling_path = os.path.join(cc.path.gout,\
                                     'GASTRoNOoM_cooling_models.db')
-        cool_db = Database.Database(cooling_path)
+        cool_db = Database.openDatabase(cooling_path)
         db_dict = cool_db[self['LAST_GASTRONOOM_MODEL']]
         
         #-- Only set a small subset of keys for now. These will always be in the
@@ -516,7 +731,8 @@ class Star(dict):
             self['LS_NO_VIB'] = []
         elif type(self['LS_NO_VIB']) is types.StringType:
             self['LS_NO_VIB'] = [self['LS_NO_VIB']]
-        ctrl = [tr.getInputString(include_nquad=0) for tr in self['GAS_LINES']]
+        ctrl = set([tr.getInputString(include_nquad=0) 
+                    for tr in self['GAS_LINES']])
         for molec in self['GAS_LIST']:
             for telescope in self['LS_TELESCOPE']:
                 if telescope == 'PACS':
@@ -800,8 +1016,8 @@ class Star(dict):
         if not self['LAST_MCMAX_MODEL']: return empty(0)
     
         fn = self.getDustFn(species)
-        rad = array(DataIO.getKeyData(incr=int(self['NRAD']),\
-                                      keyword='RADIUS',filename=fn))
+        rad = array(DataIO.getCachedKeyData(incr=int(self['NRAD']),\
+                                            keyword='RADIUS',filename=fn))
         
         unit = str(unit).lower()
         if unit == 'au':
@@ -837,8 +1053,8 @@ class Star(dict):
         if not self['LAST_MCMAX_MODEL']: return empty(0)
     
         fn = self.getDustFn(species)
-        theta = array(DataIO.getKeyData(incr=int(self['NTHETA']),\
-                                        keyword='THETA',filename=fn))
+        theta = array(DataIO.getCachedKeyData(incr=int(self['NTHETA']),\
+                                              keyword='THETA',filename=fn))
         return theta
         
         
@@ -883,8 +1099,8 @@ class Star(dict):
         #   over the theta coordinate, if requested.
         fn = self.getDustFn(species)
         incr = int(self['NRAD'])*int(self['NTHETA'])
-        dens_ori = DataIO.getKeyData(filename=fn,incr=incr,\
-                                     keyword='DENSITY')
+        dens_ori = DataIO.getCachedKeyData(filename=fn,incr=incr,\
+                                           keyword='DENSITY')
         if avg_theta: dens = Data.reduceArray(dens_ori,self['NTHETA'])
         else: dens = dens_ori
         
@@ -942,8 +1158,8 @@ class Star(dict):
         #   over the theta coordinate, if requested.
         fn = self.getDustFn(species)
         incr = int(self['NRAD'])*int(self['NTHETA'])
-        temp_ori = DataIO.getKeyData(incr=incr,keyword='TEMPERATURE',\
-                                     filename=fn)
+        temp_ori = DataIO.getCachedKeyData(incr=incr,keyword='TEMPERATURE',\
+                                           filename=fn)
         if avg_theta: temp = Data.reduceArray(temp_ori,self['NTHETA'])
         else: temp = temp_ori
 
@@ -3499,8 +3715,8 @@ class Star(dict):
                     #   Can use GAS_LINES key, as it contains both manual and 
                     #   other lines, but the latter are also assigned 
                     #   self['N_QUAD'] anyway
-                    ctrl = [tr.getInputString(include_nquad=0) 
-                            for tr in self['GAS_LINES']]
+                    ctrl = set([tr.getInputString(include_nquad=0) 
+                                for tr in self['GAS_LINES']])
                     nl = [tr for tr in nl
                              if tr.getInputString(include_nquad=0) not in ctrl]
                     self['GAS_LINES'].extend(nl)    
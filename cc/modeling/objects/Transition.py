@@ -33,6 +33,13 @@ from cc.data import LPTools
 from cc.tools.units import Equivalency as eq
 
 
+#-- The spectroscopic catalogs made by getCatalog, and the Transition() 
+#   prototypes cloned by makeTransitionsFromRadiat. Both are shared by all 
+#   molecules in the session.
+_catalog = dict()
+_prototypes = dict()
+
+
 def getLineStrengths(trl,mode='dint',nans=1,n_data=0,scale=0,**kwargs):
 
     
@@ -276,6 +283,34 @@ def extractTransFromStars(star_grid,sort_freq=1,sort_molec=1,dtype='all',\
 
 
 
+def readSphinxMany(trans_list,num_threads=4):
+    
+    '''
+    Read the sphinx output of many transitions with a pool of threads. 
+    
+    Equivalent to calling readSphinx() for every transition. Transitions with
+    sphinx output already read, or without a valid model id, are skipped. 
+    
+    @param trans_list: The transitions
+    @type trans_list: list[Transition()]
+    
+    @keyword num_threads: The number of threads reading files in parallel
+    
+                          (default: 4)
+    @type num_threads: int
+    
+    '''
+    
+    todo = [trans 
+            for trans in trans_list 
+            if not trans is None and trans.sphinx is None \
+                and trans.getModelId()]
+    fns = [trans.makeSphinxFilename(include_path=1) for trans in todo]
+    for trans,sphinx in zip(todo,SphinxReader.readMany(fns,num_threads)):
+        trans.sphinx = sphinx
+    
+    
+    
 def updateLineSpec(trans_list):
     
     '''
@@ -718,10 +753,65 @@ def makeTransitionsFromRadiat(molec,telescope,ls_min,ls_max,ls_unit='GHz',\
               'min_tau_step':min_tau_step,'tau_max':tau_max,\
               'write_intensities':write_intensities,'tau_min':tau_min,\
               'check_tau_step':check_tau_step,'n_quad':n_quad,\
-              "offset":offset,'path_gastronoom':path_gastronoom,\
-              'telescope':telescope,'molecule':molec}
+              "offset":offset,'path_gastronoom':path_gastronoom}
+    
+    #-- Select the transitions in range from the frequency-sorted catalog. The
+    #   strict inequalities of the range are kept. Sorting the selection 
+    #   restores the order of the spectroscopy file.
+    cat = getCatalog(molec)
+    if not cat['wave'].has_key(ls_unit):
+        wave = molec.radiat.getTFrequency(unit=ls_unit)
+        order = np.argsort(wave,kind='mergesort')
+        cat['wave'][ls_unit] = (wave[order],order)
+    wave,order = cat['wave'][ls_unit]
+    imin = np.searchsorted(wave,ls_min,side='right')
+    imax = np.searchsorted(wave,ls_max,side='left')
+    sel = np.sort(order[imin:imax])
+    if no_vib:
+        sel = [k for k in sel if cat['quantum'][k]['vup'] == 0]
+    
+    #-- Clone the interned prototypes, making them if needed
+    nl = []
+    for k in sel:
+        pkey = (cat['key'],telescope,k)
+        if not _prototypes.has_key(pkey):
+            proto = Transition(molecule=molec,telescope=telescope,\
+                               frequency=cat['frequency'][k],\
+                               **cat['quantum'][k])
+            proto.lup = cat['lup'][k]
+            proto.llow = cat['llow'][k]
+            proto.tindex = cat['tindex'][k]
+            _prototypes[pkey] = proto
+        nl.append(_prototypes[pkey].clone(molecule=molec,**trkeys))
+    return nl
+
+
+
+def getCatalog(molec):
+    
+    '''
+    Get the spectroscopic catalog of a molecule, based on its radiat file.
+    
+    The catalog is made once per session for every spectroscopy setup, and 
+    shared by all Molecule() objects with the same setup. It contains the 
+    quantum numbers, level indices and frequencies of all transitions in the 
+    radiat file, and the transitions sorted by frequency for every unit 
+    requested in makeTransitionsFromRadiat. 
+    
+    @param molec: The molecule for which the catalog is requested.
+    @type molec: Molecule()
+    
+    @return: The catalog. Not to be changed, except by adding units to 'wave'.
+    @rtype: dict
+    
+    '''
+    
     radiat = molec.radiat
-    wave = radiat.getTFrequency(unit=ls_unit)
+    key = (molec.molecule,radiat.fn,radiat.nline,radiat.ny,molec.ny_low,\
+           molec.ny_up,molec.spec_indices,molec.use_indices_dat)
+    if _catalog.has_key(key): 
+        return _catalog[key]
+    
     low = radiat.getTLower()
     up = radiat.getTUpper()
     if not molec.spec_indices:
@@ -729,34 +819,26 @@ def makeTransitionsFromRadiat(molec,telescope,ls_min,ls_max,ls_unit='GHz',\
         #- molec.ny_up is the number of levels above gs vib state
         #- generally ny_up/ny_low +1 is the number of vib states
         ny_low = molec.ny_low
-        n_vib = int(molec.ny_up/ny_low) + 1 
-        indices = [[i+1,int(i/ny_low),i-ny_low*int(i/ny_low)]
-                    for i in xrange(molec.ny_low*n_vib)]
-        nl = [Transition(vup=int(indices[u-1][1]),\
-                         jup=int(indices[u-1][2]),\
-                         vlow=int(indices[l-1][1]),\
-                         jlow=int(indices[l-1][2]),\
-                         **trkeys)
-              for l,u,w in zip(low,up,wave)
-              if w > ls_min and w < ls_max]
+        quantum = [{'vup':int((u-1)/ny_low),'jup':int((u-1)%ny_low),\
+                    'vlow':int((l-1)/ny_low),'jlow':int((l-1)%ny_low)}
+                   for l,u in zip(low,up)]
     else:
         indices = molec.radiat_indices
-        quantum = ['v','j','ka','kc']
-        nl = [] 
-        for l,u,w in zip(low,up,wave):
-            if w > ls_min and w < ls_max:
-                quantum_dict = dict()
-                #- some molecs only have 2 or 3 quantum numbers
-                for i in xrange(1,len(indices[0])):    
-                    quantum_dict[quantum[i-1]+'up'] = \
-                                            int(indices[u-1][i])
-                    quantum_dict[quantum[i-1]+'low'] = \
-                                            int(indices[l-1][i])
-                trkeys.update(quantum_dict)
-                nl.append(Transition(**trkeys))
-    if no_vib:
-        nl = [line for line in nl if line.vup == 0]
-    return nl
+        qnames = ['v','j','ka','kc']
+        quantum = []
+        for l,u in zip(low,up):
+            quantum_dict = dict()
+            #- some molecs only have 2 or 3 quantum numbers
+            for i in xrange(1,len(indices[0])):    
+                quantum_dict[qnames[i-1]+'up'] = int(indices[u-1][i])
+                quantum_dict[qnames[i-1]+'low'] = int(indices[l-1][i])
+            quantum.append(quantum_dict)
+    
+    _catalog[key] = {'key':key,'quantum':quantum,\
+                     'lup':[int(i) for i in up],'llow':[int(i) for i in low],\
+                     'tindex':[int(i) for i in radiat.getTI()],\
+                     'frequency':radiat.getTFrequency(unit='Hz'),'wave':{}}
+    return _catalog[key]
 
 
 
@@ -782,14 +864,16 @@ def checkUniqueness(trans_list):
     '''
 
     merged = []
+    seen = dict()
     for trans in trans_list:
-        if trans not in merged: 
+        if not seen.has_key(trans): 
+            seen[trans] = trans
             merged.append(trans)
         else:
             #-- Only add data files if there are any to begin with.
             if not trans.datafiles is None:
                 ddict = dict(zip(trans.datafiles,trans.fittedlprof))
-                merged[merged.index(trans)].addDatafile(ddict)
+                seen[trans].addDatafile(ddict)
     return merged
     
     
@@ -1133,6 +1217,54 @@ class Transition():
 
 
 
+    def clone(self,molecule=None,**kwargs):
+        
+        '''
+        Make a copy of this transition, without any model or data information.
+        
+        The quantum numbers, telescope and frequency are kept. The numerical 
+        parameters for sphinx can be replaced by passing them as keywords, e.g.
+        n_quad, offset, fraction_tau_step or path_gastronoom.
+        
+        @keyword molecule: The molecule of the copy. Default is the molecule of 
+                           this transition.
+                           
+                           (default: None)
+        @type molecule: Molecule()
+        @keyword kwargs: Transition() properties to be replaced in the copy
+        @type kwargs: dict
+        
+        @return: The copied transition
+        @rtype: Transition()
+        
+        '''
+        
+        trans = copy.copy(self)
+        if not molecule is None: 
+            trans.molecule = molecule
+        if kwargs.has_key('n_quad'): kwargs['n_quad'] = int(kwargs['n_quad'])
+        if kwargs.has_key('offset'): kwargs['offset'] = float(kwargs['offset'])
+        for k,v in kwargs.items():
+            setattr(trans,k,v)
+        
+        #-- Reset everything that is model or data dependent
+        trans.__model_id = None
+        trans.sphinx = None
+        trans.datafiles = None
+        trans.lpdata = None 
+        trans.fittedlprof = None
+        trans.vlsr = None
+        trans.best_vlsr = None
+        trans.best_mtmb = None
+        trans.chi2_best_vlsr = None
+        if trans.unresolved: 
+            trans.unreso = dict()
+            trans.unreso_err = dict()
+            trans.unreso_blends = dict()
+        return trans
+        
+        
+
     def getInputString(self,include_nquad=1):
          
         '''
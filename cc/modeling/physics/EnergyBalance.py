@@ -10,7 +10,7 @@ listed here.
 
 """
 
-import os, collections, functools, copy
+import os, collections, functools, copy, math
 import numpy as np
 from scipy.interpolate import InterpolatedUnivariateSpline as spline1d
 from scipy.interpolate import interp1d
@@ -108,6 +108,249 @@ def dTdr(T,r,v,gamma,rates=None,warn=1):
 
 
 
+class TabulatedODE(object):
+
+    '''
+    A tabulated version of the differential equation for the kinetic 
+    temperature profile (see dTdr).
+    
+    The velocity, its derivative and the summed heating and cooling rates are
+    evaluated once on a dense radial table, uniform in log(r), and the 
+    adiabatic coefficient on a table uniform in log(T). The differential 
+    equation and its Jacobian then only do a constant-time table lookup and a
+    linear interpolation in plain floats, without calling Profiler objects or 
+    allocating arrays.
+    
+    Outside the radial table, the terms are extrapolated linearly. Outside the
+    temperature table, the adiabatic coefficient is constant, as for the 
+    Profiler of gamma.
+    
+    '''
+
+    def __init__(self,r,v,gamma,rates=None,Tmin=0.1,Tmax=1e5,nsub=10,\
+                 nT=2000,warn=1):
+    
+        '''
+        Initializing a TabulatedODE instance.
+        
+        @param r: The radial grid (cm)
+        @type r: array
+        @param v: The velocity profile object
+        @type v: Velocity() 
+        @param gamma: The adiabatic coefficient profile as function of T
+        @type gamma: Profiler()
+        
+        @keyword rates: The heating and cooling rates, summed up (erg/s/cm3, 
+                        H-C), as in dTdr. Default if only adiabatic cooling
+                        is taken into account.
+                  
+                        (default: None)
+        @type rates: Profiler()
+        @keyword Tmin: The lower bound of the temperature table (K)
+        
+                       (default: 0.1)
+        @type Tmin: float
+        @keyword Tmax: The upper bound of the temperature table (K)
+        
+                       (default: 1e5)
+        @type Tmax: float
+        @keyword nsub: The number of table points per interval of the radial
+                       grid
+        
+                       (default: 10)
+        @type nsub: int
+        @keyword nT: The number of points in the temperature table
+        
+                     (default: 2000)
+        @type nT: int
+        @keyword warn: Warn when extrapolation occurs in the evaluation of the
+                       profiles on the radial table.
+        
+                       (default: 1)
+        @type warn: bool
+        
+        '''
+        
+        #-- The radial table: the adiabatic factor 1/r + 0.5/v*dv/dr and the 
+        #   rates term rates/v.
+        nr = int(nsub)*(len(r)-1)+1
+        rt = np.logspace(np.log10(r[0]),np.log10(r[-1]),nr)
+        rt[0], rt[-1] = r[0], r[-1]
+        vt = v.eval(rt,warn=warn)
+        self.A = (1./rt + 0.5/vt*v.diff(rt,warn=warn)).tolist()
+        if rates:
+            self.B = (rates.eval(rt,warn=warn)/vt).tolist()
+        else:
+            self.B = [0.]*nr
+        self.lr0 = math.log(r[0])
+        self.ilr = (nr-1)/(math.log(r[-1])-self.lr0)
+        self.nr = nr
+        
+        #-- The temperature table: gamma and its derivative per interval
+        Tt = np.logspace(np.log10(Tmin),np.log10(Tmax),nT)
+        gt = gamma.eval(Tt,warn=0)*np.ones(nT)
+        self.g = gt.tolist()
+        self.dg = (np.diff(gt)/np.diff(Tt)).tolist()
+        self.Tt = Tt.tolist()
+        self.lT0 = math.log(Tmin)
+        self.ilT = (nT-1)/(math.log(Tmax)-self.lT0)
+        self.nT = nT
+        
+        #-- Output containers, reused for every call
+        self.out = np.zeros(1)
+        self.jout = np.zeros((1,1))
+        
+        
+        
+    def __lookup(self,T,r):
+    
+        '''
+        Look up the table values at a temperature and radius.
+        
+        @param T: The temperature (K)
+        @type T: float
+        @param r: The radius (cm)
+        @type r: float
+        
+        @return: The adiabatic coefficient, its derivative, the adiabatic 
+                 factor and the rates term
+        @rtype: (float,float,float,float)
+        
+        '''
+        
+        #-- Radial table, linear in log(r), extrapolated at the edges
+        x = (math.log(r)-self.lr0)*self.ilr
+        i = min(max(int(x),0),self.nr-2)
+        f = x-i
+        A, B = self.A, self.B
+        a = A[i] + f*(A[i+1]-A[i])
+        b = B[i] + f*(B[i+1]-B[i])
+        
+        #-- Temperature table, constant beyond the edges
+        if T <= self.Tt[0]:
+            return self.g[0], 0., a, b
+        j = int((math.log(T)-self.lT0)*self.ilT)
+        if j >= self.nT-1:
+            return self.g[-1], 0., a, b
+        dg = self.dg[j]
+        return self.g[j] + dg*(T-self.Tt[j]), dg, a, b
+        
+        
+        
+    def dTdr(self,T,r):
+    
+        '''
+        The differential equation for the kinetic temperature profile.
+        
+        @param T: The temperature (K)
+        @type T: array
+        @param r: The radius (cm)
+        @type r: float
+        
+        @return: The derivative with respect to radius (K/cm)
+        @rtype: array
+        
+        '''
+        
+        T = T[0]
+        g, dg, a, b = self.__lookup(T,r)
+        self.out[0] = (2.-2.*g)*a*T + (g-1.)*b
+        return self.out
+        
+        
+        
+    def jac(self,T,r):
+    
+        '''
+        The Jacobian of the differential equation with respect to T.
+        
+        @param T: The temperature (K)
+        @type T: array
+        @param r: The radius (cm)
+        @type r: float
+        
+        @return: The derivative of dT/dr with respect to T (1/cm)
+        @rtype: array
+        
+        '''
+        
+        T = T[0]
+        g, dg, a, b = self.__lookup(T,r)
+        self.jout[0,0] = (2.-2.*g)*a - 2.*dg*a*T + dg*b
+        return self.jout
+
+
+
+def interpIntervals(Tgrid,T):
+
+    '''
+    Determine the linear interpolation (and extrapolation) weights of points 
+    on a temperature grid, grouped per interval of the grid.
+    
+    For a monotonic temperature profile, the points in the same interval form
+    a contiguous block, selected with a slice. Otherwise, the points are 
+    grouped per interval with index arrays, so there is never more than one 
+    block per interval. 
+    
+    @param Tgrid: The temperature grid, increasing (K)
+    @type Tgrid: array
+    @param T: The temperature points (K)
+    @type T: array
+    
+    @return: The blocks as (selection, interval) with the slice or index 
+             array of the points and the index of the upper bound of the 
+             interval in Tgrid, and the weights of the lower and upper bound of
+             the interval for each point (2 x T). 
+    @rtype: (list[tuple],array)
+    
+    '''
+    
+    T = np.asarray(T,dtype=float)
+    j = np.clip(np.searchsorted(Tgrid,T,side='right'),1,len(Tgrid)-1)
+    dT = Tgrid[j]-Tgrid[j-1]
+    w = np.vstack([(Tgrid[j]-T)/dT,(T-Tgrid[j-1])/dT])
+    dj = np.diff(j)
+    if (dj >= 0).all() or (dj <= 0).all():
+        edges = np.concatenate([[0],np.flatnonzero(dj)+1,[len(T)]])
+        blocks = [(slice(s,e),j[s]) for s,e in zip(edges[:-1],edges[1:])]
+    else:
+        order = np.argsort(j,kind='mergesort')
+        js = j[order]
+        edges = np.concatenate([[0],np.flatnonzero(np.diff(js))+1,[len(T)]])
+        blocks = [(order[s:e],js[s]) for s,e in zip(edges[:-1],edges[1:])]
+    return blocks, w
+
+
+
+def interpRates(Tgrid,rates,T):
+
+    '''
+    Linear interpolation and extrapolation of a table of rates in temperature,
+    identical to a linear spline interpolator per row of the table.
+    
+    Per interval of the temperature grid, the interpolation reduces to a 
+    matrix product with two columns of the table. 
+    
+    @param Tgrid: The temperature grid of the table, increasing (K)
+    @type Tgrid: array
+    @param rates: The table, with one row per rate (rate x Tgrid)
+    @type rates: array
+    @param T: The temperature points (K)
+    @type T: array
+    
+    @return: The interpolated rates (rate x T)
+    @rtype: array
+    
+    '''
+    
+    blocks, w = interpIntervals(Tgrid,T)
+    out = np.empty((rates.shape[0],w.shape[1]))
+    for sel,j in blocks:
+        out[:,sel] = np.dot(rates[:,j-1:j+1],w[:,sel])
+    return out
+
+
+
 class EnergyBalance(object):
     
     '''
@@ -405,6 +648,7 @@ class EnergyBalance(object):
             self.Texc = {}
             self.ipop = {}
             self.mol = {}
+            self.lctable = {}
             
             #-- Set the dict entries for each molecule. Also add a decorated 
             #   function for each molecule that adds the molecule as an 
@@ -1299,6 +1543,28 @@ class EnergyBalance(object):
         
         
     
+    def setTProfile(self,T):
+    
+        '''
+        Replace the temperature profile of the current iteration, eg to 
+        restart from a checkpointed profile. 
+        
+        The T-dependent properties are recalculated, as after a calcT call.
+        
+        @param T: The temperature profile on the radial grid (K)
+        @type T: array
+        
+        '''
+        
+        Tinterp = spline1d(self.r,T,k=3,ext=3)
+        keys = {'inner':self.inner,'inner_eps':self.inner_eps,'r0':self.r0,
+                'T0':self.T0}
+        self.T_iter[self.i] = Temperature.Temperature(self.r,Tinterp,**keys)
+        self.__next_iter()
+        self.Cad()
+        
+        
+    
     def iterT(self,conv=0.01,imax=50,step_size=0.,dTmax=0.10,warn=1,\
               *args,**kwargs):
     
@@ -1386,6 +1652,12 @@ class EnergyBalance(object):
         Additionals arguments are passed on to the spline1d interpolation of the
         total cooling and heating terms, e.g. k=3, ext=0 are defaults.
         
+        If ode_method is table in the inputfile, the profiles in dTdr are 
+        tabulated once for this iteration, with ode_table points per radial 
+        grid interval, and odeint is given the analytic Jacobian for its stiff
+        solver (see TabulatedODE). This is much faster than evaluating the 
+        Profiler objects in every call of dTdr (ode_method = odeint).
+        
         @keyword dTmax: The maximum allowed relative temperature change for this
                         T calculation. Set to 100% by default.
                             
@@ -1451,9 +1723,19 @@ class EnergyBalance(object):
         else:
             rp = None 
         
-        #-- Calculate the next iteration of the temperature profile
-        ode_args = {'func': dTdr, 'y0': self.T0, 't': self.r,
-                    'args': (self.v,self.gamma,rp,warn)}
+        #-- Calculate the next iteration of the temperature profile. Either 
+        #   with dTdr evaluating the profiles in every call, or with the 
+        #   profiles tabulated once for this iteration, in which case the 
+        #   Jacobian is passed for the stiff part of the solver.
+        if self.pars.get('ode_method','odeint').lower() == 'table':
+            ode = TabulatedODE(self.r,self.v,self.gamma,rp,\
+                               nsub=int(self.pars.get('ode_table',10)),\
+                               warn=warn)
+            ode_args = {'func': ode.dTdr, 'y0': self.T0, 't': self.r,
+                        'Dfun': ode.jac}
+        else:
+            ode_args = {'func': dTdr, 'y0': self.T0, 't': self.r,
+                        'args': (self.v,self.gamma,rp,warn)}
         ode_args.update(ode_kwargs)
         Tr = odeint(**ode_args)[:,0]
         
@@ -1957,91 +2239,6 @@ class EnergyBalance(object):
         
         '''
         
-        def calcLevelLC(llow,r,T):
-        
-            '''
-            Calculate the line cooling contribution for a single transition 
-            index, with a fixed lower level i and for which j > i, for the 
-            entire radial grid.
-            
-            Keep in mind, the goal is to include all transitions from every 
-            level to every level. It doesn't actually matter if the energy is 
-            lower or higher: The Sahai + Einstein equations change the sign if 
-            the lower level is really the upper level in terms of energy. 
-            
-            We can use the structure of the collision rate files, where all 
-            possible collisional transitions are included. By returning all 
-            transitions to a given lower level, we already have j > i. 
-            
-            A note must be made here. Normally one would want to work with 
-            all levels that have higher energy than Elow. However, for CO 
-            this leads to issues because some v=1 levels have lower energy
-            than some v=0 levels, while they are still sorted going v=0 to 
-            jmax, then v=1 to jmax, ie not sorted by energy. The collision
-            rates however assume that they are sorted by energy. Meaning 
-            that for some collisional transitions Eup-Elow becomes < 0 
-            because of how the CO spectroscopy is sorted. This is not 
-            necessarily a problem, hence why we assume Eup-Elow must be > 0
-            in what follows, and force it to be through abs(Eup-Elow). 
-            We assume the collision rate files are sorted properly, thus 
-            retrieve all "higher energy levels" by simply passing the llow
-            index to the getTI method. This leads to results that are 
-            identical with GASTRoNOoM CO cooling rates.
-            
-            
-            @param llow: index of the transition lower level.
-            @type llow: int
-            @param r: The radial grid in cm
-            @type r: array
-            @param T: The temperature in K for which to calculate the cooling
-            @type T: array
-            
-            @return: The contribution to the line cooling for a given lower 
-                     level i (in ergs * cm^3 / s). 
-            @rtype: float
-            
-            '''
-            
-            #-- Energy, weight and population of the lower level
-            Elow = self.mol[m].getLEnergy(index=llow,unit='erg')
-            glow = self.mol[m].getLWeight(index=llow)
-            poplow = self.pop[m].getInterp(llow)(r)
-            
-            #-- Get the transition indices that go to the level with index llow
-            #   Enforce indices to be an array.
-            indices = self.collis[m].getTI(itype='coll_trans',llow=(llow,))
-            
-            #-- In case no upper levels were found, llow is the highest level
-            #   available, and there are no collisions to be taken into account
-            #   return 0
-            if not indices.size: 
-                return 0.
-            
-            #-- Retrieve the level indices, energies, weights and populations of
-            #   upper levels
-            lups = self.collis[m].getTUpper(index=indices,itype='coll_trans') 
-            Eups = self.mol[m].getLEnergy(lups,unit='erg')
-            popups = np.array([self.pop[m].getInterp(lup)(r) for lup in lups])
-            gups = self.mol[m].getLWeight(index=lups)
-            
-            #-- Force gups/Eups into a column vector for array multiplication
-            gups.shape = (gups.size,1)
-            Eups.shape = (Eups.size,1)
-            
-            #-- Retrieve the rates between llow and all lups
-            #   Also get the respective weights and energies
-            Culs = np.array([self.collis[m].getInterp(i)(T) for i in indices])
-            
-            #-- Calculate the reversed rate for lower to upper level.
-            #   Based on the Einstein relation: Cul/Clu = gl/gu exp(Eul/kT)
-            expfac = np.exp(np.outer(-1*abs(Elow-Eups),1./(k_b*T)))
-            Clus = Culs*np.multiply(expfac,gups/glow) 
-            
-            #-- Calculate the sum of the cooling contribution across all j>i 
-            #   transitions
-            return np.sum((Clus*poplow-Culs*popups)*abs(Eups-Elow),axis=0)    
-        
-        
         #-- if cooling rate has already been calculated: don't do anything
         if self.C['lc_{}'.format(m)].has_key(self.i): 
             return 
@@ -2069,19 +2266,174 @@ class EnergyBalance(object):
         amol = self.abun[m].eval(warn=0)
 
         #-- Calculate the line cooling term for this molecule.
-        llows = self.pop[m].getLI()
-        LCterm = np.empty(shape=(len(self.r),len(llows)))
-        for i in llows: 
-            LCterm[:,i-1] = calcLevelLC(i,self.r,\
-                                        self.T.eval(inner_eps=self.inner_eps,\
-                                                    warn=not self.inner))
-        LCtotal = nh2*nh2*amol*np.sum(LCterm,axis=1)
+        T = self.T.eval(inner_eps=self.inner_eps,warn=not self.inner)
+        LCtotal = nh2*nh2*amol*self.calcLineCooling(m,self.r,T)
         
         #-- Do NOT Multiply by -1. This already gives the net energy lost
         self.C['lc_{}'.format(m)][self.i] = LCtotal
 
 
 
+    def setLineCoolingTable(self,m):
+    
+        '''
+        Set the table of collisional transitions used for the line cooling of a
+        molecule. 
+        
+        The table is made once per molecule, and holds for every collisional 
+        transition between two levels included in the level populations the 
+        level indices, the energy difference, the weight ratio and the 
+        collision rates on their temperature grid.
+        
+        Keep in mind, the goal is to include all transitions from every level 
+        to every level. It doesn't actually matter if the energy is lower or 
+        higher: The Sahai + Einstein equations change the sign if the lower 
+        level is really the upper level in terms of energy. 
+        
+        A note must be made here. Normally one would want to work with all 
+        levels that have higher energy than Elow. However, for CO this leads to
+        issues because some v=1 levels have lower energy than some v=0 levels, 
+        while they are still sorted going v=0 to jmax, then v=1 to jmax, ie not
+        sorted by energy. The collision rates however assume that they are 
+        sorted by energy. Meaning that for some collisional transitions 
+        Eup-Elow becomes < 0 because of how the CO spectroscopy is sorted. This
+        is not necessarily a problem, hence why we assume Eup-Elow must be > 0
+        in what follows, and force it to be through abs(Eup-Elow). We assume 
+        the collision rate files are sorted properly, thus take the upper and 
+        lower levels as given in the collision rate files. This leads to 
+        results that are identical with GASTRoNOoM CO cooling rates.
+        
+        @param m: The molecule name from the input molecules list.
+        @type m: str
+        
+        '''
+        
+        #-- Select the collisional transitions between levels with populations
+        ny = len(self.pop[m].getLI())
+        indices = np.array(self.collis[m].getTI(itype='coll_trans'))
+        lups = np.array(self.collis[m].getTUpper(index=indices,\
+                                                 itype='coll_trans'))
+        llows = np.array(self.collis[m].getTLower(index=indices,\
+                                                  itype='coll_trans'))
+        keep = (llows <= ny) * (lups <= ny)
+        indices, lups, llows = indices[keep], lups[keep], llows[keep]
+        
+        #-- Energies and weights of the levels
+        Eups = self.mol[m].getLEnergy(index=lups,unit='erg')
+        Elows = self.mol[m].getLEnergy(index=llows,unit='erg')
+        gups = self.mol[m].getLWeight(index=lups)
+        glows = self.mol[m].getLWeight(index=llows)
+        
+        #-- The excitation factor exp(-|Eu-El|/kT) can be written as a ratio 
+        #   of Boltzmann factors of the two levels: B_u/B_l if Eu >= El, else 
+        #   B_l/B_u. Remember which of both applies, as an index in 
+        #   [B,1/B] and [n/B,n*B] (see calcLineCooling).
+        inv = Eups < Elows
+        iup = lups-1+ny*inv
+        ilow = llows-1+ny*inv
+        dE = abs(Eups-Elows)
+        rates = np.vstack(self.collis[m].getRates(index=indices))
+        
+        #-- The de-excitation term is linear in the rates: sum the rates 
+        #   weighted with the energy per upper level already.
+        rates_up = np.zeros((ny,rates.shape[1]))
+        np.add.at(rates_up,lups-1,rates*dE[:,None])
+        
+        #-- For the excitation, sum the rates per pair of Boltzmann factor 
+        #   indices, for every point of the temperature grid 
+        #   (T x up index x low index). Only the indices in use are kept.
+        iup_u, iup_i = np.unique(iup,return_inverse=True)
+        ilow_u, ilow_i = np.unique(ilow,return_inverse=True)
+        rates_low = rates*(dE*gups/glows)[:,None]
+        M = np.zeros((rates.shape[1],len(iup_u),len(ilow_u)))
+        np.add.at(M,(slice(None),iup_i,ilow_i),rates_low.T)
+        
+        E = self.mol[m].getLEnergy(index=range(1,ny+1),unit='erg')
+        self.lctable[m] = dict([('lup',lups),('llow',llows),('dE',dE),\
+                                ('T',np.array(self.collis[m].getTemp())),\
+                                ('rates_low',rates_low),('M',M),\
+                                ('rates_up',rates_up),('E',E),\
+                                ('iup',iup_u),('ilow',ilow_u)])
+        
+        
+        
+    def calcLineCooling(self,m,r,T):
+    
+        '''
+        Calculate the line cooling per H2 molecule squared and per abundance 
+        unit, summed over all collisional transitions of a molecule.
+        
+        All transitions are done at once: The level populations are evaluated
+        on the radial grid for all levels at once with the cubic spline 
+        interpolator of the populations reader (see PopReader.getPopAll), the
+        collision rates for all transitions with a linear interpolation
+        (and extrapolation) in temperature, identical to the linear spline 
+        interpolators of the collision rates reader. 
+        
+        @param m: The molecule name from the input molecules list.
+        @type m: str
+        @param r: The radial grid in cm
+        @type r: array
+        @param T: The temperature in K for which to calculate the cooling
+        @type T: array
+        
+        @return: The line cooling (in ergs * cm^3 / s) on the radial grid
+        @rtype: array
+        
+        '''
+        
+        if not self.lctable.has_key(m): 
+            self.setLineCoolingTable(m)
+        table = self.lctable[m]
+        if not table['lup'].size: 
+            return np.zeros(len(r))
+        
+        #-- Level populations on the radial grid (level x r)
+        pops = self.pop[m].getPopAll(r)
+        
+        #-- De-excitation: Cul*nu*Eul, summed per upper level. The collision 
+        #   rates are interpolated linearly (and extrapolated) in temperature.
+        Culs = interpRates(table['T'],table['rates_up'],T)
+        down = np.einsum('ij,ij->j',Culs,pops)
+        
+        #-- Excitation: Clu*nl*Eul, with the reversed rate based on the 
+        #   Einstein relation: Cul/Clu = gl/gu exp(Eul/kT). The exponential is
+        #   calculated per level with Boltzmann factors B relative to the 
+        #   lowest level, such that the sum over transitions is a product of 
+        #   matrices per temperature interval of the collision rates. 
+        x = np.multiply.outer(table['E']-min(table['E']),1./(k_b*T))
+        fact = x.max(axis=0) < 600.
+        up = np.empty(len(T))
+        if fact.any():
+            sel = slice(None) if fact.all() else fact
+            B = np.exp(-x[:,sel])
+            n = pops[:,sel]
+            P1 = np.take(np.vstack([B,1./B]),table['iup'],axis=0)
+            P2 = np.take(np.vstack([n/B,n*B]),table['ilow'],axis=0)
+            M = table['M']
+            nup = M.shape[1]
+            blocks, w = interpIntervals(table['T'],T[sel])
+            upf = np.empty(len(B[0]))
+            for bsel,j in blocks:
+                MP2 = np.dot(M[j-1:j+1].reshape(2*nup,-1),P2[:,bsel])
+                q = np.einsum('ij,kij->kj',P1[:,bsel],MP2.reshape(2,nup,-1))
+                upf[bsel] = np.einsum('ij,ij->j',w[:,bsel],q)
+            up[sel] = upf
+        
+        #-- Unless the Boltzmann factors get too small to be represented with 
+        #   full precision (exp(-708) is the smallest normal double). Then the
+        #   exponential is calculated per transition.
+        if not fact.all():
+            Tn = T[~fact]
+            Clus = interpRates(table['T'],table['rates_low'],Tn)
+            exc = np.exp(np.multiply.outer(-table['dE'],1./(k_b*Tn)))
+            exc *= np.take(pops[:,~fact],table['llow']-1,axis=0)
+            up[~fact] = np.einsum('ij,ij->j',Clus,exc)
+        
+        return up - down
+        
+        
+        
     def plotRateIterations(self,iterations=[],dTsign='C',mechanism='ad',\
                            scale=1,fn=None,cfg=None,**kwargs):
 
@@ -0,0 +1,218 @@
+"""
+Unit test covering the line cooling and the temperature ODE in 
+physics.EnergyBalance.py
+
+"""
+
+import os
+import unittest
+import numpy as np
+from scipy.integrate import odeint
+from scipy.interpolate import InterpolatedUnivariateSpline as spline1d
+
+import cc.path
+from cc.modeling.physics import EnergyBalance as EB
+from cc.modeling.profilers import Profiler, Velocity
+from cc.tools.numerical.Interpol import BatchInterpolator
+
+
+
+class Molecule(object):
+
+    """Level energies and weights of a molecule, as MolReader()"""
+
+    def __init__(self,E,g):
+        self.E, self.g = E, g
+
+    def getLEnergy(self,index,unit='erg'):
+        return self.E[np.array(index)-1]
+
+    def getLWeight(self,index):
+        return self.g[np.array(index)-1]
+
+
+
+class Populations(object):
+
+    """Level populations on a radial grid, as PopReader()"""
+
+    def __init__(self,r,pop):
+        self.ny = len(pop)
+        self.interp = dict([(i+1,spline1d(r,p,k=3,ext=3))
+                            for i,p in enumerate(pop)])
+        self.batch = BatchInterpolator(r,pop,k=3,ext=3)
+
+    def getLI(self):
+        return range(1,self.ny+1)
+
+    def getInterp(self,i):
+        return self.interp[i]
+
+    def getPopAll(self,r):
+        return self.batch(r)
+
+
+
+class Collisions(object):
+
+    """Collision rates on a temperature grid, as CollisReader()"""
+
+    def __init__(self,lup,llow,Tgrid,rates):
+        self.lup, self.llow = lup, llow
+        self.Tgrid, self.rates = Tgrid, rates
+        self.interp = dict([(i+1,spline1d(Tgrid,rate,k=1,ext=0))
+                            for i,rate in enumerate(rates)])
+
+    def getTI(self,itype='coll_trans',lup=None,llow=None):
+        index = np.arange(1,len(self.lup)+1)
+        if llow is not None:
+            return index[np.in1d(self.llow,llow)]
+        return index
+
+    def getTUpper(self,index,itype='coll_trans'):
+        return self.lup[np.array(index)-1]
+
+    def getTLower(self,index,itype='coll_trans'):
+        return self.llow[np.array(index)-1]
+
+    def getRates(self,index):
+        return self.rates[np.array(index)-1]
+
+    def getTemp(self):
+        return self.Tgrid
+
+    def getInterp(self,i):
+        return self.interp[i]
+
+
+
+def calcLineCoolingLoop(eb,m,r,T):
+
+    """
+    The line cooling as it was calculated before the vectorization: per lower
+    level, and per collisional transition from that level.
+
+    """
+
+    total = np.zeros(len(r))
+    for llow in eb.pop[m].getLI():
+        Elow = eb.mol[m].getLEnergy(index=llow,unit='erg')
+        glow = eb.mol[m].getLWeight(index=llow)
+        poplow = eb.pop[m].getInterp(llow)(r)
+        indices = eb.collis[m].getTI(itype='coll_trans',llow=(llow,))
+        indices = [i
+                   for i in indices
+                   if eb.collis[m].getTUpper(index=i) <= len(eb.pop[m].getLI())]
+        if not indices: continue
+        lups = eb.collis[m].getTUpper(index=indices,itype='coll_trans')
+        Eups = eb.mol[m].getLEnergy(lups,unit='erg')[:,None]
+        gups = eb.mol[m].getLWeight(index=lups)[:,None]
+        popups = np.array([eb.pop[m].getInterp(l)(r) for l in lups])
+        Culs = np.array([eb.collis[m].getInterp(i)(T) for i in indices])
+        expfac = np.exp(np.outer(-1*abs(Elow-Eups),1./(EB.k_b*T)))
+        Clus = Culs*expfac*gups/glow
+        total += np.sum((Clus*poplow-Culs*popups)*abs(Eups-Elow),axis=0)
+    return total
+
+
+
+class LineCoolingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        ny = 8
+        #-- Level energies not sorted, as for CO v=1 levels, and a level
+        #   without populations (9) in the collision rates.
+        E = np.sort(rng.rand(ny+1))*1e-13
+        E[[3,5]] = E[[5,3]]
+        g = rng.randint(1,20,ny+1).astype(float)
+        pairs = [(u,l) for u in range(2,ny+2) for l in range(1,u)]
+        rng.shuffle(pairs)
+        lup = np.array([p[0] for p in pairs])
+        llow = np.array([p[1] for p in pairs])
+        Tgrid = np.array([10.,20.,50.,100.,200.,500.,1000.])
+        rates = rng.rand(len(pairs),len(Tgrid))*1e-11
+        rp = np.logspace(14,17,40)
+        pop = rng.rand(ny,len(rp))
+        pop /= pop.sum(axis=0)
+
+        self.eb = EB.EnergyBalance.__new__(EB.EnergyBalance)
+        self.eb.mol = {'m': Molecule(E,g)}
+        self.eb.pop = {'m': Populations(rp,pop)}
+        self.eb.collis = {'m': Collisions(lup,llow,Tgrid,rates)}
+        self.eb.lctable = dict()
+        self.r = np.logspace(14,17,200)
+
+    def assertCooling(self,T):
+        new = self.eb.calcLineCooling('m',self.r,T)
+        old = calcLineCoolingLoop(self.eb,'m',self.r,T)
+        scale = np.abs(old).max()
+        self.assertTrue(np.allclose(new,old,rtol=1e-10,atol=1e-12*scale),\
+                        msg='Max difference %g'%(np.abs(new-old).max()/scale))
+
+    def testMonotonic(self):
+        """ Decreasing T, inter- and extrapolated in the collision rates """
+        self.assertCooling(np.logspace(3.5,0.5,len(self.r)))
+
+    def testNonMonotonic(self):
+        """ T profile with jumps across the temperature grid """
+        T = np.logspace(3.5,0.5,len(self.r))
+        T[::7] *= 1.5
+        self.assertCooling(T)
+
+    def testLowTemperature(self):
+        """ Boltzmann factors too small for the product form """
+        self.assertCooling(np.logspace(1,-1,len(self.r)))
+
+    def testInterpRates(self):
+        """ Linear interpolation per row, as linear splines """
+        coll = self.eb.collis['m']
+        T = np.logspace(0.5,3.5,50)[::-1]
+        T[::3] *= 2.
+        new = EB.interpRates(coll.Tgrid,coll.rates,T)
+        old = np.array([spline1d(coll.Tgrid,rate,k=1,ext=0)(T)
+                        for rate in coll.rates])
+        self.assertTrue(np.allclose(new,old,rtol=1e-12,atol=0))
+
+
+
+class TabulatedODETestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.r = np.logspace(14.5,17.5,200)
+        self.v = Velocity.Velocity(self.r,Velocity.vbeta,r0=self.r[0],\
+                                   v0=3e5,vinf=1.5e6,beta=1.)
+        fn = os.path.join(cc.path.aux,'h2_physical_properties.dat')
+        self.gamma = Profiler.Profiler(x=np.logspace(0,3.5,100),\
+                                       func=Profiler.interp_file,\
+                                       ikwargs={'ext':3,'k':3},\
+                                       filename=fn,ycol=-1)
+        #-- Net heating, of the order of the adiabatic cooling
+        rates = 1e-6*(self.r[0]/self.r)**1.5*(1.+0.5*np.sin(np.log(self.r)))
+        self.rates = Profiler.Profiler(self.r,spline1d(self.r,rates,k=3,ext=0))
+        self.T0 = 2000.
+
+    def integrate(self,rates=None,nsub=10):
+        old = odeint(EB.dTdr,self.T0,self.r,\
+                     args=(self.v,self.gamma,rates,0))[:,0]
+        ode = EB.TabulatedODE(self.r,self.v,self.gamma,rates,nsub=nsub,\
+                              warn=0)
+        new = odeint(ode.dTdr,self.T0,self.r,Dfun=ode.jac)[:,0]
+        return np.abs(new/old-1.).max()
+
+    def testAdiabatic(self):
+        """ Same T profile as dTdr within 1%, for adiabatic cooling only """
+        diff = self.integrate()
+        self.assertTrue(diff < 1e-2,msg='Max relative difference %g'%diff)
+        self.assertTrue(self.integrate(nsub=40) < diff/2.)
+
+    def testRates(self):
+        """ Same T profile as dTdr within 1%, with heating and cooling rates """
+        diff = self.integrate(rates=self.rates)
+        self.assertTrue(diff < 1e-2,msg='Max relative difference %g'%diff)
+        self.assertTrue(self.integrate(rates=self.rates,nsub=40) < diff/2.)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
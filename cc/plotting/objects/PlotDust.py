@@ -1262,8 +1262,9 @@ class PlotDust(PlottingSession):
                                     star['LAST_MCMAX_MODEL'])
             denstemp = os.path.join(filepath,'denstemp.dat')
             logfile = os.path.join(filepath,'log.dat')
-            grid_shape = DataIO.getKeyData(filename=denstemp,incr=1,\
-                                           keyword='NGRAINS',single=0)[0]
+            grid_shape = DataIO.getCachedKeyData(filename=denstemp,incr=1,\
+                                                 keyword='NGRAINS',\
+                                                 single=0)[0]
             star.update({'NTHETA':int(grid_shape[1]),\
                          'NRAD':int(grid_shape[0]),\
                          'T_STAR':float(DataIO.getKeyData(filename=logfile,\
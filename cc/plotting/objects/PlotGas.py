@@ -549,6 +549,7 @@ class PlotGas(PlottingSession):
                     else:
                         vlsr = 0.0
                         noise = None
+                    Transition.readSphinxMany(current_sub)
                     for trans in current_sub:
                         if not trans is None:
                             trans.readSphinx()
@@ -1179,7 +1180,7 @@ class PlotGas(PlottingSession):
                 transitions = star['GAS_LINES']
             
             #-- Read the sphinx files and extract the P/intensity columns
-            [t.readSphinx() for t in transitions]
+            Transition.readSphinxMany(transitions)
             radii = [t.sphinx.getImpact() for t in transitions]
             linecontribs =  [getattr(t.sphinx,lcf)() for t in transitions]
             
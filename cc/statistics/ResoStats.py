@@ -266,6 +266,7 @@ class ResoStats(Statistics):
             #   set, nothing is done (so long as replace=0, the default)
             for mt in self.trans_models[st]: 
                 mt.setData(st)
+            Transition.readSphinxMany(self.trans_models[st])
                 
             #-- Collect the model integrated and peak Tmbs
             self.minttmb[st] = array([mt.getIntTmbSphinx() 
@@ -166,9 +166,19 @@ class SedStats(Statistics):
             self.mwave.append(w)
             self.mflux.append(f)
         
+        #-- Models sharing one wavelength grid are done at once, using 
+        #   integration weights of the photometric bands on that grid. Models
+        #   read from the spectrum store share the same array in that case.
         if self.photbands.size:
-            self.mphot_ivs = [Sed.calcPhotometry(w,f,self.photbands)
-                              for w,f in zip(self.mwave,self.mflux)]
+            w0 = self.mwave[0]
+            if all([w is w0 or (w.shape == w0.shape and (w == w0).all())
+                    for w in self.mwave[1:]]):
+                mphot = Sed.calcPhotometryGrid(w0,np.array(self.mflux),\
+                                               self.photbands)
+                self.mphot_ivs = list(mphot)
+            else:
+                self.mphot_ivs = [Sed.calcPhotometry(w,f,self.photbands)
+                                  for w,f in zip(self.mwave,self.mflux)]
             
         for fn in self.dphot_other.keys():
             self.mphot_other[fn] = []
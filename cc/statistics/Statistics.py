@@ -161,7 +161,7 @@ class Statistics(object):
         @keyword star_grid: The parameter sets, if not given: model ids needed
         
                             (default: [])
-        @type star_grid: list[Star()]
+        @type star_grid: list[Star()] or StarGrid()
         @keyword models: the PACS ids, only relevant if star_grid == [] and if 
                          instrument == PACS. In all other cases a star_grid is
                          required.
@@ -180,11 +180,12 @@ class Statistics(object):
             if not star_grid: 
                 raise IOError('Statistics.setModels requires a ' + \
                               'star_grid to be defined for SED data.')
-            if set([s['LAST_MCMAX_MODEL'] for s in star_grid]) == set(['']):
+            #-- Get rid of models that were not calculated successfully. The
+            #   grid is only passed through once, so it can be streamed.
+            star_grid = [s for s in star_grid if s['LAST_MCMAX_MODEL']]
+            if not star_grid:
                 return
-            #-- Get rid of models that were not calculated successfully
-            self.star_grid = [s for s in star_grid if s['LAST_MCMAX_MODEL']]
-            self.star_grid = np.array(self.star_grid)
+            self.star_grid = np.array(star_grid)
             
         #-- The unresolved-data case
         elif self.instrument:
@@ -164,6 +164,192 @@ def getKeyData(incr,filename,keyword,single=1):
 
 
 
+def getCachedKeyData(incr,filename,keyword,single=1):
+
+    """
+    Search a data file with data in columns, separated by comment lines
+    containing the type of data, with the file parsed only once.
+
+    Same as getKeyData, but the blocks of the file are taken from
+    readKeyBlocks, which caches the parsed file on disk and in memory. Use
+    this for files that are read many times, such as MCMax denstemp output.
+
+    The cache only holds the first column of every block, and the first line
+    of every block in its entirety. Other requests (incr == 0, or single == 0
+    for more than one line) are passed on to getKeyData.
+
+    @param incr: length of the data after key that is required.
+    @type incr: int
+    @param filename: name and path of the file searched
+    @type filename: string
+    @param keyword: the type of information required, always equal to one
+                    of the keywords present in the file
+    @type keyword: string
+
+    @keyword single: return an array of only the first element on every row.
+                     Otherwise the first line is returned as a list of strings,
+                     in a list.
+
+                     (default: 1)
+    @type single: bool
+
+    @return: The requested data
+    @rtype: array/list[list]
+
+    """
+
+    incr = int(incr)
+    if not incr or (not single and incr != 1):
+        return getKeyData(incr=incr,filename=filename,keyword=keyword,\
+                          single=single)
+
+    blocks = readKeyBlocks(filename)
+    key = keyword.upper()
+    for header,first,col in zip(blocks['headers'],blocks['first_lines'],\
+                                blocks['columns']):
+        if header.upper().find(key) == -1: continue
+        if not single:
+            return [first.split()]
+        #-- The block is shorter than requested: let getKeyData decide.
+        if len(col) < incr: break
+        return col[:incr]
+    return getKeyData(incr=incr,filename=filename,keyword=keyword,\
+                      single=single)
+
+
+
+#-- In-memory cache of readKeyBlocks: {filename: (mtime, size, blocks)}
+_key_blocks = dict()
+_key_blocks_order = []
+MAX_KEY_BLOCKS = 32
+
+
+
+def readKeyBlocks(filename,cache=1):
+
+    """
+    Parse a data file with data in columns, separated by comment lines, into
+    blocks in a single pass.
+
+    Every line that does not start with a number is a header line. The lines
+    between two headers are a block, and are converted to floats at once.
+
+    The result is cached in a .npz file next to the data file
+    (eg denstemp.dat -> denstemp_cache.npz), keyed on the modification time
+    and size of the data file, and in memory for the last MAX_KEY_BLOCKS
+    files. The cache is rebuilt when the data file changes. If the .npz file
+    cannot be written, only the memory cache is used.
+
+    Lines preceding the first header are ignored.
+
+    @param filename: name and path of the file
+    @type filename: string
+
+    @keyword cache: Use and write the .npz cache on disk
+
+                    (default: 1)
+    @type cache: bool
+
+    @return: The headers (list[str]), the first line of every block
+             (list[str]) and the first column of every block (list[array]),
+             with keys 'headers', 'first_lines', 'columns'.
+    @rtype: dict
+
+    """
+
+    stat = os.stat(filename)
+    key = (stat.st_mtime,stat.st_size)
+    if _key_blocks.has_key(filename) and _key_blocks[filename][0] == key:
+        _key_blocks_order.remove(filename)
+        _key_blocks_order.append(filename)
+        return _key_blocks[filename][1]
+
+    cachefn = os.path.splitext(filename)[0] + '_cache.npz'
+    blocks = None
+    if cache and os.path.isfile(cachefn):
+        try:
+            npz = np.load(cachefn)
+            if tuple(npz['key']) == key:
+                n = len(npz['headers'])
+                blocks = dict([('headers',list(npz['headers'])),\
+                               ('first_lines',list(npz['first_lines'])),\
+                               ('columns',[npz['col%i'%i]
+                                           for i in range(n)])])
+            npz.close()
+        except (IOError,ValueError,KeyError):
+            blocks = None
+
+    if blocks is None:
+        blocks = parseKeyBlocks(filename)
+        if cache:
+            arrs = dict([('col%i'%i,col)
+                         for i,col in enumerate(blocks['columns'])])
+            try:
+                #-- Write to a temporary file first, so a concurrent reader
+                #   never sees a half-written cache.
+                tmpfn = cachefn[:-4] + '_%i.npz'%os.getpid()
+                np.savez(tmpfn,key=np.array(key),\
+                         headers=np.array(blocks['headers']),\
+                         first_lines=np.array(blocks['first_lines']),**arrs)
+                os.rename(tmpfn,cachefn)
+            except (IOError,OSError):
+                pass
+
+    if _key_blocks.has_key(filename):
+        _key_blocks_order.remove(filename)
+    _key_blocks[filename] = (key,blocks)
+    _key_blocks_order.append(filename)
+    while len(_key_blocks_order) > MAX_KEY_BLOCKS:
+        del _key_blocks[_key_blocks_order.pop(0)]
+    return blocks
+
+
+
+def parseKeyBlocks(filename):
+
+    """
+    Parse a data file with data in columns, separated by comment lines, into
+    blocks. See readKeyBlocks, which caches the result.
+
+    @param filename: name and path of the file
+    @type filename: string
+
+    @return: The headers, first lines and first columns of every block
+    @rtype: dict
+
+    """
+
+    FILE = open(filename,'r')
+    lines = FILE.read().split('\n')
+    FILE.close()
+
+    #-- Header lines do not start with a number
+    numeric = '0123456789+-.'
+    iheads = [i
+              for i,line in enumerate(lines)
+              if line.strip() and line.strip()[0] not in numeric]
+    headers, first_lines, columns = [], [], []
+    for ih,iend in zip(iheads,iheads[1:]+[len(lines)]):
+        block = [line for line in lines[ih+1:iend] if line.strip()]
+        headers.append(lines[ih].strip())
+        first_lines.append(block and block[0].strip() or '')
+        if not block:
+            columns.append(np.empty(0))
+            continue
+        #-- Convert all values at once, and take the first column if every
+        #   line has the same number of columns.
+        values = np.fromstring(' '.join(block),sep=' ')
+        ncols = len(block[0].split())
+        if len(values) == ncols*len(block):
+            columns.append(values[::ncols])
+        else:
+            columns.append(np.array([float(line.split()[0])
+                                     for line in block]))
+    return dict([('headers',headers),('first_lines',first_lines),\
+                 ('columns',columns)])
+
+
+
 def readFortranFile(convert_cols,func=np.loadtxt,*args,**kwargs):
 
     '''
@@ -8,9 +8,13 @@ Author: Robin Lombaert
 """
 
 import os
+import math
+import hashlib
 import cPickle
+import cStringIO
 import time
 import subprocess
+import sqlite3
 import portalocker
 from glob import glob
 
@@ -891,8 +895,364 @@ def replaceSubstring(db,oldss,newss):
             if isinstance(v,str) and oldss in v:
                 dd[k] = v.replace(oldss,newss)
                 db.addChangedKey(m)
-                
-    
+
+
+
+def openDatabase(db_path,engine=None,**kwargs):
+
+    '''
+    Open a database with a given storage engine.
+
+    The Database() API is the same for all engines. Available engines:
+        - 'pickle': The full dictionary is cPickled to db_path. (Database())
+        - 'journal': Changes are appended to a journal next to the cPickled
+                     dictionary at db_path. (JournalDatabase())
+        - 'sqlite': Entries are saved in an SQLite database at db_path_sqlite
+                    with indexed parameter columns. (SqliteDatabase())
+
+    @param db_path: The path to the database on the hard disk.
+    @type db_path: string
+
+    @keyword engine: The storage engine. If None, the engine is determined
+                     from the files present on the disk: 'sqlite' if an SQLite
+                     database is present for db_path, 'journal' if a journal
+                     is present, 'pickle' otherwise.
+
+                     (default: None)
+    @type engine: str
+    @keyword kwargs: Extra keywords passed to the database class.
+    @type kwargs: dict
+
+    @return: The database
+    @rtype: Database()
+
+    '''
+
+    engines = {'pickle': Database, 'journal': JournalDatabase, \
+               'sqlite': SqliteDatabase}
+    if engine is None:
+        if os.path.isfile('%s_sqlite'%db_path):
+            engine = 'sqlite'
+        elif os.path.isfile('%s_journal'%db_path):
+            engine = 'journal'
+        else:
+            engine = 'pickle'
+    engine = engine.lower()
+    if not engines.has_key(engine):
+        raise IOError('Database engine %s unknown. Choose from %s.'\
+                      %(engine,', '.join(sorted(engines.keys()))))
+    return engines[engine](db_path,**kwargs)
+
+
+
+def convertToJournal(db_path):
+
+    '''
+    Convert a cPickled database to a journaled database.
+
+    The dictionary saved at db_path remains the base file of the journaled
+    database, so the conversion only rewrites it once and creates an empty
+    journal. A copy of the original database is kept as db_path_backupJournal.
+
+    Nothing is done if the database is already journaled.
+
+    @param db_path: The path to the database on the hard disk.
+    @type db_path: string
+
+    @return: The journaled database
+    @rtype: JournalDatabase()
+
+    '''
+
+    if os.path.isfile('%s_journal'%db_path):
+        print 'Database at %s is already journaled.'%db_path
+        return JournalDatabase(db_path)
+    if os.path.isfile(db_path):
+        os.system('cp %s %s'%(db_path,db_path+'_backupJournal'))
+    db = JournalDatabase(db_path)
+    db.compact()
+    return db
+
+
+
+def convertAllToJournal():
+
+    '''
+    Convert all databases of the modeling codes to journaled databases.
+
+    These are the GASTRoNOoM cooling, mline and sphinx databases in
+    cc.path.gastronoom and the MCMax databases in cc.path.mcmax. Each one is
+    converted with convertToJournal().
+
+    '''
+
+    fns = sorted(glob(os.path.join(cc.path.gastronoom,'*',\
+                                   'GASTRoNOoM_*_models.db')))
+    fns += sorted(glob(os.path.join(cc.path.mcmax,'*','MCMax_models.db')))
+    for fn in fns:
+        print "******************************"
+        print "Now converting database at:"
+        print fn
+        convertToJournal(fn)
+
+
+
+def convertFromJournal(db_path):
+
+    '''
+    Convert a journaled database back to a single cPickled database.
+
+    The journal is compacted into the base file at db_path and then removed.
+
+    @param db_path: The path to the database on the hard disk.
+    @type db_path: string
+
+    @return: The database
+    @rtype: Database()
+
+    '''
+
+    jpath = '%s_journal'%db_path
+    if not os.path.isfile(jpath):
+        print 'Database at %s is not journaled.'%db_path
+        return Database(db_path)
+    db = JournalDatabase(db_path)
+    jfile = db._open('a')
+    try:
+        db.compact(jfile)
+        os.remove(jpath)
+    finally:
+        jfile.close()
+    return Database(db_path)
+
+
+
+def convertToSqlite(db_path):
+
+    '''
+    Copy a cPickled or journaled database to an SQLite database.
+
+    The original database is left untouched, but is no longer used by 
+    openDatabase() once the SQLite database exists at db_path_sqlite. 
+
+    @param db_path: The path to the database on the hard disk.
+    @type db_path: string
+
+    @return: The SQLite database
+    @rtype: SqliteDatabase()
+
+    '''
+
+    if os.path.isfile('%s_sqlite'%db_path):
+        print 'Database at %s is already converted to SQLite.'%db_path
+        return SqliteDatabase(db_path)
+    db = openDatabase(db_path)
+    sdb = SqliteDatabase(db_path)
+    sdb.update(db)
+    sdb.sync()
+    return sdb
+
+
+
+def getLeafPaths(d,path=()):
+
+    '''
+    Return the key paths to all parameter dictionaries in a nested dictionary.
+
+    A dictionary is a parameter dictionary (ie a leaf) if it contains at least
+    one value that is not a dictionary itself. For instance, a cooling model id
+    is a leaf, while for the mline database the leaves are found at 
+    (cooling id, molecule id, molecule). Any value that is not a dictionary is 
+    a leaf as well. Empty dictionaries are skipped.
+
+    @param d: The nested dictionary
+    @type d: dict
+
+    @keyword path: The key path of d, which is prepended to the leaf paths.
+
+                   (default: ())
+    @type path: tuple
+
+    @return: The key paths
+    @rtype: list[tuple]
+
+    '''
+
+    paths = []
+    for k,v in d.items():
+        if not isinstance(v,dict):
+            paths.append(path+(k,))
+        elif not v:
+            continue
+        elif [vv for vv in v.values() if not isinstance(vv,dict)]:
+            paths.append(path+(k,))
+        else:
+            paths.extend(getLeafPaths(v,path+(k,)))
+    return paths
+
+
+
+def makeFingerprint(pars,keywords=None,tolerance=0.001,\
+                    ignore=['IN_PROGRESS']):
+
+    '''
+    Make a canonical fingerprint of a parameter dictionary.
+
+    Every numerical parameter is quantized to a logarithmic bucket with a 
+    relative width equal to the tolerance used in 
+    ModelingSession.compareCommandLists(). Other parameters are kept as is. 
+    Keywords missing from the dictionary are included as such, and nested 
+    dictionaries (such as dust_species for MCMax) are quantized as well. The 
+    sorted result is hashed.
+
+    Parameter sets that match within the tolerance have the same fingerprint, 
+    unless a value is close to a bucket edge. The fingerprint is therefore a 
+    lookup key, not a replacement for compareCommandLists().
+
+    @param pars: The parameters
+    @type pars: dict
+
+    @keyword keywords: The keywords included in the fingerprint. If None, all 
+                       keys of pars are included, except those in ignore.
+
+                       (default: None)
+    @type keywords: list[str]
+    @keyword tolerance: The relative tolerance on numerical parameters
+
+                        (default: 0.001)
+    @type tolerance: float
+    @keyword ignore: Keys excluded from the fingerprint if keywords is None
+
+                     (default: ['IN_PROGRESS'])
+    @type ignore: list[str]
+
+    @return: The fingerprint
+    @rtype: str
+
+    '''
+
+    qpars = quantizeParameters(pars,keywords,tolerance,ignore)
+    return hashlib.md5(repr(qpars)).hexdigest()
+
+
+
+def quantizeParameters(pars,keywords=None,tolerance=0.001,\
+                       ignore=['IN_PROGRESS']):
+
+    '''
+    Quantize a parameter dictionary to a sorted tuple of (key,bucket) pairs.
+
+    See makeFingerprint() for the arguments.
+
+    @return: The quantized parameters
+    @rtype: tuple
+
+    '''
+
+    if keywords is None:
+        keywords = [k for k in pars.keys() if k not in ignore]
+    qpars = []
+    for k in sorted(set(keywords)):
+        if not pars.has_key(k):
+            qpars.append((k,'MISSING'))
+            continue
+        v = pars[k]
+        if isinstance(v,dict):
+            qpars.append((k,quantizeParameters(v,None,tolerance,ignore)))
+            continue
+        try:
+            v = float(v)
+        except (TypeError,ValueError):
+            qpars.append((k,repr(v)))
+            continue
+        if not v or math.isinf(v) or math.isnan(v):
+            qpars.append((k,repr(v)))
+        else:
+            bucket = int(math.floor(math.log(abs(v))/math.log(1.+tolerance)))
+            qpars.append((k,(v > 0 and 1 or -1,bucket)))
+    return tuple(qpars)
+
+
+
+def verifyIndex(db,index,compare,max_queries=None):
+
+    '''
+    Verify that a fingerprint index on a database agrees with a linear scan.
+
+    Every leaf in the database (see getLeafPaths()) is used as a query. The 
+    matches found by comparing the query with all leaves sharing the same 
+    top-level key (or with all leaves for a flat database) are compared with
+    the confirmed hits of the index only, ie without the tolerance selection of
+    Database.selectKeys().
+
+    @param db: The database
+    @type db: Database()
+    @param index: The name of the index
+    @type index: str
+    @param compare: Comparison of two parameter sets, called as 
+                    compare(query,leaf), eg ModelingSession.cCL with the 
+                    relevant code filled in.
+    @type compare: function
+
+    @keyword max_queries: Only check this many leaves. All leaves are checked
+                          if None. 
+
+                          (default: None)
+    @type max_queries: int
+
+    @return: The number of queries, and the (query path,linear matches,
+             index matches) of the queries that do not agree
+    @rtype: (int,list[tuple])
+
+    '''
+
+    idx = db.indices[index]
+    idx.update(db,db.getChangedKeys())
+    leaves = sorted(getLeafPaths(db))
+    nested = [p for p in leaves if len(p) > 1]
+    if max_queries is not None:
+        queries = leaves[:max_queries]
+    else:
+        queries = leaves
+    disagree = []
+    for qp in queries:
+        query = getLeaf(db,qp)
+        if not isinstance(query,dict): continue
+        path = nested and qp[:1] or ()
+        scope = [p for p in leaves if p[:len(path)] == path]
+        linear = [p for p in scope
+                  if isinstance(getLeaf(db,p),dict) \
+                        and compare(query.copy(),getLeaf(db,p))]
+        hits = [path + p for p in idx.lookup(query,path)]
+        hits = [p for p in hits if compare(query.copy(),getLeaf(db,p))]
+        if sorted(linear) != sorted(hits):
+            disagree.append((qp,linear,hits))
+    print 'Index %s verified for %i queries: %i disagreements with the '\
+          %(index,len(queries),len(disagree)) + 'linear scan.'
+    return len(queries), disagree
+
+
+
+def getLeaf(d,path):
+
+    '''
+    Return the value at a key path in a nested dictionary.
+
+    @param d: The nested dictionary
+    @type d: dict
+    @param path: The key path
+    @type path: tuple
+
+    @return: The value
+    @rtype: any
+
+    '''
+
+    for k in path:
+        d = d[k]
+    return d
+
+
 
 class Database(dict):
     
@@ -1001,6 +1361,8 @@ class Database(dict):
         super(Database, self).__init__()
         self.path = db_path
         self.folder = os.path.split(self.path)[0]
+        self.indices = dict()
+        self.__stamp = None
         self.read()
         self.__changed = []
         self.__deleted = []
@@ -1179,6 +1541,7 @@ class Database(dict):
                 try:
                     try:
                         db = cPickle.load(dbfile)
+                        stamp = self.__getStamp(dbfile)
                         dbfile.close()
                         break
                     except ValueError:
@@ -1194,6 +1557,11 @@ class Database(dict):
                     time.sleep(5)
             self.clear()
             super(Database,self).update(db)
+            #-- Entries only differ from the indexed ones if the file changed
+            #   since it was last read or saved, apart from the changed keys
+            if stamp != self.__stamp:
+                self._touchIndices()
+            self.__stamp = stamp
         except IOError:
             print 'No database present at %s. Creating a new one.'%self.path
             self.__save()
@@ -1251,6 +1619,7 @@ class Database(dict):
                     #-- Just wait a few seconds to allow other instances to 
                     #   finish writing
                     time.sleep(2)
+            self._updateIndices()
             self.__deleted = []
             self.__changed = []
         
@@ -1258,6 +1627,7 @@ class Database(dict):
         #   to hard disk to update this instance to the real-time version. 
         else:
             self.read()
+            self._updateIndices()
     
     
     def __save(self):
@@ -1289,8 +1659,30 @@ class Database(dict):
         #portalocker.lock(dbfile, portalocker.LOCK_EX)
         dbfile = self._open('w')
         cPickle.dump(self,dbfile)
+        dbfile.flush()
+        self.__stamp = self.__getStamp(dbfile)
         dbfile.close()
         return backup_file
+        
+        
+        
+    def __getStamp(self,dbfile):
+    
+        '''
+        Identify the version of the database file on the disk. 
+        
+        Only called by Database() internally.
+        
+        @param dbfile: The opened database file
+        @type dbfile: file()
+        
+        @return: The inode, size and modification time of the file
+        @rtype: tuple
+        
+        '''
+        
+        st = os.fstat(dbfile.fileno())
+        return (st.st_ino,st.st_size,st.st_mtime)
             
     
     
@@ -1330,8 +1722,201 @@ class Database(dict):
         '''
         
         if key not in self.__changed: self.__changed.append(key)
+
+
+
+    def selectKeys(self,query,keywords,path=(),tolerance=0.001,index=None):
+
+        '''
+        Select the entries in the database that may match a set of parameters.
+
+        The database is treated as a tree of nested dictionaries, see 
+        getLeafPaths(). For Database(), the key paths of all leaves below path
+        are returned. Other storage engines may preselect the leaves based on
+        query, as long as every leaf that matches query within the tolerance
+        is returned.
+
+        If a fingerprint index is given (see addIndex()), the leaves with the
+        same fingerprint as query are returned first. If the index is exact,
+        they are followed by the other leaves that may match within the 
+        tolerance according to the index (see ParameterIndex.select()). The 
+        storage engine is not used in that case. 
+
+        The candidates still have to be compared with the query, for instance 
+        with ModelingSession.compareCommandLists().
+
+        @param query: The parameters to be matched
+        @type query: dict
+        @param keywords: The keywords in query that are relevant for a match
+        @type keywords: list[str]
+
+        @keyword path: The key path below which the leaves are selected, eg 
+                       the cooling id for the mline database.
+
+                       (default: ())
+        @type path: tuple
+        @keyword tolerance: The relative tolerance for numerical parameters.
+
+                            (default: 0.001)
+        @type tolerance: float
+        @keyword index: The name of the fingerprint index to be used. None if 
+                        no index is used.
+                        
+                        (default: None)
+        @type index: str
+
+        @return: The key paths of the candidates, relative to path. Sorted, 
+                 apart from the index hits, which are given first.
+        @rtype: list[tuple]
+
+        '''
+
+        if index is None or not self.indices.has_key(index):
+            return self._preselectKeys(query,keywords,path,tolerance)
+        idx = self.indices[index]
+        idx.update(self,self.getChangedKeys()+self.getDeletedKeys())
+        hits = idx.lookup(query,path)
+        if not idx.exact:
+            return hits
+        shits = set(hits)
+        return hits + [p 
+                       for p in idx.select(query,keywords,path)
+                       if p not in shits]
+
+
+
+    def _preselectKeys(self,query,keywords,path=(),tolerance=0.001):
+
+        '''
+        Select the entries in the database that may match a set of parameters,
+        specific for the storage engine. 
+        
+        Database() returns all leaves below path. See selectKeys() for the 
+        arguments.
+
+        @return: The sorted key paths of the candidates, relative to path
+        @rtype: list[tuple]
+
+        '''
+
+        d = self
+        for k in path:
+            if not isinstance(d,dict) or not d.has_key(k):
+                return []
+            d = d[k]
+        return sorted(getLeafPaths(d))
+
+
+
+    def addIndex(self,name,keywords=None,tolerance=0.001,exact=1):
+
+        '''
+        Add a fingerprint index to the database. 
+        
+        The index is saved to the hard disk at db_path_index_name, and is 
+        updated incrementally for changed entries whenever the database is
+        synchronized. Nothing is done if the index already exists.
+        
+        See makeFingerprint() and ParameterIndex() for more information.
+        
+        @param name: The name of the index, used in selectKeys()
+        @type name: str
+        
+        @keyword keywords: The keywords included in the fingerprints. All are
+                           included if None.
+                           
+                           (default: None)
+        @type keywords: list[str]
+        @keyword tolerance: The relative tolerance on numerical parameters
+        
+                            (default: 0.001)
+        @type tolerance: float
+        @keyword exact: Also return the leaves that match within the 
+                        tolerance in selectKeys(), so no match is missed when
+                        a parameter lies on the edge of a tolerance bucket. 
+                        If 0, lookups only return the fingerprint hits.
+                        
+                        (default: 1)
+        @type exact: bool
+        
+        '''
+        
+        if self.indices.has_key(name): return
+        idx = ParameterIndex(db_path=self.path,name=name,keywords=keywords,\
+                             tolerance=tolerance,exact=exact)
+        idx.update(self,self.getChangedKeys()+self.getDeletedKeys())
+        idx.save()
+        self.indices[name] = idx
+        
+        
+        
+    def _updateIndices(self):
+    
+        '''
+        Update all fingerprint indices for the entries changed since the last
+        update, and save them to the hard disk.
+        
+        Only called internally when synchronizing the database.
+        
+        '''
+        
+        for idx in self.indices.values():
+            idx.update(self,self.getChangedKeys()+self.getDeletedKeys())
+            idx.save()
+            
+            
+            
+    def _touchIndices(self,keys=None):
     
+        '''
+        Flag top-level entries that were read anew from the hard disk in all
+        fingerprint indices, see ParameterIndex.touch().
+        
+        Only called internally when reading the database.
+        
+        @keyword keys: The top-level keys. All entries if None.
+        
+                       (default: None)
+        @type keys: list
+        
+        '''
+        
+        for idx in self.indices.values():
+            idx.touch(keys)
+            
+            
+            
+    def __getstate__(self):
     
+        '''
+        Return the attributes to be pickled with the database, which excludes
+        the fingerprint indices.
+        
+        @return: The attributes
+        @rtype: dict
+        
+        '''
+        
+        state = self.__dict__.copy()
+        state.pop('indices',None)
+        state.pop('_Database__stamp',None)
+        return state
+        
+        
+        
+    def _clearChangedKeys(self):
+
+        '''
+        Empty the lists of changed and deleted keys.
+
+        Only called internally once the changes are saved to the hard disk.
+
+        '''
+
+        self.__changed = []
+        self.__deleted = []
+
+
     
     def getDeletedKeys(self):
         
@@ -1361,6 +1946,1060 @@ class Database(dict):
 
 
 
+class JournalDatabase(Database):
+
+    '''
+    A database class with an append-only journal as storage engine.
+
+    The class functions exactly as Database(), but the hard disk copy consists
+    of two files: the base file at db_path, which is a cPickled dictionary as
+    for Database(), and an append-only journal at db_path_journal.
+
+    Upon sync(), only the changed and deleted keys are appended to the journal
+    as cPickled (operation,key,value) records, rather than rewriting the full
+    dictionary. Reading the database only replays the records that were added
+    to the journal since the last read. When the journal grows larger than a
+    fraction of the base file, it is compacted: the base file is rewritten
+    from base + journal and the journal is emptied.
+
+    Access to both files is locked through the journal. A full reload of the
+    base file is only done if it was replaced since the last read, ie after a
+    compaction by another instance.
+
+    Contrary to Database(), changes made on a deeper level without calling
+    addChangedKey are not undone by read() or sync(), unless a full reload
+    happens. Use read(full=1) to force one.
+
+    Use openDatabase() to open a database with the appropriate engine, and
+    convertToJournal() to convert an existing database.
+
+    '''
+
+
+    def __init__(self,db_path,compact_fraction=1.0,compact_min_size=2**20):
+
+        '''
+        Initializing a JournalDatabase class.
+
+        @param db_path: The path to the base file of the database.
+        @type db_path: string
+
+        @keyword compact_fraction: The journal is compacted once it is larger
+                                   than this fraction of the base file size.
+
+                                   (default: 1.0)
+        @type compact_fraction: float
+        @keyword compact_min_size: The journal is never compacted when smaller
+                                   than this size in bytes.
+
+                                   (default: 2**20)
+        @type compact_min_size: int
+
+        '''
+
+        self.journal_path = '%s_journal'%db_path
+        self.compact_fraction = compact_fraction
+        self.compact_min_size = compact_min_size
+        self.__base_id = None
+        self.__offset = 0
+        super(JournalDatabase, self).__init__(db_path)
+
+
+
+    def _open(self,mode='a'):
+
+        '''
+        Open the journal of the database and lock it.
+
+        The lock remains in place until the file object is closed again. The
+        journal is always opened in binary append/read mode, regardless of the
+        mode requested, so that locking works the same for reading and writing.
+
+        @keyword mode: Ignored, kept for compatibility with Database().
+
+                       (default: 'a')
+        @type mode: string
+
+        @return: The opened journal
+        @rtype: file()
+
+        '''
+
+        jfile = open(self.journal_path,'a+b')
+        portalocker.lock(jfile, portalocker.LOCK_EX)
+        return jfile
+
+
+
+    def read(self,full=0):
+
+        '''
+        Read the database from the hard disk.
+
+        Only the journal records added since the last read are applied to the
+        database in memory, unless the base file was replaced in the meantime.
+
+        If no database is present, a new one is created.
+
+        @keyword full: Force a full reload of base file and journal. Any
+                       changes in memory are undone.
+
+                       (default: 0)
+        @type full: bool
+
+        '''
+
+        jfile = self._open()
+        try:
+            self.__replay(jfile,full=full)
+        finally:
+            jfile.close()
+
+
+
+    def sync(self):
+
+        '''
+        Update the database on the hard disk and in the memory.
+
+        The journal records added by other instances are applied first. Then
+        the keys deleted and changed in memory are appended to the journal.
+        The journal is compacted if it has grown too large.
+
+        '''
+
+        changed = self.getChangedKeys()
+        deleted = set(self.getDeletedKeys())
+        if not (changed or deleted):
+            self.read()
+            self._updateIndices()
+            return
+
+        changed = set(changed)
+        current_db = dict([(k,v) for k,v in self.items() if k in changed])
+        records = [('del',k,None) for k in deleted] + \
+                  [('set',k,v) for k,v in current_db.items()]
+        jfile = self._open()
+        try:
+            self.__replay(jfile)
+            self.__apply(self,records)
+            #-- Drop any incomplete record left behind by a crashed instance
+            jfile.truncate(self.__offset)
+            data = ''.join([cPickle.dumps(r,cPickle.HIGHEST_PROTOCOL)
+                            for r in records])
+            jfile.write(data)
+            jfile.flush()
+            os.fsync(jfile.fileno())
+            self.__offset += len(data)
+            if self.__offset > max(self.compact_min_size,\
+                                   self.compact_fraction\
+                                    *os.path.getsize(self.path)):
+                self.compact(jfile)
+        finally:
+            jfile.close()
+        self._updateIndices()
+        self._clearChangedKeys()
+
+
+
+    def compact(self,jfile=None):
+
+        '''
+        Rewrite the base file from the base file and the journal on the hard
+        disk, and empty the journal.
+
+        Changes in memory that have not been synchronized are not included.
+
+        @keyword jfile: The opened and locked journal. If None, it is opened
+                        here.
+
+                        (default: None)
+        @type jfile: file()
+
+        '''
+
+        if jfile is None:
+            jfile = self._open()
+            try:
+                return self.compact(jfile)
+            finally:
+                jfile.close()
+
+        db = self.__loadBase()
+        records, end = self.__readJournal(jfile,0)
+        self.__apply(db,records)
+        tmp_path = '%s_compact'%self.path
+        dbfile = open(tmp_path,'wb')
+        cPickle.dump(db,dbfile,cPickle.HIGHEST_PROTOCOL)
+        dbfile.flush()
+        os.fsync(dbfile.fileno())
+        dbfile.close()
+        os.rename(tmp_path,self.path)
+        jfile.truncate(0)
+        self.__offset = 0
+        self.__base_id = self.__getBaseId()
+
+
+
+    def __replay(self,jfile,full=0):
+
+        '''
+        Apply the journal records added since the last read to the database
+        in memory. The base file is reloaded if requested or if it was replaced.
+
+        @param jfile: The opened and locked journal
+        @type jfile: file()
+
+        @keyword full: Force a full reload.
+
+                       (default: 0)
+        @type full: bool
+
+        '''
+
+        if not os.path.isfile(self.path):
+            print 'No database present at %s. Creating a new one.'%self.path
+            self.compact(jfile)
+            full = 1
+        base_id = self.__getBaseId()
+        if full or base_id != self.__base_id:
+            db = self.__loadBase()
+            self.clear()
+            super(Database,self).update(db)
+            self.__offset = 0
+            self.__base_id = base_id
+            self._touchIndices()
+        records, self.__offset = self.__readJournal(jfile,self.__offset)
+        self.__apply(self,records)
+        self._touchIndices([key for op,key,val in records])
+
+
+
+    def __readJournal(self,jfile,offset):
+
+        '''
+        Read the complete records from the journal, starting at offset.
+
+        @param jfile: The opened and locked journal
+        @type jfile: file()
+        @param offset: The position in the journal in bytes
+        @type offset: int
+
+        @return: The records and the position of the end of the last complete
+                 record
+        @rtype: (list[tuple],int)
+
+        '''
+
+        jfile.seek(offset)
+        data = cStringIO.StringIO(jfile.read())
+        records = []
+        end = 0
+        while True:
+            try:
+                records.append(cPickle.load(data))
+                end = data.tell()
+            except (EOFError,ValueError,cPickle.UnpicklingError):
+                break
+        return records, offset + end
+
+
+
+    def __apply(self,db,records):
+
+        '''
+        Apply journal records to a dictionary, without flagging any changes.
+
+        @param db: The dictionary to which the records are applied
+        @type db: dict
+        @param records: The (operation,key,value) records
+        @type records: list[tuple]
+
+        '''
+
+        for op,key,val in records:
+            if op == 'set':
+                dict.__setitem__(db,key,val)
+            else:
+                dict.pop(db,key,None)
+
+
+
+    def __loadBase(self):
+
+        '''
+        Load the base file as a dictionary. An empty dictionary is returned if
+        the base file does not exist.
+
+        @return: The base dictionary
+        @rtype: dict
+
+        '''
+
+        if not os.path.isfile(self.path):
+            return dict()
+        dbfile = open(self.path,'rb')
+        try:
+            return dict(cPickle.load(dbfile))
+        finally:
+            dbfile.close()
+
+
+
+    def __getBaseId(self):
+
+        '''
+        Identify the current base file on the disk. The identity changes when
+        the base file is replaced.
+
+        @return: The inode, size and modification time of the base file
+        @rtype: tuple
+
+        '''
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino,st.st_size,st.st_mtime)
+
+
+
+class SqliteDatabase(Database):
+
+    '''
+    A database class with SQLite as storage engine.
+
+    The class functions exactly as Database(), but the hard disk copy is an
+    SQLite database at db_path_sqlite. Every (key,value) pair of the Database
+    is saved as a cPickled row. Upon sync(), only the changed and deleted keys
+    are written, and reading only loads the rows changed since the last read.
+
+    On top of that, all parameters in the leaves of the entries (see
+    getLeafPaths()) are saved in a parameter table with typed, indexed columns.
+    selectKeys() then preselects candidate models with indexed equality and
+    range queries, rather than returning every model in the database.
+
+    The database runs in WAL mode, so reading never blocks. Writing, and the
+    lock returned by _open(), use an immediate transaction, during which other
+    instances wait to write.
+
+    Use openDatabase() to open a database with the appropriate engine, and
+    convertToSqlite() to convert an existing database.
+
+    '''
+
+
+    def __init__(self,db_path,timeout=3600.):
+
+        '''
+        Initializing an SqliteDatabase class.
+
+        @param db_path: The path to the database. The SQLite database is saved
+                        at db_path_sqlite.
+        @type db_path: string
+
+        @keyword timeout: The time in seconds to wait for a lock held by
+                          another instance.
+
+                          (default: 3600.)
+        @type timeout: float
+
+        '''
+
+        self.sqlite_path = '%s_sqlite'%db_path
+        self.timeout = timeout
+        self.__version = -1
+        super(SqliteDatabase, self).__init__(db_path)
+
+
+
+    def __connect(self):
+
+        '''
+        Connect to the SQLite database, and create the tables if needed.
+
+        A new connection is made for every operation, so the Database can be
+        used safely across forked processes.
+
+        @return: The connection in autocommit mode
+        @rtype: sqlite3.Connection
+
+        '''
+
+        conn = sqlite3.connect(self.sqlite_path,timeout=self.timeout,\
+                               isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY '+\
+                     'KEY, value BLOB, version INTEGER)')
+        conn.execute('CREATE TABLE IF NOT EXISTS params (top BLOB, path BLOB,'+\
+                     ' name TEXT, num REAL, txt TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS params_num ON params '+\
+                     '(name, num)')
+        conn.execute('CREATE INDEX IF NOT EXISTS params_txt ON params '+\
+                     '(name, txt)')
+        conn.execute('CREATE INDEX IF NOT EXISTS params_top ON params (top)')
+        conn.execute('CREATE INDEX IF NOT EXISTS entries_version ON entries '+\
+                     '(version)')
+        return conn
+
+
+
+    def _open(self,mode='r'):
+
+        '''
+        Lock the database for writing by other instances.
+
+        The lock remains in place until the returned connection is closed.
+
+        @keyword mode: Ignored, kept for compatibility with Database().
+
+                       (default: 'r')
+        @type mode: string
+
+        @return: The connection holding the lock
+        @rtype: sqlite3.Connection
+
+        '''
+
+        conn = self.__connect()
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+
+
+    def read(self,full=0):
+
+        '''
+        Read the database from the hard disk.
+
+        Only the rows that were changed since the last read are loaded. Any
+        changes made in memory to those keys are undone.
+
+        @keyword full: Force a full reload. All changes in memory are undone.
+
+                       (default: 0)
+        @type full: bool
+
+        '''
+
+        if not os.path.isfile(self.sqlite_path):
+            print 'No database present at %s. Creating a new one.'\
+                  %self.sqlite_path
+        conn = self.__connect()
+        try:
+            self.__load(conn,full=full)
+        finally:
+            conn.close()
+
+
+
+    def sync(self):
+
+        '''
+        Update the database on the hard disk and in the memory.
+
+        The rows changed by other instances are loaded first. Then the keys
+        deleted and changed in memory are written, together with their
+        parameters, in a single transaction.
+
+        '''
+
+        changed = set(self.getChangedKeys())
+        deleted = set(self.getDeletedKeys())
+        if not (changed or deleted):
+            self.read()
+            self._updateIndices()
+            return
+
+        current_db = dict([(k,v) for k,v in self.items() if k in changed])
+        conn = self._open()
+        try:
+            self.__load(conn)
+            version = self.__version + 1
+            for key in deleted | changed:
+                bkey = self.__dumps(key)
+                conn.execute('DELETE FROM params WHERE top=?',(bkey,))
+                conn.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?)',\
+                             (bkey,None,version))
+                dict.pop(self,key,None)
+            for key,val in current_db.items():
+                bkey = self.__dumps(key)
+                conn.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?)',\
+                             (bkey,self.__dumps(val),version))
+                conn.executemany('INSERT INTO params VALUES (?,?,?,?,?)',\
+                                 self.__makeParams(key,val))
+                dict.__setitem__(self,key,val)
+            conn.execute('COMMIT')
+            self.__version = version
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        self._updateIndices()
+        self._clearChangedKeys()
+
+
+
+    def _preselectKeys(self,query,keywords,path=(),tolerance=0.001):
+
+        '''
+        Select the entries in the database that may match a set of parameters.
+
+        Every keyword in query with a numerical value is matched with an
+        indexed range query within the relative tolerance, every keyword with
+        a string value with an indexed equality query. Other keywords are not
+        checked. The leaves below path are returned if no keyword is checked.
+
+        Keys changed or deleted in memory since the last sync are checked in
+        memory rather than on the hard disk. Keys not present in memory are
+        never returned.
+
+        See Database.selectKeys() for the arguments.
+
+        @return: The sorted key paths of the candidates, relative to path
+        @rtype: list[tuple]
+
+        '''
+
+        selects = []
+        args = []
+        for k in keywords:
+            if not query.has_key(k): continue
+            try:
+                val = float(query[k])
+                delta = not val and 1e-10 or abs(tolerance*val)
+                selects.append('SELECT path FROM params WHERE name=? AND '+\
+                               'num>? AND num<?')
+                args.extend([k,val-delta,val+delta])
+            except (TypeError,ValueError):
+                if not isinstance(query[k],basestring): continue
+                selects.append('SELECT path FROM params WHERE name=? AND txt=?')
+                args.extend([k,query[k]])
+            if path:
+                selects[-1] += ' AND top=?'
+                args.append(self.__dumps(path[0]))
+        if not selects:
+            return super(SqliteDatabase,self)._preselectKeys(query,keywords,\
+                                                             path,tolerance)
+
+        #-- SQLite allows at most 500 terms in a compound select. Fewer terms
+        #   only give more candidates.
+        selects, args = selects[:500], args[:sum([s.count('?')
+                                                  for s in selects[:500]])]
+        conn = self.__connect()
+        try:
+            rows = conn.execute(' INTERSECT '.join(selects),args).fetchall()
+        finally:
+            conn.close()
+
+        pending = set(self.getChangedKeys()) | set(self.getDeletedKeys())
+        paths = [self.__loads(row[0]) for row in rows]
+        paths = [p for p in paths
+                 if p[:len(path)] == tuple(path) and p[0] not in pending]
+        paths = [p[len(path):] for p in paths if self.__hasPath(p)]
+        if not path:
+            paths.extend(getLeafPaths(dict([(k,self[k])
+                                            for k in pending
+                                            if self.has_key(k)])))
+        elif path[0] in pending:
+            paths.extend(super(SqliteDatabase,self)._preselectKeys(query,\
+                                                    keywords,path,tolerance))
+        return sorted(set(paths))
+
+
+
+    def __load(self,conn,full=0):
+
+        '''
+        Load the rows changed since the last read into memory.
+
+        @param conn: The connection to the database
+        @type conn: sqlite3.Connection
+
+        @keyword full: Reload all rows.
+
+                       (default: 0)
+        @type full: bool
+
+        '''
+
+        if full or self.__version < 0:
+            self.clear()
+            self._touchIndices()
+            rows = conn.execute('SELECT key,value,version FROM entries')
+        else:
+            rows = conn.execute('SELECT key,value,version FROM entries '+\
+                                'WHERE version>?',(self.__version,))
+        keys = []
+        for bkey,bval,version in rows:
+            key = self.__loads(bkey)
+            keys.append(key)
+            if bval is None:
+                dict.pop(self,key,None)
+            else:
+                dict.__setitem__(self,key,self.__loads(bval))
+            self.__version = max(self.__version,version)
+        self.__version = max(self.__version,0)
+        self._touchIndices(keys)
+
+
+
+    def __makeParams(self,key,val):
+
+        '''
+        Make the parameter rows for an entry in the database.
+
+        @param key: The key of the entry
+        @type key: any valid dict() key
+        @param val: The value of the entry
+        @type val: any
+
+        @return: The (top,path,name,num,txt) rows
+        @rtype: list[tuple]
+
+        '''
+
+        rows = []
+        bkey = self.__dumps(key)
+        for p in getLeafPaths({key:val}):
+            leaf = val
+            for k in p[1:]:
+                leaf = leaf[k]
+            if not isinstance(leaf,dict): continue
+            bpath = self.__dumps(p)
+            for name,v in leaf.items():
+                try:
+                    num = float(v)
+                except (TypeError,ValueError):
+                    num = None
+                txt = isinstance(v,basestring) and v or None
+                if num is None and txt is None: continue
+                rows.append((bkey,bpath,name,num,txt))
+        return rows
+
+
+
+    def __hasPath(self,path):
+
+        '''
+        Check if a key path is present in the database in memory.
+
+        @param path: The key path
+        @type path: tuple
+
+        @return: Presence of the key path
+        @rtype: bool
+
+        '''
+
+        d = self
+        for k in path:
+            if not isinstance(d,dict) or not d.has_key(k):
+                return False
+            d = d[k]
+        return True
+
+
+
+    def __dumps(self,obj):
+
+        '''
+        Pickle an object for storage in the database.
+
+        @param obj: The object
+        @type obj: any
+
+        @return: The pickled object
+        @rtype: sqlite3.Binary
+
+        '''
+
+        return sqlite3.Binary(cPickle.dumps(obj,cPickle.HIGHEST_PROTOCOL))
+
+
+
+    def __loads(self,bobj):
+
+        '''
+        Unpickle an object stored in the database.
+
+        @param bobj: The pickled object
+        @type bobj: buffer
+
+        @return: The object
+        @rtype: any
+
+        '''
+
+        return cPickle.loads(str(bobj))
+
+
+
+class ParameterIndex(object):
+
+    '''
+    A fingerprint index on the parameter dictionaries of a Database().
+    
+    Maps the fingerprint of every leaf in the database (see getLeafPaths() and
+    makeFingerprint()) to its key path. Next to that, the key paths are kept 
+    per keyword and per quantized value (see quantizeParameters()), so the 
+    leaves that match a query within the tolerance can be found from the 
+    index as well, including those with a value in a neighbouring bucket.
+    
+    The index is updated for the top-level entries that changed in memory 
+    (Database.getChangedKeys() and getDeletedKeys()), and for the entries 
+    that were read anew from the hard disk, which the storage engines report 
+    through touch(). The database is therefore not walked at every lookup. 
+    Only after loading the index, or after a full reload of the database, all
+    entries are checked, and only those whose pickled content changed are 
+    fingerprinted again. The index is kept on the hard disk next to the 
+    database, so it is not rebuilt in every session. 
+    
+    Typically created through Database.addIndex().
+    
+    '''
+    
+    version = 2
+
+    def __init__(self,db_path,name,keywords=None,tolerance=0.001,exact=1):
+
+        '''
+        Initializing an instance of ParameterIndex.
+        
+        The saved index is loaded if it was made with the same keywords and 
+        tolerance. 
+        
+        @param db_path: The path to the database
+        @type db_path: string
+        @param name: The name of the index
+        @type name: string
+        
+        @keyword keywords: The keywords included in the fingerprints. All are
+                           included if None.
+                           
+                           (default: None)
+        @type keywords: list[str]
+        @keyword tolerance: The relative tolerance on numerical parameters
+        
+                            (default: 0.001)
+        @type tolerance: float
+        @keyword exact: Lookups in Database.selectKeys() also return the 
+                        leaves that match within the tolerance, but not 
+                        their fingerprint (see select()).
+        
+                        (default: 1)
+        @type exact: bool
+        
+        '''
+
+        self.name = name
+        self.path = '%s_index_%s'%(db_path,name)
+        if keywords is not None:
+            keywords = sorted(set(keywords))
+        self.keywords = keywords
+        self.tolerance = tolerance
+        self.exact = exact
+        self.fps = dict()
+        self.values = dict()
+        self.tops = dict()
+        #-- The number of neighbouring buckets that can hold a match 
+        self.__nb = int(math.ceil(-math.log(1.-tolerance)\
+                                  /math.log(1.+tolerance)))
+        #-- The top-level keys to be checked at the next update. None if all 
+        #   entries must be checked.
+        self.__pending = None
+        self.__changed = False
+        self.load()
+
+
+
+    def load(self):
+    
+        '''
+        Load the index from the hard disk. 
+        
+        Nothing is loaded if the file does not exist or cannot be read, or if
+        it was made with different keywords or tolerance. 
+        
+        '''
+        
+        if not os.path.isfile(self.path): return
+        try:
+            ifile = open(self.path,'rb')
+            try:
+                saved = cPickle.load(ifile)
+            finally:
+                ifile.close()
+        except (EOFError,ValueError,cPickle.UnpicklingError):
+            return
+        if saved.get('version') != self.version \
+                or saved.get('keywords') != self.keywords \
+                or saved.get('tolerance') != self.tolerance:
+            return
+        self.tops = dict()
+        for top,(digest,entries) in saved['tops'].items():
+            self.__add(top,digest,entries)
+
+
+
+    def save(self):
+    
+        '''
+        Save the index to the hard disk if it changed. 
+        
+        The index is written to a temporary file first, which then replaces
+        the old index.
+        
+        '''
+        
+        if not self.__changed: return
+        saved = dict([('version',self.version),\
+                      ('keywords',self.keywords),\
+                      ('tolerance',self.tolerance),\
+                      ('tops',self.tops)])
+        tmp_path = '%s_tmp%i'%(self.path,os.getpid())
+        ifile = open(tmp_path,'wb')
+        try:
+            cPickle.dump(saved,ifile,cPickle.HIGHEST_PROTOCOL)
+        finally:
+            ifile.close()
+        os.rename(tmp_path,self.path)
+        self.__changed = False
+        
+        
+        
+    def touch(self,keys=None):
+    
+        '''
+        Flag top-level entries of the database that were read anew from the 
+        hard disk, so they are checked at the next update.
+        
+        Called by the storage engines when reading.
+        
+        @keyword keys: The top-level keys. All entries if None.
+        
+                       (default: None)
+        @type keys: list
+        
+        '''
+        
+        if keys is None:
+            self.__pending = None
+        elif self.__pending is not None:
+            self.__pending.update(keys)
+            
+            
+        
+    def update(self,db,keys=[]):
+    
+        '''
+        Update the index for the entries in the database that changed.
+        
+        The entries listed in keys and those flagged through touch() are 
+        fingerprinted again if their pickled content differs from the last 
+        update. All entries are checked after loading the index or after a 
+        full reload of the database. 
+        
+        @param db: The database
+        @type db: Database()
+        
+        @keyword keys: Top-level keys that changed in memory, eg the changed 
+                       and deleted keys in the database that were not 
+                       synchronized yet
+                       
+                       (default: [])
+        @type keys: list
+        
+        '''
+        
+        if self.__pending is None:
+            tops = set(db.keys()) | set(self.tops.keys())
+        else:
+            tops = self.__pending | set(keys)
+        self.__pending = set()
+        for top in tops:
+            if not db.has_key(top):
+                if self.tops.has_key(top):
+                    self.__remove(top)
+                continue
+            v = db[top]
+            digest = hashlib.md5(cPickle.dumps(v,cPickle.HIGHEST_PROTOCOL))\
+                            .hexdigest()
+            if self.tops.has_key(top) and self.tops[top][0] == digest:
+                continue
+            self.__remove(top)
+            entries = []
+            for path in getLeafPaths(dict([(top,v)])):
+                leaf = getLeaf(db,path)
+                if not isinstance(leaf,dict): continue
+                qpars = quantizeParameters(leaf,self.keywords,self.tolerance)
+                fp = hashlib.md5(repr(qpars)).hexdigest()
+                entries.append((fp,path,qpars))
+            self.__add(top,digest,entries)
+            
+            
+            
+    def lookup(self,query,path=()):
+    
+        '''
+        Return the key paths of the leaves with the same fingerprint as query.
+        
+        @param query: The parameters
+        @type query: dict
+        
+        @keyword path: Only leaves below this key path are returned
+        
+                       (default: ())
+        @type path: tuple
+        
+        @return: The sorted key paths, relative to path
+        @rtype: list[tuple]
+        
+        '''
+        
+        fp = makeFingerprint(query,self.keywords,self.tolerance)
+        return self.__below(self.fps.get(fp,[]),path)
+        
+        
+        
+    def select(self,query,keywords=None,path=()):
+    
+        '''
+        Return the key paths of the leaves that may match query within the 
+        tolerance, as in ModelingSession.compareCommandLists().
+        
+        For every keyword, the leaves are selected with the same quantized 
+        value, or for numerical values with a value in the neighbouring 
+        buckets within the tolerance. Zero matches any value smaller than 
+        1e-10. The selections are intersected. Keywords with a dictionary as 
+        value are not checked, nor are keywords missing from query if the 
+        index includes all keywords. The result is a superset of the matches.
+        
+        @param query: The parameters
+        @type query: dict
+        
+        @keyword keywords: The keywords to be checked. All keywords of the 
+                           index if None. 
+                           
+                           (default: None)
+        @type keywords: list[str]
+        @keyword path: Only leaves below this key path are returned
+        
+                       (default: ())
+        @type path: tuple
+        
+        @return: The sorted key paths, relative to path
+        @rtype: list[tuple]
+        
+        '''
+        
+        if keywords is None:
+            keywords = self.keywords
+        elif self.keywords is not None:
+            keywords = [k for k in keywords if k in self.keywords]
+        qpars = quantizeParameters(query,keywords,self.tolerance)
+        zb = math.log(1e-10)/math.log(1.+self.tolerance)
+        selection = None
+        for k,qv in qpars:
+            if qv == 'MISSING' and self.keywords is None: continue
+            if isinstance(qv,tuple) and (not qv or isinstance(qv[0],tuple)): 
+                continue
+            values = self.values.get(k,dict())
+            if isinstance(qv,tuple):
+                sets = [values.get((qv[0],qv[1]+i)) 
+                        for i in xrange(-self.__nb,self.__nb+1)]
+            elif qv in ['0.0','-0.0']:
+                sets = [paths 
+                        for v,paths in values.items()
+                        if v in ['0.0','-0.0'] \
+                            or (isinstance(v,tuple) and len(v) == 2 \
+                                and isinstance(v[1],int) and v[1] <= zb)]
+            else:
+                sets = [values.get(qv)]
+            paths = set()
+            for s in sets:
+                if s: paths.update(s)
+            selection = paths if selection is None else selection & paths
+            if not selection: return []
+        if selection is None:
+            selection = set()
+            for paths in self.fps.values():
+                selection.update(paths)
+        return self.__below(selection,path)
+                       
+                       
+                       
+    def __below(self,paths,path):
+    
+        '''
+        Select the key paths below a key path.
+        
+        @param paths: The key paths
+        @type paths: iterable
+        @param path: The key path
+        @type path: tuple
+        
+        @return: The sorted key paths, relative to path
+        @rtype: list[tuple]
+        
+        '''
+        
+        n = len(path)
+        return sorted([p[n:] for p in paths if p[:n] == path and len(p) > n])
+        
+        
+        
+    def __add(self,top,digest,entries):
+    
+        '''
+        Add a top-level entry to the index.
+        
+        @param top: The top-level key
+        @type top: any
+        @param digest: The md5 digest of the pickled entry
+        @type digest: str
+        @param entries: The (fingerprint,key path,quantized parameters) of the 
+                        leaves of the entry
+        @type entries: list[tuple]
+        
+        '''
+        
+        self.tops[top] = (digest,entries)
+        for fp,path,qpars in entries:
+            self.fps.setdefault(fp,set()).add(path)
+            for k,qv in qpars:
+                self.values.setdefault(k,dict()).setdefault(qv,set()).add(path)
+        self.__changed = True
+        
+        
+        
+    def __remove(self,top):
+    
+        '''
+        Remove a top-level entry from the index.
+        
+        @param top: The top-level key
+        @type top: any
+        
+        '''
+        
+        if not self.tops.has_key(top): return
+        for fp,path,qpars in self.tops.pop(top)[1]:
+            paths = self.fps.get(fp)
+            if paths is not None: 
+                paths.discard(path)
+                if not paths: del self.fps[fp]
+            for k,qv in qpars:
+                paths = self.values.get(k,dict()).get(qv)
+                if paths is None: continue
+                paths.discard(path)
+                if not paths: del self.values[k][qv]
+        self.__changed = True
+
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()        
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+
+"""
+A grid-level store of model spectra and visibilities.
+
+"""
+
+import os
+import hashlib
+import cPickle
+import cStringIO
+import portalocker
+import numpy as np
+
+#-- The stores opened in this process, per folder
+_stores = dict()
+
+
+
+def getStore(path):
+
+    '''
+    Get the store of a folder holding model folders, eg cc.path.mout/models.
+
+    The store is opened once per process.
+
+    @param path: The folder that contains the model folders
+    @type path: string
+
+    @return: The store
+    @rtype: SpectrumStore()
+
+    '''
+
+    path = os.path.abspath(path)
+    if not _stores.has_key(path):
+        _stores[path] = SpectrumStore(path)
+    return _stores[path]
+
+
+
+def getStamp(filenames):
+
+    '''
+    Get the stamp of the files an entry in the store was read from. An entry
+    is out of date when the stamp of its files changes.
+
+    @param filenames: The files
+    @type filenames: list[str]
+
+    @return: The number of files, and the latest modification time and total
+             size of the files
+    @rtype: tuple
+
+    '''
+
+    stats = [os.stat(fn) for fn in filenames]
+    return (len(stats),max([st.st_mtime for st in stats] or [0]),\
+            sum([st.st_size for st in stats]))
+
+
+
+class SpectrumStore(object):
+
+    '''
+    A store of the spectra and visibilities of all models in a folder.
+
+    The store consists of two append-only files in the folder: a binary data
+    file (spectra_store.dat) with the arrays as float64, and an index
+    (spectra_store.idx) with cPickled (key,stamp,x offset,size,y offset,
+    number of rows,selection) records. The key of an entry is
+    (model_id,filename), eg ('model_2015-01-01h10-00-00','spectrum45.0.dat').
+
+    Every entry consists of an x grid (wavelength or baseline) and one or
+    more rows on that grid (flux, visibilities). Entries sharing their x grid,
+    as the models of a grid typically do, point to a single copy of it in the
+    data file, and get the same array object when read.
+
+    The data file is memory-mapped read-only, so entries are returned as
+    read-only views without copying or parsing. New entries are added when a
+    model finishes (see MCMax.storeModel), or otherwise when its output is
+    read for the first time. Writing is locked through the index,
+    and the data are written before the index record, so other processes
+    never see an entry whose data are not there yet.
+
+    Use getStore() to open the store of a folder.
+
+    '''
+
+    def __init__(self,path):
+
+        '''
+        Initializing a SpectrumStore instance.
+
+        @param path: The folder that contains the model folders
+        @type path: string
+
+        '''
+
+        self.path = path
+        self.data_path = os.path.join(path,'spectra_store.dat')
+        self.index_path = os.path.join(path,'spectra_store.idx')
+        self.entries = dict()
+        self.grids = dict()
+        self.__offset = 0
+        self.__data = None
+        self.__xviews = dict()
+
+
+
+    def _open(self):
+
+        '''
+        Open the index of the store and lock it.
+
+        The lock remains in place until the file object is closed again.
+
+        @return: The opened index
+        @rtype: file()
+
+        '''
+
+        ifile = open(self.index_path,'a+b')
+        portalocker.lock(ifile, portalocker.LOCK_EX)
+        return ifile
+
+
+
+    def read(self):
+
+        '''
+        Read the index records added since the last read.
+
+        '''
+
+        if not os.path.isfile(self.index_path):
+            return
+        ifile = self._open()
+        try:
+            self.__replay(ifile)
+        finally:
+            ifile.close()
+
+
+
+    def get(self,model_id,filename,stamp):
+
+        '''
+        Get an entry from the store.
+
+        The index is read again if the entry is not known yet in this process.
+
+        @param model_id: The id of the model
+        @type model_id: string
+        @param filename: The name of the file the entry was read from
+        @type filename: string
+        @param stamp: The current stamp of the file(s), see getStamp()
+        @type stamp: tuple
+
+        @return: The x grid, the rows (2d) and the selection values of the
+                 entry, None if it is not in the store or out of date
+        @rtype: (array,array,tuple)
+
+        '''
+
+        key = (model_id,filename)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != stamp:
+            self.read()
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != stamp:
+                return None
+        return self.__getArrays(*entry[1:])
+
+
+
+    def add(self,model_id,filename,stamp,x,y,sel=()):
+
+        '''
+        Add an entry to the store, and return it as read from the store.
+
+        @param model_id: The id of the model
+        @type model_id: string
+        @param filename: The name of the file the entry was read from
+        @type filename: string
+        @param stamp: The stamp of the file(s), see getStamp()
+        @type stamp: tuple
+        @param x: The x grid
+        @type x: array
+        @param y: The rows on the x grid
+        @type y: array or list[array]
+
+        @keyword sel: The selection values of the rows, eg baselines
+
+                      (default: ())
+        @type sel: tuple
+
+        @return: The x grid, the rows (2d) and the selection values
+        @rtype: (array,array,tuple)
+
+        '''
+
+        key = (model_id,filename)
+        x = np.ascontiguousarray(x,dtype=np.float64)
+        y = np.ascontiguousarray(y,dtype=np.float64).reshape(-1,x.size)
+        ifile = self._open()
+        try:
+            self.__replay(ifile)
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != stamp:
+                xhash = hashlib.md5(x.tostring()).hexdigest()
+                dfile = open(self.data_path,'ab')
+                try:
+                    #-- Always append at a multiple of 8 bytes, also after an
+                    #   incomplete write by a crashed process
+                    dfile.seek(0,2)
+                    size = dfile.tell()
+                    if size%8:
+                        dfile.write('\0'*(8-size%8))
+                        size += 8-size%8
+                    offset = size/8
+                    if self.grids.has_key(xhash):
+                        xoff = self.grids[xhash]
+                    else:
+                        xoff = offset
+                        dfile.write(x.tostring())
+                        offset += x.size
+                    dfile.write(y.tostring())
+                    dfile.flush()
+                    os.fsync(dfile.fileno())
+                finally:
+                    dfile.close()
+                record = (key,stamp,xoff,x.size,offset,y.shape[0],\
+                          tuple(sel),xhash)
+                ifile.truncate(self.__offset)
+                data = cPickle.dumps(record,cPickle.HIGHEST_PROTOCOL)
+                ifile.write(data)
+                ifile.flush()
+                self.__offset += len(data)
+                self.__apply([record])
+                entry = self.entries[key]
+        finally:
+            ifile.close()
+        return self.__getArrays(*entry[1:])
+
+
+
+    def __replay(self,ifile):
+
+        '''
+        Apply the index records added since the last read.
+
+        @param ifile: The opened and locked index
+        @type ifile: file()
+
+        '''
+
+        ifile.seek(self.__offset)
+        data = cStringIO.StringIO(ifile.read())
+        records = []
+        end = 0
+        while True:
+            try:
+                records.append(cPickle.load(data))
+                end = data.tell()
+            except (EOFError,ValueError,cPickle.UnpicklingError):
+                break
+        self.__offset += end
+        self.__apply(records)
+
+
+
+    def __apply(self,records):
+
+        '''
+        Apply index records to the entries in memory.
+
+        @param records: The index records
+        @type records: list[tuple]
+
+        '''
+
+        for key,stamp,xoff,n,yoff,nrows,sel,xhash in records:
+            self.entries[key] = (stamp,xoff,n,yoff,nrows,sel)
+            self.grids[xhash] = xoff
+
+
+
+    def __getArrays(self,xoff,n,yoff,nrows,sel):
+
+        '''
+        Get the arrays of an entry from the memory-mapped data file.
+
+        The data file is mapped again if it grew since it was last mapped. The
+        views of the x grids made before stay in use: the data file is only
+        appended to, so they remain valid, and an x grid is always returned 
+        as the same array object.
+
+        @param xoff: The offset of the x grid (in float64)
+        @type xoff: int
+        @param n: The size of the x grid
+        @type n: int
+        @param yoff: The offset of the rows (in float64)
+        @type yoff: int
+        @param nrows: The number of rows
+        @type nrows: int
+        @param sel: The selection values of the rows
+        @type sel: tuple
+
+        @return: The x grid, the rows (2d) and the selection values
+        @rtype: (array,array,tuple)
+
+        '''
+
+        end = max(xoff,yoff+(nrows-1)*n)+n
+        if self.__data is None or self.__data.size < end:
+            size = os.path.getsize(self.data_path)/8
+            self.__data = np.memmap(self.data_path,dtype=np.float64,\
+                                    mode='r',shape=(size,))
+        if not self.__xviews.has_key(xoff):
+            self.__xviews[xoff] = self.__data[xoff:xoff+n]
+        y = self.__data[yoff:yoff+nrows*n].reshape(nrows,n)
+        return self.__xviews[xoff], y, sel
@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ["DataIO","Atmosphere","Database","TableWriter"]
+__all__ = ["DataIO","Atmosphere","Database","TableWriter",\
+           "SpectrumStore"]
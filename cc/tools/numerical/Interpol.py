@@ -7,10 +7,13 @@ Author: R. Lombaert
 
 """
 
+import collections
+import numpy as np
 from scipy import array, hstack
 from scipy import exp
 from scipy.optimize import leastsq
 from scipy import isnan
+from scipy.interpolate import make_interp_spline, BSpline
 
 from cc.plotting import Plotting2
 
@@ -154,3 +157,126 @@ def linInterpol(x_in,y_in,x):
         print 'Identical x-coordinates were submitted: Division by zero. ' + \
               'Aborting.'
         return
+
+
+
+class BatchInterpolator(object):
+
+    '''
+    Interpolation of all rows of a table on a shared grid at once.
+
+    Equivalent to an InterpolatedUnivariateSpline per row of the table, but
+    evaluated for all rows in one go: linearly along the shared knot grid for
+    k=1, or as one B-spline with vector-valued coefficients for higher orders.
+    The spline knots are chosen as for InterpolatedUnivariateSpline (the 
+    not-a-knot condition for cubic splines).
+
+    A single row can be evaluated through a thin view of the interpolator,
+    see getRow().
+
+    '''
+
+    def __init__(self,x,y,k=3,ext=0):
+
+        '''
+        Initializing a BatchInterpolator instance.
+
+        @param x: The grid, increasing
+        @type x: array
+        @param y: The table (row x grid)
+        @type y: array
+
+        @keyword k: The degree of the spline, 1 for linear interpolation
+        
+                    (default: 3)
+        @type k: int
+        @keyword ext: Extrapolation outside the grid, as for 
+                      InterpolatedUnivariateSpline: 0 extrapolates, 1 returns
+                      zeros, 2 raises a ValueError, 3 returns the boundary 
+                      value.
+
+                      (default: 0)
+        @type ext: int
+
+        '''
+
+        self.x = np.asarray(x,dtype=float)
+        self.y = np.atleast_2d(np.asarray(y,dtype=float))
+        self.k = int(k)
+        self.ext = int(ext)
+        if self.k > 1:
+            #-- Coefficients are (coefficient x row)
+            bspl = make_interp_spline(self.x,self.y.T,k=self.k)
+            self.t = bspl.t
+            self.c = np.ascontiguousarray(bspl.c)
+
+
+
+    def __call__(self,x,index=None):
+
+        '''
+        Evaluate the interpolator.
+
+        @param x: The points at which to evaluate the rows
+        @type x: array
+
+        @keyword index: The row(s) to be evaluated (0-based). All rows if None.
+                        A single row gives a single array.
+
+                        (default: None)
+        @type index: int/array
+
+        @return: The interpolated rows (row x points)
+        @rtype: array
+
+        '''
+
+        x = np.asarray(x,dtype=float)
+        shape = x.shape
+        x = x.ravel()
+        single = index is not None \
+                    and not isinstance(index,collections.Iterable)
+        if index is None: 
+            rows = slice(None)
+        else:
+            rows = np.array(index,dtype=int,ndmin=1)
+        
+        out = (x < self.x[0]) + (x > self.x[-1])
+        if self.ext == 2 and out.any():
+            raise ValueError('x value is out of the interpolation range.')
+        if self.ext == 3:
+            x = np.clip(x,self.x[0],self.x[-1])
+        
+        if self.k == 1:
+            #-- Linear interpolation (and extrapolation) in the grid interval
+            y = self.y[rows]
+            j = np.clip(np.searchsorted(self.x,x,side='right'),1,len(self.x)-1)
+            w = (x-self.x[j-1])/(self.x[j]-self.x[j-1])
+            res = y[:,j-1]*(1.-w) + y[:,j]*w
+        else:
+            res = BSpline(self.t,self.c[:,rows],self.k)(x).T
+        if self.ext == 1:
+            res[:,out] = 0.
+        
+        res = res.reshape((res.shape[0],)+shape)
+        if single: 
+            return res[0]
+        return res
+
+
+
+    def getRow(self,index):
+
+        '''
+        Get a thin view of the interpolator for a single row.
+
+        @param index: The row (0-based)
+        @type index: int
+
+        @return: The interpolator of the row, called with the points at which 
+                 to evaluate it
+        @rtype: function
+
+        '''
+
+        return lambda x: self(x,index=index)
@@ -12,12 +12,10 @@ import numpy as np
 
 from cc.tools.readers.SpectroscopyReader import SpectroscopyReader
 from cc.tools.io import DataIO
+from cc.tools.numerical.Interpol import BatchInterpolator
 
 import matplotlib.pyplot as p
 
-from scipy.interpolate import interp1d
-from scipy.interpolate import InterpolatedUnivariateSpline as spline1d
-
 
 
 class CollisReader(SpectroscopyReader):
@@ -117,7 +115,9 @@ class CollisReader(SpectroscopyReader):
             this_i = start_i+i*(ntrans + n0 + 1)
             rates[:,i] = collis[this_i:this_i+ntrans]
         
-        #-- Save into coll_trans array
+        #-- Save into coll_trans array, as views of the rows of one contiguous
+        #   array (transition x temperature)
+        self['coll_rates'] = rates
         for i in range(ntrans):
             self['coll_trans']['rates'][i] = rates[i,:]
             
@@ -298,12 +298,14 @@ class CollisReader(SpectroscopyReader):
     
     
     
-    def setInterp(self,index=None,itype='spline',*args,**kwargs):
+    def setInterp(self,index=None,itype='spline',k=3,ext=0):
     
         '''
         Set the interpolator for the collision rates versus temperature.
         
-        Additional arguments can be passed to the interpolator object.
+        All transitions are interpolated at once by a single BatchInterpolator
+        on the temperature grid. Use getInterpAll to evaluate them all, or 
+        getInterp for a single transition.
         
         @keyword index: The transition index. If default, all collision rates 
                         are interpolated. If an iterable object (such as a list)
@@ -316,30 +318,37 @@ class CollisReader(SpectroscopyReader):
         
                        (default: 'spline')
         @type itype: str
+        @keyword k: The degree of the spline. Ignored if itype is linear.
+        
+                    (default: 3)
+        @type k: int
+        @keyword ext: Extrapolation outside the temperature grid, as for
+                      InterpolatedUnivariateSpline: 0 extrapolates, 1 returns 
+                      zeros, 2 raises a ValueError, 3 returns the boundary 
+                      value.
+                      
+                      (default: 0)
+        @type ext: int
     
         '''
         
         #-- Select the interpolation type
-        itype = itype.lower()
-        if itype == 'linear':
-            interp = interp1d
-        else:
-            interp = spline1d
+        if itype.lower() == 'linear':
+            k = 1
         
         #-- Set the indices: 
         if index is None:
             index = range(1,self['pars']['ncoll_trans']+1)
-        elif not isinstance(indices,collections.Iterable) \
-                or isinstance(indices,str):
+        elif not isinstance(index,collections.Iterable) \
+                or isinstance(index,str):
             index = [index]
-                
-        self['icoll'] = dict()
+        index = np.array(index,dtype=int)
         
-        #-- Set the interpolators
-        for i in index:
-            self['icoll'][i] = interp(x=self['coll_temp'],\
-                                      y=self.get('coll_trans','rates',i),\
-                                      *args,**kwargs)
+        #-- Set the interpolator, and remember the row of every index
+        self['icoll'] = BatchInterpolator(x=self['coll_temp'],\
+                                          y=self['coll_rates'][index-1],\
+                                          k=k,ext=ext)
+        self['icoll_rows'] = dict([(i,row) for row,i in enumerate(index)])
             
             
     
@@ -348,6 +357,9 @@ class CollisReader(SpectroscopyReader):
         '''
         Get the interpolator for a given transition index. 
         
+        This is a view of the interpolator of all transitions, see 
+        getInterpAll.
+        
         @param index: The level index
         @type index: int
         
@@ -357,7 +369,33 @@ class CollisReader(SpectroscopyReader):
                  
         '''
         
-        return self['icoll'][index]
+        return self['icoll'].getRow(self['icoll_rows'][index])
+        
+        
+        
+    def getInterpAll(self,T,index=None):
+    
+        '''
+        Evaluate the collision rate interpolator for all transitions at once.
+        
+        @param T: The temperatures in K
+        @type T: array
+        
+        @keyword index: The transition indices. If None, all transitions for 
+                        which the interpolator was set are returned.
+        
+                        (default: None)
+        @type index: list[int]
+        
+        @return: The interpolated collision rates in cm^3 s^-1 (transition x T)
+        @rtype: array
+        
+        '''
+        
+        if index is None:
+            return self['icoll'](T)
+        rows = [self['icoll_rows'][i] for i in np.array(index,ndmin=1)]
+        return self['icoll'](T,index=rows)
         
         
         
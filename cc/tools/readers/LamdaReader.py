@@ -120,6 +120,9 @@ class LamdaReader(MolReader,CollisReader):
         self['coll_trans']['index'] = d3['index']
         self['coll_trans']['lup'] = d3['lup']
         self['coll_trans']['llow'] = d3['llow']
+        #-- The rates per transition are views of the rows of one contiguous
+        #   array (transition x temperature)
+        self['coll_rates'] = np.ascontiguousarray(d4)
         for i in range(self['pars']['ncoll_trans']):
-            self['coll_trans']['rates'][i] = d4[i,:]
+            self['coll_trans']['rates'][i] = self['coll_rates'][i]
 
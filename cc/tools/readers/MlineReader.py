@@ -17,6 +17,100 @@ from cc.tools.readers.MolReader import MolReader
 from cc.tools.io import DataIO
 
 
+
+def readML3Blocks(fn,nline,ny,n_impact,width=14,ncols=8):
+
+    '''
+    Read the six data blocks of an ml3 file in a single pass.
+
+    The file is memory-mapped, the lines of all blocks are gathered in one
+    fixed-width character array and converted to floats at once. See
+    MlineReader.__readML3 for the layout of the file.
+
+    Entries that cannot be converted are set to nan.
+
+    @param fn: The ml3 filename, including filepath
+    @type fn: str
+    @param nline: The number of transitions
+    @type nline: int
+    @param ny: The number of levels
+    @type ny: int
+    @param n_impact: The number of impact parameters
+    @type n_impact: int
+
+    @keyword width: The number of characters per entry
+
+                    (default: 14)
+    @type width: int
+    @keyword ncols: The number of entries per line
+
+                    (default: 8)
+    @type ncols: int
+
+    @return: The six blocks si, sf, lo, pop, DsiDloXlo, DsiDsfXsf, as
+             arrays of shape (nline or ny, n_impact), ordered by increasing
+             impact parameter
+    @rtype: list[array]
+
+    '''
+
+    #-- Number of text lines per impact parameter, and per block
+    nvals = [nline,nline,nline,ny,nline,nline]
+    nlines = [int(n)/ncols+1 for n in nvals]
+    starts = np.cumsum([0]+[nl*n_impact+3 for nl in nlines])[:-1]
+
+    #-- Find the line starts in the memory-mapped file
+    data = np.memmap(fn,dtype=np.uint8,mode='r')
+    eol = np.flatnonzero(data == ord('\n'))
+    bol = np.concatenate([[0],eol+1])
+    eol = np.concatenate([eol,[len(data)]])
+
+    #-- Gather the characters of all lines of the blocks, padded with spaces
+    ilines = np.concatenate([np.arange(st,st+nl*n_impact)
+                             for st,nl in zip(starts,nlines)])
+    llen = width*ncols
+    icol = np.arange(llen)
+    ichar = bol[ilines][:,None] + icol
+    pad = ichar >= eol[ilines][:,None]
+    chars = np.where(pad,ord(' '),data[np.where(pad,0,ichar)])
+    fields = chars.astype(np.uint8).view('S%i'%width)
+
+    #-- Split per block, drop the padding entries and convert
+    blocks = []
+    i0 = 0
+    for n,nl in zip(nvals,nlines):
+        sub = fields[i0:i0+nl*n_impact].reshape(n_impact,nl*ncols)[:,:n]
+        i0 += nl*n_impact
+        try:
+            vals = sub.astype(float)
+        except ValueError:
+            vals = np.array([[convertML3(v) for v in row] for row in sub])
+        blocks.append(np.ascontiguousarray(vals.T[:,::-1]))
+    del data
+    return blocks
+
+
+
+def convertML3(value):
+
+    '''
+    Convert an entry of an ml3 file to float. Nan is returned if this fails.
+
+    @param value: The entry
+    @type value: str
+
+    @return: The value
+    @rtype: float
+
+    '''
+
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+
 class MlineReader(MolReader,PopReader):
     
     '''
@@ -40,7 +134,7 @@ class MlineReader(MolReader,PopReader):
     
     '''
     
-    def __init__(self,fn,*args,**kwargs):
+    def __init__(self,fn,ml3_cache=0,*args,**kwargs):
         
         '''
         Creating an Mline object ready for reading Mline output.
@@ -62,8 +156,17 @@ class MlineReader(MolReader,PopReader):
                    file number is given by *.
         @type fn: string        
         
+        @keyword ml3_cache: Keep a binary copy of the ml3 data next to the ml3
+                            file (*_cache.npz), to be read instead of the ml3
+                            file as long as the latter does not change.
+                            
+                            (default: 0)
+        @type ml3_cache: bool
+        
         '''
         
+        self.ml3_cache = ml3_cache
+        
         #-- Insert wildcard character to encompass all mline output files
         fn = fn.replace('ml1','ml*').replace('ml2','ml*').replace('ml3','ml*')
         super(MlineReader, self).__init__(fn=fn,*args,**kwargs)
@@ -199,73 +302,47 @@ class MlineReader(MolReader,PopReader):
         #      given in self['props']['P']. Converted to cgs it is 
         #      given in self['props']['P_cm']. 
         #
-        #-- Define the function that reads the fixed-format file per block
-        def readBlock(N_block):
-            
-            '''
-            Read a block of data from ml3. 
-            
-            @param N_block: The index of the block (0 => 5)
-            @type N_block: int
-            
-            @return: The data 
-            @rtype: array
-            
-            '''
-            
-            #-- Number of lines for this block
-            nblock = nblock_ny if N_block == 3 else nblock_nline
-            
-            #-- Set starting index, based on number of block and block length
-            ind0 = (N_block-1)*nblock_nline + 3*N_block
-            
-            #-- If N_block > 3, one block has only ny=ny_up+ny_low values, 
-            #   otherwise add another block with nline values per subblock
-            if N_block > 3: 
-                ind0 += nblock_ny
-            else: 
-                ind0 += nblock_nline
-
-            #-- Read data and return. fn defined in mother function
-            return np.genfromtxt(fn,skip_header=ind0,max_rows=nblock,\
-                                 delimiter=[14]*8)
-        
-        #-- Grab filename and set the contents values for the six blocks.
+        #   The file is memory-mapped and all six blocks are decoded in one go.
+        #   The results are kept as 2-D arrays (index x impact parameter) in
+        #   self['ml3'], and the dictionaries per property hold views of their
+        #   rows.
         fn = self.fn.replace('ml*','ml3')
         props = ['si','sf','lo','pop','DsiDloXlo','DsiDsfXsf']
-        for pr in props: 
-            self[pr] = dict()
-        
-        #-- Gather some relevant parameters. Length of block based on n_impact 
-        #   and number of values (nline or ny). Assuming 8 columns.
         n_impact = self['pars']['n_impact']
         nline = self['pars']['nline']
-        nline_l = int(nline)/8+1
-        nblock_nline = n_impact * nline_l
         ny = self['pars']['ny']
-        ny_l = int(ny)/8+1
-        nblock_ny = n_impact * ny_l
-        
-        #-- Read data, looping over the 6 blocks.         
-        dds = [readBlock(N) for N in xrange(6)]
-        
-        #-- Set all the transition-specific information. Note indexing (0-based
-        #   in python, 1-based in fortran). Note that the arrays are reversed to
-        #   match the increasing impact parameter grid.
-        for dd,pr in zip(dds,props):
-            if pr == 'pop': continue
-            for i in xrange(nline): 
-                self[pr][i+1] = dd[i/8::nline_l,i%8][::-1]
-                
-        #-- Set the level populations. Note indexing (0-based in python, 1-based
-        #   in fortran). Note that the arrays are reversed to match the 
-        #   increasing impact parameter grid.
-        for i in xrange(ny): 
-            self['pop'][i+1] = dds[3][i/8::ny_l,i%8][::-1]
-
+        
+        blocks = None
+        cachefn = os.path.splitext(fn)[0] + '_cache.npz'
+        stat = os.stat(fn)
+        key = (stat.st_mtime,stat.st_size)
+        if self.ml3_cache and os.path.isfile(cachefn):
+            try: 
+                npz = np.load(cachefn)
+                if tuple(npz['key']) == key:
+                    blocks = dict([(pr,npz[pr]) for pr in props])
+                npz.close()
+            except (IOError,ValueError,KeyError):
+                blocks = None
+        if blocks is None:
+            blocks = dict(zip(props,readML3Blocks(fn,nline,ny,n_impact)))
+            if self.ml3_cache:
+                try:
+                    tmpfn = cachefn[:-4] + '_%i.npz'%os.getpid()
+                    np.savez(tmpfn,key=np.array(key),**blocks)
+                    os.rename(tmpfn,cachefn)
+                except (IOError,OSError):
+                    pass
+        self['ml3'] = blocks
+        
+        #-- Set the transition-specific information and the level populations. 
+        #   Note indexing (0-based in python, 1-based in fortran). 
+        for pr in props:
+            self[pr] = dict([(i+1,row) for i,row in enumerate(blocks[pr])])
+    
     
     
-    def getProp(self,prop):
+    def getProp(self,prop,index=None):
     
         '''
         Return a radial circumstellar profile associated with the impact 
@@ -273,14 +350,31 @@ class MlineReader(MolReader,PopReader):
         
         The impact parameter grid in cm is available through getP().
         
+        The properties from ml3 are given per transition (or per level for 
+        pop). By default, they are returned for all transitions at once as a 
+        2-D array (transition x impact parameter), with row i-1 for transition
+        index i.
+        
         @param prop: The requested property. One of p_rstar, vel (km/s), nmol
-                     (cm^-3), nh2 (cm^-3), amol, Tg (K), Td (K).
+                     (cm^-3), nh2 (cm^-3), amol, Tg (K), Td (K), or one of the
+                     ml3 properties si, sf, lo, pop, DsiDloXlo, DsiDsfXsf.
         @type prop: str
         
-        @return: The abundance profile
+        @keyword index: The transition index (or level index for pop) for an
+                        ml3 property. Can be a list of indices. If None, all
+                        indices are returned. Ignored for ml1 properties.
+                        
+                        (default: None)
+        @type index: int/list[int]
+        
+        @return: The profile
         @rtype: array
         
         '''
         
-        return self['props'][prop]
+        if not self['ml3'].has_key(prop): 
+            return self['props'][prop]
+        if index is None: 
+            return self['ml3'][prop]
+        return self['ml3'][prop][np.array(index,dtype=int)-1]
         
\ No newline at end of file
@@ -11,12 +11,10 @@ import os, collections
 import numpy as np
 from cc.tools.io import DataIO
 from cc.tools.readers.Reader import Reader
+from cc.tools.numerical.Interpol import BatchInterpolator
 
 import matplotlib.pyplot as p
 
-from scipy.interpolate import interp1d
-from scipy.interpolate import InterpolatedUnivariateSpline as spline1d
-
 
 
 class PopReader(Reader):
@@ -90,10 +88,13 @@ class PopReader(Reader):
         self['p'] = data[:,0]
         
         #-- Loop over the level indices. Note 1-based indexing! Column with 
-        #   index 0 is impact parameter.
+        #   index 0 is impact parameter. The populations are kept as one 
+        #   contiguous array (level x impact parameter), the dict holds views
+        #   of its rows.
         self['pars']['ny'] = len(data[0])-1
+        pops = np.ascontiguousarray(data[:,1:].T)
         for i in range(1,self['pars']['ny']+1):
-            self['pop'][i] = data[:,i]
+            self['pop'][i] = pops[i-1]
     
     
     
@@ -213,33 +214,40 @@ class PopReader(Reader):
         
         
     
-    def setInterp(self,itype='spline',*args,**kwargs):
+    def setInterp(self,itype='spline',k=3,ext=0):
     
         '''
         Set the interpolator for the level populations.
         
-        Additional arguments can be passed to the interpolator object.
+        All levels are interpolated at once by a single BatchInterpolator on 
+        the impact parameter grid. Use getPopAll to evaluate them all, or 
+        getInterp for a single level.
         
         @keyword itype: The type of interpolator. Either spline or linear.
         
                        (default: 'spline)
         @type itype: str
+        @keyword k: The degree of the spline. Ignored if itype is linear.
+        
+                    (default: 3)
+        @type k: int
+        @keyword ext: Extrapolation outside the impact parameter grid, as for
+                      InterpolatedUnivariateSpline: 0 extrapolates, 1 returns 
+                      zeros, 2 raises a ValueError, 3 returns the boundary 
+                      value.
+                      
+                      (default: 0)
+        @type ext: int
     
         '''
         
         #-- Select the interpolation type
-        itype = itype.lower()
-        if itype == 'linear':
-            interp = interp1d
-        else:
-            interp = spline1d
-        
-        self['ipop'] = dict()
+        if itype.lower() == 'linear':
+            k = 1
         
-        #-- Set the interpolators
-        for i in self.getLI():
-            self['ipop'][i] = interp(x=self['p'],y=self['pop'][i],\
-                                     *args,**kwargs)
+        #-- Set the interpolator. Rows are ordered by level index.
+        self['ipop'] = BatchInterpolator(x=self['p'],y=self.getPop(),k=k,\
+                                         ext=ext)
             
             
     
@@ -248,6 +256,8 @@ class PopReader(Reader):
         '''
         Get the interpolator for a given level index. 
         
+        This is a view of the interpolator of all levels, see getPopAll.
+        
         @param index: The level index
         @type index: int
         
@@ -257,7 +267,31 @@ class PopReader(Reader):
                  
         '''
         
-        return self['ipop'][index]
+        return self['ipop'].getRow(index-1)
+        
+        
+        
+    def getPopAll(self,r,index=None):
+    
+        '''
+        Evaluate the level population interpolator for all levels at once.
+        
+        @param r: The impact parameters in cm
+        @type r: array
+        
+        @keyword index: The level indices. If None, all levels are returned.
+        
+                        (default: None)
+        @type index: list[int]
+        
+        @return: The interpolated level populations (level x r)
+        @rtype: array
+        
+        '''
+        
+        if index is None:
+            return self['ipop'](r)
+        return self['ipop'](r,index=np.array(index,dtype=int,ndmin=1)-1)
         
         
     
@@ -8,6 +8,8 @@ Author: R. Lombaert
 """
 
 import os
+import re
+import numpy as np
 from scipy import array 
 from scipy import isnan
 from scipy import isfinite
@@ -17,6 +19,168 @@ from cc.tools.io import DataIO
 
 
 
+def parseBlock(lines):
+
+    '''
+    Convert lines of whitespace-separated numbers to a 2-D array at once.
+    
+    None is returned if the block is not rectangular or contains anything 
+    other than plain floats (eg NaN, or Fortran double notation), in which 
+    case the caller has to convert the block line by line.
+    
+    @param lines: The lines of the block
+    @type lines: list[str]
+    
+    @return: The block (line x column)
+    @rtype: array
+    
+    '''
+    
+    if not lines: return None
+    text = ' '.join(lines)
+    if re.search('[^0-9eE.+\-\s]',text): return None
+    ncols = len(lines[0].split())
+    values = np.fromstring(text,sep=' ')
+    if not ncols or len(values) != ncols*len(lines): return None
+    return values.reshape(len(lines),ncols)
+
+
+
+def readMany(fns,num_threads=4):
+
+    '''
+    Read many sphinx files with a pool of threads.
+    
+    The pool requires the futures package. Without it, the files are read 
+    one by one. Files that do not exist or cannot be read give None. 
+    
+    @param fns: The sphinx filenames, including filepath. The sphinx file 
+                number is given by *. 
+    @type fns: list[str]
+    
+    @keyword num_threads: The number of threads reading files in parallel
+    
+                          (default: 4)
+    @type num_threads: int
+    
+    @return: The SphinxReader objects in the order of the filenames
+    @rtype: list[SphinxReader]
+    
+    '''
+    
+    def read(fn):
+        try:
+            return SphinxReader(fn)
+        except (IOError,IndexError,ValueError), e:
+            print 'WARNING! Could not read %s: %s'%(fn,str(e))
+            return None
+    
+    if len(fns) < 2 or num_threads < 2:
+        return [read(fn) for fn in fns]
+    #-- Only needed when the pool is used. Requires the futures package, 
+    #   which is not in the Python 2 standard library. Read the files one by 
+    #   one if it is not available.
+    try:
+        from concurrent import futures
+    except ImportError:
+        return [read(fn) for fn in fns]
+    with futures.ThreadPoolExecutor(max_workers=int(num_threads)) as executor:
+        return list(executor.map(read,fns))
+
+
+
+def loadMany(fns,num_threads=4):
+
+    '''
+    Read the line profiles of many sphinx files, and pack them in flat 
+    arrays.
+    
+    The profiles of file i are given by index offsets[i]:offsets[i+1] in the 
+    concatenated arrays, for the convolved profiles ('velocity', 'flux', 
+    'norm_flux', 'tmb') and the intrinsic profiles ('nobeam_velocity', 
+    'nobeam_flux', with 'nobeam_offsets'). The continuum values are given per 
+    file ('cont_flux', 'cont_norm_flux', 'cont_tmb', 'nobeam_cont_flux'). 
+    Files that could not be read have zero-length profiles, nan continuum 
+    values, and False in 'valid'. 
+    
+    Use getPacked to retrieve the profile of one file.
+    
+    @param fns: The sphinx filenames, including filepath. The sphinx file 
+                number is given by *. 
+    @type fns: list[str]
+    
+    @keyword num_threads: The number of threads reading files in parallel
+    
+                          (default: 4)
+    @type num_threads: int
+    
+    @return: The packed profiles 
+    @rtype: dict
+    
+    '''
+    
+    readers = readMany(fns,num_threads=num_threads)
+    packed = dict([('filenames',list(fns)),\
+                   ('valid',np.array([not sr is None for sr in readers],\
+                                     dtype=bool))])
+    for beam,props,prefix in [('beam',['velocity','flux','norm_flux','tmb'],''),\
+                              ('nobeam',['velocity','flux'],'nobeam_')]:
+        lens = [0 if sr is None else len(sr['sph2'][beam]['velocity']) 
+                for sr in readers]
+        packed[prefix+'offsets'] = np.concatenate([[0],np.cumsum(lens)])\
+                                     .astype(int)
+        for prop in props:
+            arrs = [sr['sph2'][beam][prop] for sr in readers if not sr is None]
+            packed[prefix+prop] = np.concatenate(arrs) if arrs else np.empty(0)
+            if prop == 'velocity': continue
+            packed[prefix+'cont_'+prop] = \
+                    np.array([np.nan if sr is None 
+                              else sr['sph2'][beam+'_cont'][prop]
+                              for sr in readers])
+    return packed
+
+
+
+def getPacked(packed,index,lp='tmb',intrinsic=0,cont_subtract=1):
+
+    '''
+    Return the line profile of one file from the output of loadMany.
+    
+    @param packed: The packed profiles
+    @type packed: dict
+    @param index: The index of the file in the list given to loadMany
+    @type index: int
+    
+    @keyword lp: The line profile: 'flux', 'norm_flux' or 'tmb'. Only flux is
+                 available for the intrinsic profile.
+                 
+                 (default: 'tmb')
+    @type lp: str
+    @keyword intrinsic: Return the intrinsic profile instead of the one 
+                        convolved with the beam
+                        
+                        (default: 0)
+    @type intrinsic: bool
+    @keyword cont_subtract: Subtract the continuum value from the profile
+    
+                            (default: 1)
+    @type cont_subtract: bool
+    
+    @return: The velocity grid and the line profile
+    @rtype: (array,array)
+    
+    '''
+    
+    prefix = intrinsic and 'nobeam_' or ''
+    i0,i1 = packed[prefix+'offsets'][index:index+2]
+    vel = packed[prefix+'velocity'][i0:i1]
+    lprof = packed[prefix+lp][i0:i1]
+    if cont_subtract: 
+        lprof = lprof - packed[prefix+'cont_'+lp][index]
+    return vel, lprof
+
+
+
 class SphinxReader(Reader):
     
     '''
@@ -67,7 +231,16 @@ class SphinxReader(Reader):
         
         
         self['sph1'] = dict()
-        data = DataIO.readCols(self.fn.replace('*','1'),start_row=1)
+        fn = self.fn.replace('*','1')
+        FILE = open(fn,'r')
+        lines = FILE.read().split('\n')[1:]
+        FILE.close()
+        lines = DataIO.removeComments(lines,comment_chars=['#','!',';'])[0]
+        block = parseBlock([line for line in lines if line.strip()])
+        if block is None:
+            data = DataIO.readCols(fn,start_row=1)
+        else:
+            data = block.T
         self['sph1']['p'] = data[0]
         self['sph1']['norm_intens'] = data[1] 
         self['sph1']['weighted_intens'] = data[2] 
@@ -90,29 +263,39 @@ class SphinxReader(Reader):
         self['sph2']['beam'] = dict()
         self['sph2']['nobeam_cont'] = dict()
         self['sph2']['beam_cont'] = dict()
-        data = self.getFile(wildcard='2',delimiter=' ')
-        data_col_1 = [d[0] for d in data]
+        FILE = open(self.fn.replace('*','2'),'r')
+        lines = [line for line in FILE.read().split('\n') if line.strip()]
+        FILE.close()
+        data_col_1 = [line.split(None,1)[0] for line in lines]
         data_i = 6
         data_j = DataIO.findString(data_i,data_col_1)
-        self['sph2']['nobeam']['velocity'] = array([float(line[0]) 
-                                              for line in data[data_i:data_j]])
+        data_k = data_j + 4
+        data_l = DataIO.findString(data_k,data_col_1)
+        
+        #-- Convert the blocks at once if possible, otherwise line by line.
+        nobeam = parseBlock(lines[data_i:data_j])
+        if nobeam is None:
+            data = [line.split() for line in lines[data_i:data_j]]
+            vel = array([float(line[0]) for line in data])
+            flux = array([DataIO.convertFloat(line[-1],nans=1) 
+                          for line in data])
+        else:
+            vel, flux = nobeam[:,0], nobeam[:,-1]
+        self['sph2']['nobeam']['velocity'] = vel
         
         #-- Reverse this flux grid. Sphinx output files give the mirrored
         #   flux grid for the associated velocity grid.
-        self['sph2']['nobeam']['flux'] = array([DataIO.convertFloat(line[-1],\
-                                                                     nans=1) 
-                                              for line in data[data_i:data_j]])
-        self['sph2']['nobeam']['flux'] = self['sph2']['nobeam']['flux'][::-1]
-        data_k = data_j + 4
-        data_l = DataIO.findString(data_k,data_col_1)
-        self['sph2']['beam']['velocity'] =  array([float(line[0]) 
-                                              for line in data[data_k:data_l]])
-        self['sph2']['beam']['flux'] =      array([float(line[-1]) 
-                                              for line in data[data_k:data_l]])  
-        self['sph2']['beam']['norm_flux'] = array([float(line[1]) 
-                                              for line in data[data_k:data_l]])
-        self['sph2']['beam']['tmb'] =       array([float(line[2]) 
-                                              for line in data[data_k:data_l]])
+        self['sph2']['nobeam']['flux'] = flux[::-1]
+        beam = parseBlock(lines[data_k:data_l])
+        if beam is None:
+            data = [line.split() for line in lines[data_k:data_l]]
+            beam = array([[float(line[0]),float(line[1]),float(line[2]),\
+                           float(line[-1])] 
+                          for line in data])
+        self['sph2']['beam']['velocity'] = beam[:,0]
+        self['sph2']['beam']['flux'] = beam[:,-1]
+        self['sph2']['beam']['norm_flux'] = beam[:,1]
+        self['sph2']['beam']['tmb'] = beam[:,2]
         
         #-- Set the continuum value for the different profiles
         self.setContinuum('nobeam','flux')